@@ -36,17 +36,19 @@ def create_app(config_name='default'):
 
     @app.context_processor
     def inject_conti_personali():
-        """Inietta nei template la lista dei conti personali presenti nel DB.
+        """Inietta nei template la funzione che elenca i conti personali presenti nel DB.
 
-        Restituisce `conti_personali` come lista di dizionari con chiavi `id` e `nome`.
+        `conti_personali()` ritorna una lista di dizionari con chiavi `id` e `nome`;
+        la query gira solo se il template la chiama (non per i frammenti in cache).
         """
-        try:
-            from app.models.ContoPersonale import ContoPersonale
-            conti = ContoPersonale.query.order_by(ContoPersonale.nome_conto.asc()).all()
-            conti_list = [{'id': c.id, 'nome': c.nome_conto} for c in conti]
-            return {'conti_personali': conti_list}
-        except Exception:
-            return {'conti_personali': []}
+        def conti_personali():
+            try:
+                from app.models.ContoPersonale import ContoPersonale
+                conti = ContoPersonale.query.order_by(ContoPersonale.nome_conto.asc()).all()
+                return [{'id': c.id, 'nome': c.nome_conto} for c in conti]
+            except Exception:
+                return []
+        return {'conti_personali': conti_personali}
 
     @app.context_processor
     def inject_active_section():
@@ -125,23 +127,33 @@ def create_app(config_name='default'):
 
     @app.context_processor
     def inject_asset_version():
-        """Inietta ASSET_VERSION e helper `asset_url(path)` per aggiungere automaticamente il versioning alle risorse statiche."""
+        """Inietta ASSET_VERSION e gli helper `asset_url(path)` / `asset_urls(bundle)`.
+
+        Con la build degli asset (`python -m app.utils.assets`) gli URL puntano ai
+        file con fingerprint del manifest; senza build ai sorgenti con `?v=`.
+        """
+        v = app.config.get('ASSET_VERSION') or os.environ.get('ASSET_VERSION') or '2'
         try:
-            from flask import url_for
-            v = app.config.get('ASSET_VERSION') or os.environ.get('ASSET_VERSION') or '2'
-            def asset_url(path):
-                try:
-                    return url_for('static', filename=path) + '?v=' + str(v)
-                except Exception:
-                    return url_for('static', filename=path)
-            return {'ASSET_VERSION': v, 'asset_url': asset_url}
+            from app.utils import assets
+            return {
+                'ASSET_VERSION': v,
+                'asset_url': lambda path: assets.asset_url(path, v),
+                'asset_urls': lambda nome: assets.asset_urls(nome, v),
+            }
         except Exception:
-            return {'ASSET_VERSION': '2', 'asset_url': lambda p: p}
+            return {'ASSET_VERSION': v, 'asset_url': lambda p: p, 'asset_urls': lambda n: [n]}
 
-    # Jinja filter: format_currency (re-uses helper in app.utils.formatting)
+    # Asset con fingerprint: varianti precompresse e cache immutabile
     try:
-        from app.utils.formatting import format_currency as format_currency_helper
-        app.jinja_env.filters['format_currency'] = format_currency_helper
+        from app.utils.assets import servi_asset
+        app.add_url_rule('/static/dist/<path:filename>', endpoint='asset_dist', view_func=servi_asset)
+    except Exception:
+        pass
+
+    # Jinja filter: format_currency, legato una volta al FORMATO_VALUTA della configurazione
+    try:
+        from app.utils.formatting import crea_format_currency
+        app.jinja_env.filters['format_currency'] = crea_format_currency(app.config.get('FORMATO_VALUTA', '€ {:.2f}'))
         try:
             from app.utils.formatting import format_decimal as format_decimal_helper
             app.jinja_env.filters['format_decimal'] = format_decimal_helper
@@ -170,6 +182,13 @@ def create_app(config_name='default'):
 
         app.jinja_env.filters['format_currency'] = _fc
     
+    # Bytecode cache dei template compilati e tag {% cache %} per i frammenti
+    try:
+        from app.utils.template_cache import init_template_cache
+        init_template_cache(app)
+    except Exception:
+        pass
+
     # Importa e registra i blueprint
     from app.views.main import main_bp
     from app.views.transazioni.categorie import categorie_bp
@@ -204,6 +223,10 @@ def create_app(config_name='default'):
     app.register_blueprint(ppay_bp, url_prefix='/ppay_evolution')
     app.register_blueprint(libretto_bp, url_prefix='/libretto')
     
+    # Coda dei job in background (stato su /jobs/<id>)
+    from app.views.jobs import jobs_bp
+    app.register_blueprint(jobs_bp, url_prefix='/jobs')
+
     # Storico transazioni archiviate
     from app.views.transazioni.storico import storico_bp
     app.register_blueprint(storico_bp, url_prefix='/storico')
@@ -262,6 +285,38 @@ def create_app(config_name='default'):
             # Silent fail - column might already exist or table not ready yet
             pass
 
+    # Riconciliazione giornaliera delle rate PayPal: con i worker attivi è il job
+    # giornaliero 'riconciliazione_paypal'; senza worker gira al primo accesso del giorno
+    @app.before_request
+    def maybe_run_paypal_reconciliation():
+        if app.config.get('JOBS_WORKER'):
+            return
+        try:
+            path = request.path or ''
+            if path.startswith('/static') or path.startswith('/favicon.ico'):
+                return
+            from app.services.paypal.riconciliazione_service import riconcilia_se_necessario
+            res = riconcilia_se_necessario()
+            if res:
+                app.logger.info('PayPal reconciliation result: %s', res)
+        except Exception:
+            try:
+                app.logger.exception('maybe_run_paypal_reconciliation failed')
+            except Exception:
+                pass
+
+    # Checkpoint del ledger dei saldi (al primo accesso del giorno, connessione propria)
+    @app.before_request
+    def maybe_consolida_ledger():
+        try:
+            path = request.path or ''
+            if path.startswith('/static') or path.startswith('/favicon.ico'):
+                return
+            from app.services.conti_finanziari.ledger_service import consolida_se_necessario
+            consolida_se_necessario()
+        except Exception:
+            pass
+
     # Run monthly rollover once per financial-month when the app is first accessed
     @app.before_request
     def maybe_run_monthly_rollover():
@@ -301,29 +356,26 @@ def create_app(config_name='default'):
             if prev == marker:
                 return
 
-            # Not yet run for this financial period — run the rollover (non-destructive default)
+            # Not yet run for this financial period: con i worker attivi il rollover
+            # va in coda (la richiesta non aspetta), altrimenti gira qui come prima
+            from app.services.transazioni.monthly_rollover_service import do_monthly_rollover, registra_marker_rollover
+            if app.config.get('JOBS_WORKER'):
+                try:
+                    from app.services.jobs.job_service import JobService
+                    ok, msg, job = JobService().accoda('rollover', {'base_date': today.isoformat(), 'marker': marker}, unico=True)
+                    if ok:
+                        return
+                    app.logger.warning('Rollover non accodato: %s', msg)
+                except Exception:
+                    app.logger.exception('Accodamento del rollover non riuscito')
             try:
-                from app.services.transazioni.monthly_rollover_service import do_monthly_rollover
                 res = do_monthly_rollover(force=False, months=1, base_date=today)
                 app.logger.info('Monthly rollover auto-run result: %s', res)
             except Exception as e:
                 app.logger.exception('Error running monthly rollover on startup: %s', e)
 
             # record marker in DB so we don't run again until next financial period
-            try:
-                from app.models.RolloverState import RolloverState
-                r = db.session.query(RolloverState).order_by(RolloverState.id.asc()).first()
-                if not r:
-                    r = RolloverState(marker=marker)
-                    db.session.add(r)
-                else:
-                    r.marker = marker
-                db.session.commit()
-            except Exception:
-                try:
-                    db.session.rollback()
-                except Exception:
-                    pass
+            registra_marker_rollover(marker)
         except Exception:
             # be silent on any error to avoid breaking requests
             try:
@@ -357,6 +409,91 @@ def create_app(config_name='default'):
                 except Exception:
                     # swallow errors; migrations or manual setup may be used instead
                     pass
+                # Colonna version degli strumenti (scritture del saldo con controllo di versione)
+                try:
+                    from app.services.conti_finanziari.strumenti_service import ensure_strumenti_version_column
+                    ensure_strumenti_version_column()
+                except Exception:
+                    pass
+                # Colonna mese_addebito + indice univoco per gli addebiti PostePay (DB esistenti)
+                try:
+                    from app.services.ppay_evolution.addebiti_service import (
+                        ensure_data_riattivazione_column, ensure_mese_addebito_column,
+                    )
+                    ensure_mese_addebito_column()
+                    ensure_data_riattivazione_column()
+                except Exception:
+                    pass
+                # Colonna iterations (PBKDF2) in security_config per DB esistenti
+                try:
+                    from app.services.passwd_manager.key_rotation_service import ensure_security_config_columns
+                    ensure_security_config_columns()
+                except Exception:
+                    pass
+                # Ledger append-only dei saldi strumenti (trigger, migrazione e saldo di apertura)
+                try:
+                    from app.services.conti_finanziari.ledger_service import LedgerService
+                    LedgerService().ensure_ledger()
+                except Exception:
+                    pass
+                # Colonne version del piano terapia (ETag e diff incrementali)
+                try:
+                    from app.services.sanita.terapia_service import ensure_terapia_version_columns
+                    ensure_terapia_version_columns()
+                except Exception:
+                    pass
+                # Trigger dei contatori per categoria (statistiche senza scansioni)
+                try:
+                    from app.services.categorie.statistiche_service import ensure_statistiche_categorie
+                    ensure_statistiche_categorie()
+                except Exception:
+                    pass
+                # Riepilogo mensile materializzato dell'archivio (report pluriennali)
+                try:
+                    from app.services.transazioni.report_service import ensure_report_mensile
+                    ensure_report_mensile()
+                except Exception:
+                    pass
+                # Colonne proprietario/heartbeat della coda dei job (DB esistenti)
+                try:
+                    from app.services.jobs.job_service import ensure_jobs_columns
+                    ensure_jobs_columns()
+                except Exception:
+                    pass
+                # Collegamenti ricariche conto <-> movimenti PostePay (trigger + backfill dello storico)
+                try:
+                    from app.services.ppay_evolution.collegamenti_service import ensure_collegamenti_ppay
+                    ensure_collegamenti_ppay()
+                except Exception:
+                    pass
+                # Versioni dei dati per tabella (ETag, frammenti e snapshot condivisi tra processi):
+                # per ultima, così i trigger coprono anche le tabelle create sopra
+                try:
+                    from app.utils.http_cache import ensure_versioni_dati
+                    ensure_versioni_dati()
+                except Exception:
+                    pass
+    except Exception:
+        pass
+
+    # ETag/304 dalla versione dei dati e compressione gzip (dopo gli altri before_request)
+    try:
+        from app.utils.http_cache import init_http_cache
+        init_http_cache(app)
+    except Exception:
+        pass
+
+    # Worker della coda dei job (se JOBS_WORKER > 0), avviati alla prima richiesta
+    try:
+        from app.services.jobs.job_service import registra_worker_job
+        registra_worker_job(app)
+    except Exception:
+        pass
+
+    # Backup periodici del database (se BACKUP_INTERVALLO_ORE > 0)
+    try:
+        from app.services.backup.backup_service import avvia_backup_pianificato
+        avvia_backup_pianificato(app)
     except Exception:
         pass
 
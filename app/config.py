@@ -26,6 +26,45 @@ class Config:
         
     # Manteniamo il formato valuta (usato estensivamente nelle view/templates)
     FORMATO_VALUTA = "€ {:.2f}"
+
+    # Categoria (per nome) delle transazioni che ricaricano la PostePay Evolution
+    CATEGORIA_RICARICA_PPAY = 'Ricarica PPay Ev'
+
+    # Snapshot colonnare in memoria di transazioni e archivio per le analisi
+    # (False: ogni analisi rilegge le tabelle)
+    ANALYTICS_SNAPSHOT = True
+    ANALYTICS_SNAPSHOT_VERIFICA_SECONDI = 300  # confronto periodico col DB anche senza versioni cambiate
+
+    # Backup del database (API di backup SQLite, copia a passi di pagine)
+    BACKUP_DIR = None  # None: cartella `backup/` accanto al database
+    BACKUP_COMPRESSIONE = True
+    BACKUP_PAGINE_PER_PASSO = 256
+    BACKUP_PAUSA_PASSO = 0.05  # secondi di attesa se il database è occupato
+    BACKUP_CONSERVA_ULTIMI = 5
+    BACKUP_CONSERVA_GIORNALIERI = 7
+    BACKUP_CONSERVA_SETTIMANALI = 4
+    BACKUP_INTERVALLO_ORE = 0  # 0: backup pianificato disattivato
+
+    # Risposte condizionali (ETag dalla versione dei dati) e compressione gzip
+    HTTP_CACHE = True
+    HTTP_COMPRESSIONE_SOGLIA = 1024  # byte: sotto questa dimensione non si comprime
+    HTTP_COMPRESSIONE_LIVELLO = 6
+
+    # Template: bytecode compilato su disco e frammenti {% cache %} in memoria
+    JINJA_BYTECODE_CACHE_DIR = None  # None: cartella temporanea di sistema
+    JINJA_FRAMMENTI_MAX = 256  # 0: cache dei frammenti disattivata
+
+    # Coda dei job in background (reset, ricalcoli, rollover, export)
+    JOBS_WORKER = 2  # 0: nessun worker, le operazioni girano nella richiesta
+    JOBS_POLL_SECONDI = 2.0
+    JOBS_HEARTBEAT_SECONDI = 15.0  # job 'in_esecuzione' senza heartbeat per 4 intervalli: rimessi in coda
+    JOBS_DIR = None  # None: cartella `jobs/` accanto al database
+    JOBS_CONSERVA_GIORNI = 7
+
+    # Password manager: derivazione PBKDF2 su pool dedicato (chiave poi riusata per sessione)
+    VAULT_KDF_WORKER = 2
+    VAULT_KDF_CODA = 4  # derivazioni in attesa oltre i worker; oltre, il login è rifiutato
+    VAULT_KDF_TIMEOUT = 30  # secondi
     
 # Mapping minimale: usa solamente la configurazione di default
 config = {
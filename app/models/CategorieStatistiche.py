@@ -0,0 +1,22 @@
+"""Modello per i contatori aggregati delle categorie"""
+from app import db
+
+
+class CategoriaStatistica(db.Model):
+    """Conteggi e totali per (categoria, periodo) su transazioni e archivio.
+
+    Le righe sono mantenute da trigger SQLite su `transazioni` e
+    `transazioni_archivio`, quindi restano allineate a ogni inserimento,
+    modifica, eliminazione o archiviazione da rollover.
+    """
+    __tablename__ = 'categorie_statistiche'
+
+    categoria_id = db.Column(db.Integer, primary_key=True)  # senza FK: l'archivio sopravvive alla categoria
+    id_periodo = db.Column(db.Integer, primary_key=True)  # YYYYMM del mese finanziario
+    num_transazioni = db.Column(db.Integer, nullable=False, default=0)
+    totale = db.Column(db.Float, nullable=False, default=0.0)
+    num_archiviate = db.Column(db.Integer, nullable=False, default=0)
+    totale_archiviate = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f'<CategoriaStatistica cat={self.categoria_id} periodo={self.id_periodo} n={self.num_transazioni}+{self.num_archiviate}>'
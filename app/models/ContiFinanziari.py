@@ -12,6 +12,9 @@ class Strumento(db.Model):
     tipologia = db.Column(db.String(50), nullable=False)
     saldo_iniziale = db.Column(db.Float, nullable=False, default=0.0)
     saldo_corrente = db.Column(db.Float, nullable=False, default=0.0)
+    # Incrementata a ogni scrittura del saldo: le impostazioni assolute possono
+    # verificare di non sovrascrivere una modifica concorrente
+    version = db.Column(db.Integer, nullable=False, default=0)
 
     def __repr__(self):
         return f"<Strumento {self.descrizione} ({self.tipologia}) saldo={self.saldo_corrente}>"
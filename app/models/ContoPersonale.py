@@ -44,29 +44,59 @@ class ContoPersonaleMovimento(db.Model):
 
 # SQLAlchemy event listeners to keep `strumento.saldo_corrente` in sync with movimenti
 from sqlalchemy import event, text
+from sqlalchemy.orm.attributes import get_history
 
+# I movimenti sono importi positivi che riducono il saldo: ogni evento applica
+# solo la propria variazione, senza risommare tutti i movimenti del conto.
+_DELTA_STRUMENTO_SQL = text(
+    "UPDATE conti_finanziari SET saldo_corrente = COALESCE(saldo_corrente, 0) + :delta, version = version + 1 "
+    "WHERE id_conto = (SELECT id_strumento FROM conto_personale WHERE id = :cid)"
+)
 
-def _recompute_and_update_strumento(connection, conto_id):
-    """Ricalcola il saldo corrente per il conto `conto_id` e aggiorna la tabella `strumento`."""
-    # Recupera id_strumento per il conto
-    row = connection.execute(text("SELECT id_strumento FROM conto_personale WHERE id = :cid"), {'cid': conto_id}).fetchone()
-    if not row:
-        return
-    id_str = row[0]
-    if not id_str:
+
+def applica_delta_strumento(connection, conto_id, delta):
+    """Somma `delta` al saldo corrente dello strumento collegato al conto `conto_id`."""
+    if conto_id is None or not delta:
         return
+    from app.services.conti_finanziari.ledger_service import registra_nel_ledger
+    parametri = {'delta': float(delta), 'cid': conto_id}
+    registra_nel_ledger(connection, ':delta', 'id_conto = (SELECT id_strumento FROM conto_personale WHERE id = :cid)', parametri)
+    connection.execute(_DELTA_STRUMENTO_SQL, parametri)
+
 
-    # Somma degli importi (tutti positivi)
-    total = connection.execute(text("SELECT coalesce(sum(importo),0) FROM conto_personale_movimenti WHERE conto_id = :cid"), {'cid': conto_id}).scalar() or 0.0
-    saldo_iniziale = connection.execute(text("SELECT saldo_iniziale FROM conti_finanziari WHERE id_conto = :id"), {'id': id_str}).scalar() or 0.0
-    nuovo = float(saldo_iniziale) - float(total)
-    connection.execute(text("UPDATE conti_finanziari SET saldo_corrente = :s WHERE id_conto = :id"), {'s': nuovo, 'id': id_str})
+# Saldo corrente = saldo iniziale - movimenti del conto, calcolato dentro la stessa UPDATE
+_SALDO_RIALLINEATO_SQL = (
+    "COALESCE(:iniziale, saldo_iniziale, 0) - "
+    "(SELECT COALESCE(SUM(importo), 0) FROM conto_personale_movimenti WHERE conto_id = :cid)"
+)
+_RIALLINEA_STRUMENTO_SQL = text(
+    "UPDATE conti_finanziari SET "
+    "saldo_iniziale = COALESCE(:iniziale, saldo_iniziale), "
+    f"saldo_corrente = {_SALDO_RIALLINEATO_SQL}, "
+    "version = version + 1 "
+    "WHERE id_conto = :sid"
+)
+
+
+def riallinea_saldo_strumento(connection, conto_id, id_strumento, saldo_iniziale=None):
+    """Ricalcola il saldo dello strumento dai movimenti del conto (impostando prima il saldo iniziale, se indicato)."""
+    if conto_id is None or id_strumento is None:
+        return
+    from app.services.conti_finanziari.ledger_service import registra_nel_ledger
+    parametri = {
+        'cid': conto_id,
+        'sid': id_strumento,
+        'iniziale': float(saldo_iniziale) if saldo_iniziale is not None else None,
+    }
+    registra_nel_ledger(connection, f'({_SALDO_RIALLINEATO_SQL}) - COALESCE(saldo_corrente, 0)', 'id_conto = :sid',
+                        parametri, origine='rettifica')
+    connection.execute(_RIALLINEA_STRUMENTO_SQL, parametri)
 
 
 @event.listens_for(ContoPersonaleMovimento, 'after_insert')
 def _after_insert_movimento(_mapper, connection, target):
     try:
-        _recompute_and_update_strumento(connection, target.conto_id)
+        applica_delta_strumento(connection, target.conto_id, -float(target.importo or 0))
     except Exception:
         # non vogliamo fallire l'operazione principale per problemi di sincronizzazione
         pass
@@ -75,7 +105,7 @@ def _after_insert_movimento(_mapper, connection, target):
 @event.listens_for(ContoPersonaleMovimento, 'after_delete')
 def _after_delete_movimento(_mapper, connection, target):
     try:
-        _recompute_and_update_strumento(connection, target.conto_id)
+        applica_delta_strumento(connection, target.conto_id, float(target.importo or 0))
     except Exception:
         pass
 
@@ -83,6 +113,14 @@ def _after_delete_movimento(_mapper, connection, target):
 @event.listens_for(ContoPersonaleMovimento, 'after_update')
 def _after_update_movimento(_mapper, connection, target):
     try:
-        _recompute_and_update_strumento(connection, target.conto_id)
+        h_imp = get_history(target, 'importo')
+        h_cid = get_history(target, 'conto_id')
+        if not h_imp.has_changes() and not h_cid.has_changes():
+            return
+        vecchio_importo = h_imp.deleted[0] if h_imp.deleted else target.importo
+        vecchio_conto = h_cid.deleted[0] if h_cid.deleted else target.conto_id
+        # storna il vecchio movimento e applica il nuovo
+        applica_delta_strumento(connection, vecchio_conto, float(vecchio_importo or 0))
+        applica_delta_strumento(connection, target.conto_id, -float(target.importo or 0))
     except Exception:
         pass
@@ -0,0 +1,53 @@
+"""Modello per la coda persistente delle operazioni lunghe"""
+from app import db
+from datetime import datetime
+import json
+
+
+class Job(db.Model):
+    """Operazione eseguita in background dai worker (reset, ricalcolo, rollover, export...).
+
+    `stato` passa da 'in_coda' a 'in_esecuzione' e poi a 'completato', 'errore'
+    o 'annullato'; un job fallito torna 'in_coda' finché restano tentativi.
+    Mentre è 'in_esecuzione' il processo `proprietario` aggiorna `heartbeat`.
+    """
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False, index=True)
+    stato = db.Column(db.String(20), nullable=False, default='in_coda', index=True)
+    parametri = db.Column(db.Text, nullable=True)  # JSON
+    risultato = db.Column(db.Text, nullable=True)  # JSON
+    errore = db.Column(db.Text, nullable=True)
+    progresso = db.Column(db.Float, nullable=False, default=0.0)  # 0..1
+    messaggio = db.Column(db.String(255), nullable=True)
+    tentativi = db.Column(db.Integer, nullable=False, default=0)
+    max_tentativi = db.Column(db.Integer, nullable=False, default=1)
+    annulla_richiesto = db.Column(db.Boolean, nullable=False, default=False)
+    proprietario = db.Column(db.String(64), nullable=True)  # processo che lo sta eseguendo
+    heartbeat = db.Column(db.DateTime, nullable=True)  # ultimo segnale di vita del proprietario
+    esegui_dopo = db.Column(db.DateTime, nullable=True)  # attesa prima del nuovo tentativo
+    data_creazione = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    data_inizio = db.Column(db.DateTime, nullable=True)
+    data_fine = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'stato': self.stato,
+            'parametri': json.loads(self.parametri) if self.parametri else {},
+            'risultato': json.loads(self.risultato) if self.risultato else None,
+            'errore': self.errore,
+            'progresso': round(float(self.progresso or 0.0), 3),
+            'messaggio': self.messaggio,
+            'tentativi': self.tentativi,
+            'max_tentativi': self.max_tentativi,
+            'annulla_richiesto': bool(self.annulla_richiesto),
+            'data_creazione': self.data_creazione.isoformat() if self.data_creazione else None,
+            'data_inizio': self.data_inizio.isoformat() if self.data_inizio else None,
+            'data_fine': self.data_fine.isoformat() if self.data_fine else None,
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.tipo} {self.stato}>'
@@ -0,0 +1,44 @@
+"""Modelli per il registro (ledger) dei movimenti di saldo degli strumenti"""
+from app import db
+from datetime import datetime
+
+
+class LedgerConto(db.Model):
+    """Registro append-only delle variazioni di `conti_finanziari.saldo_corrente`.
+
+    Le righe sono scritte dalle operazioni che modificano il saldo
+    (`ledger_service.registra_nel_ledger`) e, per i nuovi strumenti, da un
+    trigger SQLite; `data` è in ora locale.
+    """
+    __tablename__ = 'conti_finanziari_ledger'
+
+    id = db.Column(db.Integer, primary_key=True)
+    id_conto = db.Column(db.Integer, db.ForeignKey('conti_finanziari.id_conto'), nullable=False)
+    data = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    delta = db.Column(db.Float, nullable=False)
+    origine = db.Column(db.String(20), nullable=False, default='update')  # 'apertura', 'insert', 'movimento', 'rettifica', ...
+
+    __table_args__ = (
+        db.Index('ix_ledger_conto_id', 'id_conto', 'id'),
+    )
+
+    def __repr__(self):
+        return f"<LedgerConto conto={self.id_conto} delta={self.delta} ({self.origine})>"
+
+
+class CheckpointConto(db.Model):
+    """Checkpoint periodico del saldo: saldo cumulato fino alla riga `ledger_id` inclusa."""
+    __tablename__ = 'conti_finanziari_checkpoint'
+
+    id = db.Column(db.Integer, primary_key=True)
+    id_conto = db.Column(db.Integer, db.ForeignKey('conti_finanziari.id_conto'), nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.DateTime, nullable=False)
+    saldo = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('id_conto', 'ledger_id', name='uq_checkpoint_conto_ledger'),
+    )
+
+    def __repr__(self):
+        return f"<CheckpointConto conto={self.id_conto} ledger={self.ledger_id} saldo={self.saldo}>"
@@ -0,0 +1,32 @@
+from app import db
+from datetime import datetime
+
+
+class PasswdKeyRotation(db.Model):
+    """Stato di una rotazione della chiave master in corso (una sola alla volta)."""
+    __tablename__ = 'key_rotation_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    new_salt = db.Column(db.LargeBinary, nullable=False)
+    new_iterations = db.Column(db.Integer, nullable=False)
+    new_test_encrypted = db.Column(db.Text, nullable=False)
+    stato = db.Column(db.String(20), nullable=False, default='in_corso')  # 'in_corso', 'completata'
+    totale = db.Column(db.Integer, nullable=False, default=0)
+    processate = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<PasswdKeyRotation {self.stato} {self.processate}/{self.totale}>"
+
+
+class PasswdRotationStaging(db.Model):
+    """Credenziali già ricifrate con la nuova chiave, in attesa dello swap finale."""
+    __tablename__ = 'credentials_rotation'
+
+    credential_id = db.Column(db.Integer, primary_key=True)
+    password = db.Column(db.Text, nullable=True)
+    altro = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f"<PasswdRotationStaging {self.credential_id}>"
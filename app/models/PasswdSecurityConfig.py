@@ -1,4 +1,5 @@
 from app import db
+from datetime import datetime
 
 
 class PasswdSecurityConfig(db.Model):
@@ -7,3 +8,19 @@ class PasswdSecurityConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     salt = db.Column(db.LargeBinary, nullable=True)
     test_encrypted = db.Column(db.Text, nullable=True)
+    # Iterazioni PBKDF2 usate per derivare la chiave (NULL = valore di default storico)
+    iterations = db.Column(db.Integer, nullable=True)
+
+
+class PasswdVaultSessione(db.Model):
+    """Chiave del vault derivata al login, cifrata con il token della sessione.
+
+    Il token sta solo nel cookie di sessione: la riga da sola non basta a
+    ricavare la chiave, e la password non viene mai salvata.
+    """
+    __tablename__ = 'vault_sessioni'
+
+    id = db.Column(db.String(64), primary_key=True)  # sha256 del token di sessione
+    chiave_cifrata = db.Column(db.Text, nullable=False)
+    scadenza = db.Column(db.DateTime, nullable=False, index=True)
+    data_creazione = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -16,6 +16,8 @@ class AbbonamentoPostePay(db.Model):
     attivo = db.Column(db.Boolean, nullable=False, default=True)
     data_creazione = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     data_disattivazione = db.Column(db.DateTime, nullable=True)
+    # Ultima riattivazione (ora locale): gli addebiti arretrati non risalgono oltre
+    data_riattivazione = db.Column(db.DateTime, nullable=True)
 
     @property
     def prossimo_addebito(self):
@@ -48,6 +50,13 @@ class AbbonamentoPostePay(db.Model):
     def __repr__(self):
         return f'<AbbonamentoPostePay {self.nome}: {self.importo}>'
 
+
+@db.event.listens_for(AbbonamentoPostePay.attivo, 'set', active_history=True)
+def _registra_riattivazione(target, value, oldvalue, _initiator):
+    # Da disattivo ad attivo (da qualsiasi percorso: toggle, update_abbonamento, ...)
+    if value and oldvalue is False:
+        target.data_riattivazione = datetime.now()
+
 class MovimentoPostePay(db.Model):
     """Modello per i movimenti PostePay Evolution"""
     # Renamed to match new naming convention
@@ -62,11 +71,33 @@ class MovimentoPostePay(db.Model):
     # FK updated to match renamed abbonamenti table
     abbonamento_id = db.Column(db.Integer, db.ForeignKey('ppay_evolution_abbonamenti.id'), nullable=True)
     abbonamento = db.relationship('AbbonamentoPostePay', backref=db.backref('movimenti', lazy=True))
+    # Mese di competenza (YYYYMM) degli addebiti automatici: garantisce un solo addebito per abbonamento/mese
+    mese_addebito = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('abbonamento_id', 'mese_addebito', name='uq_ppay_mov_abbonamento_mese'),
+    )
     
     def __repr__(self):
         return f'<MovimentoPostePay {self.descrizione}: {self.importo}>'
-    
-    def __repr__(self):
-        return f'<MovimentoPostePay {self.descrizione}: {self.importo}>'
 
 
+
+
+class CollegamentoRicarica(db.Model):
+    """Collegamento 1:1 tra una transazione del conto (ricarica) e il movimento PostePay corrispondente.
+
+    Le righe sono scritte alla creazione della coppia e rimosse da trigger
+    SQLite quando una delle due parti viene eliminata.
+    """
+    __tablename__ = 'ppay_evolution_collegamenti'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Senza FK: le righe seguono le eliminazioni tramite trigger
+    transazione_id = db.Column(db.Integer, nullable=False, unique=True, index=True)
+    movimento_id = db.Column(db.Integer, nullable=False, unique=True, index=True)
+    origine = db.Column(db.String(20), nullable=False, default='creazione')  # 'creazione' o 'backfill'
+    data_creazione = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CollegamentoRicarica tx={self.transazione_id} mov={self.movimento_id}>'
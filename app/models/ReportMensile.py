@@ -0,0 +1,23 @@
+"""Modello per il riepilogo mensile materializzato dell'archivio"""
+from app import db
+from datetime import datetime
+
+
+class ReportMensile(db.Model):
+    """Totali per (periodo, categoria, tipo) dei mesi archiviati dal rollover.
+
+    Aggiornato dal rollover per i periodi appena archiviati: i report
+    pluriennali leggono questa tabella invece delle righe di `transazioni_archivio`.
+    """
+    __tablename__ = 'report_mensile'
+
+    id_periodo = db.Column(db.Integer, primary_key=True)  # YYYYMM del mese finanziario
+    categoria_id = db.Column(db.Integer, primary_key=True)  # 0 = senza categoria (es. PayPal)
+    tipo = db.Column(db.String(20), primary_key=True)  # 'entrata' o 'uscita'
+    categoria_nome = db.Column(db.String(100), nullable=True)  # denormalizzato come nell'archivio
+    num_transazioni = db.Column(db.Integer, nullable=False, default=0)
+    totale = db.Column(db.Float, nullable=False, default=0.0)
+    data_aggiornamento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ReportMensile {self.id_periodo} cat={self.categoria_id} {self.tipo} {self.totale}>'
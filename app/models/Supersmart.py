@@ -26,12 +26,19 @@ class Supersmart(db.Model):
         """Calcola il totale che si riceverà a scadenza (deposito + netto)"""
         return self.deposito + self.netto
     
+    def annota_scadenza(self, oggi):
+        """Fissa la data di riferimento per `giorni_rimanenti` e `is_scaduto` (una sola per elenco)."""
+        self._oggi = oggi
+
+    def _data_riferimento(self):
+        return self.__dict__.get('_oggi') or datetime.now().date()
+
     @property
     def giorni_rimanenti(self):
         """Calcola i giorni rimanenti alla scadenza"""
         if not self.data_scadenza:
             return 0
-        oggi = datetime.now().date()
+        oggi = self._data_riferimento()
         if self.data_scadenza < oggi:
             return 0
         return (self.data_scadenza - oggi).days
@@ -41,4 +48,4 @@ class Supersmart(db.Model):
         """Verifica se il deposito è scaduto"""
         if not self.data_scadenza:
             return True
-        return self.data_scadenza < datetime.now().date()
+        return self.data_scadenza < self._data_riferimento()
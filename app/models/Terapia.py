@@ -8,6 +8,8 @@ class TerapiaPlan(db.Model):
     start_date = db.Column(db.Date, nullable=False)
     total_drugs = db.Column(db.Integer, nullable=False, default=0)
     num_deliveries = db.Column(db.Integer, nullable=False, default=0)
+    # Incrementata a ogni modifica delle consegne: usata per ETag e diff incrementali
+    version = db.Column(db.Integer, nullable=False, default=0)
 
     deliveries = db.relationship('TerapiaDelivery', backref='plan', cascade='all, delete-orphan', lazy='dynamic')
 
@@ -17,6 +19,7 @@ class TerapiaPlan(db.Model):
             'start_date': self.start_date.isoformat() if self.start_date else None,
             'total_drugs': self.total_drugs,
             'num_deliveries': self.num_deliveries,
+            'version': self.version or 0,
             'deliveries': [d.to_dict() for d in self.deliveries.order_by(TerapiaDelivery.delivery_number).all()]
         }
 
@@ -34,6 +37,8 @@ class TerapiaDelivery(db.Model):
     # Delivery scheduling: scheduled date and confirmation flag
     scheduled_delivery_date = db.Column(db.Date, nullable=True)  # Data programmata consegna
     delivery_confirmed = db.Column(db.Boolean, nullable=False, default=False)  # Consegna confermata
+    # Versione del piano in cui la consegna è stata modificata l'ultima volta
+    version = db.Column(db.Integer, nullable=False, default=0)
 
     def to_dict(self):
         return {
@@ -79,6 +79,9 @@ class Veicoli(db.Model):
     @property
     def bollo_scaduto(self):
         """Indica se esiste un bollo non pagato per l'anno corrente."""
+        # Valore precalcolato dall'analisi del garage (evita una query per veicolo)
+        if '_bollo_scaduto' in self.__dict__:
+            return self.__dict__['_bollo_scaduto']
         try:
             current_year = date.today().year
             # AutoBolli è definito più sotto nel file; la query viene eseguita a runtime
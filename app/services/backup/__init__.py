@@ -0,0 +1,2 @@
+"""Package per il backup e il ripristino del database."""
+from .backup_service import *  # noqa: F401,F403
@@ -0,0 +1,348 @@
+"""Backup online del database SQLite tramite l'API di backup di sqlite3.
+
+La copia avanza a blocchi di pagine (`Connection.backup(pages=...)`): tra un
+passo e l'altro il database resta disponibile agli altri processi e, se
+viene modificato durante la copia, SQLite riparte in automatico, quindi il
+risultato è sempre uno stato coerente (mai un file copiato a metà di una
+scrittura). Ogni copia è verificata con `PRAGMA integrity_check` prima di
+essere conservata; opzionalmente viene compressa con gzip. Le copie vecchie
+sono eliminate secondo la retention configurata (ultime N, una al giorno,
+una a settimana).
+"""
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import current_app
+
+from app import db
+from app.services import BaseService
+
+logger = logging.getLogger(__name__)
+
+# <base>_backup_<YYYYmmdd_HHMMSS>[_<motivo>].db[.gz] (anche i backup legacy del reset)
+_NOME_BACKUP = re.compile(
+    r'^(?P<base>.+?)_backup_(?P<ts>\d{8}_\d{6})(?:_(?P<motivo>[a-z0-9\-]+))?(?P<ext>\.(?:db|sqlite3?))(?P<gz>\.gz)?$'
+)
+
+_pianificatore = None
+_pianificatore_lock = threading.Lock()
+
+
+def percorso_database(app=None):
+    """Percorso del file SQLite configurato (None per database in memoria o non SQLite)."""
+    app = app or current_app
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI', '') or ''
+    if not uri.startswith('sqlite'):
+        return None
+    percorso = uri[len('sqlite:///'):] if uri.startswith('sqlite:///') else uri.replace('sqlite://', '')
+    if not percorso or percorso == ':memory:':
+        return None
+    return os.path.abspath(percorso)
+
+
+def _uri_sola_lettura(percorso):
+    return Path(percorso).resolve().as_uri() + '?mode=ro'
+
+
+def verifica_integrita(percorso):
+    """Esegue `PRAGMA integrity_check` sul file; ritorna (ok, messaggio)."""
+    conn = sqlite3.connect(_uri_sola_lettura(percorso), uri=True)
+    try:
+        esito = [r[0] for r in conn.execute('PRAGMA integrity_check').fetchall()]
+    finally:
+        conn.close()
+    if esito == ['ok']:
+        return True, 'ok'
+    return False, '; '.join(str(e) for e in esito[:5])
+
+
+class BackupService(BaseService):
+    """Creazione, verifica, retention e ripristino dei backup del database"""
+
+    def __init__(self, app=None):
+        self.app = app or current_app._get_current_object()
+
+    def _config(self, chiave, default=None):
+        valore = self.app.config.get(chiave)
+        return default if valore is None else valore
+
+    def percorso_database(self):
+        return percorso_database(self.app)
+
+    def cartella(self):
+        """Cartella dei backup (default: `backup/` accanto al database)."""
+        cartella = self._config('BACKUP_DIR')
+        if not cartella:
+            cartella = os.path.join(os.path.dirname(self.percorso_database() or '.'), 'backup')
+        os.makedirs(cartella, exist_ok=True)
+        return cartella
+
+    def _copia_online(self, sorgente, destinazione):
+        """Copia `sorgente` in `destinazione` a passi di pagine; ritorna il numero di pagine."""
+        pagine = {'totale': 0}
+
+        def _progresso(_status, _rimanenti, totale):
+            pagine['totale'] = totale
+
+        src = sqlite3.connect(_uri_sola_lettura(sorgente), uri=True)
+        dst = sqlite3.connect(destinazione)
+        try:
+            src.backup(
+                dst,
+                pages=int(self._config('BACKUP_PAGINE_PER_PASSO', 256)),
+                progress=_progresso,
+                sleep=float(self._config('BACKUP_PAUSA_PASSO', 0.05)),
+            )
+        finally:
+            dst.close()
+            src.close()
+        return pagine['totale']
+
+    def _ultima_modifica_db(self, percorso):
+        # In modalità WAL le scritture recenti sono nel file -wal
+        return max(os.path.getmtime(p) for p in (percorso, percorso + '-wal') if os.path.exists(p))
+
+    def crea_backup(self, motivo='manuale', comprimi=None, solo_se_modificato=False, retention=True):
+        """Crea un backup verificato del database.
+
+        Con `solo_se_modificato` il backup è saltato se il database non è
+        cambiato dopo l'ultimo backup; con `retention=False` le copie vecchie
+        non vengono eliminate. Ritorna (success, messaggio, info).
+        """
+        sorgente = self.percorso_database()
+        if not sorgente or not os.path.exists(sorgente):
+            return False, 'Database SQLite non trovato', None
+        if comprimi is None:
+            comprimi = bool(self._config('BACKUP_COMPRESSIONE', True))
+
+        if solo_se_modificato:
+            esistenti = self.elenco_backup()
+            if esistenti and self._ultima_modifica_db(sorgente) <= esistenti[0]['timestamp'].timestamp():
+                return True, 'Database invariato dall\'ultimo backup', None
+
+        cartella = self.cartella()
+        inizio = time.monotonic()
+        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        base, ext = os.path.splitext(os.path.basename(sorgente))
+        motivo = re.sub(r'[^a-z0-9\-]+', '-', (motivo or 'manuale').lower()).strip('-') or 'manuale'
+        nome = f"{base}_backup_{ts}_{motivo}{ext or '.db'}"
+        n = 1
+        while any(os.path.exists(os.path.join(cartella, nome + gz)) for gz in ('', '.gz')):
+            n += 1
+            nome = f"{base}_backup_{ts}_{motivo}-{n}{ext or '.db'}"
+        temporaneo = os.path.join(cartella, f'.{nome}.part')
+        try:
+            pagine = self._copia_online(sorgente, temporaneo)
+            ok, esito = verifica_integrita(temporaneo)
+            if not ok:
+                raise ValueError(f'integrity_check fallito: {esito}')
+            if comprimi:
+                nome += '.gz'
+                compresso = temporaneo + '.gz'
+                with open(temporaneo, 'rb') as f_in, gzip.open(compresso, 'wb', compresslevel=6) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                os.remove(temporaneo)
+                temporaneo = compresso
+            destinazione = os.path.join(cartella, nome)
+            os.replace(temporaneo, destinazione)
+        except Exception as e:
+            for p in (temporaneo, temporaneo + '.gz'):
+                if os.path.exists(p):
+                    os.remove(p)
+            logger.error('Backup del database non riuscito: %s', e)
+            return False, f'Backup non riuscito: {e}', None
+
+        eliminati = self.applica_retention() if retention else []
+        info = {
+            'nome': nome,
+            'path': destinazione,
+            'dimensione': os.path.getsize(destinazione),
+            'compresso': bool(comprimi),
+            'pagine': pagine,
+            'durata_s': round(time.monotonic() - inizio, 3),
+            'eliminati': eliminati,
+        }
+        logger.info('Backup creato: %s (%s byte)', destinazione, info['dimensione'])
+        return True, 'Backup creato', info
+
+    def elenco_backup(self):
+        """Backup presenti (più recenti prima), inclusi quelli legacy accanto al database."""
+        cartelle = [self.cartella()]
+        sorgente = self.percorso_database()
+        if sorgente and os.path.dirname(sorgente) not in cartelle:
+            cartelle.append(os.path.dirname(sorgente))
+        voci = []
+        for cartella in cartelle:
+            for nome in os.listdir(cartella):
+                m = _NOME_BACKUP.match(nome)
+                if not m:
+                    continue
+                percorso = os.path.join(cartella, nome)
+                voci.append({
+                    'nome': nome,
+                    'path': percorso,
+                    'timestamp': datetime.strptime(m.group('ts'), '%Y%m%d_%H%M%S'),
+                    'motivo': m.group('motivo') or 'reset',
+                    'compresso': bool(m.group('gz')),
+                    'dimensione': os.path.getsize(percorso),
+                })
+        voci.sort(key=lambda v: v['timestamp'], reverse=True)
+        return voci
+
+    def _trova(self, nome):
+        return next((v for v in self.elenco_backup() if v['nome'] == nome), None)
+
+    def applica_retention(self):
+        """Elimina i backup non coperti dalla retention; ritorna i nomi eliminati.
+
+        Si conservano gli ultimi BACKUP_CONSERVA_ULTIMI, il più recente di
+        ciascuno degli ultimi BACKUP_CONSERVA_GIORNALIERI giorni e di ciascuna
+        delle ultime BACKUP_CONSERVA_SETTIMANALI settimane.
+        """
+        voci = self.elenco_backup()
+        ultimi = int(self._config('BACKUP_CONSERVA_ULTIMI', 5))
+        giorni = int(self._config('BACKUP_CONSERVA_GIORNALIERI', 7))
+        settimane = int(self._config('BACKUP_CONSERVA_SETTIMANALI', 4))
+        adesso = datetime.now()
+
+        conservati = {v['nome'] for v in voci[:ultimi]}
+        giorni_visti, settimane_visti = set(), set()
+        for v in voci:
+            giorno = v['timestamp'].date()
+            settimana = v['timestamp'].isocalendar()[:2]
+            if v['timestamp'] >= adesso - timedelta(days=giorni) and giorno not in giorni_visti:
+                giorni_visti.add(giorno)
+                conservati.add(v['nome'])
+            if v['timestamp'] >= adesso - timedelta(weeks=settimane) and settimana not in settimane_visti:
+                settimane_visti.add(settimana)
+                conservati.add(v['nome'])
+
+        eliminati = []
+        for v in voci:
+            if v['nome'] not in conservati:
+                try:
+                    os.remove(v['path'])
+                    eliminati.append(v['nome'])
+                except OSError as e:
+                    logger.warning('Impossibile eliminare il backup %s: %s', v['path'], e)
+        return eliminati
+
+    @contextmanager
+    def _file_sqlite(self, voce):
+        """Percorso di un file SQLite leggibile per il backup (decompresso se necessario)."""
+        if not voce['compresso']:
+            yield voce['path']
+            return
+        fd, temporaneo = tempfile.mkstemp(suffix='.db', dir=self.cartella())
+        try:
+            with os.fdopen(fd, 'wb') as f_out, gzip.open(voce['path'], 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            yield temporaneo
+        finally:
+            os.remove(temporaneo)
+
+    def verifica_backup(self, nome):
+        """Controlla l'integrità di un backup esistente; ritorna (ok, messaggio)."""
+        voce = self._trova(nome)
+        if not voce:
+            return False, 'Backup non trovato'
+        try:
+            with self._file_sqlite(voce) as percorso:
+                return verifica_integrita(percorso)
+        except Exception as e:
+            return False, str(e)
+
+    def ripristina(self, nome):
+        """Ripristina il database dal backup indicato, dopo averlo verificato.
+
+        Prima del ripristino viene salvata una copia dello stato corrente
+        (motivo `pre-ripristino`). La copia verso il database in uso passa
+        dall'API di backup, quindi le altre connessioni vedono il cambio in
+        modo atomico. Ritorna (success, messaggio).
+        """
+        voce = self._trova(nome)
+        destinazione = self.percorso_database()
+        if not voce or not destinazione:
+            return False, 'Backup o database non trovato'
+        try:
+            with self._file_sqlite(voce) as percorso:
+                ok, esito = verifica_integrita(percorso)
+                if not ok:
+                    return False, f'Backup corrotto: {esito}'
+                # Senza retention: potrebbe eliminare proprio il backup da ripristinare
+                ok, msg, _ = self.crea_backup(motivo='pre-ripristino', retention=False)
+                if not ok:
+                    return False, msg
+                # Le connessioni del pool non devono tenere lock né pagine in cache
+                db.session.remove()
+                db.engine.dispose()
+                src = sqlite3.connect(_uri_sola_lettura(percorso), uri=True)
+                dst = sqlite3.connect(destinazione)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+                    src.close()
+        except Exception as e:
+            logger.error('Ripristino da %s non riuscito: %s', nome, e)
+            return False, f'Ripristino non riuscito: {e}'
+
+        # Cache in memoria derivate dal database
+        try:
+            from app.services.transazioni.snapshot_service import snapshot_transazioni
+            snapshot_transazioni.invalida()
+        except Exception:
+            pass
+        try:
+            from app.services.conto_personale.conti_personali_service import invalida_cache_conti
+            invalida_cache_conti()
+        except Exception:
+            pass
+        try:
+            from app.utils.http_cache import invalida
+            invalida()
+        except Exception:
+            pass
+        logger.info('Database ripristinato da %s', voce['path'])
+        return True, f'Database ripristinato da {nome}'
+
+
+def avvia_backup_pianificato(app):
+    """Avvia il thread dei backup periodici se BACKUP_INTERVALLO_ORE > 0.
+
+    Il thread salta i backup quando il database non è cambiato. Ritorna
+    l'evento che ferma il thread (None se la pianificazione è disattivata).
+    """
+    global _pianificatore
+    try:
+        ore = float(app.config.get('BACKUP_INTERVALLO_ORE') or 0)
+    except (TypeError, ValueError):
+        ore = 0
+    if ore <= 0:
+        return None
+    with _pianificatore_lock:
+        if _pianificatore is not None:
+            return _pianificatore
+        stop = threading.Event()
+
+        def _ciclo():
+            while not stop.wait(ore * 3600):
+                try:
+                    with app.app_context():
+                        BackupService(app).crea_backup(motivo='pianificato', solo_se_modificato=True)
+                except Exception as e:
+                    logger.error('Backup pianificato non riuscito: %s', e)
+
+        threading.Thread(target=_ciclo, name='backup-pianificato', daemon=True).start()
+        _pianificatore = stop
+        return stop
@@ -3,3 +3,7 @@ try:
     from .categorie_service import *  # noqa: F401,F403
 except Exception:
     pass
+try:
+    from .statistiche_service import *  # noqa: F401,F403
+except Exception:
+    pass
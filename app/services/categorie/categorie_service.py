@@ -1,6 +1,8 @@
 """Servizio per la gestione delle categorie"""
 from app.services import BaseService
 from app.models.Categorie import Categorie
+from app.models.Transazioni import Transazioni
+from app.services.categorie.statistiche_service import get_statistiche_categorie
 from app import db
 
 class CategorieService(BaseService):
@@ -75,9 +77,12 @@ class CategorieService(BaseService):
             if categoria.nome == 'PayPal':
                 return False, "Non è possibile eliminare la categoria PayPal"
             
-            # Verifica che non ci siano transazioni associate
-            if categoria.transazioni:
-                return False, f"Impossibile eliminare la categoria '{categoria.nome}': ci sono {len(categoria.transazioni)} transazioni associate"
+            # Verifica che non ci siano transazioni associate (conteggio SQL, senza caricare la relazione)
+            num_transazioni = db.session.query(db.func.count(Transazioni.id)).filter(
+                Transazioni.categoria_id == categoria.id
+            ).scalar() or 0
+            if num_transazioni:
+                return False, f"Impossibile eliminare la categoria '{categoria.nome}': ci sono {num_transazioni} transazioni associate"
             
             nome = categoria.nome
             success, message = self.delete(categoria)
@@ -87,20 +92,9 @@ class CategorieService(BaseService):
         except Exception as e:
             return False, str(e)
     
-    def get_categories_stats(self):
-        """Calcola statistiche delle categorie"""
+    def get_categories_stats(self, mesi=12):
+        """Statistiche delle categorie dalla tabella dei contatori (una GROUP BY, nessuna relazione caricata)"""
         try:
-            categorie = self.get_all_categories()
-            stats = []
-            
-            for categorie in categorie:
-                num_transazioni = len(categorie.transazioni) if categorie.transazioni else 0
-                stats.append({
-                    'categorie': categorie,
-                    'num_transazioni': num_transazioni
-                })
-            
-            return stats
-            
+            return get_statistiche_categorie(mesi=mesi)
         except Exception as e:
             return []
@@ -0,0 +1,154 @@
+"""Statistiche per categoria servite dalla tabella di contatori `categorie_statistiche`.
+
+I contatori (numero e totale per categoria e periodo, separati tra transazioni
+correnti e archiviate) sono aggiornati da trigger SQLite: leggere le
+statistiche costa una `GROUP BY categoria_id` su una tabella che cresce con
+categorie x mesi, non con il numero di transazioni.
+"""
+import logging
+
+from sqlalchemy import text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Periodo (YYYYMM) della riga: id_periodo se valorizzato, altrimenti il mese
+# finanziario (27 -> 26) calcolato dalla data effettiva o dalla data
+_PERIODO_SQL = """COALESCE({r}.id_periodo, CAST(strftime('%Y%m',
+    CASE WHEN CAST(strftime('%d', COALESCE({r}.data_effettiva, {r}.data)) AS INTEGER) >= 27
+         THEN date(COALESCE({r}.data_effettiva, {r}.data), 'start of month', '+1 month')
+         ELSE COALESCE({r}.data_effettiva, {r}.data) END) AS INTEGER))"""
+
+# Tabelle sorgente -> colonne contatore aggiornate
+_SORGENTI = {
+    'transazioni': ('num_transazioni', 'totale'),
+    'transazioni_archivio': ('num_archiviate', 'totale_archiviate'),
+}
+
+
+def _triggers_sql(tabella, col_num, col_tot):
+    incrementa = f"""
+        INSERT INTO categorie_statistiche (categoria_id, id_periodo, num_transazioni, totale, num_archiviate, totale_archiviate)
+        SELECT NEW.categoria_id, {_PERIODO_SQL.format(r='NEW')}, 0, 0, 0, 0
+        WHERE NEW.categoria_id IS NOT NULL
+        ON CONFLICT (categoria_id, id_periodo) DO NOTHING;
+        UPDATE categorie_statistiche SET {col_num} = {col_num} + 1, {col_tot} = {col_tot} + COALESCE(NEW.importo, 0)
+        WHERE NEW.categoria_id IS NOT NULL AND categoria_id = NEW.categoria_id AND id_periodo = {_PERIODO_SQL.format(r='NEW')};
+    """
+    decrementa = f"""
+        UPDATE categorie_statistiche SET {col_num} = {col_num} - 1, {col_tot} = {col_tot} - COALESCE(OLD.importo, 0)
+        WHERE OLD.categoria_id IS NOT NULL AND categoria_id = OLD.categoria_id AND id_periodo = {_PERIODO_SQL.format(r='OLD')};
+    """
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_{tabella}_cat_stat_ins AFTER INSERT ON {tabella} BEGIN {incrementa} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{tabella}_cat_stat_del AFTER DELETE ON {tabella} BEGIN {decrementa} END",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{tabella}_cat_stat_upd
+            AFTER UPDATE OF categoria_id, importo, id_periodo, data, data_effettiva ON {tabella}
+            BEGIN {decrementa} {incrementa} END""",
+    ]
+
+
+_RICOSTRUZIONE_SQL = f"""
+INSERT INTO categorie_statistiche (categoria_id, id_periodo, num_transazioni, totale, num_archiviate, totale_archiviate)
+SELECT categoria_id, periodo, SUM(n_tx), SUM(tot_tx), SUM(n_arc), SUM(tot_arc)
+FROM (
+    SELECT t.categoria_id, {_PERIODO_SQL.format(r='t')} AS periodo,
+           1 AS n_tx, COALESCE(t.importo, 0) AS tot_tx, 0 AS n_arc, 0 AS tot_arc
+    FROM transazioni t WHERE t.categoria_id IS NOT NULL
+    UNION ALL
+    SELECT a.categoria_id, {_PERIODO_SQL.format(r='a')} AS periodo,
+           0, 0, 1, COALESCE(a.importo, 0)
+    FROM transazioni_archivio a WHERE a.categoria_id IS NOT NULL
+)
+GROUP BY categoria_id, periodo
+"""
+
+
+def ricostruisci_statistiche_categorie():
+    """Ricalcola da zero i contatori (usato alla prima installazione dei trigger)."""
+    try:
+        db.session.execute(text("DELETE FROM categorie_statistiche"))
+        db.session.execute(text(_RICOSTRUZIONE_SQL))
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Ricostruzione statistiche categorie non riuscita: %s', e)
+        return False
+
+
+def ensure_statistiche_categorie():
+    """Installa i trigger dei contatori; alla prima installazione popola la tabella."""
+    try:
+        presenti = {r[0] for r in db.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%_cat_stat_%'"
+        )).fetchall()}
+        attesi = {f"trg_{t}_cat_stat_{op}" for t in _SORGENTI for op in ('ins', 'del', 'upd')}
+        for tabella, (col_num, col_tot) in _SORGENTI.items():
+            for sql in _triggers_sql(tabella, col_num, col_tot):
+                db.session.execute(text(sql))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Installazione trigger statistiche categorie non riuscita: %s', e)
+        return False
+    if not attesi.issubset(presenti):
+        # Contatori non mantenuti finora: vanno allineati allo storico esistente
+        return ricostruisci_statistiche_categorie()
+    return True
+
+
+def get_statistiche_categorie(mesi=12, exclude_paypal=True):
+    """Conteggi, totali e andamento mensile per categoria (correnti + archiviate).
+
+    Ritorna una lista di dict ordinata per tipo e nome, ciascuno con `trend`
+    (lista di {'periodo', 'num', 'totale'} per gli ultimi `mesi` periodi presenti).
+    """
+    filtro = "WHERE c.nome != 'PayPal'" if exclude_paypal else ''
+    righe = db.session.execute(text(f"""
+        SELECT c.id, c.nome, c.tipo,
+               COALESCE(SUM(s.num_transazioni), 0), COALESCE(SUM(s.totale), 0),
+               COALESCE(SUM(s.num_archiviate), 0), COALESCE(SUM(s.totale_archiviate), 0),
+               MIN(CASE WHEN s.num_transazioni + s.num_archiviate > 0 THEN s.id_periodo END),
+               MAX(CASE WHEN s.num_transazioni + s.num_archiviate > 0 THEN s.id_periodo END)
+        FROM categorie c
+        LEFT JOIN categorie_statistiche s ON s.categoria_id = c.id
+        {filtro}
+        GROUP BY c.id
+        ORDER BY c.tipo, c.nome
+    """)).fetchall()
+
+    trend = {}
+    if mesi:
+        for categoria_id, periodo, num, totale in db.session.execute(text("""
+            SELECT categoria_id, id_periodo, num_transazioni + num_archiviate, totale + totale_archiviate
+            FROM categorie_statistiche
+            WHERE id_periodo IN (
+                SELECT DISTINCT id_periodo FROM categorie_statistiche
+                WHERE num_transazioni + num_archiviate > 0
+                ORDER BY id_periodo DESC LIMIT :mesi
+            )
+            ORDER BY id_periodo
+        """), {'mesi': int(mesi)}):
+            if num:
+                trend.setdefault(categoria_id, []).append(
+                    {'periodo': periodo, 'num': int(num), 'totale': round(float(totale), 2)})
+
+    return [
+        {
+            'id': r[0],
+            'nome': r[1],
+            'tipo': r[2],
+            'num_transazioni': int(r[3]),
+            'totale': round(float(r[4]), 2),
+            'num_archiviate': int(r[5]),
+            'totale_archiviate': round(float(r[6]), 2),
+            'num_totale': int(r[3]) + int(r[5]),
+            'importo_totale': round(float(r[4]) + float(r[6]), 2),
+            'primo_periodo': r[7],
+            'ultimo_periodo': r[8],
+            'trend': trend.get(r[0], []),
+        }
+        for r in righe
+    ]
@@ -1,2 +1,3 @@
 """Package per i servizi conti finanziari."""
 from .strumenti_service import *  # noqa: F401,F403
+from .ledger_service import *  # noqa: F401,F403
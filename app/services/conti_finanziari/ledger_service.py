@@ -0,0 +1,238 @@
+"""Registro append-only dei saldi degli strumenti (`conti_finanziari`) con checkpoint periodici.
+
+Le variazioni del saldo sono registrate come delta in `conti_finanziari_ledger`
+dalle stesse operazioni che le applicano (`registra_nel_ledger`, chiamata da
+StrumentiService, dai movimenti dei conti personali e dagli addebiti PostePay)
+nella stessa transazione dell'UPDATE: il delta registrato è quello voluto, non
+la differenza osservata su `saldo_corrente`. Un aggiornamento perso o una
+scrittura del saldo fuori da queste operazioni emerge quindi come drift tra
+ledger e `saldo_corrente` (`verifica_drift`).
+
+`conti_finanziari_checkpoint` conserva il saldo cumulato ogni `CHECKPOINT_OGNI`
+righe, così il saldo (attuale o storico) si ottiene dall'ultimo checkpoint più
+una coda corta di delta. Le date sono in ora locale, come quelle passate a
+`saldo(al=...)`.
+"""
+import logging
+from datetime import datetime, date, time
+
+from sqlalchemy import text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Numero di righe di coda oltre il quale viene creato un nuovo checkpoint
+CHECKPOINT_OGNI = 50
+
+# Tolleranza (in euro) per considerare allineati ledger e saldo_corrente
+TOLLERANZA_DRIFT = 0.005
+
+_ultimo_consolidamento = None
+
+# Ora locale di SQLite, nello stesso formato di `_as_db_datetime`
+_ADESSO_SQL = "datetime('now', 'localtime')"
+
+_TRIGGERS_SQL = [
+    # Saldo di partenza degli strumenti creati (anche via ORM)
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_conti_finanziari_ledger_ins
+    AFTER INSERT ON conti_finanziari
+    BEGIN
+        INSERT INTO conti_finanziari_ledger (id_conto, data, delta, origine)
+        VALUES (NEW.id_conto, {_ADESSO_SQL}, COALESCE(NEW.saldo_corrente, 0), 'insert');
+    END
+    """,
+    # Uno strumento eliminato non lascia storico orfano (né lo passa a un nuovo id riusato)
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_conti_finanziari_ledger_del
+    AFTER DELETE ON conti_finanziari
+    BEGIN
+        DELETE FROM conti_finanziari_checkpoint WHERE id_conto = OLD.id_conto;
+        DELETE FROM conti_finanziari_ledger WHERE id_conto = OLD.id_conto;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_conti_finanziari_ledger_append_only
+    BEFORE UPDATE ON conti_finanziari_ledger
+    BEGIN
+        SELECT RAISE(ABORT, 'conti_finanziari_ledger è append-only');
+    END
+    """,
+]
+
+
+def registra_nel_ledger(esecutore, delta_sql, condizione, parametri=None, origine='movimento'):
+    """Registra nel ledger la variazione `delta_sql` per gli strumenti che soddisfano `condizione`.
+
+    `delta_sql` e `condizione` sono espressioni SQL sulle colonne di
+    conti_finanziari (valori precedenti all'UPDATE, che va eseguita dopo nella
+    stessa transazione); `esecutore` è la sessione o la connessione del
+    chiamante. Le variazioni nulle non sono registrate.
+    """
+    parametri = dict(parametri or {}, ledger_origine=origine)
+    esecutore.execute(text(f"""
+        INSERT INTO conti_finanziari_ledger (id_conto, data, delta, origine)
+        SELECT id_conto, {_ADESSO_SQL}, {delta_sql}, :ledger_origine
+        FROM conti_finanziari
+        WHERE ({condizione}) AND ({delta_sql}) <> 0
+    """), parametri)
+
+
+# Ultimo checkpoint per conto + coda di delta successiva, per tutti gli strumenti
+_STATO_LEDGER_SQL = """
+WITH cp AS (
+    SELECT c.id_conto, c.ledger_id, c.saldo
+    FROM conti_finanziari_checkpoint c
+    WHERE c.ledger_id = (
+        SELECT MAX(c2.ledger_id) FROM conti_finanziari_checkpoint c2 WHERE c2.id_conto = c.id_conto
+    )
+),
+coda AS (
+    SELECT l.id_conto, SUM(l.delta) AS somma, COUNT(*) AS righe, MAX(l.id) AS ultimo_id, MAX(l.data) AS ultima_data
+    FROM conti_finanziari_ledger l
+    LEFT JOIN cp ON cp.id_conto = l.id_conto
+    WHERE l.id > COALESCE(cp.ledger_id, 0)
+    GROUP BY l.id_conto
+)
+SELECT s.id_conto, s.descrizione, s.saldo_corrente,
+       COALESCE(cp.saldo, 0) + COALESCE(coda.somma, 0) AS saldo_ledger,
+       COALESCE(coda.righe, 0) AS righe_coda,
+       coda.ultimo_id, coda.ultima_data
+FROM conti_finanziari s
+LEFT JOIN cp ON cp.id_conto = s.id_conto
+LEFT JOIN coda ON coda.id_conto = s.id_conto
+"""
+
+
+def _as_db_datetime(al):
+    """Normalizza `al` (date o datetime) nel formato testuale usato da SQLite."""
+    if isinstance(al, datetime):
+        return al.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(al, date):
+        return datetime.combine(al, time.max).strftime('%Y-%m-%d %H:%M:%S')
+    return str(al)
+
+
+class LedgerService:
+    """Service per il registro dei saldi degli strumenti."""
+
+    def ensure_ledger(self):
+        """Crea i trigger e registra il saldo di apertura degli strumenti senza storico (best-effort)."""
+        try:
+            self._migra_trigger_precedenti()
+            for sql in _TRIGGERS_SQL:
+                db.session.execute(text(sql))
+            db.session.execute(text(f"""
+                INSERT INTO conti_finanziari_ledger (id_conto, data, delta, origine)
+                SELECT s.id_conto, {_ADESSO_SQL}, COALESCE(s.saldo_corrente, 0), 'apertura'
+                FROM conti_finanziari s
+                WHERE NOT EXISTS (SELECT 1 FROM conti_finanziari_ledger l WHERE l.id_conto = s.id_conto)
+            """))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning('Inizializzazione ledger conti_finanziari non riuscita: %s', e)
+            return False
+        self.consolida_checkpoint()
+        return True
+
+    def _migra_trigger_precedenti(self):
+        """Rimuove il trigger che copiava le variazioni di saldo_corrente e porta le date UTC in ora locale."""
+        trigger = dict(db.session.execute(text(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_conti_finanziari_ledger_%'"
+        )).fetchall())
+        db.session.execute(text("DROP TRIGGER IF EXISTS trg_conti_finanziari_ledger_upd"))
+        if 'CURRENT_TIMESTAMP' in (trigger.get('trg_conti_finanziari_ledger_ins') or ''):
+            # Righe scritte con CURRENT_TIMESTAMP (UTC): conversione una tantum, a guardia append-only sospesa
+            db.session.execute(text("DROP TRIGGER IF EXISTS trg_conti_finanziari_ledger_ins"))
+            db.session.execute(text("DROP TRIGGER IF EXISTS trg_conti_finanziari_ledger_append_only"))
+            db.session.execute(text("UPDATE conti_finanziari_ledger SET data = datetime(data, 'localtime')"))
+            db.session.execute(text("UPDATE conti_finanziari_checkpoint SET data = datetime(data, 'localtime')"))
+        # Storico rimasto da strumenti già eliminati
+        for tabella in ('conti_finanziari_checkpoint', 'conti_finanziari_ledger'):
+            db.session.execute(text(
+                f"DELETE FROM {tabella} WHERE id_conto NOT IN (SELECT id_conto FROM conti_finanziari)"
+            ))
+
+    def consolida_checkpoint(self, min_righe=CHECKPOINT_OGNI):
+        """Crea in blocco un checkpoint per ogni strumento con almeno `min_righe` delta in coda.
+
+        Usa una connessione e una transazione proprie, indipendenti dalla sessione del chiamante.
+        """
+        try:
+            with db.engine.begin() as conn:
+                res = conn.execute(text(f"""
+                    INSERT INTO conti_finanziari_checkpoint (id_conto, ledger_id, data, saldo)
+                    SELECT id_conto, ultimo_id, ultima_data, saldo_ledger
+                    FROM ({_STATO_LEDGER_SQL})
+                    WHERE righe_coda >= :min_righe AND ultimo_id IS NOT NULL
+                """), {'min_righe': max(int(min_righe), 1)})
+                return int(res.rowcount or 0)
+        except Exception as e:
+            logger.warning('Consolidamento checkpoint ledger non riuscito: %s', e)
+            return 0
+
+    def saldo(self, id_conto, al=None):
+        """Saldo dello strumento secondo il ledger, attuale o alla data/ora `al` (ora locale).
+
+        Sola lettura: i checkpoint sono creati da `consolida_se_necessario`.
+        """
+        params = {'id': id_conto}
+        filtro_cp = ''
+        filtro_coda = ''
+        if al is not None:
+            params['al'] = _as_db_datetime(al)
+            filtro_cp = 'AND data <= :al'
+            filtro_coda = 'AND data <= :al'
+
+        cp = db.session.execute(text(f"""
+            SELECT ledger_id, saldo FROM conti_finanziari_checkpoint
+            WHERE id_conto = :id {filtro_cp}
+            ORDER BY ledger_id DESC LIMIT 1
+        """), params).fetchone()
+        params['da_id'] = cp[0] if cp else 0
+        somma = db.session.execute(text(f"""
+            SELECT COALESCE(SUM(delta), 0) FROM conti_finanziari_ledger
+            WHERE id_conto = :id AND id > :da_id {filtro_coda}
+        """), params).scalar()
+
+        return float(cp[1] if cp else 0.0) + float(somma or 0.0)
+
+    def verifica_drift(self, tolleranza=TOLLERANZA_DRIFT):
+        """Confronta in blocco ledger e `saldo_corrente` per tutti gli strumenti.
+
+        Il ledger è scritto indipendentemente dal saldo: una differenza indica un
+        aggiornamento perso o una modifica di `saldo_corrente` non registrata.
+        Restituisce la lista degli strumenti disallineati con saldo registrato,
+        saldo da ledger e differenza.
+        """
+        rows = db.session.execute(text(_STATO_LEDGER_SQL)).fetchall()
+        drift = []
+        for id_conto, descrizione, saldo_corrente, saldo_ledger, righe_coda, _ultimo_id, _ultima_data in rows:
+            differenza = float(saldo_corrente or 0.0) - float(saldo_ledger or 0.0)
+            if abs(differenza) > tolleranza:
+                drift.append({
+                    'id_conto': id_conto,
+                    'descrizione': descrizione,
+                    'saldo_corrente': float(saldo_corrente or 0.0),
+                    'saldo_ledger': round(float(saldo_ledger or 0.0), 2),
+                    'differenza': round(differenza, 2),
+                })
+        return drift
+
+    def movimenti(self, id_conto, limit=50):
+        """Ultime righe del ledger per lo strumento (più recenti prima)."""
+        from app.models.LedgerConti import LedgerConto
+        return (LedgerConto.query.filter_by(id_conto=id_conto)
+                .order_by(LedgerConto.id.desc()).limit(limit).all())
+
+
+def consolida_se_necessario(oggi=None):
+    """Consolida i checkpoint al più una volta al giorno (usato dal before_request)."""
+    global _ultimo_consolidamento
+    oggi = oggi or date.today()
+    if _ultimo_consolidamento == oggi:
+        return None
+    _ultimo_consolidamento = oggi
+    return LedgerService().consolida_checkpoint()
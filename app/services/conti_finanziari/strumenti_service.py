@@ -1,7 +1,48 @@
-"""Service per la gestione degli strumenti (conti, carte, ecc.)"""
+"""Service per la gestione degli strumenti (conti, carte, ecc.)
+
+Il saldo corrente non viene mai letto e riscritto da Python: le variazioni
+(ricariche, spese, movimenti eliminati) passano da `applica_delta*`, una
+sola UPDATE `saldo_corrente = saldo_corrente + :delta`, quindi due richieste
+concorrenti non si sovrascrivono. Ogni scrittura incrementa `version`; le
+impostazioni assolute del saldo possono indicare la versione letta e
+falliscono con `SaldoModificato` se nel frattempo il saldo è cambiato; le
+uscite possono indicare un `saldo_minimo`, verificato nella stessa UPDATE
+(`SaldoInsufficiente` se non rispettato).
+Ogni scrittura registra la propria variazione nel ledger (stessa transazione).
+"""
+from sqlalchemy import func, text, update
+from sqlalchemy.exc import SQLAlchemyError
+
 from app import db
 from app.models.ContiFinanziari import Strumento
-from sqlalchemy.exc import SQLAlchemyError
+from app.services.conti_finanziari.ledger_service import registra_nel_ledger
+
+# Dopo un'UPDATE in blocco gli oggetti Strumento già in sessione vengono aggiornati
+_SINCRONIZZA = {'synchronize_session': 'fetch'}
+
+
+class SaldoModificato(Exception):
+    """Il saldo è stato modificato da un'altra operazione dopo essere stato letto."""
+
+
+class SaldoInsufficiente(Exception):
+    """La variazione porterebbe il saldo sotto il minimo richiesto."""
+
+
+def ensure_strumenti_version_column():
+    """Aggiunge la colonna `version` a conti_finanziari se mancante."""
+    try:
+        cols = [r[1] for r in db.session.execute(text("PRAGMA table_info('conti_finanziari');")).fetchall()]
+        if cols and 'version' not in cols:
+            db.session.execute(text("ALTER TABLE conti_finanziari ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+        db.session.commit()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
 
 
 class StrumentiService:
@@ -30,7 +71,58 @@ class StrumentiService:
             db.session.rollback()
             raise
 
-    def update_saldo(self, descrizione, nuovo_saldo):
+    # --- Variazioni atomiche ---------------------------------------------------
+
+    def applica_delta_by_id(self, id_conto, delta, commit=True, saldo_minimo=None, origine='movimento'):
+        """Somma `delta` al saldo corrente dello strumento; ritorna il nuovo saldo (None se non esiste).
+
+        Con `commit=False` la variazione resta nella transazione del chiamante,
+        insieme al movimento che la giustifica. Con `saldo_minimo` la UPDATE si
+        applica solo se il nuovo saldo non scende sotto il minimo, altrimenti
+        solleva SaldoInsufficiente senza scrivere nulla. `origine` è registrata
+        nel ledger insieme alla variazione.
+        """
+        return self._applica_delta('id_conto', id_conto, delta, commit, saldo_minimo, origine)
+
+    def applica_delta(self, descrizione, delta, commit=True, saldo_minimo=None, origine='movimento'):
+        """Come `applica_delta_by_id`, individuando lo strumento per descrizione."""
+        return self._applica_delta('descrizione', descrizione, delta, commit, saldo_minimo, origine)
+
+    def _applica_delta(self, campo, valore, delta, commit, saldo_minimo=None, origine='movimento'):
+        delta = float(delta or 0.0)
+        condizioni = [getattr(Strumento, campo) == valore]
+        condizione_sql, parametri = f'{campo} = :valore', {'delta': delta, 'valore': valore}
+        if saldo_minimo is not None:
+            condizioni.append(func.coalesce(Strumento.saldo_corrente, 0.0) + delta >= float(saldo_minimo))
+            condizione_sql += ' AND COALESCE(saldo_corrente, 0) + :delta >= :minimo'
+            parametri['minimo'] = float(saldo_minimo)
+        try:
+            registra_nel_ledger(db.session, ':delta', condizione_sql, parametri, origine=origine)
+            riga = db.session.execute(
+                update(Strumento)
+                .where(*condizioni)
+                .values(
+                    saldo_corrente=func.coalesce(Strumento.saldo_corrente, 0.0) + delta,
+                    version=Strumento.version + 1,
+                )
+                .returning(Strumento.saldo_corrente),
+                execution_options=_SINCRONIZZA,
+            ).fetchone()
+            if riga is None and saldo_minimo is not None:
+                if db.session.query(Strumento.id_conto).filter(condizioni[0]).first() is not None:
+                    raise SaldoInsufficiente('Saldo insufficiente')
+            if commit:
+                db.session.commit()
+            return float(riga[0]) if riga else None
+        except SQLAlchemyError:
+            # con commit=False la transazione appartiene al chiamante
+            if commit:
+                db.session.rollback()
+            raise
+
+    # --- Impostazioni assolute -------------------------------------------------
+
+    def update_saldo(self, descrizione, nuovo_saldo, versione_attesa=None):
         """Aggiorna il saldo_corrente (e crea lo strumento se mancante)."""
         try:
             s = self.get_by_descrizione(descrizione)
@@ -38,40 +130,71 @@ class StrumentiService:
                 # non conosciamo la tipologia: usiamo 'conto' generico
                 s = Strumento(descrizione=descrizione, tipologia='conto', saldo_iniziale=0.0, saldo_corrente=nuovo_saldo)
                 db.session.add(s)
-            else:
-                s.saldo_corrente = nuovo_saldo
-            db.session.commit()
-            return s
+                db.session.commit()
+                return s
         except SQLAlchemyError:
             db.session.rollback()
             raise
+        return self.update_saldo_by_id(s.id_conto, nuovo_saldo, versione_attesa=versione_attesa)
+
+    def update_saldo_by_id(self, id_conto, nuovo_saldo, versione_attesa=None, commit=True):
+        """Imposta il saldo corrente (e crea lo strumento se mancante).
 
-    def update_saldo_by_id(self, id_conto, nuovo_saldo):
+        Con `versione_attesa` il saldo viene scritto solo se la versione dello
+        strumento è ancora quella letta, altrimenti solleva SaldoModificato.
+        Per sommare una variazione usare `applica_delta_by_id`.
+        """
+        condizioni = [Strumento.id_conto == id_conto]
+        condizione_sql, parametri = 'id_conto = :id', {'id': id_conto, 'nuovo': float(nuovo_saldo)}
+        if versione_attesa is not None:
+            condizioni.append(Strumento.version == int(versione_attesa))
+            condizione_sql += ' AND version = :versione'
+            parametri['versione'] = int(versione_attesa)
         try:
-            s = self.get_by_id(id_conto)
-            if not s:
+            registra_nel_ledger(db.session, ':nuovo - COALESCE(saldo_corrente, 0)', condizione_sql, parametri, origine='rettifica')
+            res = db.session.execute(
+                update(Strumento)
+                .where(*condizioni)
+                .values(saldo_corrente=float(nuovo_saldo), version=Strumento.version + 1),
+                execution_options=_SINCRONIZZA,
+            )
+            if not res.rowcount:
+                s = self.get_by_id(id_conto)
+                if s is not None:
+                    raise SaldoModificato(f'Saldo di "{s.descrizione}" modificato nel frattempo')
                 s = Strumento(id_conto=id_conto, descrizione=f'Conto {id_conto}', tipologia='conto', saldo_iniziale=0.0, saldo_corrente=nuovo_saldo)
                 db.session.add(s)
-            else:
-                s.saldo_corrente = nuovo_saldo
-            db.session.commit()
-            return s
+            if commit:
+                db.session.commit()
+            return self.get_by_id(id_conto)
         except SQLAlchemyError:
-            db.session.rollback()
+            # con commit=False la transazione appartiene al chiamante
+            if commit:
+                db.session.rollback()
             raise
 
     def update_saldo_iniziale_by_id(self, id_conto, nuovo_saldo_iniziale):
+        """Imposta il saldo iniziale spostando il saldo corrente della stessa differenza (una sola UPDATE)."""
+        nuovo = float(nuovo_saldo_iniziale)
         try:
-            s = self.get_by_id(id_conto)
-            if not s:
-                s = Strumento(id_conto=id_conto, descrizione=f'Conto {id_conto}', tipologia='conto', saldo_iniziale=nuovo_saldo_iniziale, saldo_corrente=nuovo_saldo_iniziale)
+            # Nel SET SQLite legge i valori precedenti della riga: la differenza è calcolata sul vecchio saldo_iniziale
+            registra_nel_ledger(db.session, ':nuovo - COALESCE(saldo_iniziale, 0)', 'id_conto = :id',
+                                {'nuovo': nuovo, 'id': id_conto}, origine='saldo_iniziale')
+            res = db.session.execute(
+                update(Strumento)
+                .where(Strumento.id_conto == id_conto)
+                .values(
+                    saldo_iniziale=nuovo,
+                    saldo_corrente=func.coalesce(Strumento.saldo_corrente, 0.0) + nuovo - func.coalesce(Strumento.saldo_iniziale, 0.0),
+                    version=Strumento.version + 1,
+                ),
+                execution_options=_SINCRONIZZA,
+            )
+            if not res.rowcount:
+                s = Strumento(id_conto=id_conto, descrizione=f'Conto {id_conto}', tipologia='conto', saldo_iniziale=nuovo, saldo_corrente=nuovo)
                 db.session.add(s)
-            else:
-                differenza = nuovo_saldo_iniziale - (s.saldo_iniziale or 0.0)
-                s.saldo_iniziale = nuovo_saldo_iniziale
-                s.saldo_corrente = (s.saldo_corrente or 0.0) + differenza
             db.session.commit()
-            return s
+            return self.get_by_id(id_conto)
         except SQLAlchemyError:
             db.session.rollback()
             raise
@@ -1,9 +1,10 @@
 """
 Service per la gestione dei conti personali.
 """
+import threading
 from datetime import datetime, date
-from sqlalchemy import func, and_, desc
-from app.models.ContoPersonale import ContoPersonale, ContoPersonaleMovimento as VersamentoPersonale
+from sqlalchemy import and_, desc, insert
+from app.models.ContoPersonale import ContoPersonale, ContoPersonaleMovimento as VersamentoPersonale, applica_delta_strumento, riallinea_saldo_strumento
 from app.models.ContiFinanziari import Strumento
 from app.services.conti_finanziari.strumenti_service import StrumentiService
 from app import db
@@ -12,11 +13,42 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# nome_conto -> id del ContoPersonale con strumento già associato.
+# Evita di rieseguire ensure_strumento (e i relativi commit) a ogni richiesta.
+_cache_conti = {}
+_cache_lock = threading.Lock()
+
+
+def invalida_cache_conti(nome_conto=None):
+    """Svuota la cache conto -> strumento (tutta o per un singolo conto)."""
+    with _cache_lock:
+        if nome_conto is None:
+            _cache_conti.clear()
+        else:
+            _cache_conti.pop(nome_conto, None)
+
+
 class ContiPersonaliService:
     """Service per i conti personali (generico)."""
     
     def __init__(self):
         pass
+
+    def _risolvi_conto(self, nome_conto):
+        """Conto personale con strumento associato, risolto una sola volta per processo."""
+        with _cache_lock:
+            conto_id = _cache_conti.get(nome_conto)
+        if conto_id is not None:
+            conto = db.session.get(ContoPersonale, conto_id)
+            if conto is not None and conto.nome_conto == nome_conto and conto.id_strumento:
+                return conto
+            invalida_cache_conti(nome_conto)
+
+        conto = self.inizializza_conto_personale(nome_conto)
+        if conto is not None and conto.id_strumento:
+            with _cache_lock:
+                _cache_conti[nome_conto] = conto.id
+        return conto
     
     def inizializza_conto_personale(self, nome_conto):
         """Inizializza un conto personale se non esiste (replica della funzione originale)"""
@@ -78,7 +110,7 @@ class ContiPersonaliService:
     def get_conto_data(self, nome_conto):
         """Recupera i dati completi per un conto"""
         try:
-            conto = self.inizializza_conto_personale(nome_conto)
+            conto = self._risolvi_conto(nome_conto)
             if not conto:
                 return None, []
             
@@ -93,9 +125,13 @@ class ContiPersonaliService:
             return None, []
     
     def aggiungi_versamento(self, nome_conto, data, descrizione, importo):
-        """Aggiunge un versamento al conto (replica della funzione originale)"""
+        """Aggiunge un versamento al conto.
+
+        Il saldo dello strumento viene aggiornato dal listener del modello con il
+        solo delta del movimento, nella stessa transazione dell'inserimento.
+        """
         try:
-            conto = self.inizializza_conto_personale(nome_conto)
+            conto = self._risolvi_conto(nome_conto)
             if not conto:
                 return False, "Conto non trovato"
             # Validazione: l'importo deve essere positivo
@@ -107,17 +143,6 @@ class ContiPersonaliService:
             if valore <= 0:
                 return False, "L'importo del versamento deve essere maggiore di 0"
 
-            # Calcola il nuovo saldo usando lo Strumento associato come sorgente di verità
-            ss = StrumentiService()
-            # preferiamo usare id_strumento se presente
-            if conto.id_strumento:
-                strum = ss.get_by_id(conto.id_strumento)
-            else:
-                strum = ss.get_by_descrizione(f"Conto Personale {nome_conto}")
-
-            current_saldo = float(strum.saldo_corrente) if strum and strum.saldo_corrente is not None else 0.0
-            nuovo_saldo = current_saldo - abs(valore)
-
             # Crea il versamento: memorizziamo l'importo come POSITIVO (rappresenta l'ammontare versato)
             versamento = VersamentoPersonale(
                 conto_id=conto.id,
@@ -129,27 +154,68 @@ class ContiPersonaliService:
             db.session.add(versamento)
             db.session.commit()
 
-            # Dopo aver aggiunto il movimento, ricalcoliamo il saldo corrente aggregando i movimenti
-            try:
-                # Somma degli importi per il conto (tutti i movimenti sono valori positivi)
-                total = db.session.query(func.coalesce(func.sum(VersamentoPersonale.importo), 0)).filter(VersamentoPersonale.conto_id == conto.id).scalar()
-                # saldo corrente = saldo_iniziale - total
-                if conto.id_strumento:
-                    ss.update_saldo_by_id(conto.id_strumento, (strum.saldo_iniziale if strum and strum.saldo_iniziale is not None else 0.0) - float(total))
-                else:
-                    ss.update_saldo(f"Conto Personale {nome_conto}", (strum.saldo_iniziale if strum and strum.saldo_iniziale is not None else 0.0) - float(total))
-            except Exception as e:
-                logger.warning(f"Attenzione: impossibile sincronizzare lo strumento per {nome_conto}: {e}", exc_info=True)
-
             return True, "Versamento aggiunto con successo"
             
         except Exception as e:
             db.session.rollback()
             logger.exception(f"Errore nell'aggiunta versamento: {e}")
             return False, f"Errore nel versamento: {str(e)}"
+
+    def aggiungi_versamenti(self, nome_conto, versamenti):
+        """Inserisce più versamenti sul conto in un'unica transazione.
+
+        `versamenti` è una lista di dict con chiavi `data` (date o 'YYYY-MM-DD'),
+        `descrizione` e `importo`. I movimenti sono validati tutti prima di
+        scrivere: se uno non è valido non viene inserito nulla. Il saldo dello
+        strumento riceve un solo aggiornamento con la somma degli importi.
+        Ritorna (success, message, num_inseriti).
+        """
+        try:
+            conto = self._risolvi_conto(nome_conto)
+            if not conto:
+                return False, "Conto non trovato", 0
+
+            righe = []
+            for i, v in enumerate(versamenti or [], start=1):
+                descrizione = str(v.get('descrizione') or '').strip()
+                if not descrizione:
+                    return False, f"Riga {i}: la descrizione è obbligatoria", 0
+                try:
+                    valore = float(v.get('importo'))
+                except Exception:
+                    return False, f"Riga {i}: importo non valido", 0
+                if valore <= 0:
+                    return False, f"Riga {i}: l'importo del versamento deve essere maggiore di 0", 0
+                data_v = v.get('data') or date.today()
+                if isinstance(data_v, str):
+                    try:
+                        data_v = datetime.strptime(data_v, '%Y-%m-%d').date()
+                    except ValueError:
+                        return False, f"Riga {i}: data non valida", 0
+                righe.append({
+                    'conto_id': conto.id,
+                    'data': data_v,
+                    'descrizione': descrizione,
+                    'importo': abs(valore),
+                })
+
+            if not righe:
+                return False, "Nessun versamento da inserire", 0
+
+            # executemany: i listener ORM non scattano, il delta è applicato qui una volta sola
+            db.session.execute(insert(VersamentoPersonale), righe)
+            applica_delta_strumento(db.session.connection(), conto.id, -sum(r['importo'] for r in righe))
+            db.session.commit()
+
+            return True, f"{len(righe)} versamenti aggiunti con successo", len(righe)
+
+        except Exception as e:
+            db.session.rollback()
+            logger.exception(f"Errore nell'aggiunta versamenti: {e}")
+            return False, f"Errore nei versamenti: {str(e)}", 0
     
     def elimina_versamento(self, versamento_id):
-        """Elimina un versamento e ripristina il saldo"""
+        """Elimina un versamento e ripristina il saldo (delta applicato dal listener del modello)"""
         try:
             versamento = db.session.query(VersamentoPersonale).filter(
                 VersamentoPersonale.id == versamento_id
@@ -157,26 +223,7 @@ class ContiPersonaliService:
             
             if not versamento:
                 return False, "Versamento non trovato"
-            
-            conto = versamento.conto
-            
-            # Dopo l'eliminazione, ricalcoliamo il totale dei movimenti e aggiorniamo lo strumento
-            try:
-                ss = StrumentiService()
-                total = db.session.query(func.coalesce(func.sum(VersamentoPersonale.importo), 0)).filter(VersamentoPersonale.conto_id == conto.id).scalar()
-                if conto.id_strumento:
-                    s = ss.get_by_id(conto.id_strumento)
-                    iniz = s.saldo_iniziale if s and s.saldo_iniziale is not None else 0.0
-                    ss.update_saldo_by_id(conto.id_strumento, iniz - float(total))
-                else:
-                    descr = f"Conto Personale {conto.nome_conto}"
-                    s = ss.get_by_descrizione(descr)
-                    if s:
-                        ss.update_saldo(descr, (s.saldo_iniziale or 0.0) - float(total))
-            except Exception as e:
-                logger.warning(f"Attenzione: impossibile sincronizzare lo strumento per {conto.nome_conto}: {e}", exc_info=True)
 
-            # Elimina il versamento
             db.session.delete(versamento)
             db.session.commit()
 
@@ -202,18 +249,10 @@ class ContiPersonaliService:
                 VersamentoPersonale.conto_id == conto.id
             ).delete()
 
-            # Dopo la cancellazione, il totale è zero quindi impostiamo il saldo corrente al valore iniziale
+            # Dopo la cancellazione, il totale è zero quindi il saldo corrente torna al valore iniziale
+            # (stessa transazione della cancellazione)
             try:
-                ss = StrumentiService()
-                if conto.id_strumento:
-                    s = ss.get_by_id(conto.id_strumento)
-                    iniz = s.saldo_iniziale if s and s.saldo_iniziale is not None else 0.0
-                    ss.update_saldo_by_id(conto.id_strumento, iniz)
-                else:
-                    descr = f"Conto Personale {nome_conto}"
-                    s = ss.get_by_descrizione(descr)
-                    if s:
-                        ss.update_saldo(descr, s.saldo_iniziale or 0.0)
+                riallinea_saldo_strumento(db.session.connection(), conto.id, self._id_strumento(conto))
             except Exception as e:
                 logger.warning(f"Attenzione: impossibile sincronizzare lo strumento per {nome_conto}: {e}", exc_info=True)
 
@@ -225,6 +264,13 @@ class ContiPersonaliService:
             logger.exception(f"Errore nel reset conto: {e}")
             return False, f"Errore durante il reset: {str(e)}"
     
+    def _id_strumento(self, conto):
+        """Strumento del conto: quello collegato o, per i conti non ancora collegati, quello per descrizione."""
+        if conto.id_strumento:
+            return conto.id_strumento
+        s = StrumentiService().get_by_descrizione(f"Conto Personale {conto.nome_conto}")
+        return s.id_conto if s else None
+
     def aggiorna_saldo_iniziale(self, nome_conto, nuovo_saldo):
         """Aggiorna il saldo iniziale del conto"""
         try:
@@ -237,20 +283,11 @@ class ContiPersonaliService:
             
             # Aggiorniamo il saldo iniziale nello strumento corrispondente e adattiamo il saldo corrente
             try:
-                ss = StrumentiService()
-                if conto.id_strumento:
-                    ss.update_saldo_iniziale_by_id(conto.id_strumento, nuovo_saldo)
-                    # ricalcola corrente = saldo_iniziale - total_movimenti
-                    total = db.session.query(func.coalesce(func.sum(VersamentoPersonale.importo), 0)).filter(VersamentoPersonale.conto_id == conto.id).scalar()
-                    ss.update_saldo_by_id(conto.id_strumento, float(nuovo_saldo) - float(total))
-                else:
-                    descr = f"Conto Personale {nome_conto}"
-                    s = ss.get_by_descrizione(descr)
-                    if s:
-                        ss.update_saldo_iniziale_by_id(s.id_conto, nuovo_saldo)
-                        total = db.session.query(func.coalesce(func.sum(VersamentoPersonale.importo), 0)).filter(VersamentoPersonale.conto_id == conto.id).scalar()
-                        ss.update_saldo_by_id(s.id_conto, float(nuovo_saldo) - float(total))
+                # corrente = saldo_iniziale - totale movimenti, in un'unica UPDATE
+                riallinea_saldo_strumento(db.session.connection(), conto.id, self._id_strumento(conto), saldo_iniziale=nuovo_saldo)
+                db.session.commit()
             except Exception:
+                db.session.rollback()
                 logger.warning(f"Attenzione: impossibile sincronizzare lo strumento per {nome_conto}", exc_info=True)
 
             return True, "Saldo iniziale aggiornato con successo"
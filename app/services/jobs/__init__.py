@@ -0,0 +1,3 @@
+"""Package per la coda persistente dei job in background."""
+from .job_service import *  # noqa: F401,F403
+from .tipi_job import *  # noqa: F401,F403
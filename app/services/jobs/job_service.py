@@ -0,0 +1,436 @@
+"""Coda persistente (tabella `jobs`) per le operazioni lunghe, eseguite da worker in thread.
+
+Le richieste accodano il job e rispondono subito con il suo id; lo stato si
+segue su `/jobs/<id>`. Un worker prende il prossimo job con una sola UPDATE
+(`... RETURNING id`) che vi scrive anche il processo `proprietario`, quindi più
+thread o processi non eseguono mai lo stesso job due volte. Il progresso dei
+job in corso resta in memoria ed è salvato sulla riga al termine; la richiesta
+di annullamento è scritta sulla riga (`annulla_richiesto`) e il job la
+rilegge periodicamente, interrompendosi al successivo `progresso`: un job che
+termina la sua funzione è 'completato' anche se l'annullamento è arrivato
+tardi. Un job fallito torna in coda con attesa crescente finché restano
+tentativi. I worker partono alla prima richiesta servita; ogni processo
+aggiorna l'`heartbeat` dei propri job in esecuzione e rimette in coda solo
+quelli il cui heartbeat è scaduto (processo arrestato), mai quelli ancora
+seguiti da un altro processo vivo. Lo stesso thread accoda una volta al
+giorno i tipi registrati con `giornaliero=True` (parametro `giorno`: un solo
+job per tipo e giorno anche con più processi).
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from app import db
+from app.models.Job import Job
+from app.services import BaseService
+
+logger = logging.getLogger(__name__)
+
+STATI_ATTIVI = ('in_coda', 'in_esecuzione')
+STATI_FINALI = ('completato', 'errore', 'annullato')
+# Ogni quanti secondi un job in esecuzione rilegge dalla riga la richiesta di annullamento
+INTERVALLO_CONTROLLO_ANNULLA = 1.0
+# Dopo quanti heartbeat mancati un job 'in_esecuzione' è considerato interrotto
+HEARTBEAT_MANCATI = 4
+
+# Identifica il processo nella colonna `proprietario` dei job che esegue
+PROCESSO = f'{socket.gethostname()[:30]}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+# nome -> (funzione, tentativi massimi); popolato da `tipo_job`
+TIPI_JOB = {}
+# Tipi accodati automaticamente una volta al giorno
+TIPI_GIORNALIERI = []
+
+_in_corso = {}  # job_id -> {'progresso', 'messaggio', 'annulla'}
+_in_corso_lock = threading.Lock()
+_sveglia = threading.Event()
+_worker = []
+_worker_lock = threading.Lock()
+_avvio_richiesto = False
+
+
+def ensure_jobs_columns():
+    """Aggiunge a jobs le colonne proprietario e heartbeat se mancanti."""
+    try:
+        cols = [r[1] for r in db.session.execute(text("PRAGMA table_info('jobs');")).fetchall()]
+        if cols and 'proprietario' not in cols:
+            db.session.execute(text("ALTER TABLE jobs ADD COLUMN proprietario VARCHAR(64)"))
+        if cols and 'heartbeat' not in cols:
+            db.session.execute(text("ALTER TABLE jobs ADD COLUMN heartbeat DATETIME"))
+        db.session.commit()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
+
+
+class JobAnnullato(Exception):
+    """Sollevata da `ContestoJob.progresso` quando è stato chiesto l'annullamento."""
+
+
+def tipo_job(nome, max_tentativi=1, giornaliero=False):
+    """Registra `funzione(contesto, **parametri)` come tipo di job.
+
+    Con `giornaliero` il job è accodato ogni giorno dai worker con il
+    parametro `giorno` (data ISO).
+    """
+    def _registra(funzione):
+        TIPI_JOB[nome] = (funzione, max_tentativi)
+        if giornaliero and nome not in TIPI_GIORNALIERI:
+            TIPI_GIORNALIERI.append(nome)
+        return funzione
+    return _registra
+
+
+def cartella_job(app=None):
+    """Cartella dei file prodotti dai job (default: `jobs/` accanto al database)."""
+    from flask import current_app
+    from app.services.backup.backup_service import percorso_database
+    app = app or current_app
+    cartella = app.config.get('JOBS_DIR')
+    if not cartella:
+        cartella = os.path.join(os.path.dirname(percorso_database(app) or '.'), 'jobs')
+    os.makedirs(cartella, exist_ok=True)
+    return cartella
+
+
+class ContestoJob:
+    """Passato alla funzione del job: progresso, annullamento e file di output."""
+
+    def __init__(self, job_id, cartella):
+        self.job_id = job_id
+        self._cartella = cartella
+        self._ultimo_controllo = time.monotonic()
+
+    @property
+    def annullato(self):
+        with _in_corso_lock:
+            if _in_corso.get(self.job_id, {}).get('annulla'):
+                return True
+        # L'annullamento può essere stato chiesto da un altro processo: si legge
+        # `annulla_richiesto` con una connessione propria (fuori dalla transazione del job)
+        ora = time.monotonic()
+        if ora - self._ultimo_controllo < INTERVALLO_CONTROLLO_ANNULLA:
+            return False
+        self._ultimo_controllo = ora
+        try:
+            with db.engine.connect() as conn:
+                richiesto = conn.execute(
+                    text("SELECT annulla_richiesto FROM jobs WHERE id = :id"), {'id': self.job_id}
+                ).scalar()
+        except Exception:
+            return False
+        if richiesto:
+            with _in_corso_lock:
+                _in_corso.setdefault(self.job_id, {})['annulla'] = True
+        return bool(richiesto)
+
+    def progresso(self, fatti, totale=None, messaggio=None):
+        """Aggiorna il progresso (frazione, o fatti/totale); solleva JobAnnullato se richiesto."""
+        frazione = fatti / totale if totale else fatti
+        with _in_corso_lock:
+            stato = _in_corso.setdefault(self.job_id, {})
+            stato['progresso'] = max(0.0, min(1.0, float(frazione)))
+            if messaggio is not None:
+                stato['messaggio'] = str(messaggio)[:255]
+        if self.annullato:
+            raise JobAnnullato()
+
+    def file_output(self, nome):
+        """Percorso per un file prodotto dal job (scaricabile da `/jobs/<id>/download`)."""
+        cartella = os.path.join(self._cartella, str(self.job_id))
+        os.makedirs(cartella, exist_ok=True)
+        return os.path.join(cartella, os.path.basename(nome))
+
+
+class JobService(BaseService):
+    """Accodamento, stato e annullamento dei job"""
+
+    def accoda(self, tipo, parametri=None, max_tentativi=None, unico=False):
+        """Accoda un job; con `unico` riusa un job dello stesso tipo ancora attivo.
+
+        Ritorna (success, message, job).
+        """
+        if tipo not in TIPI_JOB:
+            return False, f'Tipo di job sconosciuto: {tipo}', None
+        try:
+            if unico:
+                attivo = Job.query.filter(Job.tipo == tipo, Job.stato.in_(STATI_ATTIVI)).order_by(Job.id).first()
+                if attivo:
+                    return True, f'Job {attivo.id} già in coda', attivo
+            job = Job(
+                tipo=tipo,
+                parametri=json.dumps(parametri or {}, default=str),
+                max_tentativi=max_tentativi or TIPI_JOB[tipo][1],
+            )
+            db.session.add(job)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return False, f'Impossibile accodare il job: {e}', None
+        _sveglia.set()
+        return True, f'Job {job.id} accodato', job
+
+    def stato(self, job_id):
+        """Stato del job come dizionario (progresso in tempo reale se in esecuzione), o None."""
+        job = db.session.get(Job, job_id)
+        if job is None:
+            return None
+        dati = job.to_dict()
+        with _in_corso_lock:
+            vivo = dict(_in_corso.get(job_id, {}))
+        if job.stato == 'in_esecuzione' and vivo:
+            dati['progresso'] = round(vivo.get('progresso', dati['progresso']), 3)
+            dati['messaggio'] = vivo.get('messaggio', dati['messaggio'])
+            dati['annulla_richiesto'] = dati['annulla_richiesto'] or bool(vivo.get('annulla'))
+        dati['file'] = bool((dati['risultato'] or {}).get('file'))
+        return dati
+
+    def annulla(self, job_id):
+        """Annulla un job in coda, o chiede l'interruzione di uno in esecuzione. Ritorna (success, message)."""
+        job = db.session.get(Job, job_id)
+        if job is None:
+            return False, 'Job inesistente'
+        if job.stato in STATI_FINALI:
+            return False, f'Job già {job.stato}'
+        try:
+            # Solo se ancora in coda: un worker potrebbe averlo appena preso
+            res = db.session.execute(text(
+                "UPDATE jobs SET stato = 'annullato', annulla_richiesto = 1, data_fine = :ora "
+                "WHERE id = :id AND stato = 'in_coda'"
+            ), {'id': job_id, 'ora': datetime.utcnow()})
+            if res.rowcount:
+                db.session.commit()
+                return True, 'Job annullato'
+            job.annulla_richiesto = True
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return False, f'Annullamento non riuscito: {e}'
+        with _in_corso_lock:
+            _in_corso.setdefault(job_id, {})['annulla'] = True
+        return True, 'Annullamento richiesto'
+
+    def elenco(self, limite=50):
+        return [j.to_dict() for j in Job.query.order_by(Job.id.desc()).limit(limite).all()]
+
+    def file_risultato(self, job_id):
+        """Percorso del file prodotto da un job completato, o None."""
+        job = db.session.get(Job, job_id)
+        if job is None or job.stato != 'completato' or not job.risultato:
+            return None
+        percorso = (json.loads(job.risultato) or {}).get('file')
+        return percorso if percorso and os.path.isfile(percorso) else None
+
+    def pulisci(self, giorni=7, app=None):
+        """Elimina i job terminati da più di `giorni` giorni e i loro file; ritorna quanti."""
+        limite = datetime.utcnow() - timedelta(days=giorni)
+        vecchi = Job.query.filter(Job.stato.in_(STATI_FINALI), Job.data_fine < limite).all()
+        cartella = cartella_job(app)
+        for job in vecchi:
+            shutil.rmtree(os.path.join(cartella, str(job.id)), ignore_errors=True)
+            db.session.delete(job)
+        db.session.commit()
+        return len(vecchi)
+
+
+# --- Worker ----------------------------------------------------------------
+
+def _prendi_prossimo():
+    """Marca come 'in_esecuzione' il prossimo job pronto e ne ritorna l'id (None se non ce ne sono)."""
+    ora = datetime.utcnow()
+    riga = db.session.execute(text("""
+        UPDATE jobs SET stato = 'in_esecuzione', data_inizio = :ora, tentativi = tentativi + 1, messaggio = NULL,
+                        proprietario = :processo, heartbeat = :ora
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE stato = 'in_coda' AND (esegui_dopo IS NULL OR esegui_dopo <= :ora)
+            ORDER BY id LIMIT 1
+        ) AND stato = 'in_coda'
+        RETURNING id
+    """), {'ora': ora, 'processo': PROCESSO}).fetchone()
+    db.session.commit()
+    return riga[0] if riga else None
+
+
+def _concludi(job_id, **campi):
+    with _in_corso_lock:
+        vivo = _in_corso.pop(job_id, {})
+    campi.setdefault('progresso', vivo.get('progresso', 0.0))
+    campi.setdefault('messaggio', vivo.get('messaggio'))
+    try:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        if job.proprietario != PROCESSO:
+            # Heartbeat scaduto: il job è già stato rimesso in coda (o ripreso da un altro processo)
+            logger.warning('Job %s non più assegnato a questo processo: esito ignorato', job_id)
+            return
+        for chiave, valore in campi.items():
+            setattr(job, chiave, valore)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error('Aggiornamento dello stato del job %s non riuscito: %s', job_id, e)
+
+
+def _esegui(app, job_id):
+    job = db.session.get(Job, job_id)
+    funzione, _ = TIPI_JOB.get(job.tipo, (None, 0))
+    if funzione is None:
+        _concludi(job_id, stato='errore', errore=f'Tipo di job sconosciuto: {job.tipo}', data_fine=datetime.utcnow())
+        return
+    parametri = json.loads(job.parametri) if job.parametri else {}
+    with _in_corso_lock:
+        _in_corso[job_id] = {'progresso': 0.0, 'annulla': bool(job.annulla_richiesto)}
+    contesto = ContestoJob(job_id, cartella_job(app))
+    try:
+        # Terminata la funzione le sue modifiche sono confermate: il job è completato
+        # anche se l'annullamento è stato chiesto dopo l'ultimo `progresso`
+        risultato = funzione(contesto, **parametri)
+        _concludi(job_id, stato='completato', progresso=1.0, errore=None, data_fine=datetime.utcnow(),
+                  risultato=json.dumps(risultato, default=str) if risultato is not None else None)
+    except JobAnnullato:
+        _concludi(job_id, stato='annullato', messaggio='Annullato', data_fine=datetime.utcnow())
+    except Exception as e:
+        logger.exception('Job %s (%s) fallito', job_id, job.tipo)
+        job = db.session.get(Job, job_id)
+        if job.tentativi < job.max_tentativi:
+            attesa = 5 * 2 ** (job.tentativi - 1)
+            _concludi(job_id, stato='in_coda', errore=str(e), messaggio=f'Nuovo tentativo tra {attesa}s',
+                      esegui_dopo=datetime.utcnow() + timedelta(seconds=attesa))
+        else:
+            _concludi(job_id, stato='errore', errore=str(e), data_fine=datetime.utcnow())
+
+
+def aggiorna_heartbeat():
+    """Segnala che i job 'in_esecuzione' di questo processo sono ancora seguiti."""
+    try:
+        db.session.execute(text(
+            "UPDATE jobs SET heartbeat = :ora WHERE stato = 'in_esecuzione' AND proprietario = :processo"
+        ), {'ora': datetime.utcnow(), 'processo': PROCESSO})
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Heartbeat dei job non aggiornato: %s', e)
+
+
+def recupera_job_interrotti(intervallo_heartbeat):
+    """Rimette in coda i job 'in_esecuzione' senza heartbeat recente (errore se senza tentativi)."""
+    ora = datetime.utcnow()
+    try:
+        db.session.execute(text("""
+            UPDATE jobs SET stato = CASE WHEN tentativi < max_tentativi THEN 'in_coda' ELSE 'errore' END,
+                            errore = 'Interrotto: processo arrestato',
+                            data_fine = CASE WHEN tentativi < max_tentativi THEN NULL ELSE :ora END,
+                            proprietario = NULL
+            WHERE stato = 'in_esecuzione' AND (heartbeat IS NULL OR heartbeat < :scadenza)
+        """), {'ora': ora, 'scadenza': ora - timedelta(seconds=intervallo_heartbeat * HEARTBEAT_MANCATI)})
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Recupero dei job interrotti non riuscito: %s', e)
+
+
+def accoda_giornalieri(oggi=None):
+    """Accoda i tipi giornalieri non ancora accodati per `oggi`; ritorna gli id accodati."""
+    oggi = oggi or date.today()
+    accodati = []
+    for tipo in TIPI_GIORNALIERI:
+        parametri = {'giorno': oggi.isoformat()}
+        try:
+            esiste = db.session.execute(text(
+                "SELECT 1 FROM jobs WHERE tipo = :tipo AND parametri = :parametri LIMIT 1"
+            ), {'tipo': tipo, 'parametri': json.dumps(parametri, default=str)}).first()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning('Controllo del job giornaliero %s non riuscito: %s', tipo, e)
+            continue
+        if esiste:
+            continue
+        ok, msg, job = JobService().accoda(tipo, parametri, unico=True)
+        if ok:
+            accodati.append(job.id)
+        else:
+            logger.warning('Job giornaliero %s non accodato: %s', tipo, msg)
+    return accodati
+
+
+def avvia_worker_job(app):
+    """Avvia JOBS_WORKER thread che eseguono la coda; ritorna il numero di worker attivi."""
+    try:
+        numero = int(app.config.get('JOBS_WORKER', 2) or 0)
+    except (TypeError, ValueError):
+        numero = 0
+    attesa = float(app.config.get('JOBS_POLL_SECONDI', 2.0) or 2.0)
+    intervallo = float(app.config.get('JOBS_HEARTBEAT_SECONDI', 15.0) or 15.0)
+    with _worker_lock:
+        if numero <= 0 or _worker:
+            return len(_worker)
+        with app.app_context():
+            recupera_job_interrotti(intervallo)
+            accoda_giornalieri()
+            try:
+                JobService().pulisci(int(app.config.get('JOBS_CONSERVA_GIORNI', 7)), app)
+            except Exception:
+                db.session.rollback()
+
+        def _ciclo():
+            while True:
+                try:
+                    with app.app_context():
+                        job_id = _prendi_prossimo()
+                        if job_id is not None:
+                            _esegui(app, job_id)
+                            continue
+                except Exception as e:
+                    logger.error('Worker dei job: %s', e)
+                _sveglia.wait(attesa)
+                _sveglia.clear()
+
+        def _heartbeat():
+            while True:
+                time.sleep(intervallo)
+                try:
+                    with app.app_context():
+                        aggiorna_heartbeat()
+                        recupera_job_interrotti(intervallo)
+                        accoda_giornalieri()
+                except Exception as e:
+                    logger.error('Heartbeat dei job: %s', e)
+
+        for i in range(numero):
+            t = threading.Thread(target=_ciclo, name=f'job-worker-{i + 1}', daemon=True)
+            t.start()
+            _worker.append(t)
+        threading.Thread(target=_heartbeat, name='job-heartbeat', daemon=True).start()
+        return len(_worker)
+
+
+def registra_worker_job(app):
+    """Avvia i worker alla prima richiesta servita.
+
+    Così i job girano solo nel processo che serve le richieste (e ne vede
+    annullamenti, progresso e contatori delle cache), non nel processo padre
+    del reloader di Werkzeug, che esegue anch'esso `create_app`.
+    """
+    @app.before_request
+    def _avvia_worker_job():
+        global _avvio_richiesto
+        if _avvio_richiesto:
+            return
+        _avvio_richiesto = True
+        try:
+            avvia_worker_job(app)
+        except Exception as e:
+            logger.error('Avvio dei worker dei job non riuscito: %s', e)
@@ -0,0 +1,75 @@
+"""Tipi di job: le operazioni lunghe esistenti eseguite dai worker della coda.
+
+Ogni funzione riceve il `ContestoJob` e i parametri salvati sul job e ritorna
+un dizionario serializzabile (il risultato mostrato da `/jobs/<id>`); un
+errore non gestito fa fallire il tentativo.
+"""
+import shutil
+from datetime import date
+
+from app.services.jobs.job_service import tipo_job
+
+
+@tipo_job('reset')
+def job_reset(contesto, importo, months=6, full_wipe=False):
+    """Reset dell'orizzonte (`ResetService.reset_horizon`)."""
+    from app.services.transazioni.reset_service import ResetService
+    contesto.progresso(0.0, messaggio='Reset in corso')
+    ok, res = ResetService().reset_horizon(float(importo), months=int(months), full_wipe=bool(full_wipe))
+    if not ok:
+        raise RuntimeError(res)
+    return res
+
+
+@tipo_job('ricalcolo_riepiloghi')
+def job_ricalcolo_riepiloghi(contesto, anno=None, mese=None):
+    """Ricalcolo completo di `saldi_mensili` da (anno, mese) all'ultimo mese presente."""
+    from app.views.transazioni.dettaglio_periodo import _recompute_summaries_from
+    _recompute_summaries_from(anno, mese, progresso=contesto.progresso)
+    return {'da': f'{int(mese):02d}/{anno}' if anno and mese else 'periodo corrente'}
+
+
+@tipo_job('rollover')
+def job_rollover(contesto, base_date=None, marker=None, months=1, force=False):
+    """Rollover mensile; come in esecuzione diretta il marker è registrato comunque."""
+    from app.services.transazioni.monthly_rollover_service import do_monthly_rollover, registra_marker_rollover
+    giorno = date.fromisoformat(base_date) if base_date else date.today()
+    contesto.progresso(0.0, messaggio='Rollover in corso')
+    res = do_monthly_rollover(force=bool(force), months=int(months), base_date=giorno)
+    if marker:
+        registra_marker_rollover(marker)
+    return res
+
+
+@tipo_job('riconciliazione_paypal', max_tentativi=3, giornaliero=True)
+def job_riconciliazione_paypal(contesto, giorno=None):
+    """Riconciliazione giornaliera delle rate PayPal (`riconcilia_rate_paypal`)."""
+    from app.services.paypal.riconciliazione_service import riconcilia_rate_paypal
+    contesto.progresso(0.0, messaggio='Riconciliazione in corso')
+    res = riconcilia_rate_paypal(oggi=date.fromisoformat(giorno) if giorno else None)
+    if 'error' in res:
+        raise RuntimeError(res['error'])
+    return res
+
+
+@tipo_job('export_xlsx')
+def job_export_xlsx(contesto):
+    """Export XLSX di transazioni, archivio e saldi su file scaricabile."""
+    from app.services.transazioni.export_service import export_dati_finanziari
+    contesto.progresso(0.0, messaggio='Export in corso')
+    nome = f"bilancio_{date.today().strftime('%Y%m%d')}.xlsx"
+    percorso = contesto.file_output(nome)
+    with export_dati_finanziari() as buffer, open(percorso, 'wb') as f:
+        shutil.copyfileobj(buffer, f)
+    return {'file': percorso, 'nome': nome}
+
+
+@tipo_job('backup', max_tentativi=3)
+def job_backup(contesto, motivo='job'):
+    """Backup online del database (`BackupService.crea_backup`)."""
+    from app.services.backup.backup_service import BackupService
+    contesto.progresso(0.0, messaggio='Backup in corso')
+    ok, msg, info = BackupService().crea_backup(motivo=motivo)
+    if not ok:
+        raise RuntimeError(msg)
+    return info
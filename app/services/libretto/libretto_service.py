@@ -1,9 +1,21 @@
 """Servizio per la gestione del Libretto Smart"""
+import threading
+
+import numpy as np
+from sqlalchemy import select, func, case
+
 from app import db
 from app.models.Libretto import Libretto
 from app.models.Supersmart import Supersmart
 from datetime import datetime, date
 
+# Ritenuta fiscale sugli interessi dei depositi Supersmart
+RITENUTA_INTERESSI = 0.26
+
+# Scadenziario per libretto: libretto_id -> (impronta dei depositi, giorno, risultato)
+_cache_scadenziario = {}
+_cache_lock = threading.Lock()
+
 
 class LibrettoService:
     """Servizio per gestire le operazioni sul Libretto Smart"""
@@ -40,11 +52,15 @@ class LibrettoService:
         """Recupera i depositi del libretto"""
         query = Supersmart.query.filter_by(libretto_id=libretto_id)
         
+        oggi = date.today()
         if solo_attivi:
-            oggi = date.today()
             query = query.filter(Supersmart.data_scadenza >= oggi)
-        
-        return query.order_by(Supersmart.data_scadenza.desc()).all()
+
+        depositi = query.order_by(Supersmart.data_scadenza.desc()).all()
+        # Stato di scadenza calcolato una sola volta per tutte le righe
+        for d in depositi:
+            d.annota_scadenza(oggi)
+        return depositi
     
     def crea_deposito(self, libretto_id, descrizione, data_attivazione, data_scadenza, 
                       tasso, deposito, netto):
@@ -96,22 +112,99 @@ class LibrettoService:
         db.session.commit()
         return True
     
-    def get_statistiche(self, libretto_id):
-        """Calcola statistiche sui depositi"""
-        depositi = self.get_depositi(libretto_id)
-        depositi_attivi = self.get_depositi(libretto_id, solo_attivi=True)
-        
-        totale_depositato_attivo = sum(d.deposito for d in depositi_attivi)
-        totale_netto_attivo = sum(d.netto for d in depositi_attivi)
-        totale_depositato_storico = sum(d.deposito for d in depositi)
-        totale_netto_storico = sum(d.netto for d in depositi)
-        
+    def get_statistiche(self, libretto_id, oggi=None):
+        """Calcola statistiche sui depositi con un'unica query aggregata"""
+        if oggi is None:
+            oggi = date.today()
+        attivo = Supersmart.data_scadenza >= oggi
+        row = db.session.execute(
+            select(
+                func.count(Supersmart.id),
+                func.coalesce(func.sum(Supersmart.deposito), 0.0),
+                func.coalesce(func.sum(Supersmart.netto), 0.0),
+                func.coalesce(func.sum(case((attivo, 1), else_=0)), 0),
+                func.coalesce(func.sum(case((attivo, Supersmart.deposito), else_=0.0)), 0.0),
+                func.coalesce(func.sum(case((attivo, Supersmart.netto), else_=0.0)), 0.0),
+            ).where(Supersmart.libretto_id == libretto_id)
+        ).one()
+        numero_totali, depositato_storico, netto_storico, numero_attivi, depositato_attivo, netto_attivo = row
+
         return {
-            'numero_depositi_attivi': len(depositi_attivi),
-            'numero_depositi_totali': len(depositi),
-            'totale_depositato_attivo': totale_depositato_attivo,
-            'totale_netto_attivo': totale_netto_attivo,
-            'totale_a_scadenza_attivo': totale_depositato_attivo + totale_netto_attivo,
-            'totale_depositato_storico': totale_depositato_storico,
-            'totale_netto_storico': totale_netto_storico,
+            'numero_depositi_attivi': int(numero_attivi),
+            'numero_depositi_totali': int(numero_totali),
+            'totale_depositato_attivo': float(depositato_attivo),
+            'totale_netto_attivo': float(netto_attivo),
+            'totale_a_scadenza_attivo': float(depositato_attivo) + float(netto_attivo),
+            'totale_depositato_storico': float(depositato_storico),
+            'totale_netto_storico': float(netto_storico),
         }
+
+    def _impronta_depositi(self, libretto_id):
+        """Impronta dei depositi: cambia a ogni inserimento, modifica o eliminazione."""
+        return tuple(db.session.execute(
+            select(func.count(Supersmart.id), func.max(Supersmart.id), func.max(Supersmart.data_aggiornamento),
+                   func.total(Supersmart.id))
+            .where(Supersmart.libretto_id == libretto_id)
+        ).one())
+
+    def get_scadenziario(self, libretto_id, oggi=None):
+        """Scadenziario dei depositi attivi: flussi di cassa per mese di scadenza.
+
+        Interessi lordi da `tasso` (capitalizzazione semplice, giorni/365) e netti
+        al netto della ritenuta; se il deposito ha già un `netto` registrato si usa
+        quello. Il risultato resta in cache finché i depositi non cambiano.
+        """
+        if oggi is None:
+            oggi = date.today()
+        impronta = self._impronta_depositi(libretto_id)
+        with _cache_lock:
+            cached = _cache_scadenziario.get(libretto_id)
+            if cached and cached[0] == impronta and cached[1] == oggi:
+                return cached[2]
+
+        righe = db.session.execute(
+            select(Supersmart.data_attivazione, Supersmart.data_scadenza, Supersmart.tasso,
+                   Supersmart.deposito, Supersmart.netto)
+            .where(Supersmart.libretto_id == libretto_id, Supersmart.data_scadenza >= oggi)
+        ).all()
+        risultato = {'mesi': [], 'totale_capitale': 0.0, 'totale_interessi_netti': 0.0, 'tasso_medio_ponderato': None}
+        if righe:
+            attivazione = np.array([r[0].toordinal() for r in righe])
+            scadenza = np.array([r[1].toordinal() for r in righe])
+            tasso = np.array([float(r[2] or 0) for r in righe])
+            capitale = np.array([float(r[3] or 0) for r in righe])
+            netto_registrato = np.array([float(r[4] or 0) for r in righe])
+            mese = np.array([r[1].year * 100 + r[1].month for r in righe])
+
+            durata = np.maximum(scadenza - attivazione, 0)
+            lordi = capitale * tasso / 100.0 * durata / 365.0
+            netti = np.where(netto_registrato > 0, netto_registrato, lordi * (1 - RITENUTA_INTERESSI))
+
+            mesi, idx = np.unique(mese, return_inverse=True)
+            capitale_mese = np.bincount(idx, weights=capitale)
+            lordi_mese = np.bincount(idx, weights=lordi)
+            netti_mese = np.bincount(idx, weights=netti)
+            numero_mese = np.bincount(idx)
+            totale_mese = capitale_mese + netti_mese
+            cumulato = np.cumsum(totale_mese)
+
+            risultato['mesi'] = [
+                {
+                    'mese': f"{m // 100:04d}-{m % 100:02d}",
+                    'numero_depositi': int(numero_mese[i]),
+                    'capitale': round(float(capitale_mese[i]), 2),
+                    'interessi_lordi': round(float(lordi_mese[i]), 2),
+                    'interessi_netti': round(float(netti_mese[i]), 2),
+                    'totale': round(float(totale_mese[i]), 2),
+                    'cumulato': round(float(cumulato[i]), 2),
+                }
+                for i, m in enumerate(mesi)
+            ]
+            risultato['totale_capitale'] = round(float(capitale.sum()), 2)
+            risultato['totale_interessi_netti'] = round(float(netti.sum()), 2)
+            if capitale.sum() > 0:
+                risultato['tasso_medio_ponderato'] = round(float(np.average(tasso, weights=capitale)), 4)
+
+        with _cache_lock:
+            _cache_scadenziario[libretto_id] = (impronta, oggi, risultato)
+        return risultato
@@ -1,2 +1,4 @@
 # package marker for passwd_manager service
 from .passwd_manager_service import *
+from .key_rotation_service import *  # noqa: F401,F403
+from .chiavi_sessione import *  # noqa: F401,F403
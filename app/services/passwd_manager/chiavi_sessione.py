@@ -0,0 +1,179 @@
+"""Derivazione della chiave fuori dal thread della richiesta e chiavi del vault per sessione.
+
+PBKDF2 gira su un pool di thread limitato (`VAULT_KDF_WORKER`): la primitiva di
+`cryptography` rilascia il GIL, quindi le altre richieste continuano a essere
+servite. Le derivazioni in attesa sono limitate da `VAULT_KDF_CODA`: oltre,
+il login viene rifiutato invece di accumulare lavoro (e tentativi).
+
+Dopo il login la chiave derivata non viene ricalcolata: è salvata in
+`vault_sessioni` cifrata con un token casuale che sta solo nel cookie di
+sessione. Qualsiasi worker (thread o processo) ricostruisce il cipher dal
+token e dalla riga, senza conoscere la password; una cache in memoria evita
+anche quella lettura. Le chiavi scadono dopo `PERMANENT_SESSION_LIFETIME` di
+inattività (scadenza prorogata a ogni uso) e sono eliminate al logout.
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cryptography.fernet import Fernet, InvalidToken
+from flask import current_app, has_request_context, session
+from sqlalchemy import select, update
+
+from app import db
+from app.models.PasswdSecurityConfig import PasswdVaultSessione
+
+logger = logging.getLogger(__name__)
+
+CHIAVE_SESSIONE = 'vault_token'
+TTL_DEFAULT = timedelta(minutes=3)
+
+_executor = None
+_executor_lock = threading.Lock()
+_posti_coda = None
+
+_cache = {}  # id -> (cipher, scadenza monotonic)
+_cache_lock = threading.Lock()
+
+
+class DerivazioneOccupata(Exception):
+    """Troppe derivazioni di chiave già in attesa."""
+
+
+def _config(chiave, default):
+    try:
+        return current_app.config.get(chiave, default)
+    except RuntimeError:
+        return default
+
+
+def _pool():
+    global _executor, _posti_coda
+    with _executor_lock:
+        if _executor is None:
+            worker = max(1, int(_config('VAULT_KDF_WORKER', 2)))
+            _executor = ThreadPoolExecutor(max_workers=worker, thread_name_prefix='vault-kdf')
+            _posti_coda = threading.BoundedSemaphore(worker + max(0, int(_config('VAULT_KDF_CODA', 4))))
+        return _executor, _posti_coda
+
+
+def deriva_chiave(funzione, *args):
+    """Esegue la derivazione `funzione(*args)` sul pool KDF e ne attende il risultato.
+
+    Solleva DerivazioneOccupata se il pool ha già troppe richieste in attesa.
+    """
+    executor, posti = _pool()
+    if not posti.acquire(blocking=False):
+        raise DerivazioneOccupata()
+    try:
+        futuro = executor.submit(funzione, *args)
+    except Exception:
+        posti.release()
+        raise
+    futuro.add_done_callback(lambda _f: posti.release())
+    return futuro.result(timeout=float(_config('VAULT_KDF_TIMEOUT', 30)))
+
+
+def _ttl():
+    ttl = _config('PERMANENT_SESSION_LIFETIME', TTL_DEFAULT)
+    return ttl if isinstance(ttl, timedelta) else timedelta(seconds=float(ttl or TTL_DEFAULT.total_seconds()))
+
+
+def _id_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def registra_chiave(chiave):
+    """Associa la chiave derivata alla sessione corrente; ritorna il cipher."""
+    token = Fernet.generate_key().decode()
+    ttl = _ttl()
+    riga = PasswdVaultSessione(
+        id=_id_token(token),
+        chiave_cifrata=Fernet(token.encode()).encrypt(chiave).decode(),
+        scadenza=datetime.utcnow() + ttl,
+    )
+    try:
+        PasswdVaultSessione.query.filter(PasswdVaultSessione.scadenza < datetime.utcnow()).delete()
+        db.session.add(riga)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Chiave di sessione del vault non salvata: %s', e)
+    cipher = Fernet(chiave)
+    with _cache_lock:
+        _cache[riga.id] = (cipher, time.monotonic() + ttl.total_seconds())
+    session[CHIAVE_SESSIONE] = token
+    return cipher
+
+
+def cipher_sessione():
+    """Cipher della sessione corrente, o None se il vault non è sbloccato per questa sessione."""
+    if not has_request_context():
+        return None
+    token = session.get(CHIAVE_SESSIONE)
+    if not token:
+        return None
+    rid, ttl, ora = _id_token(token), _ttl(), time.monotonic()
+    with _cache_lock:
+        voce = _cache.get(rid)
+    # La scadenza in cache è quella salvata su DB: la si proroga (una scrittura)
+    # solo quando è trascorsa metà della durata
+    if voce and voce[1] - ora > ttl.total_seconds() / 2:
+        return voce[0]
+    # Connessione propria: chiamata anche a metà di una modifica del chiamante
+    # (encrypt_data), la cui sessione non va né confermata né annullata
+    tabella = PasswdVaultSessione.__table__
+    try:
+        with db.engine.begin() as conn:
+            riga = conn.execute(
+                select(tabella.c.chiave_cifrata, tabella.c.scadenza).where(tabella.c.id == rid)
+            ).fetchone()
+            if riga is None or riga.scadenza < datetime.utcnow():
+                _dimentica(rid)
+                return None
+            cipher = Fernet(Fernet(token.encode()).decrypt(riga.chiave_cifrata.encode()))
+            conn.execute(update(tabella).where(tabella.c.id == rid).values(scadenza=datetime.utcnow() + ttl))
+    except (InvalidToken, ValueError):
+        _dimentica(rid)
+        return None
+    except Exception as e:
+        logger.warning('Lettura della chiave di sessione del vault non riuscita: %s', e)
+        return voce[0] if voce and voce[1] > ora else None
+    with _cache_lock:
+        _cache[rid] = (cipher, ora + ttl.total_seconds())
+    return cipher
+
+
+def _dimentica(rid):
+    with _cache_lock:
+        _cache.pop(rid, None)
+
+
+def revoca_sessione():
+    """Elimina la chiave della sessione corrente (logout)."""
+    if not has_request_context():
+        return
+    token = session.pop(CHIAVE_SESSIONE, None)
+    if not token:
+        return
+    rid = _id_token(token)
+    _dimentica(rid)
+    try:
+        PasswdVaultSessione.query.filter_by(id=rid).delete()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+
+def revoca_tutte():
+    """Elimina le chiavi di tutte le sessioni (dopo una rotazione della chiave master)."""
+    with _cache_lock:
+        _cache.clear()
+    try:
+        PasswdVaultSessione.query.delete()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
@@ -0,0 +1,219 @@
+"""Rotazione della chiave master del password manager (cambio password o parametri PBKDF2).
+
+Le credenziali vengono ricifrate a blocchi: la lettura e la scrittura sul DB
+avvengono nel thread della richiesta, mentre decifratura e cifratura sono
+distribuite su un pool di thread (le primitive di `cryptography` rilasciano il
+GIL). I valori ricifrati vengono salvati in `credentials_rotation` con un
+commit per blocco, così una rotazione interrotta può riprendere dal punto in
+cui si era fermata. Lo swap finale di credenziali e `security_config` avviene
+in un'unica transazione.
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import text
+
+from app import db
+from app.models.PasswdSecurityConfig import PasswdSecurityConfig
+from app.models.PasswdKeyRotation import PasswdKeyRotation, PasswdRotationStaging
+from app.services.passwd_manager import passwd_manager_service as pm
+from app.services.passwd_manager.vault_cache import vault_cache
+from app.services.passwd_manager.chiavi_sessione import DerivazioneOccupata, registra_chiave, revoca_tutte
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+MAX_WORKERS = 4
+
+# Righe ancora da ricifrare (nessuna copia in staging)
+_PENDING_SQL = """
+SELECT c.id, c.password, c.altro FROM credentials c
+WHERE NOT EXISTS (SELECT 1 FROM credentials_rotation r WHERE r.credential_id = c.id)
+ORDER BY c.id
+LIMIT :limit
+"""
+
+
+def ensure_security_config_columns():
+    """Aggiunge la colonna `iterations` a security_config se mancante (migrazione best-effort)."""
+    try:
+        cols = [r[1] for r in db.session.execute(text("PRAGMA table_info('security_config');")).fetchall()]
+        if cols and 'iterations' not in cols:
+            db.session.execute(text("ALTER TABLE security_config ADD COLUMN iterations INTEGER"))
+            db.session.commit()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
+
+
+def _ricifra(old_cipher, new_cipher, valore):
+    if not valore:
+        return valore
+    try:
+        return new_cipher.encrypt(old_cipher.decrypt(valore.encode())).decode()
+    except InvalidToken:
+        # Valore non decifrabile già con la vecchia chiave: lo si conserva com'è
+        return valore
+
+
+def _ricifra_blocco(old_cipher, new_cipher, righe):
+    """Eseguito nei worker: nessun accesso al DB, solo crittografia."""
+    return [
+        {'credential_id': cid, 'password': _ricifra(old_cipher, new_cipher, pw), 'altro': _ricifra(old_cipher, new_cipher, altro)}
+        for cid, pw, altro in righe
+    ]
+
+
+def get_rotation_status():
+    """Stato della rotazione in corso (o None) per il reporting dell'avanzamento."""
+    stato = PasswdKeyRotation.query.order_by(PasswdKeyRotation.id.desc()).first()
+    if not stato:
+        return None
+    return {
+        'stato': stato.stato,
+        'totale': stato.totale,
+        'processate': stato.processate,
+        'percentuale': round(100.0 * stato.processate / stato.totale, 1) if stato.totale else 100.0,
+        'started_at': stato.started_at.isoformat() if stato.started_at else None,
+        'updated_at': stato.updated_at.isoformat() if stato.updated_at else None,
+    }
+
+
+def _prepara_rotazione(new_password, iterations):
+    """Crea lo stato della rotazione oppure verifica la nuova password per riprenderla."""
+    stato = PasswdKeyRotation.query.filter_by(stato='in_corso').first()
+    if stato:
+        new_key = pm.derive_key_off_thread(new_password, stato.new_salt, stato.new_iterations)
+        try:
+            if Fernet(new_key).decrypt(stato.new_test_encrypted.encode()).decode() != 'test_string':
+                raise InvalidToken()
+        except InvalidToken:
+            return None, None, "La nuova password non corrisponde alla rotazione in corso"
+        return stato, new_key, None
+
+    # Nuova rotazione: eventuali residui di staging non sono più validi
+    PasswdRotationStaging.query.delete()
+    salt = os.urandom(16)
+    iterations = int(iterations or pm.PBKDF2_ITERATIONS)
+    new_key = pm.derive_key_off_thread(new_password, salt, iterations)
+    new_cipher = Fernet(new_key)
+    stato = PasswdKeyRotation(
+        new_salt=salt,
+        new_iterations=iterations,
+        new_test_encrypted=new_cipher.encrypt(b'test_string').decode(),
+        stato='in_corso',
+        totale=db.session.execute(text("SELECT COUNT(*) FROM credentials")).scalar() or 0,
+        processate=0,
+    )
+    db.session.add(stato)
+    db.session.commit()
+    return stato, new_key, None
+
+
+def _processa_pendenti(stato, old_cipher, new_cipher, executor, batch_size, max_workers, progress_cb=None):
+    """Ricifra a blocchi le righe senza staging, con commit e avanzamento per blocco."""
+    while True:
+        righe = db.session.execute(text(_PENDING_SQL), {'limit': batch_size}).fetchall()
+        if not righe:
+            return
+        passo = max(1, -(-len(righe) // max_workers))
+        blocchi = [righe[i:i + passo] for i in range(0, len(righe), passo)]
+        staged = []
+        for parziale in executor.map(lambda b: _ricifra_blocco(old_cipher, new_cipher, b), blocchi):
+            staged.extend(parziale)
+
+        db.session.execute(
+            text("INSERT OR REPLACE INTO credentials_rotation (credential_id, password, altro) "
+                 "VALUES (:credential_id, :password, :altro)"),
+            staged,
+        )
+        stato.totale = db.session.execute(text("SELECT COUNT(*) FROM credentials")).scalar() or 0
+        stato.processate = db.session.execute(text("SELECT COUNT(*) FROM credentials_rotation")).scalar() or 0
+        db.session.commit()
+        if progress_cb:
+            try:
+                progress_cb(stato.processate, stato.totale)
+            except Exception:
+                pass
+
+
+def rotate_master_key(old_password, new_password, iterations=None,
+                      batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, progress_cb=None):
+    """Ricifra tutte le credenziali con una nuova password master e/o nuove iterazioni PBKDF2.
+
+    Ritorna (bool, messaggio). Se interrotta, richiamarla con le stesse password
+    riprende dai blocchi non ancora elaborati.
+    """
+    if not new_password:
+        return False, "La nuova password è obbligatoria"
+    # La rotazione non deve indebolire la derivazione dell'intero vault
+    if iterations is not None and int(iterations) < pm.PBKDF2_ITERATIONS:
+        return False, f"Le iterazioni PBKDF2 non possono essere inferiori a {pm.PBKDF2_ITERATIONS}"
+
+    ensure_security_config_columns()
+    cfg = PasswdSecurityConfig.query.filter_by(id=1).first()
+    if not cfg or not cfg.salt or not cfg.test_encrypted:
+        return False, "Password Manager non configurato"
+
+    try:
+        old_cipher = Fernet(pm.derive_key_off_thread(old_password or '', cfg.salt, cfg.iterations))
+    except DerivazioneOccupata:
+        return False, "Troppe operazioni in corso, riprovare tra poco"
+    try:
+        if old_cipher.decrypt(cfg.test_encrypted.encode()).decode() != 'test_string':
+            return False, "Password attuale non valida"
+    except InvalidToken:
+        return False, "Password attuale non valida"
+
+    try:
+        stato, new_key, errore = _prepara_rotazione(new_password, iterations)
+        if errore:
+            return False, errore
+        new_cipher = Fernet(new_key)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _processa_pendenti(stato, old_cipher, new_cipher, executor, batch_size, max_workers, progress_cb)
+
+            # Swap atomico: ultime righe modificate nel frattempo + credenziali + security_config
+            righe = db.session.execute(text(_PENDING_SQL), {'limit': -1}).fetchall()
+            if righe:
+                db.session.execute(
+                    text("INSERT OR REPLACE INTO credentials_rotation (credential_id, password, altro) "
+                         "VALUES (:credential_id, :password, :altro)"),
+                    _ricifra_blocco(old_cipher, new_cipher, righe),
+                )
+
+        db.session.execute(text("""
+            UPDATE credentials SET
+                password = (SELECT r.password FROM credentials_rotation r WHERE r.credential_id = credentials.id),
+                altro = (SELECT r.altro FROM credentials_rotation r WHERE r.credential_id = credentials.id)
+            WHERE id IN (SELECT credential_id FROM credentials_rotation)
+        """))
+        cfg.salt = stato.new_salt
+        cfg.iterations = stato.new_iterations
+        cfg.test_encrypted = stato.new_test_encrypted
+        db.session.execute(text("DELETE FROM credentials_rotation"))
+        stato.stato = 'completata'
+        stato.processate = stato.totale = db.session.execute(text("SELECT COUNT(*) FROM credentials")).scalar() or 0
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Rotazione chiave non riuscita: %s', e)
+        return False, f"Rotazione interrotta: {str(e)}. Riprovare per riprendere."
+
+    # Le chiavi delle altre sessioni non valgono più; questa resta sbloccata con la nuova
+    revoca_tutte()
+    registra_chiave(new_key)
+    vault_cache.purge()
+    if progress_cb:
+        try:
+            progress_cb(stato.processate, stato.totale)
+        except Exception:
+            pass
+    return True, f"Chiave ruotata: {stato.processate} credenziali ricifrate"
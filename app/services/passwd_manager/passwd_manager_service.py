@@ -10,41 +10,55 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
 from app.models.PasswdCredential import PasswdCredential
 from app.models.PasswdSecurityConfig import PasswdSecurityConfig
+from app.services.passwd_manager.vault_cache import vault_cache
+from app.services.passwd_manager.chiavi_sessione import (
+    DerivazioneOccupata, cipher_sessione, deriva_chiave, registra_chiave, revoca_sessione
+)
 from typing import Optional
-import os
-import tempfile
-import openpyxl
+from app.utils.xlsx_export import write_xlsx
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Module-level cipher (similar behaviour to original project)
-_cipher: Optional[Fernet] = None
+# Iterazioni PBKDF2 di default (security_config.iterations NULL usa questo valore)
+PBKDF2_ITERATIONS = 100000
 
 
-def derive_key_from_password(password: str, salt: bytes) -> bytes:
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=100000)
+def derive_key_from_password(password: str, salt: bytes, iterations: Optional[int] = None) -> bytes:
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations or PBKDF2_ITERATIONS)
     key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
     return key
 
 
+def derive_key_off_thread(password: str, salt: bytes, iterations: Optional[int] = None) -> bytes:
+    """`derive_key_from_password` eseguita sul pool KDF limitato (vedi chiavi_sessione)."""
+    return deriva_chiave(derive_key_from_password, password, salt, iterations)
+
+
 def initialize_encryption(password: str) -> bool:
     """Initialize cipher using password and the stored security config.
 
     Returns True when the provided password unlocks the stored `test_encrypted`.
+    La chiave derivata resta associata alla sessione corrente: le richieste
+    successive (anche su altri worker) non ripetono PBKDF2.
     """
-    global _cipher
     try:
         cfg = PasswdSecurityConfig.query.filter_by(id=1).first()
         if not cfg or not cfg.salt or not cfg.test_encrypted:
             return False
 
-        key = derive_key_from_password(password, cfg.salt)
+        try:
+            key = derive_key_off_thread(password or '', cfg.salt, cfg.iterations)
+        except DerivazioneOccupata:
+            logger.warning('initialize_encryption: troppe derivazioni di chiave in attesa')
+            return False
         test_cipher = Fernet(key)
         try:
             test_data = test_cipher.decrypt(cfg.test_encrypted.encode()).decode()
             if test_data == 'test_string':
-                _cipher = test_cipher
+                registra_chiave(key)
+                # Nuovo sblocco: nessun dato della sessione precedente resta in cache
+                vault_cache.purge()
                 return True
         except Exception:
             return False
@@ -54,7 +68,13 @@ def initialize_encryption(password: str) -> bool:
 
 
 def is_initialized() -> bool:
-    return _cipher is not None
+    return cipher_sessione() is not None
+
+
+def lock_vault():
+    """Blocca il vault: dimentica la chiave della sessione e svuota la cache delle credenziali."""
+    revoca_sessione()
+    vault_cache.purge()
 
 
 def has_security_config() -> bool:
@@ -63,23 +83,34 @@ def has_security_config() -> bool:
 
 
 def encrypt_data(data: str) -> str:
-    if not data or not _cipher:
+    cipher = cipher_sessione() if data else None
+    if not cipher:
         return ''
     try:
-        return _cipher.encrypt(data.encode()).decode()
+        return cipher.encrypt(data.encode()).decode()
     except Exception:
         return ''
 
 
 def decrypt_data(encrypted_data: str) -> str:
-    if not encrypted_data or not _cipher:
+    cipher = cipher_sessione() if encrypted_data else None
+    if not cipher:
         return ''
     try:
-        return _cipher.decrypt(encrypted_data.encode()).decode()
+        return cipher.decrypt(encrypted_data.encode()).decode()
     except Exception:
         return ''
 
 
+def _discard_rotation_staging(credential_id):
+    """Scarta la copia ricifrata di una credenziale modificata durante una rotazione chiave."""
+    try:
+        from app.models.PasswdKeyRotation import PasswdRotationStaging
+        PasswdRotationStaging.query.filter_by(credential_id=credential_id).delete()
+    except Exception:
+        pass
+
+
 def init_database_if_needed():
     """Create tables (if needed). This relies on db.create_all() being called
     from the app factory; kept for compatibility with tests or direct calls."""
@@ -87,10 +118,23 @@ def init_database_if_needed():
 
 
 def get_all_credentials():
+    """Tutte le credenziali con password e altro in chiaro (usato dall'export)."""
     if not is_initialized():
         return []
-    rows = PasswdCredential.query.order_by(PasswdCredential.categoria, PasswdCredential.servizio).all()
-    return [r.to_decrypted_dict(decrypt_data) for r in rows]
+    return [vault_cache.get_decrypted(r['id'], decrypt_data) for r in vault_cache.list()]
+
+
+def list_credentials(category_filter=None):
+    """Elenco credenziali senza decifrare: password/altro sono indicati da HAS_PASSWORD/HAS_ALTRO."""
+    if not is_initialized():
+        return []
+    return vault_cache.list(category_filter)
+
+
+def count_credentials_by_category():
+    if not is_initialized():
+        return {}
+    return vault_cache.count_by_category()
 
 
 def add_credential(categoria, servizio, utenza, password, altro):
@@ -101,6 +145,7 @@ def add_credential(categoria, servizio, utenza, password, altro):
     c = PasswdCredential(categoria=categoria, servizio=servizio, utenza=utenza or '', password=pw_enc, altro=altro_enc)
     db.session.add(c)
     db.session.commit()
+    vault_cache.invalidate()
     return c.id
 
 
@@ -109,7 +154,9 @@ def delete_credential(credential_id):
     if not c:
         return False
     db.session.delete(c)
+    _discard_rotation_staging(credential_id)
     db.session.commit()
+    vault_cache.invalidate()
     return True
 
 
@@ -124,21 +171,17 @@ def update_credential(credential_id, categoria, servizio, utenza, password, altr
     c.utenza = utenza or ''
     c.password = encrypt_data(password or '')
     c.altro = encrypt_data(altro or '')
+    _discard_rotation_staging(credential_id)
     db.session.commit()
+    vault_cache.invalidate()
     return True
 
 
 def search_credentials(query, category_filter=None):
+    """Ricerca su categoria, servizio e utenza tramite l'indice in memoria (senza decifrare)."""
     if not is_initialized():
         return []
-    q = PasswdCredential.query
-    if query:
-        like = f"%{query.lower()}%"
-        q = q.filter(db.or_(db.func.lower(PasswdCredential.categoria).like(like), db.func.lower(PasswdCredential.servizio).like(like)))
-    if category_filter:
-        q = q.filter_by(categoria=category_filter)
-    rows = q.order_by(PasswdCredential.categoria, PasswdCredential.servizio).all()
-    return [r.to_decrypted_dict(decrypt_data) for r in rows]
+    return vault_cache.search(query, category_filter)
 
 
 def get_categories():
@@ -161,53 +204,30 @@ def get_credential_by_id(credential_id):
 
 
 def get_credential_by_id_decrypted(credential_id):
-    c = PasswdCredential.query.get(credential_id)
-    if not c:
+    if not is_initialized():
+        return None
+    return vault_cache.get_decrypted(credential_id, decrypt_data)
+
+
+def reveal_credential_field(credential_id, campo):
+    """Decifra un singolo campo ('password' o 'altro') della credenziale."""
+    if not is_initialized():
         return None
-    return c.to_decrypted_dict(decrypt_data)
+    return vault_cache.reveal(credential_id, campo, decrypt_data)
 
 
 def export_to_xlsx(protection_password=None):
-    """Export all decrypted credentials to a temporary xlsx file.
+    """Export all decrypted credentials to a temporary xlsx file (write-only mode).
 
-    If msoffcrypto is installed and protection_password is provided, it will try
-    to protect the file.
+    If protection_password is provided the buffer is encrypted before being
+    returned. Returns None on failure, including when encryption is not
+    possible (the export is never returned in plaintext).
     """
     try:
-        data = get_all_credentials()
-        rows = [(r['CATEGORIA'], r['SERVIZIO'], r['UTENZA'], r['PASSWORD'], r['ALTRO']) for r in data]
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Password Database'
         headers = ['CATEGORIA', 'SERVIZIO', 'UTENZA', 'PASSWORD', 'ALTRO']
-        for i, h in enumerate(headers, 1):
-            ws.cell(row=1, column=i, value=h)
-        for r_idx, row in enumerate(rows, 2):
-            for c_idx, val in enumerate(row, 1):
-                ws.cell(row=r_idx, column=c_idx, value=val)
-
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-        wb.save(tmp.name)
-
-        # try to protect with msoffcrypto if requested
-        if protection_password:
-            try:
-                import msoffcrypto
-                import io
-                with open(tmp.name, 'rb') as f:
-                    office_file = msoffcrypto.OfficeFile(f)
-                    # produce protected file
-                    protected_tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-                    with open(protected_tmp.name, 'wb') as out_f:
-                        office_file.encrypt(protection_password, out_f)
-                    os.unlink(tmp.name)
-                    return protected_tmp.name
-            except Exception:
-                logger.exception('msoffcrypto not available or encryption failed')
-                return tmp.name
-
-        return tmp.name
+        rows = ((r['CATEGORIA'], r['SERVIZIO'], r['UTENZA'], r['PASSWORD'], r['ALTRO'])
+                for r in (vault_cache.get_decrypted(i['id'], decrypt_data) for i in list_credentials()))
+        return write_xlsx([('Password Database', headers, rows)], protection_password=protection_password)
     except Exception:
         logger.exception('export_to_xlsx failed')
         return None
@@ -0,0 +1,212 @@
+"""Cache in memoria del vault sbloccato per il password manager.
+
+Conserva le credenziali così come sono nel DB (password e altro ancora cifrati)
+e le decifra solo quando un campo viene effettivamente rivelato, memorizzando il
+risultato. Mantiene un indice n-gram (1-3 caratteri) su categoria, servizio e
+utenza per la ricerca. La cache scade dopo `PERMANENT_SESSION_LIFETIME` di
+inattività e viene svuotata al blocco (logout) o a un nuovo sblocco.
+"""
+import threading
+import time
+from datetime import timedelta
+
+from app.models.PasswdCredential import PasswdCredential
+
+# Campi indicizzati per la ricerca e campi cifrati decifrati su richiesta
+CAMPI_INDICE = ('categoria', 'servizio', 'utenza')
+CAMPI_CIFRATI = ('password', 'altro')
+
+# Lunghezza massima degli n-gram indicizzati (trigrammi)
+MAX_NGRAM = 3
+
+# Durata di default se l'app non è disponibile (allineata a config.PERMANENT_SESSION_LIFETIME)
+TTL_DEFAULT = timedelta(minutes=3)
+
+
+def _ngrams(testo, n):
+    return {testo[i:i + n] for i in range(len(testo) - n + 1)}
+
+
+class VaultCache:
+    """Vault sbloccato: elenco credenziali, indice di ricerca e campi decifrati."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._voci = None       # id -> dict con campi in chiaro e cifrati
+        self._ordine = []       # id ordinati per categoria, servizio
+        self._indice = {}       # n-gram -> set(id)
+        self._decifrati = {}    # (id, campo) -> valore in chiaro
+        self._scadenza = 0.0
+        self._timer = None
+
+    # === Ciclo di vita ===
+
+    def _ttl_secondi(self):
+        try:
+            from flask import current_app
+            ttl = current_app.config.get('PERMANENT_SESSION_LIFETIME', TTL_DEFAULT)
+        except Exception:
+            ttl = TTL_DEFAULT
+        if isinstance(ttl, timedelta):
+            return ttl.total_seconds()
+        return float(ttl or TTL_DEFAULT.total_seconds())
+
+    def _tocca(self):
+        self._scadenza = time.monotonic() + self._ttl_secondi()
+        if self._timer is None:
+            self._programma_purge(self._ttl_secondi())
+
+    def _programma_purge(self, ritardo):
+        # Timer unico: allo scadere svuota la cache se non è stata usata nel frattempo
+        self._timer = threading.Timer(max(ritardo, 1.0), self._purge_se_scaduta)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _purge_se_scaduta(self):
+        with self._lock:
+            self._timer = None
+            if self._voci is None:
+                return
+            residuo = self._scadenza - time.monotonic()
+            if residuo <= 0:
+                self.purge()
+            else:
+                self._programma_purge(residuo)
+
+    def purge(self):
+        """Svuota completamente la cache (blocco del vault o scadenza)."""
+        with self._lock:
+            self._voci = None
+            self._ordine = []
+            self._indice = {}
+            self._decifrati = {}
+            self._scadenza = 0.0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def invalidate(self):
+        """Scarta i dati caricati dopo una modifica: verranno ricaricati al prossimo accesso."""
+        self.purge()
+
+    def _carica(self):
+        """Carica le credenziali (senza decifrare) e costruisce l'indice n-gram."""
+        if self._voci is not None and time.monotonic() < self._scadenza:
+            return
+        if self._voci is not None:
+            # Scaduta per inattività
+            self.purge()
+
+        rows = PasswdCredential.query.order_by(PasswdCredential.categoria, PasswdCredential.servizio).all()
+        voci = {}
+        indice = {}
+        for r in rows:
+            voce = {
+                'id': r.id,
+                'CATEGORIA': r.categoria,
+                'SERVIZIO': r.servizio,
+                'UTENZA': r.utenza,
+                'password': r.password,
+                'altro': r.altro,
+            }
+            voci[r.id] = voce
+            for campo in CAMPI_INDICE:
+                testo = (getattr(r, campo) or '').lower()
+                for n in range(1, MAX_NGRAM + 1):
+                    for g in _ngrams(testo, n):
+                        indice.setdefault(g, set()).add(r.id)
+        self._voci = voci
+        self._ordine = [r.id for r in rows]
+        self._indice = indice
+        self._decifrati = {}
+
+    # === Lettura ===
+
+    def _elenco(self, voce):
+        return {
+            'id': voce['id'],
+            'CATEGORIA': voce['CATEGORIA'],
+            'SERVIZIO': voce['SERVIZIO'],
+            'UTENZA': voce['UTENZA'],
+            'HAS_PASSWORD': bool(voce['password']),
+            'HAS_ALTRO': bool(voce['altro']),
+        }
+
+    def list(self, category_filter=None):
+        """Elenco credenziali senza campi cifrati (solo indicatori di presenza)."""
+        with self._lock:
+            self._carica()
+            self._tocca()
+            voci = (self._voci[i] for i in self._ordine)
+            if category_filter:
+                voci = (v for v in voci if v['CATEGORIA'] == category_filter)
+            return [self._elenco(v) for v in voci]
+
+    def search(self, query, category_filter=None):
+        """Ricerca per sottostringa su categoria, servizio e utenza tramite l'indice n-gram."""
+        q = (query or '').strip().lower()
+        if not q:
+            return self.list(category_filter)
+        with self._lock:
+            self._carica()
+            self._tocca()
+            n = min(len(q), MAX_NGRAM)
+            candidati = None
+            for g in _ngrams(q, n):
+                ids = self._indice.get(g, set())
+                candidati = ids if candidati is None else candidati & ids
+                if not candidati:
+                    return []
+            risultati = []
+            for i in self._ordine:
+                if i not in candidati:
+                    continue
+                voce = self._voci[i]
+                if category_filter and voce['CATEGORIA'] != category_filter:
+                    continue
+                # Verifica finale: gli n-gram possono dare falsi positivi
+                if any(q in (voce[c.upper()] or '').lower() for c in CAMPI_INDICE):
+                    risultati.append(self._elenco(voce))
+            return risultati
+
+    def count_by_category(self):
+        with self._lock:
+            self._carica()
+            self._tocca()
+            conteggi = {}
+            for i in self._ordine:
+                cat = self._voci[i]['CATEGORIA']
+                conteggi[cat] = conteggi.get(cat, 0) + 1
+            return conteggi
+
+    def reveal(self, credential_id, campo, decrypt_fn):
+        """Decifra (una sola volta) il campo cifrato richiesto della credenziale."""
+        if campo not in CAMPI_CIFRATI:
+            raise ValueError(f"Campo non cifrato: {campo}")
+        with self._lock:
+            self._carica()
+            self._tocca()
+            voce = self._voci.get(credential_id)
+            if voce is None:
+                return None
+            chiave = (credential_id, campo)
+            if chiave not in self._decifrati:
+                cifrato = voce[campo]
+                self._decifrati[chiave] = decrypt_fn(cifrato) if cifrato else ''
+            return self._decifrati[chiave]
+
+    def get_decrypted(self, credential_id, decrypt_fn):
+        """Credenziale completa con password e altro in chiaro (decifrati su richiesta)."""
+        with self._lock:
+            self._carica()
+            voce = self._voci.get(credential_id)
+            if voce is None:
+                return None
+            d = {k: voce[k] for k in ('id', 'CATEGORIA', 'SERVIZIO', 'UTENZA')}
+            d['PASSWORD'] = self.reveal(credential_id, 'password', decrypt_fn)
+            d['ALTRO'] = self.reveal(credential_id, 'altro', decrypt_fn)
+            return d
+
+
+# Istanza unica, come il cipher a livello di modulo del service
+vault_cache = VaultCache()
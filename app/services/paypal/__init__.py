@@ -1,2 +1,3 @@
 """Package per i servizi PayPal."""
 from .paypal_service import *  # noqa: F401,F403
+from .riconciliazione_service import *  # noqa: F401,F403
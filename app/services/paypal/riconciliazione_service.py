@@ -0,0 +1,133 @@
+"""Riconciliazione set-based delle rate PayPal con le transazioni.
+
+Le rate scadute e non pagate dei piani attivi vengono lette con una sola query,
+le transazioni candidate con un'altra; l'abbinamento avviene tramite una mappa
+indicizzata su (data, importo arrotondato al centesimo) e gli aggiornamenti di
+stato e `importo_rimanente` sono applicati in blocco con un unico commit.
+"""
+import logging
+from datetime import date
+
+from sqlalchemy import or_, update, select, func
+
+from app import db
+from app.models.Paypal import PaypalAbbonamenti, PaypalMovimenti
+from app.models.Transazioni import Transazioni
+
+logger = logging.getLogger(__name__)
+
+# Stati che identificano un piano attivo ('attivo' legacy, 'in_corso' usato altrove)
+STATI_PIANO_ATTIVO = ('attivo', 'in_corso')
+
+# Ultimo giorno in cui la riconciliazione automatica è stata eseguita (per processo)
+_ultima_riconciliazione = None
+
+
+def _chiave(data_rif, importo):
+    return (data_rif, round(float(importo or 0.0), 2))
+
+
+def riconcilia_rate_paypal(oggi=None):
+    """Aggiorna stato delle rate, `importo_rimanente` e completamento dei piani attivi.
+
+    - le rate in attesa con `data_pagamento` valorizzata diventano pagate;
+    - le rate scadute vengono pagate con la data della transazione corrispondente
+      (stessa data o data effettiva e stesso importo), altrimenti alla scadenza;
+    - `importo_rimanente` è la somma delle rate ancora in attesa e i piani a zero
+      vengono segnati come completati.
+    """
+    if oggi is None:
+        oggi = date.today()
+    result = {'rate_pagate': 0, 'rate_abbinate': 0, 'piani_completati': 0}
+
+    try:
+        piani_attivi = select(PaypalAbbonamenti.id).where(PaypalAbbonamenti.stato.in_(STATI_PIANO_ATTIVO))
+
+        # 1) Rate già con data di pagamento: allinea lo stato
+        res = db.session.execute(
+            update(PaypalMovimenti)
+            .where(PaypalMovimenti.stato == 'in_attesa',
+                   PaypalMovimenti.data_pagamento.isnot(None),
+                   PaypalMovimenti.piano_id.in_(piani_attivi))
+            .values(stato='pagata')
+            .execution_options(synchronize_session=False)
+        )
+        result['rate_pagate'] += int(res.rowcount or 0)
+
+        # 2) Rate scadute non pagate (una query)
+        scadute = db.session.execute(
+            select(PaypalMovimenti.id, PaypalMovimenti.data_scadenza, PaypalMovimenti.importo)
+            .where(PaypalMovimenti.stato == 'in_attesa',
+                   PaypalMovimenti.data_pagamento.is_(None),
+                   PaypalMovimenti.data_scadenza <= oggi,
+                   PaypalMovimenti.piano_id.in_(piani_attivi))
+        ).all()
+
+        if scadute:
+            date_scadenza = {r.data_scadenza for r in scadute}
+
+            # 3) Transazioni candidate (una query) indicizzate per (data, importo)
+            candidate = db.session.execute(
+                select(Transazioni.id, Transazioni.data, Transazioni.data_effettiva, Transazioni.importo)
+                .where(or_(Transazioni.data.in_(date_scadenza), Transazioni.data_effettiva.in_(date_scadenza)))
+                .order_by(Transazioni.id)
+            ).all()
+            indice = {}
+            for t in candidate:
+                data_pagamento = t.data_effettiva or t.data
+                for data_rif in (t.data, t.data_effettiva):
+                    if data_rif in date_scadenza:
+                        indice.setdefault(_chiave(data_rif, t.importo), data_pagamento)
+
+            # 4) Aggiornamento in blocco per chiave primaria
+            righe = []
+            for r in scadute:
+                data_pagamento = indice.get(_chiave(r.data_scadenza, r.importo))
+                if data_pagamento is not None:
+                    result['rate_abbinate'] += 1
+                righe.append({'id': r.id, 'stato': 'pagata', 'data_pagamento': data_pagamento or r.data_scadenza})
+            db.session.execute(update(PaypalMovimenti), righe)
+            result['rate_pagate'] += len(righe)
+
+        # 5) Importo rimanente e completamento, per tutti i piani attivi
+        residuo = (
+            select(func.coalesce(func.sum(PaypalMovimenti.importo), 0.0))
+            .where(PaypalMovimenti.piano_id == PaypalAbbonamenti.id, PaypalMovimenti.stato == 'in_attesa')
+            .scalar_subquery()
+        )
+        db.session.execute(
+            update(PaypalAbbonamenti)
+            .where(PaypalAbbonamenti.stato.in_(STATI_PIANO_ATTIVO))
+            .values(importo_rimanente=residuo)
+            .execution_options(synchronize_session=False)
+        )
+        res = db.session.execute(
+            update(PaypalAbbonamenti)
+            .where(PaypalAbbonamenti.stato.in_(STATI_PIANO_ATTIVO), PaypalAbbonamenti.importo_rimanente == 0)
+            .values(stato='completato')
+            .execution_options(synchronize_session=False)
+        )
+        result['piani_completati'] = int(res.rowcount or 0)
+
+        db.session.commit()
+        # Gli oggetti già caricati in sessione devono rileggere lo stato aggiornato
+        db.session.expire_all()
+        return result
+    except Exception as e:
+        db.session.rollback()
+        logger.error('Errore riconciliazione rate PayPal: %s', e)
+        result['error'] = str(e)
+        return result
+
+
+def riconcilia_se_necessario(oggi=None):
+    """Esegue la riconciliazione al più una volta al giorno (before_request se JOBS_WORKER = 0)."""
+    global _ultima_riconciliazione
+    if oggi is None:
+        oggi = date.today()
+    if _ultima_riconciliazione == oggi:
+        return None
+    result = riconcilia_rate_paypal(oggi=oggi)
+    if 'error' not in result:
+        _ultima_riconciliazione = oggi
+    return result
@@ -1,2 +1,4 @@
 """Package per i servizi PostePay Evolution."""
 from .ppay_evolution_service import *  # noqa: F401,F403
+from .addebiti_service import *  # noqa: F401,F403
+from .collegamenti_service import *  # noqa: F401,F403
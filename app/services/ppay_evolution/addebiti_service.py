@@ -0,0 +1,200 @@
+"""Motore di generazione degli addebiti automatici degli abbonamenti PostePay Evolution.
+
+Calcola in un'unica query (anti-join su `ppay_evolution_movimenti`) gli addebiti
+dovuti per tutti gli abbonamenti attivi, recuperando anche i mesi saltati (ma
+non quelli in cui l'abbonamento era disattivato), li inserisce in blocco e
+applica al saldo dello strumento un solo aggiornamento aggregato. L'idempotenza è garantita dal vincolo univoco (abbonamento_id, mese_addebito).
+"""
+import calendar
+import logging
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import text, insert
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models.PostePayEvolution import MovimentoPostePay
+from app.services.conti_finanziari.strumenti_service import StrumentiService
+
+logger = logging.getLogger(__name__)
+
+STRUMENTO_PPAY = 'Postepay Evolution'
+
+# Mese successivo espresso in formato YYYYMM
+_NEXT_MESE_SQL = "CASE WHEN {x} % 100 = 12 THEN {x} + 89 ELSE {x} + 1 END"
+
+# Mese di competenza di un movimento: colonna esplicita o, per i movimenti
+# precedenti alla migrazione, derivato dalla data
+_MESE_MOV_SQL = "COALESCE(mv.mese_addebito, CAST(strftime('%Y%m', mv.data) AS INTEGER))"
+
+_ADDEBITI_DOVUTI_SQL = f"""
+WITH RECURSIVE mesi(mese) AS (
+    SELECT :mese_da
+    UNION ALL
+    SELECT {_NEXT_MESE_SQL.format(x='mese')} FROM mesi WHERE mese < :mese_a
+),
+ultimi AS (
+    SELECT mv.abbonamento_id AS abbonamento_id, MAX({_MESE_MOV_SQL}) AS ultimo_mese
+    FROM ppay_evolution_movimenti mv
+    WHERE mv.abbonamento_id IS NOT NULL
+    GROUP BY mv.abbonamento_id
+)
+SELECT a.id, a.nome, a.importo, a.giorno_addebito, mesi.mese, a.data_riattivazione
+FROM ppay_evolution_abbonamenti a
+CROSS JOIN mesi
+LEFT JOIN ultimi u ON u.abbonamento_id = a.id
+WHERE a.attivo = 1
+  AND mesi.mese >= COALESCE({_NEXT_MESE_SQL.format(x='u.ultimo_mese')}, :mese_a)
+  AND mesi.mese >= COALESCE(CAST(strftime('%Y%m', a.data_riattivazione) AS INTEGER), 0)
+  AND NOT EXISTS (
+      SELECT 1 FROM ppay_evolution_movimenti mv
+      WHERE mv.abbonamento_id = a.id AND {_MESE_MOV_SQL} = mesi.mese
+  )
+ORDER BY mesi.mese, a.id
+"""
+
+
+def _mese_key(d):
+    return d.year * 100 + d.month
+
+
+def _data_addebito(mese, giorno_addebito):
+    """Data di addebito nel mese YYYYMM, limitata all'ultimo giorno del mese."""
+    anno, mese_num = divmod(int(mese), 100)
+    ultimo_giorno = calendar.monthrange(anno, mese_num)[1]
+    return date(anno, mese_num, min(int(giorno_addebito), ultimo_giorno))
+
+
+def ensure_mese_addebito_column():
+    """Aggiunge la colonna mese_addebito e l'indice univoco se mancanti (migrazione best-effort)."""
+    try:
+        cols = [r[1] for r in db.session.execute(text("PRAGMA table_info('ppay_evolution_movimenti');")).fetchall()]
+        if 'mese_addebito' not in cols:
+            db.session.execute(text("ALTER TABLE ppay_evolution_movimenti ADD COLUMN mese_addebito INTEGER"))
+            # Backfill: un solo movimento per abbonamento/mese riceve la chiave, così l'indice è creabile
+            db.session.execute(text("""
+                UPDATE ppay_evolution_movimenti
+                SET mese_addebito = CAST(strftime('%Y%m', data) AS INTEGER)
+                WHERE abbonamento_id IS NOT NULL
+                  AND id IN (
+                      SELECT MIN(id) FROM ppay_evolution_movimenti
+                      WHERE abbonamento_id IS NOT NULL
+                      GROUP BY abbonamento_id, strftime('%Y%m', data)
+                  )
+            """))
+        db.session.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_ppay_mov_abbonamento_mese "
+            "ON ppay_evolution_movimenti (abbonamento_id, mese_addebito)"
+        ))
+        db.session.commit()
+        return True
+    except Exception as e:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        logger.warning('Migrazione mese_addebito non riuscita: %s', e)
+        return False
+
+
+def ensure_data_riattivazione_column():
+    """Aggiunge la colonna data_riattivazione agli abbonamenti PostePay se mancante."""
+    try:
+        cols = [r[1] for r in db.session.execute(text("PRAGMA table_info('ppay_evolution_abbonamenti');")).fetchall()]
+        if cols and 'data_riattivazione' not in cols:
+            db.session.execute(text("ALTER TABLE ppay_evolution_abbonamenti ADD COLUMN data_riattivazione DATETIME"))
+        db.session.commit()
+        return True
+    except Exception as e:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        logger.warning('Migrazione data_riattivazione non riuscita: %s', e)
+        return False
+
+
+def _come_data(valore):
+    """Data da un valore DATETIME letto con SQL testuale (stringa o datetime)."""
+    if valore is None:
+        return None
+    if isinstance(valore, str):
+        return date.fromisoformat(valore[:10])
+    return valore.date() if hasattr(valore, 'date') else valore
+
+
+def get_addebiti_dovuti(oggi=None, max_mesi=12):
+    """Restituisce gli addebiti dovuti e non ancora registrati, senza scrivere nulla.
+
+    Per ogni abbonamento attivo considera i mesi successivi all'ultimo addebito
+    registrato (al più `max_mesi` indietro) fino al mese corrente; un abbonamento
+    mai addebitato parte dal mese corrente. Per un abbonamento riattivato non
+    sono dovuti gli addebiti con data precedente alla riattivazione (il periodo
+    di sospensione non si recupera). Gli addebiti del mese corrente sono dovuti
+    solo se il giorno di addebito è già passato.
+    """
+    if oggi is None:
+        oggi = date.today()
+    mese_a = _mese_key(oggi)
+    mese_da = _mese_key(oggi - relativedelta(months=max(int(max_mesi), 0)))
+
+    rows = db.session.execute(text(_ADDEBITI_DOVUTI_SQL), {'mese_da': mese_da, 'mese_a': mese_a}).fetchall()
+
+    dovuti = []
+    for abbonamento_id, nome, importo, giorno_addebito, mese, data_riattivazione in rows:
+        try:
+            data_addebito = _data_addebito(mese, giorno_addebito)
+        except Exception:
+            # giorno_addebito non valido: salta l'abbonamento
+            continue
+        if data_addebito > oggi:
+            continue
+        riattivazione = _come_data(data_riattivazione)
+        if riattivazione and data_addebito < riattivazione:
+            continue
+        dovuti.append({
+            'data': data_addebito,
+            'descrizione': f"{nome} {data_addebito.strftime('%m/%Y')}",
+            'importo': abs(importo or 0.0),
+            'tipo': 'Abbonamento',
+            'tipo_movimento': 'uscita',
+            'abbonamento_id': abbonamento_id,
+            'mese_addebito': int(mese),
+        })
+    return dovuti
+
+
+def genera_addebiti_abbonamenti(oggi=None, max_mesi=12):
+    """Registra in blocco gli addebiti dovuti e aggiorna il saldo con un unico delta.
+
+    Inserimento e aggiornamento del saldo avvengono nella stessa transazione: se
+    un'altra richiesta ha già registrato uno degli addebiti il vincolo univoco
+    fa fallire l'inserimento e nulla viene applicato.
+    """
+    result = {'creati': 0, 'totale_addebitato': 0.0, 'mesi': []}
+    ensure_mese_addebito_column()
+    try:
+        dovuti = get_addebiti_dovuti(oggi=oggi, max_mesi=max_mesi)
+        if not dovuti:
+            return result
+
+        totale = round(sum(d['importo'] for d in dovuti), 2)
+        db.session.execute(insert(MovimentoPostePay), dovuti)
+        StrumentiService().applica_delta(STRUMENTO_PPAY, -totale, commit=False, origine='addebito')
+        db.session.commit()
+
+        result['creati'] = len(dovuti)
+        result['totale_addebitato'] = totale
+        result['mesi'] = sorted({d['mese_addebito'] for d in dovuti})
+        return result
+    except IntegrityError:
+        # Addebiti registrati nel frattempo da un'altra richiesta
+        db.session.rollback()
+        result['concorrente'] = True
+        return result
+    except Exception as e:
+        db.session.rollback()
+        logger.error('Errore generazione addebiti abbonamenti PostePay: %s', e)
+        result['error'] = str(e)
+        return result
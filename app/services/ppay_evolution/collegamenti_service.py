@@ -0,0 +1,131 @@
+"""Collegamenti espliciti tra ricariche del conto e movimenti PostePay Evolution.
+
+Una transazione di categoria "Ricarica PPay Ev" genera un movimento di
+ricarica sulla carta: la coppia è registrata in `ppay_evolution_collegamenti`
+alla creazione, così le eliminazioni a cascata e la riconciliazione sono
+ricerche per indice invece di confronti su data e importo. I trigger tolgono
+il collegamento quando una delle due righe sparisce (anche per eliminazioni
+SQL dirette, come l'archiviazione del rollover); il backfill collega lo
+storico creato prima dell'introduzione della tabella.
+"""
+import logging
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import func, select, text
+
+from app import db
+from app.models.Categorie import Categorie
+from app.models.PostePayEvolution import CollegamentoRicarica, MovimentoPostePay
+from app.models.Transazioni import Transazioni
+
+logger = logging.getLogger(__name__)
+
+# Nome della categoria delle transazioni che ricaricano la PostePay Evolution
+# (sovrascrivibile con la config CATEGORIA_RICARICA_PPAY); l'id si risolve dal database
+NOME_CATEGORIA_RICARICA_PPAY = 'Ricarica PPay Ev'
+
+_id_categoria_ricarica = {}  # (url del database, nome) -> id
+
+_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS trg_transazioni_ppay_link_del AFTER DELETE ON transazioni
+       BEGIN DELETE FROM ppay_evolution_collegamenti WHERE transazione_id = OLD.id; END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_ppay_movimenti_link_del AFTER DELETE ON ppay_evolution_movimenti
+       BEGIN DELETE FROM ppay_evolution_collegamenti WHERE movimento_id = OLD.id; END""",
+]
+
+# Abbina ricariche e transazioni non collegate con stessa data e importo;
+# ROW_NUMBER accoppia 1:1 anche le ricariche identiche nello stesso giorno
+_BACKFILL_SQL = """
+INSERT INTO ppay_evolution_collegamenti (transazione_id, movimento_id, origine, data_creazione)
+SELECT t.id, m.id, 'backfill', :ora
+FROM (
+    SELECT id, data, importo, ROW_NUMBER() OVER (PARTITION BY data, importo ORDER BY id) AS n
+    FROM transazioni
+    WHERE categoria_id = :categoria
+      AND id NOT IN (SELECT transazione_id FROM ppay_evolution_collegamenti)
+) t
+JOIN (
+    SELECT id, data, importo, ROW_NUMBER() OVER (PARTITION BY data, importo ORDER BY id) AS n
+    FROM ppay_evolution_movimenti
+    WHERE tipo = 'Ricarica'
+      AND id NOT IN (SELECT movimento_id FROM ppay_evolution_collegamenti)
+) m ON m.data = t.data AND m.importo = t.importo AND m.n = t.n
+"""
+
+
+def categoria_ricarica_ppay():
+    """Id della categoria di ricarica PostePay, cercata per nome una volta sola (None se manca)."""
+    nome = NOME_CATEGORIA_RICARICA_PPAY
+    if has_app_context():
+        nome = current_app.config.get('CATEGORIA_RICARICA_PPAY') or nome
+    chiave = (str(db.engine.url), nome)
+    if chiave in _id_categoria_ricarica:
+        return _id_categoria_ricarica[chiave]
+    with db.session.no_autoflush:
+        id_categoria = db.session.execute(
+            select(Categorie.id).where(func.lower(Categorie.nome) == nome.strip().lower()).order_by(Categorie.id)
+        ).scalar()
+    # Una categoria mancante non si memorizza: può essere creata in seguito
+    if id_categoria is not None:
+        _id_categoria_ricarica[chiave] = id_categoria
+    return id_categoria
+
+
+def e_ricarica_ppay(categoria_id):
+    """True se `categoria_id` è la categoria di ricarica PostePay."""
+    return categoria_id is not None and categoria_id == categoria_ricarica_ppay()
+
+
+def collega_ricarica(transazione_id, movimento_id, origine='creazione'):
+    """Registra il collegamento nella sessione corrente (commit a carico del chiamante)."""
+    link = CollegamentoRicarica(transazione_id=transazione_id, movimento_id=movimento_id, origine=origine)
+    db.session.add(link)
+    return link
+
+
+def movimento_collegato(transazione_id):
+    """Movimento PostePay collegato alla transazione, o None."""
+    return MovimentoPostePay.query.join(
+        CollegamentoRicarica, CollegamentoRicarica.movimento_id == MovimentoPostePay.id
+    ).filter(CollegamentoRicarica.transazione_id == transazione_id).first()
+
+
+def transazione_collegata(movimento_id):
+    """Transazione del conto collegata al movimento PostePay, o None."""
+    return Transazioni.query.join(
+        CollegamentoRicarica, CollegamentoRicarica.transazione_id == Transazioni.id
+    ).filter(CollegamentoRicarica.movimento_id == movimento_id).first()
+
+
+def backfill_collegamenti():
+    """Collega in blocco le coppie storiche ancora prive di collegamento; ritorna quante."""
+    try:
+        res = db.session.execute(text(_BACKFILL_SQL), {
+            'ora': datetime.utcnow(),
+            'categoria': categoria_ricarica_ppay(),
+        })
+        db.session.commit()
+        return int(res.rowcount or 0)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Backfill collegamenti PostePay non riuscito: %s', e)
+        return 0
+
+
+def ensure_collegamenti_ppay():
+    """Installa i trigger di pulizia; alla prima installazione collega lo storico."""
+    try:
+        presenti = {r[0] for r in db.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%_link_del'"
+        )).fetchall()}
+        for sql in _TRIGGERS:
+            db.session.execute(text(sql))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Installazione trigger collegamenti PostePay non riuscita: %s', e)
+        return False
+    if len(presenti) < len(_TRIGGERS):
+        backfill_collegamenti()
+    return True
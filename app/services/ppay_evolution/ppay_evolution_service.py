@@ -169,10 +169,11 @@ class PostePayEvolutionService(BaseService):
         ).first()
     
     def create_movimento(self, data, importo, tipo, descrizione=None, 
-                        abbonamento_id=None, tipo_movimento=None):
+                        abbonamento_id=None, tipo_movimento=None, transazione_id=None):
         """Crea un nuovo movimento PostePay.
         importo: sempre positivo
         tipo_movimento: 'entrata' o 'uscita'
+        transazione_id: transazione del conto da collegare al movimento (ricariche)
         """
         movimento = MovimentoPostePay(
             data=data,
@@ -183,6 +184,10 @@ class PostePayEvolutionService(BaseService):
             abbonamento_id=abbonamento_id
         )
         db.session.add(movimento)
+        if transazione_id is not None:
+            from app.services.ppay_evolution.collegamenti_service import collega_ricarica
+            db.session.flush()
+            collega_ricarica(transazione_id, movimento.id)
         # Persistiamo il movimento e aggiorniamo lo Strumento (source of truth)
         try:
             db.session.commit()
@@ -196,12 +201,8 @@ class PostePayEvolutionService(BaseService):
         # Aggiorna saldo nello strumento
         # importo è sempre positivo, tipo_movimento determina il segno
         try:
-            ss = StrumentiService()
-            strum = ss.get_by_descrizione('Postepay Evolution')
-            if strum:
-                signed_value = -abs(float(movimento.importo or 0)) if movimento.tipo_movimento == 'uscita' else abs(float(movimento.importo or 0))
-                new_bal = (strum.saldo_corrente or 0.0) + signed_value
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
+            signed_value = -abs(float(movimento.importo or 0)) if movimento.tipo_movimento == 'uscita' else abs(float(movimento.importo or 0))
+            StrumentiService().applica_delta('Postepay Evolution', signed_value)
         except Exception:
             pass
 
@@ -224,14 +225,9 @@ class PostePayEvolutionService(BaseService):
         # Ricalcola effetto sul saldo usando lo Strumento come source of truth
         if 'importo' in kwargs or 'tipo' in kwargs:
             try:
-                ss = StrumentiService()
-                strum = ss.get_by_descrizione('Postepay Evolution')
-                if strum:
-                    new_importo = float(movimento.importo or 0)
-                    # delta to apply to the strumento is new - old
-                    delta = new_importo - old_importo
-                    new_bal = (strum.saldo_corrente or 0.0) + delta
-                    ss.update_saldo_by_id(strum.id_conto, new_bal)
+                new_importo = float(movimento.importo or 0)
+                # delta to apply to the strumento is new - old (stessa transazione del movimento)
+                StrumentiService().applica_delta('Postepay Evolution', new_importo - old_importo, commit=False)
             except Exception:
                 pass
         
@@ -245,12 +241,8 @@ class PostePayEvolutionService(BaseService):
             return False
         # Aggiorna il saldo annullando l'effetto del movimento sullo Strumento
         try:
-            ss = StrumentiService()
-            strum = ss.get_by_descrizione('Postepay Evolution')
-            if strum:
-                # remove movimento effect: subtract movimento.importo
-                new_bal = (strum.saldo_corrente or 0.0) - float(movimento.importo or 0)
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
+            # remove movimento effect: subtract movimento.importo (stessa transazione della cancellazione)
+            StrumentiService().applica_delta('Postepay Evolution', -float(movimento.importo or 0), commit=False)
         except Exception:
             pass
 
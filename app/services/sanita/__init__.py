@@ -0,0 +1,2 @@
+"""Package per i servizi sanità."""
+from .terapia_service import *  # noqa: F401,F403
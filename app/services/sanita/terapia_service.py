@@ -0,0 +1,109 @@
+"""Piano della terapia biologica: generazione delle consegne e diff incrementali.
+
+Le consegne del piano vengono create con un unico insert multiplo. Ogni
+modifica incrementa `TerapiaPlan.version` e marca le consegne toccate con la
+nuova versione: il calendario riceve solo le consegne cambiate rispetto alla
+versione che possiede, e la GET del piano può rispondere 304 tramite ETag.
+"""
+import logging
+import time
+from datetime import date
+
+from sqlalchemy import insert, text
+
+from app import db
+from app.models.Terapia import TerapiaPlan, TerapiaDelivery
+
+logger = logging.getLogger(__name__)
+
+# Una consegna ogni 28 giorni, due dosi per consegna
+GIORNI_TRA_CONSEGNE = 28
+DOSI_PER_CONSEGNA = 2
+
+
+def ensure_terapia_version_columns():
+    """Aggiunge le colonne `version` a terapia_plan e terapia_delivery se mancanti."""
+    try:
+        for tabella in ('terapia_plan', 'terapia_delivery'):
+            cols = [r[1] for r in db.session.execute(text(f"PRAGMA table_info('{tabella}');")).fetchall()]
+            if cols and 'version' not in cols:
+                db.session.execute(text(f"ALTER TABLE {tabella} ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+        db.session.commit()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
+
+
+def etag_piano(plan):
+    """Valore ETag del piano (cambia a ogni modifica)."""
+    if plan is None:
+        return 'terapia-none'
+    return f"terapia-{plan.id}-{plan.version or 0}"
+
+
+def crea_piano(start, qty_per_delivery=DOSI_PER_CONSEGNA):
+    """Crea il piano con tutte le consegne (ogni 28 giorni fino al 31/12 dell'anno successivo).
+
+    Le consegne sono inserite con un unico executemany. Il commit è a carico del chiamante.
+    """
+    last_day = date(start.year + 1, 12, 31)
+    num = (last_day - start).days // GIORNI_TRA_CONSEGNE + 1
+
+    # Versione iniziale basata sull'orario: eliminando e ricreando il piano (stesso id
+    # riutilizzato da SQLite) l'ETag non coincide con quello del piano precedente
+    versione = int(time.time())
+    plan = TerapiaPlan(start_date=start, num_deliveries=num, total_drugs=num * qty_per_delivery, version=versione)
+    db.session.add(plan)
+    db.session.flush()
+
+    # Nessuna consegna o dose è segnata al momento della creazione
+    db.session.execute(insert(TerapiaDelivery), [
+        {
+            'plan_id': plan.id,
+            'delivery_number': n,
+            'quantity': qty_per_delivery,
+            'received': False,
+            'dose1': False,
+            'dose2': False,
+            'delivery_confirmed': False,
+            'version': versione,
+        }
+        for n in range(1, num + 1)
+    ])
+    return plan
+
+
+def registra_modifica(plan, *deliveries):
+    """Incrementa la versione del piano e la assegna alle consegne modificate."""
+    plan.version = (plan.version or 0) + 1
+    for d in deliveries:
+        d.version = plan.version
+    return plan.version
+
+
+def diff_piano(plan, since):
+    """Consegne modificate dopo la versione `since`, con i dati di testata del piano.
+
+    Se `since` non è una versione valida per il piano, ritorna None: il client
+    deve ricaricare il piano completo.
+    """
+    versione = plan.version or 0
+    if since is None or since < 0 or since > versione:
+        return None
+    cambiate = TerapiaDelivery.query.filter(
+        TerapiaDelivery.plan_id == plan.id,
+        TerapiaDelivery.version > since,
+    ).order_by(TerapiaDelivery.delivery_number).all()
+    return {
+        'id': plan.id,
+        'start_date': plan.start_date.isoformat() if plan.start_date else None,
+        'total_drugs': plan.total_drugs,
+        'num_deliveries': plan.num_deliveries,
+        'version': versione,
+        'base_version': since,
+        'deliveries': [d.to_dict() for d in cambiate],
+    }
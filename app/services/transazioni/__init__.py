@@ -5,6 +5,12 @@ try:
     from .monthly_summary_service import *  # noqa: F401,F403
     from .dettaglio_periodo_service import *  # noqa: F401,F403
     from .transazioni_service import *  # noqa: F401,F403
+    from .import_service import *  # noqa: F401,F403
+    from .previsioni_service import *  # noqa: F401,F403
+    from .snapshot_service import *  # noqa: F401,F403
+    from .report_service import *  # noqa: F401,F403
+    from .dettaglio_delta_service import *  # noqa: F401,F403
+    from .operazioni_batch_service import *  # noqa: F401,F403
 except Exception:
     # In fase di deploy/aggiornamento, evitare di rompere import per errori temporanei
     pass
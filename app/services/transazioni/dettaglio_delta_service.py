@@ -0,0 +1,228 @@
+"""Aggiornamento incrementale del dettaglio periodo dopo mutazioni puntuali.
+
+Dopo aggiunta, modifica o eliminazione di una transazione non serve
+ricalcolare il dettaglio completo (con il cammino dei saldi mese per mese):
+il contributo della riga prima e dopo la modifica basta per aggiornare con
+poche UPDATE gli aggregati già persistiti (`saldi_mensili`, residui in
+`budget_mensili`) e per costruire una risposta compatta per il client.
+Le letture toccano solo le righe del periodo visualizzato (indice su
+`id_periodo`), quindi il costo non dipende dalla lunghezza dello storico.
+"""
+import logging
+from datetime import date
+
+from sqlalchemy import text
+
+from app import db
+from app.models.Budget import Budget
+from app.models.BudgetMensili import BudgetMensili
+from app.models.Categorie import Categorie
+from app.models.SaldiMensili import SaldiMensili
+from app.services import BaseService, get_month_boundaries
+
+logger = logging.getLogger(__name__)
+
+# Le uscite di questa categoria non contano nelle uscite previste (vedi DettaglioPeriodoService)
+CATEGORIA_CORREZIONE = 'Correzione Saldo'
+
+
+def stato_transazione(tx):
+    """Contributo di una transazione ai riepiloghi, o None se non vi partecipa.
+
+    Come nel dettaglio, le transazioni senza categoria (PayPal) sono escluse.
+    """
+    if tx is None or tx.categoria_id is None or not tx.id_periodo:
+        return None
+    return {
+        'id_periodo': int(tx.id_periodo),
+        'categoria_id': int(tx.categoria_id),
+        'tipo': tx.tipo,
+        'importo': float(tx.importo or 0.0),
+    }
+
+
+def _effettuata_sql():
+    # Stessa regola del dettaglio: effettuata se ha data_effettiva o la data è passata
+    return "(data_effettiva IS NOT NULL OR data <= :oggi)"
+
+
+class DettaglioDeltaService(BaseService):
+    """Applica la variazione di una transazione agli aggregati del periodo"""
+
+    def _spese_per_categoria(self, periodo, oggi):
+        """{categoria_id: (spese effettuate, spese pianificate)} delle uscite del periodo."""
+        righe = db.session.execute(text(f"""
+            SELECT categoria_id,
+                   TOTAL(CASE WHEN {_effettuata_sql()} THEN importo END),
+                   TOTAL(CASE WHEN NOT {_effettuata_sql()} THEN importo END)
+            FROM transazioni
+            WHERE id_periodo = :p AND tipo = 'uscita' AND categoria_id IS NOT NULL
+            GROUP BY categoria_id
+        """), {'p': periodo, 'oggi': oggi.isoformat()}).fetchall()
+        return {r[0]: (float(r[1] or 0.0), float(r[2] or 0.0)) for r in righe}
+
+    def _budget_periodo(self, periodo, spese, categorie):
+        """Voci di budget del periodo (stessa forma di `budget_items` del dettaglio)."""
+        anno, mese = divmod(periodo, 100)
+        mensili = {mb.categoria_id: mb for mb in BudgetMensili.query.filter_by(year=anno, month=mese).all()}
+        voci = {}
+        for b in Budget.query.all():
+            mb = mensili.get(b.categoria_id)
+            iniziale = float(mb.importo if mb else (b.importo or 0.0))
+            eff, pian = spese.get(b.categoria_id, (0.0, 0.0))
+            cat = categorie.get(b.categoria_id)
+            voci[b.categoria_id] = {
+                'categoria_id': b.categoria_id,
+                'categoria_nome': cat.nome if cat else f'Categorie {b.categoria_id}',
+                'categoria_tipo': cat.tipo if cat else 'uscita',
+                'iniziale': iniziale,
+                'spese_effettuate': eff,
+                'spese_pianificate': pian,
+                'residuo': iniziale - (eff + pian),
+                '_mensile': mb,
+            }
+        return voci
+
+    def applica(self, variazioni, start_date, end_date):
+        """Aggiorna `saldi_mensili` e i residui per le variazioni `(prima, dopo)`.
+
+        `prima` e `dopo` sono stati prodotti da `stato_transazione` (None per
+        inserimento/eliminazione); più variazioni sono applicate insieme, con
+        un solo aggiornamento per periodo. Ritorna il riepilogo compatto del
+        periodo `start_date`-`end_date`, oppure None se gli aggregati
+        persistiti non coprono i periodi toccati: il chiamante deve allora
+        ricalcolare tutto.
+        """
+        try:
+            oggi = date.today()
+            fine = get_month_boundaries(end_date)[1]
+            periodo_vista = fine.year * 100 + fine.month
+            contributi = []
+            for prima, dopo in variazioni:
+                contributi += [(s, -1.0) for s in (prima,) if s] + [(s, 1.0) for s in (dopo,) if s]
+            periodi = sorted({s['id_periodo'] for s, _ in contributi} | {periodo_vista})
+            categorie = {c.id: c for c in Categorie.query.all()}
+
+            delta_periodi, budget_vista, spese_vista = {}, {}, {}
+            for p in periodi:
+                righe = [(s, segno) for s, segno in contributi if s['id_periodo'] == p]
+                spese = self._spese_per_categoria(p, oggi)
+                voci = self._budget_periodo(p, spese, categorie)
+
+                d_entrate = sum(segno * s['importo'] for s, segno in righe if s['tipo'] == 'entrata')
+                d_uscite = sum(
+                    segno * s['importo'] for s, segno in righe
+                    if s['tipo'] != 'entrata'
+                    and getattr(categorie.get(s['categoria_id']), 'nome', None) != CATEGORIA_CORREZIONE
+                )
+                # Il residuo positivo dei budget toccati entra nelle uscite previste
+                toccate = {}
+                for s, segno in righe:
+                    if s['tipo'] == 'uscita' and s['categoria_id'] in voci:
+                        toccate[s['categoria_id']] = toccate.get(s['categoria_id'], 0.0) + segno * s['importo']
+                for cid, variazione in toccate.items():
+                    voce = voci[cid]
+                    residuo_prima = voce['residuo'] + variazione
+                    d_uscite += max(voce['residuo'], 0.0) - max(residuo_prima, 0.0)
+                    if voce['_mensile'] is not None:
+                        voce['_mensile'].residuo_mensile = float(voce['residuo'])
+
+                d_bilancio = d_entrate - d_uscite
+                delta_periodi[p] = {'entrate': d_entrate, 'uscite': d_uscite, 'bilancio': d_bilancio}
+                if p == periodo_vista:
+                    budget_vista, spese_vista = voci, toccate
+
+                if not righe:
+                    continue
+                anno, mese = divmod(p, 100)
+                riga = SaldiMensili.query.filter_by(year=anno, month=mese).first()
+                if riga is None:
+                    ultimo = db.session.execute(text(
+                        "SELECT MAX(year * 100 + month) FROM saldi_mensili WHERE COALESCE(is_seed, 0) = 0"
+                    )).scalar()
+                    if ultimo and p < int(ultimo):
+                        # Buco nei riepiloghi: solo il ricalcolo completo può crearlo
+                        db.session.rollback()
+                        return None
+                    continue
+                if riga.is_seed:
+                    # Il mese seed non viene mai rigenerato, quindi non propaga nulla
+                    continue
+                riga.entrate = float(riga.entrate or 0.0) + d_entrate
+                riga.uscite = float(riga.uscite or 0.0) + d_uscite
+                riga.saldo_finale = float(riga.saldo_finale or 0.0) + d_bilancio
+                if d_bilancio:
+                    db.session.flush()
+                    db.session.execute(text("""
+                        UPDATE saldi_mensili
+                        SET saldo_iniziale = saldo_iniziale + :d, saldo_finale = saldo_finale + :d
+                        WHERE year * 100 + month > :p AND COALESCE(is_seed, 0) = 0
+                    """), {'d': d_bilancio, 'p': p})
+            db.session.commit()
+
+            anno, mese = divmod(periodo_vista, 100)
+            riga = SaldiMensili.query.filter_by(year=anno, month=mese).first()
+            if riga is None:
+                return None
+            return self._riepilogo(riga, start_date, end_date, oggi, periodo_vista, periodi,
+                                   delta_periodi, budget_vista, spese_vista, contributi, categorie)
+        except Exception as e:
+            try:
+                db.session.rollback()
+            except Exception:
+                pass
+            logger.warning('Aggiornamento incrementale del dettaglio non riuscito: %s', e)
+            return None
+
+    def _riepilogo(self, riga, start_date, end_date, oggi, periodo_vista, periodi,
+                   delta_periodi, budget_vista, spese_vista, contributi, categorie):
+        """Totali aggiornati, voci di budget toccate e variazioni delle statistiche."""
+        saldo_iniziale = float(riga.saldo_iniziale or 0.0)
+        saldo_finale = float(riga.saldo_finale or 0.0)
+
+        # Saldo attuale: nel periodo corrente contano le transazioni fino a oggi,
+        # negli altri quelle effettuate (stessa regola del dettaglio completo)
+        condizione = "data <= :oggi" if start_date <= oggi <= end_date else _effettuata_sql()
+        bilancio_effettuato = db.session.execute(text(f"""
+            SELECT TOTAL(CASE WHEN tipo = 'entrata' THEN importo ELSE -importo END)
+            FROM transazioni
+            WHERE id_periodo = :p AND categoria_id IS NOT NULL AND {condizione}
+        """), {'p': periodo_vista, 'oggi': oggi.isoformat()}).scalar() or 0.0
+
+        voci_toccate = [
+            {k: v for k, v in budget_vista[cid].items() if k != '_mensile'}
+            for cid in spese_vista
+        ]
+        somma_residui = sum(v['residuo'] for v in budget_vista.values())
+
+        statistiche = {}
+        for s, segno in contributi:
+            if s['id_periodo'] == periodo_vista and s['tipo'] == 'uscita':
+                statistiche[s['categoria_id']] = statistiche.get(s['categoria_id'], 0.0) + segno * s['importo']
+
+        delta = delta_periodi.get(periodo_vista, {'entrate': 0.0, 'uscite': 0.0, 'bilancio': 0.0})
+        return {
+            'entrate': float(riga.entrate or 0.0),
+            'uscite': float(riga.uscite or 0.0),
+            'bilancio': float((riga.entrate or 0.0) - (riga.uscite or 0.0)),
+            'saldo_iniziale_mese': saldo_iniziale,
+            'saldo_attuale_mese': saldo_iniziale + float(bilancio_effettuato),
+            'saldo_finale_mese': saldo_finale,
+            'saldo_previsto_fine_mese': saldo_finale,
+            'saldo_finale_plus_residui': saldo_finale + somma_residui,
+            'budget_items': voci_toccate,
+            'stats_delta': [
+                {
+                    'categoria_id': cid,
+                    'categoria_nome': getattr(categorie.get(cid), 'nome', None) or f'Categorie {cid}',
+                    'importo': importo,
+                }
+                for cid, importo in statistiche.items() if importo
+            ],
+            'delta': {
+                'entrate': delta['entrate'],
+                'uscite': delta['uscite'],
+                'bilancio': delta['bilancio'],
+                'saldo_iniziale': sum(delta_periodi[p]['bilancio'] for p in periodi if p < periodo_vista),
+            },
+        }
@@ -0,0 +1,68 @@
+"""Export XLSX dei dati finanziari (transazioni, archivio, saldi mensili)."""
+from sqlalchemy import select
+
+from app import db
+from app.models.Categorie import Categorie
+from app.models.Transazioni import Transazioni
+from app.models.TransazioniArchivio import TransazioniArchivio
+from app.models.SaldiMensili import SaldiMensili
+from app.utils.xlsx_export import write_xlsx
+
+# Righe lette dal DB per ogni blocco durante l'export
+YIELD_PER = 500
+
+
+def _stream(stmt):
+    """Itera le righe di una select a blocchi, senza caricarle tutte in memoria."""
+    for row in db.session.execute(stmt.execution_options(yield_per=YIELD_PER)):
+        yield tuple(row)
+
+
+def _righe_transazioni():
+    stmt = (
+        select(Transazioni.id, Transazioni.data, Transazioni.data_effettiva, Transazioni.descrizione,
+               Categorie.nome, Transazioni.tipo, Transazioni.importo, Transazioni.id_periodo,
+               Transazioni.tx_ricorrente, Transazioni.tx_modificata)
+        .outerjoin(Categorie, Categorie.id == Transazioni.categoria_id)
+        .order_by(Transazioni.data, Transazioni.id)
+    )
+    return _stream(stmt)
+
+
+def _righe_archivio():
+    stmt = (
+        select(TransazioniArchivio.transazione_id, TransazioniArchivio.data, TransazioniArchivio.data_effettiva,
+               TransazioniArchivio.descrizione, TransazioniArchivio.categoria_nome, TransazioniArchivio.tipo,
+               TransazioniArchivio.importo, TransazioniArchivio.id_periodo, TransazioniArchivio.tx_ricorrente,
+               TransazioniArchivio.data_archiviazione)
+        .order_by(TransazioniArchivio.data, TransazioniArchivio.id)
+    )
+    return _stream(stmt)
+
+
+def _righe_saldi():
+    stmt = (
+        select(SaldiMensili.year, SaldiMensili.month, SaldiMensili.saldo_iniziale, SaldiMensili.entrate,
+               SaldiMensili.uscite, SaldiMensili.saldo_finale, SaldiMensili.is_seed)
+        .order_by(SaldiMensili.year, SaldiMensili.month)
+    )
+    return _stream(stmt)
+
+
+def export_dati_finanziari(protection_password=None):
+    """Crea l'export XLSX con un foglio per transazioni, archivio e saldi mensili.
+
+    Ritorna un file temporaneo (vedi `write_xlsx`) pronto per la risposta.
+    """
+    sheets = [
+        ('Transazioni',
+         ['ID', 'DATA', 'DATA_EFFETTIVA', 'DESCRIZIONE', 'CATEGORIA', 'TIPO', 'IMPORTO', 'ID_PERIODO', 'RICORRENTE', 'MODIFICATA'],
+         _righe_transazioni()),
+        ('Archivio',
+         ['ID_TRANSAZIONE', 'DATA', 'DATA_EFFETTIVA', 'DESCRIZIONE', 'CATEGORIA', 'TIPO', 'IMPORTO', 'ID_PERIODO', 'RICORRENTE', 'DATA_ARCHIVIAZIONE'],
+         _righe_archivio()),
+        ('Saldi mensili',
+         ['ANNO', 'MESE', 'SALDO_INIZIALE', 'ENTRATE', 'USCITE', 'SALDO_FINALE', 'SEED'],
+         _righe_saldi()),
+    ]
+    return write_xlsx(sheets, protection_password=protection_password)
@@ -0,0 +1,388 @@
+"""Import massivo di estratti conto (CSV, XLSX, XLS) nelle transazioni.
+
+Il file viene letto riga per riga (openpyxl in read-only, csv in streaming,
+xlrd per il vecchio formato XLS) e processato a blocchi: ogni blocco viene
+normalizzato, categorizzato, filtrato dai duplicati tramite un conteggio degli
+hash costruito con una sola query e inserito con un `executemany`. Le righe
+identiche sono contate: se il file ne contiene più di quante ne esistano già
+(es. due pagamenti uguali nello stesso giorno) le eccedenti vengono importate. Il commit è
+unico a fine import; il ricalcolo dei riepiloghi mensili è demandato al
+chiamante, una sola volta a partire dal periodo più vecchio importato.
+"""
+import csv
+import hashlib
+import io
+import logging
+import re
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert, select, func
+
+from app import db
+from app.services import get_month_boundaries
+from app.models.Categorie import Categorie
+from app.models.Transazioni import Transazioni
+from app.models.TransazioniArchivio import TransazioniArchivio
+
+logger = logging.getLogger(__name__)
+
+# Righe processate e inserite per ogni blocco
+CHUNK_SIZE = 500
+
+# Righe iniziali in cui cercare l'intestazione (gli estratti conto hanno spesso un preambolo)
+MAX_RIGHE_INTESTAZIONE = 30
+
+# Intestazioni riconosciute per ogni campo (confronto su testo normalizzato)
+ALIAS_COLONNE = {
+    'data': ('data', 'data operazione', 'data contabile', 'data registrazione', 'date'),
+    'data_effettiva': ('data valuta', 'valuta', 'data effettiva'),
+    'descrizione': ('descrizione', 'descrizione operazione', 'causale', 'dettagli', 'operazione', 'description'),
+    'importo': ('importo', 'importo eur', 'importo euro', 'amount'),
+    'entrate': ('entrate', 'avere', 'accrediti'),
+    'uscite': ('uscite', 'dare', 'addebiti'),
+    'tipo': ('tipo',),
+    'categoria': ('categoria',),
+}
+
+# Categoria usata quando nessuna regola si applica
+CATEGORIE_DEFAULT = {'uscita': 'Altro', 'entrata': 'Extra'}
+
+FORMATI_DATA = ('%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d')
+
+# Origine dei numeri seriali Excel (sistema 1900)
+_EXCEL_EPOCH = date(1899, 12, 30)
+
+
+def _normalizza(testo):
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', ' ', str(testo or '').lower())).strip()
+
+
+# === Lettura dei formati ===
+
+class _DialettoDefault(csv.excel):
+    # Separatore usato dagli estratti conto italiani quando il rilevamento fallisce
+    delimiter = ';'
+
+
+def _righe_csv(stream):
+    campione = stream.read(65536)
+    try:
+        campione.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Un carattere multibyte troncato a fine campione non indica un'altra codifica
+        encoding = 'utf-8-sig' if e.start >= len(campione) - 3 else 'cp1252'
+    try:
+        dialetto = csv.Sniffer().sniff(campione.decode(encoding, errors='ignore'), delimiters=';,\t|')
+    except csv.Error:
+        dialetto = _DialettoDefault
+    stream.seek(0)
+    testo = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    try:
+        for riga in csv.reader(testo, dialetto):
+            yield riga
+    finally:
+        # Evita che la chiusura del wrapper chiuda anche lo stream dell'upload
+        testo.detach()
+
+
+def _righe_xlsx(stream, foglio=None):
+    import openpyxl
+    wb = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        ws = wb[foglio] if foglio else wb.worksheets[0]
+        for riga in ws.iter_rows(values_only=True):
+            yield list(riga)
+    finally:
+        wb.close()
+
+
+def _righe_xls(stream, foglio=None):
+    try:
+        import xlrd
+    except ImportError:
+        raise ValueError("Per importare file .xls è necessario il pacchetto xlrd")
+    book = xlrd.open_workbook(file_contents=stream.read(), on_demand=True)
+    try:
+        sh = book.sheet_by_name(foglio) if foglio else book.sheet_by_index(0)
+        for r in range(sh.nrows):
+            riga = []
+            for cella in sh.row(r):
+                if cella.ctype == xlrd.XL_CELL_DATE:
+                    riga.append(xlrd.xldate_as_datetime(cella.value, book.datemode))
+                else:
+                    riga.append(cella.value)
+            yield riga
+    finally:
+        book.release_resources()
+
+
+def _leggi_righe(stream, filename, foglio=None):
+    estensione = (filename or '').rsplit('.', 1)[-1].lower()
+    if estensione == 'csv':
+        return _righe_csv(stream)
+    if estensione in ('xlsx', 'xlsm'):
+        return _righe_xlsx(stream, foglio)
+    if estensione == 'xls':
+        return _righe_xls(stream, foglio)
+    raise ValueError("Formato non supportato: usare CSV, XLSX o XLS")
+
+
+def _blocchi(righe, dimensione):
+    blocco = []
+    for riga in righe:
+        blocco.append(riga)
+        if len(blocco) >= dimensione:
+            yield blocco
+            blocco = []
+    if blocco:
+        yield blocco
+
+
+# === Conversione dei valori ===
+
+def _parse_data(valore):
+    if valore is None or valore == '':
+        return None
+    if isinstance(valore, datetime):
+        return valore.date()
+    if isinstance(valore, date):
+        return valore
+    if isinstance(valore, (int, float)):
+        # Numero seriale Excel (celle data non formattate)
+        if 20000 <= valore <= 80000:
+            return _EXCEL_EPOCH + timedelta(days=int(valore))
+        return None
+    testo = str(valore).strip().split(' ')[0]
+    for fmt in FORMATI_DATA:
+        try:
+            return datetime.strptime(testo, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_importo(valore):
+    if valore is None or valore == '':
+        return None
+    if isinstance(valore, (int, float)):
+        return float(valore)
+    testo = re.sub(r'[^\d,.\-+]', '', str(valore))
+    if not testo:
+        return None
+    # Il separatore più a destra è quello decimale ("1.234,56" oppure "1,234.56")
+    if ',' in testo and testo.rfind(',') > testo.rfind('.'):
+        testo = testo.replace('.', '').replace(',', '.')
+    else:
+        testo = testo.replace(',', '')
+    try:
+        return float(testo)
+    except ValueError:
+        return None
+
+
+def _mappa_colonne(intestazione, mappatura=None):
+    """Indice di colonna per ogni campo riconosciuto nell'intestazione."""
+    normalizzate = [_normalizza(c) for c in intestazione]
+    colonne = {}
+    for campo, alias in ALIAS_COLONNE.items():
+        cercati = [_normalizza(mappatura[campo])] if mappatura and mappatura.get(campo) else alias
+        for nome in cercati:
+            if nome in normalizzate:
+                colonne[campo] = normalizzate.index(nome)
+                break
+    return colonne
+
+
+def _trova_intestazione(righe, mappatura=None):
+    """Consuma le righe fino all'intestazione e ritorna la mappa delle colonne."""
+    for n, riga in enumerate(righe):
+        if n >= MAX_RIGHE_INTESTAZIONE:
+            break
+        colonne = _mappa_colonne(riga, mappatura)
+        if 'data' in colonne and ('importo' in colonne or 'entrate' in colonne or 'uscite' in colonne):
+            return colonne
+    return None
+
+
+def _hash_transazione(data_tx, importo, tipo, descrizione):
+    chiave = f"{data_tx.isoformat()}|{round(float(importo), 2):.2f}|{tipo}|{_normalizza(descrizione)}"
+    return hashlib.sha1(chiave.encode('utf-8')).hexdigest()
+
+
+# === Categorizzazione ===
+
+class _Categorizzatore:
+    """Assegna la categoria in base alla descrizione.
+
+    Ordine delle regole: regole esplicite (parola chiave -> categoria), descrizioni
+    già note (categoria più frequente tra transazioni e archivio, anche come
+    sottostringa), nome della categoria contenuto nella descrizione, default per tipo.
+    """
+
+    def __init__(self, regole=None):
+        categorie = Categorie.query.all()
+        self.tipo_categoria = {c.id: c.tipo for c in categorie}
+        self.per_nome = {_normalizza(c.nome): c.id for c in categorie}
+        self.regole = [(_normalizza(k), v) for k, v in (regole or {}).items() if _normalizza(k)]
+
+        frequenze = {}
+        for tabella in (Transazioni, TransazioniArchivio):
+            righe = db.session.execute(
+                select(tabella.descrizione, tabella.categoria_id, func.count())
+                .where(tabella.categoria_id.isnot(None))
+                .group_by(tabella.descrizione, tabella.categoria_id)
+            ).all()
+            for descrizione, categoria_id, n in righe:
+                chiave = (_normalizza(descrizione), categoria_id)
+                frequenze[chiave] = frequenze.get(chiave, 0) + n
+        note = {}
+        for (descrizione, categoria_id), n in frequenze.items():
+            if descrizione and n > note.get(descrizione, (None, 0))[1]:
+                note[descrizione] = (categoria_id, n)
+        self.note = {d: c for d, (c, _) in note.items()}
+        # Descrizioni più lunghe prima: la corrispondenza più specifica vince
+        self.note_ordinate = sorted(self.note.items(), key=lambda x: -len(x[0]))
+        self.nomi_ordinati = sorted(self.per_nome.items(), key=lambda x: -len(x[0]))
+
+        self.default = {}
+        for tipo, nome in CATEGORIE_DEFAULT.items():
+            cid = self.per_nome.get(_normalizza(nome))
+            if cid is None:
+                cid = next((c.id for c in categorie if c.tipo == tipo), None)
+            self.default[tipo] = cid
+
+    def _compatibile(self, categoria_id, tipo):
+        return categoria_id is not None and self.tipo_categoria.get(categoria_id) == tipo
+
+    def categoria(self, descrizione, tipo, nome_categoria=None):
+        if nome_categoria:
+            cid = self.per_nome.get(_normalizza(nome_categoria))
+            if cid is not None:
+                return cid
+        testo = _normalizza(descrizione)
+        for parola, cid in self.regole:
+            if parola in testo and self._compatibile(cid, tipo):
+                return cid
+        cid = self.note.get(testo)
+        if self._compatibile(cid, tipo):
+            return cid
+        for gruppo in (self.note_ordinate, self.nomi_ordinati):
+            for chiave, cid in gruppo:
+                if chiave and chiave in testo and self._compatibile(cid, tipo):
+                    return cid
+        return self.default.get(tipo)
+
+
+def _hash_esistenti():
+    """Quante volte ogni hash compare in transazioni e archivio (una query per tabella)."""
+    hashes = Counter()
+    for tabella in (Transazioni, TransazioniArchivio):
+        for data_tx, importo, tipo, descrizione in db.session.execute(
+            select(tabella.data, tabella.importo, tabella.tipo, tabella.descrizione)
+        ):
+            if data_tx is not None and importo is not None:
+                hashes[_hash_transazione(data_tx, importo, tipo, descrizione)] += 1
+    return hashes
+
+
+def _converti_riga(riga, colonne):
+    """Ritorna (data, data_effettiva, descrizione, importo, tipo, nome_categoria) o None."""
+    def valore(campo):
+        i = colonne.get(campo)
+        return riga[i] if i is not None and i < len(riga) else None
+
+    data_tx = _parse_data(valore('data'))
+    if data_tx is None:
+        return None
+
+    tipo = _normalizza(valore('tipo'))
+    importo = _parse_importo(valore('importo'))
+    if importo is None:
+        entrata = _parse_importo(valore('entrate')) or 0.0
+        uscita = _parse_importo(valore('uscite')) or 0.0
+        importo = abs(entrata) - abs(uscita)
+    if not importo:
+        return None
+    if tipo not in ('entrata', 'uscita'):
+        tipo = 'uscita' if importo < 0 else 'entrata'
+
+    descrizione = str(valore('descrizione') or '').strip()[:200] or 'Importazione estratto conto'
+    data_effettiva = _parse_data(valore('data_effettiva')) or data_tx
+    return data_tx, data_effettiva, descrizione, round(abs(importo), 2), tipo, valore('categoria')
+
+
+def importa_estratto_conto(stream, filename, mappatura=None, regole=None, foglio=None, chunk_size=CHUNK_SIZE):
+    """Importa le righe di un estratto conto (CSV/XLSX/XLS) come transazioni.
+
+    - `mappatura`: override campo -> intestazione (es. {'descrizione': 'Causale'});
+    - `regole`: parola chiave nella descrizione -> categoria_id;
+    - `foglio`: nome del foglio per i file Excel (default il primo).
+
+    Ritorna (success, message, risultato) dove `risultato` contiene i conteggi
+    e `periodi`, gli id_periodo (YYYYMM) toccati dall'import.
+    """
+    risultato = {'importate': 0, 'duplicate': 0, 'scartate': 0, 'periodi': []}
+    try:
+        righe = iter(_leggi_righe(stream, filename, foglio))
+        colonne = _trova_intestazione(righe, mappatura)
+        if colonne is None:
+            return False, "Intestazione non trovata: servono almeno le colonne data e importo", risultato
+
+        categorizzatore = _Categorizzatore(regole)
+        esistenti = _hash_esistenti()
+        oggi = date.today()
+        periodi_cache = {}
+        periodi = set()
+
+        for blocco in _blocchi(righe, chunk_size):
+            nuove = []
+            for riga in blocco:
+                convertita = _converti_riga(riga, colonne)
+                if convertita is None:
+                    if any(c not in (None, '') for c in riga):
+                        risultato['scartate'] += 1
+                    continue
+                data_tx, data_effettiva, descrizione, importo, tipo, nome_categoria = convertita
+
+                h = _hash_transazione(data_tx, importo, tipo, descrizione)
+                # Scartata solo finché il database ne contiene altrettante copie
+                if esistenti[h] > 0:
+                    esistenti[h] -= 1
+                    risultato['duplicate'] += 1
+                    continue
+
+                # Le righe con data futura restano programmate come in create_transazione
+                if data_effettiva > oggi:
+                    data_effettiva = None
+                data_periodo = data_effettiva or data_tx
+                id_periodo = periodi_cache.get(data_periodo)
+                if id_periodo is None:
+                    fine = get_month_boundaries(data_periodo)[1]
+                    id_periodo = periodi_cache[data_periodo] = fine.year * 100 + fine.month
+                periodi.add(id_periodo)
+
+                nuove.append({
+                    'data': data_tx,
+                    'data_effettiva': data_effettiva,
+                    'descrizione': descrizione,
+                    'importo': importo,
+                    'categoria_id': categorizzatore.categoria(descrizione, tipo, nome_categoria),
+                    'tipo': tipo,
+                    'tx_ricorrente': False,
+                    'tx_modificata': False,
+                    'id_periodo': id_periodo,
+                })
+            if nuove:
+                db.session.execute(insert(Transazioni), nuove)
+                risultato['importate'] += len(nuove)
+
+        db.session.commit()
+        risultato['periodi'] = sorted(periodi)
+        return True, (f"Importate {risultato['importate']} transazioni "
+                      f"({risultato['duplicate']} duplicate, {risultato['scartate']} scartate)"), risultato
+    except Exception as e:
+        db.session.rollback()
+        logger.error('Errore import estratto conto: %s', e)
+        return False, str(e), risultato
@@ -86,6 +86,7 @@ def do_monthly_rollover(force=False, months=1, base_date=None):
             ).all()
             
             archived_count = 0
+            archived_periods = set()
             # Archivia ogni transazione prima di eliminarla
             for tx in old_transactions:
                 # Recupera il nome della categoria per denormalizzazione
@@ -112,6 +113,7 @@ def do_monthly_rollover(force=False, months=1, base_date=None):
                 )
                 db.session.add(archived_tx)
                 archived_count += 1
+                archived_periods.add(tx.id_periodo)
             
             # Commit dell'archiviazione
             db.session.commit()
@@ -123,6 +125,10 @@ def do_monthly_rollover(force=False, months=1, base_date=None):
             ).delete(synchronize_session=False)
             db.session.commit()
             result['deleted_old_transactions'] = int(deleted_old)
+
+            # Rimaterializza il riepilogo mensile dei periodi appena archiviati
+            from app.services.transazioni.report_service import aggiorna_report_mensile
+            result['report_mensile_aggiornati'] = aggiorna_report_mensile(archived_periods)
         except Exception as e:
             db.session.rollback()
             result['delete_old_error'] = str(e)
@@ -274,3 +280,23 @@ def do_monthly_rollover(force=False, months=1, base_date=None):
         # best-effort: return error info
         db.session.rollback()
         return {'error': str(e)}
+
+
+def registra_marker_rollover(marker):
+    """Salva in `rollover_state` il periodo finanziario per cui il rollover è stato eseguito."""
+    try:
+        from app.models.RolloverState import RolloverState
+        r = db.session.query(RolloverState).order_by(RolloverState.id.asc()).first()
+        if not r:
+            r = RolloverState(marker=marker)
+            db.session.add(r)
+        else:
+            r.marker = marker
+        db.session.commit()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
@@ -0,0 +1,238 @@
+"""Operazioni multiple (aggiungi/modifica/elimina) sulle transazioni in una sola richiesta.
+
+Le operazioni sono validate tutte insieme prima di toccare il database e
+applicate in un'unica transazione: o passano tutte o nessuna. Le variazioni
+`(prima, dopo)` di ciascuna riga sono restituite al chiamante, che aggiorna i
+riepiloghi dei periodi toccati una volta sola.
+"""
+import logging
+import math
+from datetime import datetime
+
+from app import db
+from app.models.Categorie import Categorie
+from app.models.Transazioni import Transazioni
+from app.services import BaseService, get_month_boundaries
+from app.services.ppay_evolution.collegamenti_service import e_ricarica_ppay, movimento_collegato
+from app.services.transazioni.dettaglio_delta_service import stato_transazione
+
+logger = logging.getLogger(__name__)
+
+AZIONI = ('aggiungi', 'modifica', 'elimina')
+TIPI = ('entrata', 'uscita')
+MAX_OPERAZIONI = 500
+
+
+def _periodo(tx):
+    fine = get_month_boundaries(tx.data_effettiva or tx.data)[1]
+    return int(fine.year) * 100 + int(fine.month)
+
+
+class OperazioniBatchService(BaseService):
+    """Validazione e applicazione atomica di un lotto di operazioni sulle transazioni"""
+
+    def _valida_campi(self, op, categorie_ids, obbligatori):
+        """Normalizza i campi di aggiungi/modifica; ritorna (campi, errore)."""
+        campi = {}
+        if 'data' in op or 'data' in obbligatori:
+            try:
+                campi['data'] = datetime.strptime(str(op.get('data') or ''), '%Y-%m-%d').date()
+            except ValueError:
+                return None, 'Data mancante o non valida.'
+        if 'importo' in op or 'importo' in obbligatori:
+            try:
+                campi['importo'] = float(op.get('importo'))
+            except (TypeError, ValueError):
+                return None, 'Importo mancante o non valido.'
+            # NaN e infinito passano da float() (e dal parser JSON di Flask)
+            if not math.isfinite(campi['importo']):
+                return None, 'Importo mancante o non valido.'
+        if 'tipo' in op:
+            if op.get('tipo') not in TIPI:
+                return None, 'Tipo non valido.'
+            campi['tipo'] = op['tipo']
+        if 'categoria_id' in op:
+            valore = op.get('categoria_id')
+            try:
+                campi['categoria_id'] = int(valore) if valore not in (None, '') else None
+            except (TypeError, ValueError):
+                return None, 'Categoria non valida.'
+            if campi['categoria_id'] is not None and campi['categoria_id'] not in categorie_ids:
+                return None, 'Categoria inesistente.'
+        if 'descrizione' in op:
+            campi['descrizione'] = str(op.get('descrizione') or '')
+        return campi, None
+
+    def valida(self, operazioni):
+        """Controlla l'intero lotto senza modificare il database.
+
+        Ritorna (operazioni normalizzate, transazioni esistenti per id, errori),
+        dove errori è una lista di {'indice', 'message'}.
+        """
+        if not isinstance(operazioni, list) or not operazioni:
+            return [], {}, [{'indice': None, 'message': 'Nessuna operazione da applicare.'}]
+        if len(operazioni) > MAX_OPERAZIONI:
+            return [], {}, [{'indice': None, 'message': f'Massimo {MAX_OPERAZIONI} operazioni per richiesta.'}]
+
+        categorie_ids = {c.id for c in Categorie.query.all()}
+        ids = set()
+        for op in operazioni:
+            if isinstance(op, dict) and op.get('azione') in ('modifica', 'elimina'):
+                try:
+                    ids.add(int(op.get('id')))
+                except (TypeError, ValueError):
+                    pass
+        esistenti = {t.id: t for t in Transazioni.query.filter(Transazioni.id.in_(ids)).all()} if ids else {}
+
+        normalizzate, errori, visti = [], [], set()
+        for i, op in enumerate(operazioni):
+            if not isinstance(op, dict) or op.get('azione') not in AZIONI:
+                errori.append({'indice': i, 'message': 'Azione non valida.'})
+                continue
+            azione = op['azione']
+            voce = {'indice': i, 'azione': azione}
+            if azione != 'aggiungi':
+                try:
+                    voce['id'] = int(op.get('id'))
+                except (TypeError, ValueError):
+                    errori.append({'indice': i, 'message': 'Id transazione mancante.'})
+                    continue
+                if voce['id'] not in esistenti:
+                    errori.append({'indice': i, 'message': f"Transazione {voce['id']} inesistente."})
+                    continue
+                if voce['id'] in visti:
+                    errori.append({'indice': i, 'message': f"Transazione {voce['id']} presente in più operazioni."})
+                    continue
+                visti.add(voce['id'])
+            if azione != 'elimina':
+                obbligatori = ('data', 'importo') if azione == 'aggiungi' else ()
+                campi, errore = self._valida_campi(op, categorie_ids, obbligatori)
+                if errore:
+                    errori.append({'indice': i, 'message': errore})
+                    continue
+                voce['campi'] = campi
+            normalizzate.append(voce)
+        return normalizzate, esistenti, errori
+
+    def applica(self, operazioni):
+        """Valida e applica il lotto in un'unica transazione.
+
+        Ritorna (success, message, risultato): in caso di successo risultato
+        contiene 'operazioni' (esito per indice), 'variazioni' per i
+        riepiloghi e 'data_minima' (prima data toccata); altrimenti 'errori'.
+        """
+        normalizzate, esistenti, errori = self.valida(operazioni)
+        if errori:
+            return False, 'Operazioni non valide', {'errori': errori}
+
+        oggi = datetime.now().date()
+        applicate, ricariche_eliminate, date_toccate = [], [], []
+        try:
+            for voce in normalizzate:
+                azione, campi = voce['azione'], voce.get('campi', {})
+                if azione == 'aggiungi':
+                    tx = Transazioni(
+                        data=campi['data'],
+                        data_effettiva=campi['data'] if campi['data'] <= oggi else None,
+                        descrizione=campi.get('descrizione', ''),
+                        importo=campi['importo'],
+                        categoria_id=campi.get('categoria_id'),
+                        tipo=campi.get('tipo', 'uscita'),
+                        tx_ricorrente=False,
+                    )
+                    tx.id_periodo = _periodo(tx)
+                    db.session.add(tx)
+                    applicate.append((voce, None, tx))
+                    date_toccate.append(tx.data)
+                    continue
+
+                tx = esistenti[voce['id']]
+                prima = stato_transazione(tx)
+                date_toccate.append(tx.data)
+                if azione == 'elimina':
+                    movimento = movimento_collegato(tx.id)
+                    if movimento is not None:
+                        ricariche_eliminate.append(movimento.id)
+                    db.session.delete(tx)
+                    applicate.append((voce, prima, None))
+                    continue
+
+                if 'data' in campi:
+                    tx.data = campi['data']
+                    tx.data_effettiva = tx.data if tx.data <= oggi else None
+                for campo in ('descrizione', 'importo', 'categoria_id', 'tipo'):
+                    if campo in campi:
+                        setattr(tx, campo, campi[campo])
+                # Modificata dall'utente: il soft-reset non deve ricrearla
+                tx.tx_modificata = True
+                tx.id_periodo = _periodo(tx)
+                date_toccate.append(tx.data)
+                applicate.append((voce, prima, tx))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Applicazione lotto di operazioni non riuscita')
+            return False, 'Errore durante il salvataggio delle operazioni.', {'errori': []}
+
+        risultati, variazioni = [], []
+        for voce, prima, tx in applicate:
+            esito = {'indice': voce['indice'], 'azione': voce['azione'], 'id': voce.get('id')}
+            if tx is not None:
+                esito['id'] = tx.id
+                esito['transazione'] = {
+                    'id': tx.id,
+                    'data': tx.data.strftime('%Y-%m-%d') if tx.data else None,
+                    'descrizione': tx.descrizione,
+                    'importo': float(tx.importo or 0.0),
+                    'categoria_id': tx.categoria_id,
+                    'categoria_nome': tx.categoria.nome if tx.categoria else None,
+                    'tipo': tx.tipo,
+                    'tx_ricorrente': bool(getattr(tx, 'tx_ricorrente', False)),
+                }
+            risultati.append(esito)
+            variazioni.append((prima, stato_transazione(tx)))
+
+        self._allinea_postepay(
+            [tx for voce, _, tx in applicate if voce['azione'] == 'aggiungi' and e_ricarica_ppay(tx.categoria_id)],
+            ricariche_eliminate,
+        )
+        return True, f'{len(risultati)} operazioni applicate', {
+            'operazioni': risultati,
+            'variazioni': variazioni,
+            'data_minima': min(date_toccate) if date_toccate else None,
+        }
+
+    def _allinea_postepay(self, ricariche_create, ricariche_eliminate):
+        """Crea/elimina i movimenti PostePay collegati alle ricariche (best-effort, dopo il commit)."""
+        if not ricariche_create and not ricariche_eliminate:
+            return
+        try:
+            from app.models.PostePayEvolution import MovimentoPostePay
+            from app.services.ppay_evolution.ppay_evolution_service import PostePayEvolutionService
+            from app.services.conti_finanziari.strumenti_service import StrumentiService
+
+            ppay_svc = PostePayEvolutionService()
+            for tx in ricariche_create:
+                ppay_svc.create_movimento(
+                    data=tx.data,
+                    importo=tx.importo,
+                    tipo='Ricarica',
+                    descrizione='Ricarica PPay Evolution',
+                    abbonamento_id=None,
+                    tipo_movimento='entrata',
+                    transazione_id=tx.id
+                )
+            for movimento_id in ricariche_eliminate:
+                mov = MovimentoPostePay.query.get(movimento_id)
+                if not mov:
+                    continue
+                signed_value = -abs(mov.importo) if mov.tipo_movimento == 'uscita' else abs(mov.importo)
+                db.session.delete(mov)
+                StrumentiService().applica_delta('Postepay Evolution', -signed_value, commit=False)
+                db.session.commit()
+        except Exception as e:
+            try:
+                db.session.rollback()
+            except Exception:
+                pass
+            logger.error('Allineamento movimenti PostePay non riuscito: %s', e)
@@ -0,0 +1,351 @@
+"""Proiezione dei saldi sui mesi finanziari futuri e scenari "what-if".
+
+La proiezione non genera righe in `transazioni`: ricorrenze, budget e
+scadenze PayPal/PostePay vengono lette una volta e trasformate in matrici
+numpy (ricorrenze x mesi), applicando le stesse regole del generatore
+(`GeneratedTransactionService`): giorno del mese mappato sul periodo 27 -> 26,
+ricorrenze annuali solo nel mese di `prossima_data`, `skip_month_if_annual`
+per le mensili. Uno scenario modifica la lista delle ricorrenze o dei budget
+e ricalcola le matrici, quindi risponde senza toccare il database.
+"""
+import logging
+from datetime import date
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import text
+
+from app import db
+from app.services import BaseService, get_month_boundaries
+
+logger = logging.getLogger(__name__)
+
+GIORNO_INIZIO = 27
+MESI_DEFAULT = 24
+MESI_MAX = 60
+
+NOMI_MESI = [
+    '', 'Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio', 'Giugno',
+    'Luglio', 'Agosto', 'Settembre', 'Ottobre', 'Novembre', 'Dicembre'
+]
+
+
+def _mese(valore):
+    """Mese (1..12) da una data o da una stringa 'YYYY-MM-DD'; None se assente."""
+    if not valore:
+        return None
+    try:
+        if isinstance(valore, str):
+            return int(valore.split('-')[1])
+        return valore.month
+    except Exception:
+        return None
+
+
+def _periodo(d):
+    """id_periodo (YYYYMM della fine periodo) della data `d`."""
+    fine = get_month_boundaries(d)[1]
+    return fine.year * 100 + fine.month
+
+
+class PrevisioniService(BaseService):
+    """Saldi previsti su 12-60 mesi finanziari e confronto con scenari alternativi"""
+
+    # --- lettura dati ---
+
+    def _carica_ricorrenze(self):
+        righe = db.session.execute(text(
+            "SELECT id, descrizione, tipo, importo, giorno, cadenza, prossima_data, "
+            "categoria_id, skip_month_if_annual FROM transazioni_ricorrenti WHERE attivo = 1"
+        )).fetchall()
+        ricorrenze = []
+        for r in righe:
+            cadenza = r[5] or 'mensile'
+            if isinstance(cadenza, bytes):
+                cadenza = cadenza.decode('utf-8')
+            ricorrenze.append({
+                'id': r[0],
+                'descrizione': r[1] or '',
+                'tipo': r[2] or 'uscita',
+                'importo': float(r[3] or 0.0),
+                'giorno': int(r[4] or 1),
+                'annuale': cadenza.lower().startswith('ann'),
+                'mese': _mese(r[6]),
+                'categoria_id': r[7],
+                'skip_month_if_annual': bool(r[8]),
+            })
+        return ricorrenze
+
+    def _carica_budget(self, periodi):
+        """Budget di default per categoria e override mensili nel range dei periodi."""
+        budget = {cat: float(imp or 0.0) for cat, imp in db.session.execute(
+            text("SELECT categoria_id, importo FROM budget")).fetchall()}
+        override = {}
+        if budget:
+            for cat, anno, mese, imp in db.session.execute(text(
+                "SELECT categoria_id, year, month, importo FROM budget_mensili "
+                "WHERE year * 100 + month BETWEEN :da AND :a"
+            ), {'da': int(periodi[0]), 'a': int(periodi[-1])}).fetchall():
+                override[(cat, anno * 100 + mese)] = float(imp or 0.0)
+        return budget, override
+
+    def _carica_paypal(self, periodi):
+        """Rate PayPal non ancora pagate, sommate per periodo (le scadute cadono nel primo)."""
+        serie = np.zeros(len(periodi))
+        try:
+            righe = db.session.execute(text(
+                "SELECT data_scadenza, importo FROM paypal_movimenti WHERE stato != 'pagata'"
+            )).fetchall()
+        except Exception:
+            return serie
+        indice = {p: i for i, p in enumerate(periodi)}
+        for scadenza, importo in righe:
+            if isinstance(scadenza, str):
+                scadenza = date.fromisoformat(scadenza[:10])
+            p = _periodo(scadenza)
+            if p < periodi[0]:
+                serie[0] += float(importo or 0.0)
+            elif p in indice:
+                serie[indice[p]] += float(importo or 0.0)
+        return serie
+
+    def _carica_ppay(self, n):
+        """Addebiti mensili degli abbonamenti PostePay Evolution attivi."""
+        try:
+            totale = db.session.execute(text(
+                "SELECT COALESCE(SUM(importo), 0) FROM ppay_evolution_abbonamenti WHERE attivo = 1"
+            )).scalar() or 0.0
+        except Exception:
+            totale = 0.0
+        return np.full(n, float(totale))
+
+    def _ancoraggio(self, oggi):
+        """Saldo di partenza: saldo finale del periodo corrente in `saldi_mensili`
+        (o dell'ultimo periodo precedente disponibile)."""
+        corrente = _periodo(oggi)
+        riga = db.session.execute(text(
+            "SELECT year, month, saldo_finale FROM saldi_mensili "
+            "WHERE year * 100 + month <= :p ORDER BY year DESC, month DESC LIMIT 1"
+        ), {'p': corrente}).fetchone()
+        if riga:
+            return riga[0] * 100 + riga[1], float(riga[2] or 0.0)
+        # Nessun riepilogo: si parte dal periodo precedente al corrente con il saldo iniziale
+        try:
+            saldo = float(db.session.execute(text("SELECT importo FROM saldo_iniziale LIMIT 1")).scalar() or 0.0)
+        except Exception:
+            saldo = 0.0
+        precedente = get_month_boundaries(oggi)[0] - relativedelta(days=1)
+        return _periodo(precedente), saldo
+
+    def carica_modello(self, mesi=MESI_DEFAULT, oggi=None):
+        """Legge dal DB tutto ciò che serve alla proiezione (poche query, nessuna riga generata)."""
+        oggi = oggi or date.today()
+        mesi = max(1, min(int(mesi or MESI_DEFAULT), MESI_MAX))
+        periodo_ancora, saldo_ancora = self._ancoraggio(oggi)
+
+        anno, mese = divmod(periodo_ancora, 100)
+        primo = date(anno, mese, 1) + relativedelta(months=1)
+        fine_periodi = [primo + relativedelta(months=i) for i in range(mesi)]
+        periodi = np.array([d.year * 100 + d.month for d in fine_periodi])
+
+        budget, override = self._carica_budget(periodi)
+        return {
+            'periodo_ancora': periodo_ancora,
+            'saldo_ancora': saldo_ancora,
+            'periodi': periodi,
+            'ricorrenze': self._carica_ricorrenze(),
+            'budget': budget,
+            'budget_override': override,
+            'paypal': self._carica_paypal(periodi),
+            'ppay': self._carica_ppay(len(periodi)),
+        }
+
+    # --- calcolo vettoriale ---
+
+    @staticmethod
+    def _importi(ricorrenze, periodi):
+        """Matrice (ricorrenze x mesi) degli importi che cadono in ciascun periodo."""
+        n_r, n_m = len(ricorrenze), len(periodi)
+        if not n_r:
+            return np.zeros((0, n_m))
+
+        mese_fine = periodi % 100
+        giorno = np.array([r['giorno'] for r in ricorrenze])
+        # Un giorno >= 27 cade nel mese di inizio del periodo (il precedente alla fine)
+        mese_cal = np.where(giorno[:, None] >= GIORNO_INIZIO, (mese_fine[None, :] - 2) % 12 + 1, mese_fine[None, :])
+
+        annuale = np.array([r['annuale'] for r in ricorrenze])
+        mese_annuale = np.array([r['mese'] or 0 for r in ricorrenze])
+        attiva = ~(annuale[:, None] & (mese_annuale[:, None] > 0) & (mese_cal != mese_annuale[:, None]))
+
+        # skip_month_if_annual: mesi di calendario in cui un'annuale equivalente sostituisce la mensile
+        chiavi_annuali, descr_annuali = {}, {}
+        for r in ricorrenze:
+            if r['annuale'] and r['mese']:
+                chiavi_annuali.setdefault(r['mese'], set()).add((r['categoria_id'], r['tipo']))
+                if r['descrizione']:
+                    descr_annuali.setdefault(r['mese'], set()).add(r['descrizione'].lower())
+        salta = np.zeros((n_r, 13), dtype=bool)
+        for i, r in enumerate(ricorrenze):
+            if r['annuale'] or not r['skip_month_if_annual']:
+                continue
+            descr = r['descrizione'].lower()
+            for m in range(1, 13):
+                if (r['categoria_id'], r['tipo']) in chiavi_annuali.get(m, ()):
+                    salta[i, m] = True
+                elif descr and any(descr in d or d in descr for d in descr_annuali.get(m, ())):
+                    salta[i, m] = True
+        attiva &= ~np.take_along_axis(salta, mese_cal, axis=1)
+
+        # Finestra di validità opzionale (usata dagli scenari)
+        dal = np.array([r.get('dal') or 0 for r in ricorrenze])
+        al = np.array([r.get('al') or 999999 for r in ricorrenze])
+        attiva &= (periodi[None, :] >= dal[:, None]) & (periodi[None, :] <= al[:, None])
+
+        importo = np.array([r['importo'] for r in ricorrenze])
+        return attiva * importo[:, None]
+
+    def proietta(self, modello, includi_paypal=True, includi_ppay=False):
+        """Serie mensili di entrate, uscite (con residui di budget) e saldo previsto.
+
+        Le uscite seguono la regola del dettaglio: uscite pianificate più i
+        residui positivi dei budget di categoria. Le rate PayPal (e, se
+        richiesto, gli addebiti PostePay) sono riportate a parte e sottratte
+        dal saldo solo se incluse.
+        """
+        periodi = modello['periodi']
+        ricorrenze = modello['ricorrenze']
+        importi = self._importi(ricorrenze, periodi)
+
+        uscita = np.array([r['tipo'] == 'uscita' for r in ricorrenze], dtype=bool)
+        entrate = importi[~uscita].sum(axis=0) if len(ricorrenze) else np.zeros(len(periodi))
+        uscite_ric = importi[uscita].sum(axis=0) if len(ricorrenze) else np.zeros(len(periodi))
+
+        # Residui di budget: max(budget - uscite pianificate della categoria, 0)
+        residui = np.zeros(len(periodi))
+        budget = modello['budget']
+        if budget:
+            categorie = list(budget)
+            indice = {c: i for i, c in enumerate(categorie)}
+            assegnazione = np.zeros((len(categorie), len(ricorrenze)))
+            for j, r in enumerate(ricorrenze):
+                if r['tipo'] == 'uscita' and r['categoria_id'] in indice:
+                    assegnazione[indice[r['categoria_id']], j] = 1.0
+            spesa = assegnazione @ importi if len(ricorrenze) else np.zeros((len(categorie), len(periodi)))
+            limiti = np.tile(np.array([budget[c] for c in categorie])[:, None], (1, len(periodi)))
+            for (cat, periodo), imp in modello['budget_override'].items():
+                if cat in indice:
+                    limiti[indice[cat], periodi == periodo] = imp
+            residui = np.clip(limiti - spesa, 0.0, None).sum(axis=0)
+
+        uscite = uscite_ric + residui
+        impegni = modello['paypal'] * includi_paypal + modello['ppay'] * includi_ppay
+        bilancio = entrate - uscite - impegni
+        saldo = modello['saldo_ancora'] + np.cumsum(bilancio)
+
+        minimo = int(np.argmin(saldo)) if len(saldo) else 0
+        return {
+            'periodo_ancora': int(modello['periodo_ancora']),
+            'saldo_ancora': round(modello['saldo_ancora'], 2),
+            'mesi': [
+                {
+                    'periodo': int(p),
+                    'nome': f"{NOMI_MESI[p % 100]} {p // 100}",
+                    'entrate': round(float(entrate[i]), 2),
+                    'uscite_ricorrenti': round(float(uscite_ric[i]), 2),
+                    'residui_budget': round(float(residui[i]), 2),
+                    'uscite': round(float(uscite[i]), 2),
+                    'paypal': round(float(modello['paypal'][i]), 2),
+                    'ppay': round(float(modello['ppay'][i]), 2),
+                    'bilancio': round(float(bilancio[i]), 2),
+                    'saldo': round(float(saldo[i]), 2),
+                }
+                for i, p in enumerate(periodi)
+            ],
+            'saldo_finale': round(float(saldo[-1]), 2) if len(saldo) else round(modello['saldo_ancora'], 2),
+            'saldo_minimo': round(float(saldo[minimo]), 2) if len(saldo) else None,
+            'periodo_saldo_minimo': int(periodi[minimo]) if len(saldo) else None,
+        }
+
+    # --- scenari ---
+
+    @staticmethod
+    def applica_scenario(modello, modifiche):
+        """Copia del modello con le modifiche dello scenario applicate.
+
+        Ogni modifica è un dict con `azione`:
+          - 'aggiungi': nuova ricorrenza (descrizione, tipo, importo, giorno,
+            cadenza, mese per le annuali, categoria_id, dal/al opzionali)
+          - 'rimuovi': ricorrenza `id`, da `dal` (default: tutto l'orizzonte)
+          - 'importo': nuovo `importo` per la ricorrenza `id`, da `dal`
+          - 'budget': nuovo `importo` del budget della `categoria_id`, da `dal`
+        `dal`/`al` sono id_periodo YYYYMM.
+        """
+        ricorrenze = [dict(r) for r in modello['ricorrenze']]
+        budget = dict(modello['budget'])
+        override = dict(modello['budget_override'])
+        per_id = {r['id']: r for r in ricorrenze}
+
+        for i, m in enumerate(modifiche or [], start=1):
+            azione = (m.get('azione') or '').lower()
+            dal = int(m['dal']) if m.get('dal') else None
+            if azione == 'aggiungi':
+                cadenza = (m.get('cadenza') or 'mensile').lower()
+                ricorrenze.append({
+                    'id': None,
+                    'descrizione': m.get('descrizione') or 'Scenario',
+                    'tipo': 'entrata' if m.get('tipo') == 'entrata' else 'uscita',
+                    'importo': abs(float(m.get('importo') or 0.0)),
+                    'giorno': int(m.get('giorno') or 1),
+                    'annuale': cadenza.startswith('ann'),
+                    'mese': int(m['mese']) if m.get('mese') else None,
+                    'categoria_id': m.get('categoria_id'),
+                    'skip_month_if_annual': False,
+                    'dal': dal,
+                    'al': int(m['al']) if m.get('al') else None,
+                })
+            elif azione in ('rimuovi', 'importo'):
+                r = per_id.get(m.get('id'))
+                if r is None:
+                    raise ValueError(f"Modifica {i}: ricorrenza {m.get('id')} non trovata")
+                if dal:
+                    # fino a dal-1 resta la ricorrenza originale, da dal vale la modifica
+                    anno, mese = divmod(dal, 100)
+                    prima = date(anno, mese, 1) - relativedelta(months=1)
+                    storica = dict(r, al=prima.year * 100 + prima.month)
+                    ricorrenze.append(storica)
+                    r['dal'] = dal
+                if azione == 'rimuovi':
+                    r['importo'] = 0.0
+                else:
+                    r['importo'] = abs(float(m.get('importo') or 0.0))
+            elif azione == 'budget':
+                cat = m.get('categoria_id')
+                nuovo = abs(float(m.get('importo') or 0.0))
+                if dal:
+                    # il default resta per i periodi precedenti: gli override coprono da `dal` in poi
+                    for p in modello['periodi']:
+                        if p >= dal:
+                            override[(cat, int(p))] = nuovo
+                    budget.setdefault(cat, 0.0)
+                else:
+                    budget[cat] = nuovo
+                    override = {k: v for k, v in override.items() if k[0] != cat}
+            else:
+                raise ValueError(f"Modifica {i}: azione '{m.get('azione')}' non riconosciuta")
+
+        return dict(modello, ricorrenze=ricorrenze, budget=budget, budget_override=override)
+
+    def previsione(self, mesi=MESI_DEFAULT, scenario=None, oggi=None, includi_paypal=True, includi_ppay=False):
+        """Proiezione base e, se indicato uno scenario, proiezione alternativa con le differenze."""
+        modello = self.carica_modello(mesi=mesi, oggi=oggi)
+        base = self.proietta(modello, includi_paypal=includi_paypal, includi_ppay=includi_ppay)
+        if not scenario:
+            return {'base': base}
+        alternativo = self.proietta(self.applica_scenario(modello, scenario),
+                                    includi_paypal=includi_paypal, includi_ppay=includi_ppay)
+        differenza = [
+            {'periodo': b['periodo'], 'saldo': round(s['saldo'] - b['saldo'], 2)}
+            for b, s in zip(base['mesi'], alternativo['mesi'])
+        ]
+        return {'base': base, 'scenario': alternativo, 'differenza': differenza}
@@ -0,0 +1,232 @@
+"""Report pluriennali (anno su anno, 12 mesi mobili, trend per categoria).
+
+La parte storica viene da `report_mensile`, aggregato materializzato dei
+periodi archiviati che il rollover aggiorna quando sposta un mese in
+`transazioni_archivio`. La parte recente viene da una sola GROUP BY su
+`transazioni`, che contiene solo i mesi non ancora archiviati. Le serie
+sono costruite con numpy su un asse continuo di periodi.
+"""
+import logging
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy import text
+
+from app import db
+from app.services import BaseService, get_month_boundaries
+
+logger = logging.getLogger(__name__)
+
+NOMI_MESI = [
+    '', 'Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio', 'Giugno',
+    'Luglio', 'Agosto', 'Settembre', 'Ottobre', 'Novembre', 'Dicembre'
+]
+
+_AGGREGA_ARCHIVIO_SQL = """
+INSERT INTO report_mensile (id_periodo, categoria_id, tipo, categoria_nome, num_transazioni, totale, data_aggiornamento)
+SELECT id_periodo, COALESCE(categoria_id, 0), tipo, MAX(categoria_nome), COUNT(*), TOTAL(importo), :ora
+FROM transazioni_archivio
+{filtro}
+GROUP BY id_periodo, COALESCE(categoria_id, 0), tipo
+"""
+
+
+def aggiorna_report_mensile(periodi=None):
+    """Rimaterializza `report_mensile` per i periodi indicati (tutti se None).
+
+    Il commit è a carico della funzione; ritorna il numero di periodi aggiornati.
+    """
+    try:
+        if periodi is None:
+            db.session.execute(text("DELETE FROM report_mensile"))
+            db.session.execute(text(_AGGREGA_ARCHIVIO_SQL.format(filtro='')), {'ora': datetime.utcnow()})
+            n = db.session.execute(text("SELECT COUNT(DISTINCT id_periodo) FROM report_mensile")).scalar() or 0
+        else:
+            periodi = sorted({int(p) for p in periodi if p})
+            if not periodi:
+                return 0
+            segnaposto = ', '.join(f':p{i}' for i in range(len(periodi)))
+            parametri = {f'p{i}': p for i, p in enumerate(periodi)}
+            db.session.execute(text(f"DELETE FROM report_mensile WHERE id_periodo IN ({segnaposto})"), parametri)
+            db.session.execute(
+                text(_AGGREGA_ARCHIVIO_SQL.format(filtro=f'WHERE id_periodo IN ({segnaposto})')),
+                {**parametri, 'ora': datetime.utcnow()},
+            )
+            n = len(periodi)
+        db.session.commit()
+        return int(n)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Aggiornamento report_mensile non riuscito: %s', e)
+        return 0
+
+
+def ensure_report_mensile():
+    """Popola `report_mensile` se vuoto ma l'archivio contiene già dei periodi."""
+    try:
+        vuoto = db.session.execute(text("SELECT 1 FROM report_mensile LIMIT 1")).fetchone() is None
+        archivio = db.session.execute(text("SELECT 1 FROM transazioni_archivio LIMIT 1")).fetchone() is not None
+        if vuoto and archivio:
+            aggiorna_report_mensile()
+        return True
+    except Exception:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
+        return False
+
+
+def _periodo_successivo(p):
+    anno, mese = divmod(int(p), 100)
+    return (anno + 1) * 100 + 1 if mese == 12 else p + 1
+
+
+class ReportService(BaseService):
+    """Serie storiche su archivio + transazioni correnti"""
+
+    def _righe(self, fino_a=None, includi_senza_categoria=False):
+        """(periodo, categoria_id, categoria_nome, tipo, num, totale) da report_mensile e transazioni."""
+        if fino_a is None:
+            fine = get_month_boundaries(date.today())[1]
+            fino_a = fine.year * 100 + fine.month
+        filtro_cat = '' if includi_senza_categoria else 'AND r.categoria_id != 0'
+        archivio = db.session.execute(text(f"""
+            SELECT r.id_periodo, r.categoria_id, COALESCE(c.nome, r.categoria_nome), r.tipo, r.num_transazioni, r.totale
+            FROM report_mensile r LEFT JOIN categorie c ON c.id = r.categoria_id
+            WHERE r.id_periodo <= :fino {filtro_cat}
+        """), {'fino': fino_a}).fetchall()
+        filtro_cat = '' if includi_senza_categoria else 'AND t.categoria_id IS NOT NULL'
+        correnti = db.session.execute(text(f"""
+            SELECT t.id_periodo, COALESCE(t.categoria_id, 0), c.nome, t.tipo, COUNT(*), TOTAL(t.importo)
+            FROM transazioni t LEFT JOIN categorie c ON c.id = t.categoria_id
+            WHERE t.id_periodo IS NOT NULL AND t.id_periodo <= :fino {filtro_cat}
+            GROUP BY t.id_periodo, COALESCE(t.categoria_id, 0), t.tipo
+        """), {'fino': fino_a}).fetchall()
+        return list(archivio) + list(correnti)
+
+    @staticmethod
+    def _asse(periodi_presenti):
+        """Asse continuo di periodi dal primo all'ultimo presente."""
+        if not len(periodi_presenti):
+            return np.zeros(0, dtype=int)
+        p, fine, asse = int(min(periodi_presenti)), int(max(periodi_presenti)), []
+        while p <= fine:
+            asse.append(p)
+            p = _periodo_successivo(p)
+        return np.array(asse)
+
+    def _serie(self, righe):
+        """Asse dei periodi e vettori entrate/uscite/conteggi allineati."""
+        periodi = np.array([r[0] for r in righe], dtype=int)
+        asse = self._asse(periodi)
+        if not len(asse):
+            return asse, np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+        idx = np.searchsorted(asse, periodi)
+        importi = np.array([float(r[5] or 0.0) for r in righe])
+        entrata = np.array([r[3] == 'entrata' for r in righe], dtype=bool)
+        num = np.array([int(r[4] or 0) for r in righe])
+        n = len(asse)
+        entrate = np.bincount(idx, weights=np.where(entrata, importi, 0.0), minlength=n)
+        uscite = np.bincount(idx, weights=np.where(entrata, 0.0, importi), minlength=n)
+        conteggi = np.bincount(idx, weights=num, minlength=n).astype(int)
+        return asse, entrate, uscite, conteggi
+
+    def anno_su_anno(self, fino_a=None, includi_senza_categoria=False):
+        """Matrice anni x mesi di entrate, uscite e bilancio, con totali e variazione annua."""
+        asse, entrate, uscite, _ = self._serie(self._righe(fino_a, includi_senza_categoria))
+        if not len(asse):
+            return {'anni': []}
+        anni = np.unique(asse // 100)
+        riga, colonna = np.searchsorted(anni, asse // 100), asse % 100 - 1
+        matrice_e = np.zeros((len(anni), 12))
+        matrice_u = np.zeros((len(anni), 12))
+        matrice_e[riga, colonna] = entrate
+        matrice_u[riga, colonna] = uscite
+        # Mesi coperti da dati per anno: il confronto usa gli stessi mesi dell'anno precedente
+        coperti = np.zeros((len(anni), 12), dtype=bool)
+        coperti[riga, colonna] = True
+
+        risultato = []
+        for i, anno in enumerate(anni):
+            tot_e, tot_u = matrice_e[i].sum(), matrice_u[i].sum()
+            voce = {
+                'anno': int(anno),
+                'mesi': [
+                    {'mese': m + 1, 'nome': NOMI_MESI[m + 1],
+                     'entrate': round(float(matrice_e[i, m]), 2), 'uscite': round(float(matrice_u[i, m]), 2),
+                     'bilancio': round(float(matrice_e[i, m] - matrice_u[i, m]), 2)}
+                    for m in range(12) if coperti[i, m]
+                ],
+                'entrate': round(float(tot_e), 2),
+                'uscite': round(float(tot_u), 2),
+                'bilancio': round(float(tot_e - tot_u), 2),
+                'variazione_uscite_pct': None,
+                'variazione_entrate_pct': None,
+            }
+            if i > 0 and anni[i - 1] == anno - 1:
+                stessi = coperti[i] & coperti[i - 1]
+                prec_e, prec_u = matrice_e[i - 1, stessi].sum(), matrice_u[i - 1, stessi].sum()
+                cur_e, cur_u = matrice_e[i, stessi].sum(), matrice_u[i, stessi].sum()
+                if prec_u:
+                    voce['variazione_uscite_pct'] = round(float((cur_u - prec_u) / prec_u * 100), 1)
+                if prec_e:
+                    voce['variazione_entrate_pct'] = round(float((cur_e - prec_e) / prec_e * 100), 1)
+            risultato.append(voce)
+        return {'anni': risultato}
+
+    def mobile_12_mesi(self, fino_a=None, includi_senza_categoria=False, finestra=12):
+        """Somme mobili su `finestra` mesi di entrate, uscite e bilancio (dal primo mese completo)."""
+        asse, entrate, uscite, _ = self._serie(self._righe(fino_a, includi_senza_categoria))
+        if len(asse) < finestra:
+            return {'finestra': finestra, 'serie': []}
+
+        def _mobile(v):
+            c = np.concatenate([[0.0], np.cumsum(v)])
+            return c[finestra:] - c[:-finestra]
+
+        me, mu = _mobile(entrate), _mobile(uscite)
+        return {
+            'finestra': finestra,
+            'serie': [
+                {'periodo': int(p), 'entrate': round(float(e), 2), 'uscite': round(float(u), 2),
+                 'bilancio': round(float(e - u), 2), 'media_uscite_mensile': round(float(u / finestra), 2)}
+                for p, e, u in zip(asse[finestra - 1:], me, mu)
+            ],
+        }
+
+    def trend_categorie(self, tipo='uscita', ultimi_mesi=None, fino_a=None):
+        """Serie per categoria sull'asse dei periodi, con totale, media e pendenza mensile."""
+        righe = [r for r in self._righe(fino_a) if r[3] == tipo]
+        asse, _, _, _ = self._serie(righe)
+        if not len(asse):
+            return {'periodi': [], 'categorie': []}
+        if ultimi_mesi:
+            asse = asse[-int(ultimi_mesi):]
+            righe = [r for r in righe if r[0] >= asse[0]]
+
+        categorie = sorted({r[1] for r in righe})
+        nomi = {r[1]: r[2] for r in righe}
+        ic = np.searchsorted(np.array(categorie), np.array([r[1] for r in righe], dtype=int))
+        ip = np.searchsorted(asse, np.array([r[0] for r in righe], dtype=int))
+        importi = np.array([float(r[5] or 0.0) for r in righe])
+        matrice = np.bincount(ic * len(asse) + ip, weights=importi,
+                              minlength=len(categorie) * len(asse)).reshape(len(categorie), len(asse))
+
+        # Pendenza della retta ai minimi quadrati (euro/mese) per ciascuna categoria
+        x = np.arange(len(asse), dtype=float)
+        xc = x - x.mean()
+        pendenze = (matrice - matrice.mean(axis=1, keepdims=True)) @ xc / (xc @ xc) if len(asse) > 1 else np.zeros(len(categorie))
+
+        ordine = np.argsort(-matrice.sum(axis=1))
+        return {
+            'periodi': [int(p) for p in asse],
+            'categorie': [
+                {'categoria_id': int(categorie[i]) or None, 'nome': nomi.get(categorie[i]) or 'Senza categoria',
+                 'serie': [round(float(v), 2) for v in matrice[i]],
+                 'totale': round(float(matrice[i].sum()), 2),
+                 'media': round(float(matrice[i].mean()), 2),
+                 'pendenza_mensile': round(float(pendenze[i]), 2)}
+                for i in ordine
+            ],
+        }
@@ -4,9 +4,6 @@ from app import db
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import text
-import os
-import shutil
-from flask import current_app
 
 
 class ResetService(BaseService):
@@ -24,43 +21,15 @@ class ResetService(BaseService):
         start_date = date(financial_end.year, financial_end.month, 1)
 
         try:
-            # Automatic DB backup (best-effort)
+            # Automatic DB backup (best-effort): online copy via the SQLite backup API
             backup_path = None
             try:
-                # Try to infer sqlite DB path from SQLALCHEMY_DATABASE_URI
-                db_uri = current_app.config.get('SQLALCHEMY_DATABASE_URI', '') if current_app else ''
+                from app.services.backup.backup_service import BackupService
+                ok_backup, _, backup_info = BackupService().crea_backup(motivo='reset')
+                if ok_backup and backup_info:
+                    backup_path = backup_info['path']
             except Exception:
-                db_uri = ''
-
-            db_path = None
-            if db_uri and db_uri.startswith('sqlite'):
-                # handle sqlite:///absolute/path and sqlite://relative
-                if db_uri.startswith('sqlite:///'):
-                    db_path = db_uri[len('sqlite:///'):]
-                else:
-                    db_path = db_uri.replace('sqlite://', '')
-                if db_path == ':memory:':
-                    db_path = None
-            # fallback to repository db path
-            if not db_path:
-                repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
-                candidate = os.path.join(repo_root, 'db', 'bilancio.db')
-                if os.path.exists(candidate):
-                    db_path = candidate
-
-            if db_path and os.path.exists(db_path):
-                try:
-                    # Save backup in the same directory as the DB file
-                    backup_dir = os.path.dirname(db_path) or os.getcwd()
-                    os.makedirs(backup_dir, exist_ok=True)
-                    ts = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-                    base_name = os.path.splitext(os.path.basename(db_path))[0]
-                    ext = os.path.splitext(db_path)[1] or '.db'
-                    backup_name = f"{base_name}_backup_{ts}{ext}"
-                    backup_path = os.path.join(backup_dir, backup_name)
-                    shutil.copy2(db_path, backup_path)
-                except Exception:
-                    backup_path = None
+                backup_path = None
 
             # 1) Update the 'Conto Bancoposta' strumento saldo_iniziale (and saldo_corrente)
             try:
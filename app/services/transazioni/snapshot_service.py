@@ -0,0 +1,338 @@
+"""Snapshot colonnare in memoria di `transazioni` e `transazioni_archivio` per le analisi.
+
+Le righe di entrambe le tabelle sono tenute in array numpy compatti (data come
+giorni dal 1970 in int32, importo float64, categoria e tipo come codici
+interi): aggregazioni per periodo, categoria e anno sono riduzioni vettoriali
+(`bincount`) senza query né oggetti ORM.
+
+Lo snapshot si carica al primo utilizzo. Le scritture ORM (insert, update,
+delete) vengono applicate in coda agli array dopo il commit. Per le scritture
+fatte fuori dall'ORM o da altri processi si usa la versione per tabella di
+`http_cache` (riga di `versioni_dati` incrementata da trigger): solo se è
+cambiata dall'ultima sincronizzazione, o comunque ogni
+`ANALYTICS_SNAPSHOT_VERIFICA_SECONDI` (database senza trigger, es. appena
+ripristinato), si confronta un'impronta SQL (conteggio, id massimo, somme
+intere) con lo snapshot, recuperando le sole righe nuove o ricaricando tutto
+se la tabella è cambiata in altro modo.
+"""
+import logging
+import threading
+import time
+from datetime import date
+
+import numpy as np
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models.Transazioni import Transazioni
+from app.models.TransazioniArchivio import TransazioniArchivio
+from app.utils import http_cache
+
+logger = logging.getLogger(__name__)
+
+GIORNO_INIZIO = 27
+
+# Codici delle colonne categoriali
+FONTE_CORRENTI, FONTE_ARCHIVIO = 0, 1
+TIPO_ENTRATA, TIPO_USCITA = 0, 1
+NESSUNA_CATEGORIA = -1
+
+_TABELLE = {FONTE_CORRENTI: 'transazioni', FONTE_ARCHIVIO: 'transazioni_archivio'}
+_MODELLI = {Transazioni: FONTE_CORRENTI, TransazioniArchivio: FONTE_ARCHIVIO}
+
+_COLONNE_SQL = (
+    "id, CAST(julianday(data) - 2440587.5 AS INTEGER), importo, "
+    "COALESCE(categoria_id, -1), CASE WHEN tipo = 'entrata' THEN 0 ELSE 1 END, "
+    "COALESCE(id_periodo, 0), data_effettiva IS NOT NULL"
+)
+# Importi in decimillesimi troncati: somma intera confrontabile esattamente con numpy
+_SCALA_IMPORTO = 10000
+_IMPRONTA_SQL = (
+    "SELECT COUNT(*), COALESCE(MAX(id), 0), "
+    f"COALESCE(SUM(CAST(importo * {_SCALA_IMPORTO} AS INTEGER)), 0), TOTAL(COALESCE(categoria_id, -1)), "
+    "TOTAL(CAST(julianday(data) - 2440587.5 AS INTEGER)), TOTAL(data_effettiva IS NOT NULL), "
+    "TOTAL(tipo = 'entrata') FROM {tabella}"
+)
+
+_EPOCA = date(1970, 1, 1).toordinal()
+
+
+def periodi_da_giorni(giorni):
+    """id_periodo (YYYYMM della fine del mese finanziario 27 -> 26) da giorni dal 1970."""
+    giorni = np.asarray(giorni, dtype='int64').astype('datetime64[D]')
+    mesi = giorni.astype('datetime64[M]')
+    giorno_mese = (giorni - mesi).astype('int64') + 1
+    fine = (mesi + (giorno_mese >= GIORNO_INIZIO)).astype('int64')  # mesi dal 1970
+    return ((fine // 12 + 1970) * 100 + fine % 12 + 1).astype('int32')
+
+
+class _Colonne:
+    """Array paralleli di una o più righe."""
+    __slots__ = ('fonte', 'id', 'giorno', 'importo', 'categoria', 'tipo', 'periodo', 'effettiva')
+
+    def __init__(self, fonte, righe):
+        n = len(righe)
+        self.fonte = np.full(n, fonte, dtype='int8')
+        if n:
+            cols = list(zip(*righe))
+            self.id = np.array(cols[0], dtype='int64')
+            self.giorno = np.array(cols[1], dtype='int32')
+            self.importo = np.array(cols[2], dtype='float64')
+            self.categoria = np.array(cols[3], dtype='int32')
+            self.tipo = np.array(cols[4], dtype='int8')
+            periodo = np.array(cols[5], dtype='int32')
+            self.effettiva = np.array(cols[6], dtype=bool)
+        else:
+            self.id = np.zeros(0, dtype='int64')
+            self.giorno = np.zeros(0, dtype='int32')
+            self.importo = np.zeros(0, dtype='float64')
+            self.categoria = np.zeros(0, dtype='int32')
+            self.tipo = np.zeros(0, dtype='int8')
+            periodo = np.zeros(0, dtype='int32')
+            self.effettiva = np.zeros(0, dtype=bool)
+        # id_periodo mancante: derivato dalla data
+        self.periodo = np.where(periodo > 0, periodo, periodi_da_giorni(self.giorno)).astype('int32')
+
+    @classmethod
+    def concatena(cls, parti):
+        out = cls.__new__(cls)
+        for nome in cls.__slots__:
+            setattr(out, nome, np.concatenate([getattr(p, nome) for p in parti]))
+        return out
+
+    def filtra(self, maschera):
+        out = self.__class__.__new__(self.__class__)
+        for nome in self.__slots__:
+            setattr(out, nome, getattr(self, nome)[maschera])
+        return out
+
+
+def _riga_da_oggetto(obj):
+    giorno = obj.data.toordinal() - _EPOCA if obj.data else 0
+    return (
+        obj.id, giorno, float(obj.importo or 0.0),
+        obj.categoria_id if obj.categoria_id is not None else NESSUNA_CATEGORIA,
+        TIPO_ENTRATA if obj.tipo == 'entrata' else TIPO_USCITA,
+        obj.id_periodo or 0, obj.data_effettiva is not None,
+    )
+
+
+class SnapshotTransazioni:
+    """Snapshot colonnare condiviso dal processo (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._colonne = None
+        self._url = None
+        self._versioni = {}
+        self._verificato = 0.0
+
+    # --- caricamento e sincronizzazione ---
+
+    def _leggi(self, fonte, da_id=0):
+        righe = db.session.execute(text(
+            f"SELECT {_COLONNE_SQL} FROM {_TABELLE[fonte]} WHERE id > :da ORDER BY id"
+        ), {'da': da_id}).fetchall()
+        return _Colonne(fonte, righe)
+
+    def _impronta_db(self, fonte):
+        r = db.session.execute(text(_IMPRONTA_SQL.format(tabella=_TABELLE[fonte]))).fetchone()
+        return tuple(int(v) for v in r)
+
+    def _impronta_snapshot(self, fonte):
+        c = self._colonne
+        m = c.fonte == fonte
+        if not m.any():
+            return (0, 0, 0, 0, 0, 0, 0)
+        importi = np.trunc(c.importo[m] * _SCALA_IMPORTO).astype('int64')
+        return (
+            int(m.sum()), int(c.id[m].max()), int(importi.sum()), int(c.categoria[m].sum()),
+            int(c.giorno[m].astype('int64').sum()), int(c.effettiva[m].sum()), int((c.tipo[m] == TIPO_ENTRATA).sum()),
+        )
+
+    @staticmethod
+    def _versioni_db():
+        # Letti prima delle tabelle: un commit concorrente porta al più a una verifica in più
+        contatori = http_cache.istantanea()
+        return {f: http_cache.versione_tabelle((t,), contatori) for f, t in _TABELLE.items()}
+
+    def ricarica(self):
+        """Rilegge entrambe le tabelle da zero."""
+        with self._lock:
+            versioni = self._versioni_db()
+            self._colonne = _Colonne.concatena([self._leggi(f) for f in _TABELLE])
+            self._url = str(db.engine.url)
+            self._versioni, self._verificato = versioni, time.monotonic()
+            return self._colonne
+
+    def sincronizza(self):
+        """Allinea lo snapshot al database e ritorna le colonne correnti."""
+        with self._lock:
+            if not _abilitato() or self._colonne is None or self._url != str(db.engine.url):
+                return self.ricarica()
+            versioni = self._versioni_db()
+            scaduta = time.monotonic() - self._verificato >= _intervallo_verifica()
+            for fonte in _TABELLE:
+                if not scaduta and versioni[fonte] == self._versioni.get(fonte):
+                    continue
+                atteso = self._impronta_db(fonte)
+                attuale = self._impronta_snapshot(fonte)
+                if atteso == attuale:
+                    continue
+                # Solo righe aggiunte (es. insert massivi): leggi gli id oltre il massimo noto
+                if atteso[0] > attuale[0] and atteso[1] > attuale[1]:
+                    nuove = self._leggi(fonte, da_id=attuale[1])
+                    self._colonne = _Colonne.concatena([self._colonne, nuove])
+                    if atteso == self._impronta_snapshot(fonte):
+                        continue
+                return self.ricarica()
+            self._versioni = versioni
+            if scaduta:
+                self._verificato = time.monotonic()
+            return self._colonne
+
+    def invalida(self):
+        with self._lock:
+            self._colonne = None
+
+    def applica_modifiche(self, operazioni):
+        """Applica a snapshot caricato le operazioni ORM confermate: (op, fonte, id, riga)."""
+        with self._lock:
+            if self._colonne is None or not operazioni:
+                return
+            # Conta solo lo stato finale di ogni riga toccata nella transazione
+            ultimo = {}
+            for op, fonte, id_, riga in operazioni:
+                ultimo[(fonte, id_)] = (op, riga)
+            c = self._colonne
+            rimuovi = np.zeros(len(c.id), dtype=bool)
+            aggiunte = {f: [] for f in _TABELLE}
+            for fonte in _TABELLE:
+                ids = [i for (f, i) in ultimo if f == fonte]
+                if ids:
+                    rimuovi |= (c.fonte == fonte) & np.isin(c.id, ids)
+            for (fonte, _id), (op, riga) in ultimo.items():
+                if op != 'delete':
+                    aggiunte[fonte].append(riga)
+            parti = [c.filtra(~rimuovi)] if rimuovi.any() else [c]
+            parti += [_Colonne(f, righe) for f, righe in aggiunte.items() if righe]
+            self._colonne = _Colonne.concatena(parti) if len(parti) > 1 else parti[0]
+
+    # --- aggregazioni ---
+
+    def _selezione(self, da_periodo=None, a_periodo=None, fonti=None, solo_effettive=False):
+        c = self.sincronizza()
+        m = np.ones(len(c.id), dtype=bool)
+        if da_periodo:
+            m &= c.periodo >= int(da_periodo)
+        if a_periodo:
+            m &= c.periodo <= int(a_periodo)
+        if fonti is not None:
+            m &= np.isin(c.fonte, list(fonti))
+        if solo_effettive:
+            m &= c.effettiva
+        return c.filtra(m)
+
+    @staticmethod
+    def _per_chiave(chiavi, c):
+        """Entrate, uscite e conteggi raggruppati per `chiavi` con bincount."""
+        valori, inv = np.unique(chiavi, return_inverse=True)
+        n = len(valori)
+        entrata = c.tipo == TIPO_ENTRATA
+        entrate = np.bincount(inv, weights=np.where(entrata, c.importo, 0.0), minlength=n)
+        uscite = np.bincount(inv, weights=np.where(entrata, 0.0, c.importo), minlength=n)
+        conteggi = np.bincount(inv, minlength=n)
+        return valori, entrate, uscite, conteggi
+
+    def per_periodo(self, da_periodo=None, a_periodo=None, fonti=None, solo_effettive=False):
+        """Entrate, uscite, bilancio e numero di movimenti per id_periodo."""
+        c = self._selezione(da_periodo, a_periodo, fonti, solo_effettive)
+        valori, entrate, uscite, conteggi = self._per_chiave(c.periodo, c)
+        return [
+            {'periodo': int(p), 'entrate': round(float(e), 2), 'uscite': round(float(u), 2),
+             'bilancio': round(float(e - u), 2), 'num': int(n)}
+            for p, e, u, n in zip(valori, entrate, uscite, conteggi)
+        ]
+
+    def per_anno(self, fonti=None, solo_effettive=False):
+        """Totali per anno solare della fine periodo."""
+        c = self._selezione(fonti=fonti, solo_effettive=solo_effettive)
+        valori, entrate, uscite, conteggi = self._per_chiave(c.periodo // 100, c)
+        return [
+            {'anno': int(a), 'entrate': round(float(e), 2), 'uscite': round(float(u), 2),
+             'bilancio': round(float(e - u), 2), 'num': int(n)}
+            for a, e, u, n in zip(valori, entrate, uscite, conteggi)
+        ]
+
+    def per_categoria(self, da_periodo=None, a_periodo=None, fonti=None, solo_effettive=False):
+        """Totali per categoria (categoria_id None per i movimenti senza categoria)."""
+        c = self._selezione(da_periodo, a_periodo, fonti, solo_effettive)
+        valori, entrate, uscite, conteggi = self._per_chiave(c.categoria, c)
+        return [
+            {'categoria_id': None if k == NESSUNA_CATEGORIA else int(k), 'entrate': round(float(e), 2),
+             'uscite': round(float(u), 2), 'num': int(n)}
+            for k, e, u, n in zip(valori, entrate, uscite, conteggi)
+        ]
+
+    def matrice_categorie(self, da_periodo=None, a_periodo=None, fonti=None, tipo='uscita'):
+        """Matrice categorie x periodi degli importi di un tipo (per grafici di trend).
+
+        Ritorna (categorie, periodi, matrice numpy).
+        """
+        c = self._selezione(da_periodo, a_periodo, fonti)
+        c = c.filtra(c.tipo == (TIPO_ENTRATA if tipo == 'entrata' else TIPO_USCITA))
+        categorie, ic = np.unique(c.categoria, return_inverse=True)
+        periodi, ip = np.unique(c.periodo, return_inverse=True)
+        matrice = np.bincount(ic * len(periodi) + ip, weights=c.importo,
+                              minlength=len(categorie) * len(periodi)).reshape(len(categorie), len(periodi))
+        return categorie, periodi, matrice
+
+
+def _abilitato():
+    if not has_app_context():
+        return True
+    return bool(current_app.config.get('ANALYTICS_SNAPSHOT', True))
+
+
+def _intervallo_verifica():
+    if not has_app_context():
+        return 300
+    return current_app.config.get('ANALYTICS_SNAPSHOT_VERIFICA_SECONDI', 300)
+
+
+snapshot_transazioni = SnapshotTransazioni()
+
+
+# --- propagazione delle scritture ORM ---
+
+def _registra(op):
+    def _listener(_mapper, _connection, target):
+        sess = object_session(target)
+        if sess is None or snapshot_transazioni._colonne is None:
+            return
+        riga = _riga_da_oggetto(target) if op != 'delete' else None
+        sess.info.setdefault('snapshot_transazioni', []).append((op, _MODELLI[type(target)], target.id, riga))
+    return _listener
+
+
+for _modello in _MODELLI:
+    for _op in ('insert', 'update', 'delete'):
+        event.listen(_modello, f'after_{_op}', _registra(_op))
+
+
+@event.listens_for(Session, 'after_commit')
+def _dopo_commit(sess):
+    operazioni = sess.info.pop('snapshot_transazioni', None)
+    if operazioni:
+        try:
+            snapshot_transazioni.applica_modifiche(operazioni)
+        except Exception:
+            logger.warning('Aggiornamento snapshot transazioni non riuscito', exc_info=True)
+            snapshot_transazioni.invalida()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _dopo_rollback(sess, _previous_transaction):
+    sess.info.pop('snapshot_transazioni', None)
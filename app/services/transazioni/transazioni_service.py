@@ -2,6 +2,7 @@
 from app.services import BaseService, DateUtilsService, get_month_boundaries
 from app.models.Transazioni import Transazioni
 from app.models.Categorie import Categorie
+from app.services.ppay_evolution.collegamenti_service import e_ricarica_ppay
 from app import db
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
@@ -136,12 +137,12 @@ class TransazioneService(BaseService):
                 # Aggiungi la transazione alla sessione
                 db.session.add(transazioni)
 
-                # If categoria_id == 10 (Ricarica PPay Ev): questa è un'uscita dal conto principale
+                # Categoria "Ricarica PPay Ev": questa è un'uscita dal conto principale
                 # che corrisponde a un'entrata (ricarica) su PostePay Evolution.
                 # Commit the transazione first so it has a proper primary key.
-                if categoria_id == 10:
+                if e_ricarica_ppay(categoria_id):
                     db.session.commit()
-                    current_app.logger.info(f"Transazione cat 10 creata con id {transazioni.id}, importo {importo}")
+                    current_app.logger.info(f"Transazione di ricarica PostePay creata con id {transazioni.id}, importo {importo}")
 
                     try:
                         # Usa il servizio dedicato per creare il movimento in modo che venga
@@ -156,7 +157,8 @@ class TransazioneService(BaseService):
                             tipo='Ricarica',
                             descrizione='Ricarica PPay Evolution',
                             abbonamento_id=None,
-                            tipo_movimento='entrata'
+                            tipo_movimento='entrata',
+                            transazione_id=transazioni.id
                         )
                         current_app.logger.info(f"Movimento PostePay creato con id {movimento.id if movimento else 'None'}")
                     except Exception as e:
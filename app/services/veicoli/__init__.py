@@ -1,2 +1,3 @@
 """Package per i servizi veicoli."""
 from .veicoli_service import *  # noqa: F401,F403
+from .garage_analytics_service import *  # noqa: F401,F403
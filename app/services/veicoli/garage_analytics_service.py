@@ -0,0 +1,237 @@
+"""Analisi dei costi del garage calcolate in blocco per tutti i veicoli.
+
+Bolli, assicurazioni e manutenzioni vengono letti con una query aggregata per
+tabella (raggruppata per veicolo e anno), indipendentemente dal numero di
+veicoli. Stato del finanziamento, serie annuali del costo di possesso (TCO)
+e costo per km sono calcolati con numpy su matrici veicoli x anni.
+"""
+import calendar
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select, func
+
+from app import db
+from app.services import BaseService
+from app.models.Veicoli import Veicoli, AutoBolli, AutoManutenzioni, Assicurazioni
+
+NOMI_MESI = {
+    1: 'Gennaio', 2: 'Febbraio', 3: 'Marzo', 4: 'Aprile',
+    5: 'Maggio', 6: 'Giugno', 7: 'Luglio', 8: 'Agosto',
+    9: 'Settembre', 10: 'Ottobre', 11: 'Novembre', 12: 'Dicembre'
+}
+
+
+def _rate_pagate(prima_rata, numero_rate, al):
+    """Rate pagate alla data `al` per array di (anno, mese, giorno) della prima rata.
+
+    Stessa regola di `Veicoli.totale_versato`: conta il mese corrente se il
+    giorno della rata è già passato, senza superare il numero di rate.
+    """
+    anni, mesi, giorni = prima_rata
+    trascorsi = (al[0] - anni) * 12 + (al[1] - mesi) + (al[2] >= giorni)
+    return np.clip(trascorsi, 0, numero_rate)
+
+
+def _prossima_assicurazione(ultimo_pagamento):
+    try:
+        return ultimo_pagamento.replace(year=ultimo_pagamento.year + 1)
+    except ValueError:
+        return ultimo_pagamento.replace(day=28, month=2, year=ultimo_pagamento.year + 1)
+
+
+class GarageAnalyticsService(BaseService):
+    """Costi aggregati, stato finanziamento e serie TCO per i veicoli del garage"""
+
+    def _costi_per_anno(self, veicolo_ids=None):
+        """Tre query aggregate (veicolo, anno) per bolli, assicurazioni e manutenzioni."""
+        def _query(modello, anno, *colonne):
+            stmt = select(modello.veicolo_id, anno, *colonne).group_by(modello.veicolo_id, anno)
+            if veicolo_ids is not None:
+                stmt = stmt.where(modello.veicolo_id.in_(veicolo_ids))
+            return db.session.execute(stmt).all()
+
+        bolli = _query(AutoBolli, AutoBolli.anno_riferimento,
+                       func.sum(AutoBolli.importo), func.count(), func.count(AutoBolli.data_pagamento))
+        assicurazioni = _query(Assicurazioni, Assicurazioni.anno_riferimento,
+                               func.sum(Assicurazioni.importo), func.max(Assicurazioni.data_pagamento))
+        anno_intervento = func.cast(func.strftime('%Y', AutoManutenzioni.data_intervento), db.Integer)
+        manutenzioni = _query(AutoManutenzioni, anno_intervento,
+                              func.sum(AutoManutenzioni.costo), func.max(AutoManutenzioni.km_intervento))
+        return bolli, assicurazioni, manutenzioni
+
+    def analizza(self, veicoli=None, oggi=None, solo_questi=False):
+        """Analisi completa del garage.
+
+        Ritorna un dict con `veicoli` (id -> metriche), `anni` (asse delle serie)
+        e `totali` (finanziamento, versato, saldo rimanente, costo sostenuto).
+        Con `solo_questi` le query aggregate sono limitate ai veicoli passati.
+        """
+        if oggi is None:
+            oggi = date.today()
+        if veicoli is None:
+            veicoli = Veicoli.query.order_by(Veicoli.modello).all()
+        risultato = {'veicoli': {}, 'anni': [], 'totali': {
+            'costo_finanziamento': 0.0, 'totale_versato': 0.0, 'saldo_rimanente': 0.0, 'costo_sostenuto': 0.0}}
+        if not veicoli:
+            return risultato
+
+        bolli, assicurazioni, manutenzioni = self._costi_per_anno([v.id for v in veicoli] if solo_questi else None)
+        indice = {v.id: i for i, v in enumerate(veicoli)}
+        n = len(veicoli)
+
+        # Asse degli anni comune a tutti i veicoli
+        anni_dati = [r[1] for r in (*bolli, *assicurazioni, *manutenzioni) if r[0] in indice and r[1]]
+        anni_dati += [v.prima_rata.year for v in veicoli if getattr(v, 'prima_rata', None)]
+        primo_anno = min(anni_dati + [oggi.year])
+        anni = np.arange(primo_anno, oggi.year + 1)
+        a = len(anni)
+
+        # === Finanziamento (vettoriale sui veicoli) ===
+        finanziato = np.array([bool(v.prima_rata and v.numero_rate and v.rata_mensile) for v in veicoli])
+        pr = [v.prima_rata if f else date(oggi.year + 1, 1, 1) for v, f in zip(veicoli, finanziato)]
+        prima_rata = (np.array([d.year for d in pr]), np.array([d.month for d in pr]), np.array([d.day for d in pr]))
+        numero_rate = np.array([int(v.numero_rate or 0) for v in veicoli])
+        rata = np.array([float(v.rata_mensile or 0) for v in veicoli]) * finanziato
+        costo_finanziamento = np.array([float(v.costo_finanziamento or 0) for v in veicoli])
+
+        rate_pagate = _rate_pagate(prima_rata, numero_rate, (oggi.year, oggi.month, oggi.day))
+        totale_versato = rate_pagate * rata
+        rate_rimanenti = np.where(finanziato, numero_rate - rate_pagate, 0)
+        saldo_rimanente = np.maximum(0, costo_finanziamento - totale_versato)
+
+        # Rate pagate a fine di ogni anno (l'anno corrente si ferma a oggi) -> quota annua
+        fine_anno = anni[:, None]
+        mese_fine = np.where(anni == oggi.year, oggi.month, 12)[:, None]
+        giorno_fine = np.where(anni == oggi.year, oggi.day, 31)[:, None]
+        cumulate = _rate_pagate(tuple(x[None, :] for x in prima_rata), numero_rate[None, :],
+                                (fine_anno, mese_fine, giorno_fine))  # anni x veicoli
+        rate_anno = np.diff(cumulate, axis=0, prepend=0).T * rata[:, None]
+
+        # === Costi annui da query aggregate ===
+        bolli_anno = np.zeros((n, a))
+        assicurazioni_anno = np.zeros((n, a))
+        manutenzioni_anno = np.zeros((n, a))
+        km_letti = np.zeros((n, a))
+        anni_bollo_pagati = {v.id: set() for v in veicoli}
+        bolli_non_pagati = set()
+        ultima_assicurazione = {}
+
+        def _celle(righe):
+            for r in righe:
+                i = indice.get(r[0])
+                if i is not None and r[1] and primo_anno <= r[1] <= oggi.year:
+                    yield i, r[1] - primo_anno, r
+
+        for i, j, r in _celle(bolli):
+            bolli_anno[i, j] += float(r[2] or 0)
+        for r in bolli:
+            if r[0] in anni_bollo_pagati:
+                # Come nella vista originale, un bollo registrato per l'anno conta come pagato
+                anni_bollo_pagati[r[0]].add(r[1])
+                if r[3] > r[4]:
+                    bolli_non_pagati.add((r[0], r[1]))
+        for i, j, r in _celle(assicurazioni):
+            assicurazioni_anno[i, j] += float(r[2] or 0)
+        for r in assicurazioni:
+            if r[0] in indice and r[3] and (r[0] not in ultima_assicurazione or r[3] > ultima_assicurazione[r[0]]):
+                ultima_assicurazione[r[0]] = r[3]
+        for i, j, r in _celle(manutenzioni):
+            manutenzioni_anno[i, j] += float(r[2] or 0)
+            km_letti[i, j] = max(km_letti[i, j], float(r[3] or 0))
+
+        # km percorsi: contachilometri massimo a fine anno, riportato in avanti, poi differenze
+        contachilometri = np.maximum.accumulate(km_letti, axis=1)
+        km_anno = np.diff(contachilometri, axis=1, prepend=0)
+        km_totali = contachilometri[:, -1]
+
+        costo_anno = rate_anno + bolli_anno + assicurazioni_anno + manutenzioni_anno
+        tco_cumulato = np.cumsum(costo_anno, axis=1)
+        costo_km_anno = np.divide(costo_anno, km_anno, out=np.full((n, a), np.nan), where=km_anno > 0)
+        costo_sostenuto = tco_cumulato[:, -1]
+        costo_km = np.divide(costo_sostenuto, km_totali, out=np.full(n, np.nan), where=km_totali > 0)
+        # Totali su tutti gli anni registrati (anche pagamenti anticipati oltre l'anno corrente)
+        def _totale(righe):
+            righe = [r for r in righe if r[0] in indice]
+            return np.bincount([indice[r[0]] for r in righe], weights=[float(r[2] or 0) for r in righe], minlength=n)
+
+        totale_bolli = _totale(bolli)
+        totale_assicurazioni = _totale(assicurazioni)
+        totale_manutenzioni = _totale(manutenzioni)
+        # Stessa definizione di calculate_total_cost_veicolo (finanziamento per intero)
+        costo_totale = costo_finanziamento + totale_bolli + totale_assicurazioni + totale_manutenzioni
+
+        def _arrotonda(valori):
+            return [None if np.isnan(x) else round(float(x), 4) for x in valori]
+
+        for v in veicoli:
+            i = indice[v.id]
+            pagati = anni_bollo_pagati[v.id]
+            risultato['veicoli'][v.id] = {
+                'totale_versato': round(float(totale_versato[i]), 2),
+                'rate_rimanenti': int(rate_rimanenti[i]),
+                'saldo_rimanente': round(float(saldo_rimanente[i]), 2),
+                'totale_bolli': round(float(totale_bolli[i]), 2),
+                'totale_assicurazioni': round(float(totale_assicurazioni[i]), 2),
+                'totale_manutenzioni': round(float(totale_manutenzioni[i]), 2),
+                'costo_totale': round(float(costo_totale[i]), 2),
+                'costo_sostenuto': round(float(costo_sostenuto[i]), 2),
+                'km_totali': int(km_totali[i]),
+                'costo_per_km': None if np.isnan(costo_km[i]) else round(float(costo_km[i]), 4),
+                'bollo_scaduto': (v.id, oggi.year) in bolli_non_pagati,
+                'anni_bollo_pagati': sorted(pagati),
+                'ultima_assicurazione': ultima_assicurazione.get(v.id),
+                'serie': {
+                    'costo_anno': [round(float(x), 2) for x in costo_anno[i]],
+                    'tco_cumulato': [round(float(x), 2) for x in tco_cumulato[i]],
+                    'km_anno': [int(x) for x in km_anno[i]],
+                    'costo_per_km': _arrotonda(costo_km_anno[i]),
+                },
+            }
+
+        risultato['anni'] = [int(x) for x in anni]
+        risultato['totali'] = {
+            'costo_finanziamento': round(float(costo_finanziamento.sum()), 2),
+            'totale_versato': round(float(totale_versato.sum()), 2),
+            'saldo_rimanente': round(float(saldo_rimanente.sum()), 2),
+            'costo_sostenuto': round(float(costo_sostenuto.sum()), 2),
+        }
+        return risultato
+
+    def scadenze(self, veicoli, analisi, oggi=None):
+        """Prossime scadenze per veicolo e bolli in attesa, senza query aggiuntive."""
+        if oggi is None:
+            oggi = date.today()
+        prossime = {}
+        bolli_in_attesa = []
+        for v in veicoli:
+            dati = analisi['veicoli'].get(v.id, {})
+            pagati = set(dati.get('anni_bollo_pagati', []))
+            next_bollo = next_assicurazione = None
+            mese = getattr(v, 'mese_scadenza_bollo', None)
+            if getattr(v, 'tipo', None) in ('auto', 'moto'):
+                if mese:
+                    anno = oggi.year + 1 if oggi.year in pagati else oggi.year
+                    next_bollo = f"{NOMI_MESI.get(int(mese), 'Mese ' + str(mese))} {anno}"
+                if dati.get('ultima_assicurazione'):
+                    next_assicurazione = _prossima_assicurazione(dati['ultima_assicurazione']).strftime('%d/%m/%Y')
+            prossime[v.id] = (next_bollo, next_assicurazione)
+
+            if getattr(v, 'tipo', None) != 'bici' and mese and v.prima_rata:
+                for anno in range(v.prima_rata.year + 1, oggi.year + 1):
+                    if anno in pagati:
+                        continue
+                    ultimo_giorno = date(anno, mese, calendar.monthrange(anno, mese)[1])
+                    if anno == oggi.year:
+                        priorita = 'alta' if oggi.month > mese else ('media' if oggi.month == mese else 'bassa')
+                    else:
+                        priorita = 'alta'
+                    bolli_in_attesa.append({
+                        'veicolo': v,
+                        'tipo': 'Bollo Auto',
+                        'anno': anno,
+                        'mese_scadenza': NOMI_MESI.get(mese, f'Mese {mese}'),
+                        'priorita': priorita,
+                        'giorni': (ultimo_giorno - oggi).days,
+                    })
+        return prossime, bolli_in_attesa
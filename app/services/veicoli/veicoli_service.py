@@ -3,7 +3,7 @@ from app.services import BaseService
 from app.models.Veicoli import Veicoli, AutoBolli, AutoManutenzioni, Assicurazioni
 from app import db
 from datetime import date
-from sqlalchemy import desc, and_
+from sqlalchemy import desc, and_, select, func
 
 
 class VeicoliService(BaseService):
@@ -221,18 +221,16 @@ class VeicoliService(BaseService):
         if not veicolo:
             return 0
 
-        total = float(veicolo.costo_finanziamento or 0)
+        # Somme calcolate dal DB con un'unica select di subquery scalari
+        def _somma(colonna, modello, *filtri):
+            return (select(func.coalesce(func.sum(colonna), 0.0))
+                    .where(modello.veicolo_id == veicolo_id, *filtri)
+                    .scalar_subquery())
 
-        # Somma bolli pagati
-        bolli = self.get_bolli_by_veicolo(veicolo_id)
-        total += sum(float(b.importo or 0) for b in bolli if b.data_pagamento)
+        bolli, assicurazioni, manutenzioni = db.session.execute(select(
+            _somma(AutoBolli.importo, AutoBolli, AutoBolli.data_pagamento.isnot(None)),
+            _somma(Assicurazioni.importo, Assicurazioni, Assicurazioni.data_pagamento.isnot(None)),
+            _somma(AutoManutenzioni.costo, AutoManutenzioni),
+        )).one()
 
-        # Somma assicurazioni
-        assicurazioni = self.get_assicurazioni_by_veicolo(veicolo_id)
-        total += sum(float(a.importo or 0) for a in assicurazioni if a.data_pagamento)
-
-        # Somma manutenzioni
-        manutenzioni = self.get_manutenzioni_by_veicolo(veicolo_id)
-        total += sum(float(m.costo or 0) for m in manutenzioni)
-
-        return total
+        return float(veicolo.costo_finanziamento or 0) + float(bolli) + float(assicurazioni) + float(manutenzioni)
@@ -58,6 +58,18 @@
         } catch(e){ console && console.error && console.error('updateBudgetItems error', e); }
     }
 
+    // Applica le variazioni per categoria restituite dalle mutazioni alle statistiche in cache
+    function mergeStatsDelta(stats, deltas){
+        var byName = {};
+        var out = (stats || []).map(function(s){ var c = { categoria_nome: s.categoria_nome, importo: Number(s.importo || 0) }; byName[c.categoria_nome] = c; return c; });
+        (deltas || []).forEach(function(d){
+            var c = byName[d.categoria_nome];
+            if (!c) { c = { categoria_nome: d.categoria_nome, importo: 0 }; byName[c.categoria_nome] = c; out.push(c); }
+            c.importo += Number(d.importo || 0);
+        });
+        return out.filter(function(c){ return c.importo > 0.005; }).sort(function(a, b){ return b.importo - a.importo; });
+    }
+
     function applySummary(summary){
         try{
             if (!summary) return;
@@ -88,6 +100,8 @@
             try {
                 if (summary.stats_categorie && Array.isArray(summary.stats_categorie)) {
                     try { window._dettaglio_latest_stats = summary.stats_categorie; } catch(e) {}
+                } else if (summary.stats_delta && Array.isArray(summary.stats_delta)) {
+                    window._dettaglio_latest_stats = mergeStatsDelta(window._dettaglio_latest_stats || [], summary.stats_delta);
                 }
             } catch(e) { console && console.error && console.error('cache stats error', e); }
         } catch(e){ console && console.error && console.error('applySummary error', e); }
@@ -246,6 +260,57 @@
 
     
 
+    // Coda di operazioni (aggiungi/modifica/elimina) inviate insieme all'endpoint batch.
+    // Le modifiche ravvicinate vengono accorpate in una sola richiesta e un solo ricalcolo.
+    function createBatchQueue(cfg){
+        var url = '/dettaglio/' + encodeURIComponent(cfg.start_date) + '/' + encodeURIComponent(cfg.end_date) + '/batch';
+        var queue = [], timer = null, delay = cfg.batchDelay || 400;
+
+        function schedule(){ if (timer) clearTimeout(timer); timer = setTimeout(invia, delay); }
+
+        function accoda(op){
+            return new Promise(function(resolve, reject){
+                var prev = op.id ? queue.filter(function(q){ return q.op.id === op.id; })[0] : null;
+                if (prev && prev.op.azione === 'modifica' && op.azione === 'modifica') {
+                    Object.assign(prev.op, op);
+                    prev.callbacks.push({ resolve: resolve, reject: reject });
+                } else if (prev && op.azione === 'elimina') {
+                    prev.op = op;
+                    prev.callbacks.push({ resolve: resolve, reject: reject });
+                } else {
+                    queue.push({ op: op, callbacks: [{ resolve: resolve, reject: reject }] });
+                }
+                schedule();
+            });
+        }
+
+        function invia(){
+            if (timer) { clearTimeout(timer); timer = null; }
+            var batch = queue; queue = [];
+            if (!batch.length) return Promise.resolve(null);
+            return postForm(url, { operazioni: batch.map(function(q){ return q.op; }) }).then(function(json){
+                if (!json || json.status !== 'ok') throw new Error((json && json.message) || 'Errore salvataggio operazioni');
+                if (json.summary) applySummary(json.summary);
+                var esiti = {};
+                (json.operazioni || []).forEach(function(e){ esiti[e.indice] = e; });
+                batch.forEach(function(q, i){ q.callbacks.forEach(function(cb){ cb.resolve(esiti[i] || null); }); });
+                return json;
+            }).catch(function(err){
+                batch.forEach(function(q){ q.callbacks.forEach(function(cb){ cb.reject(err); }); });
+                throw err;
+            });
+        }
+
+        return { accoda: accoda, invia: invia, size: function(){ return queue.length; } };
+    }
+
+    // Campi del form di modifica inline come operazione batch (i campi vuoti restano invariati)
+    function modificaFromForm(id, fd){
+        var op = { azione: 'modifica', id: id };
+        fd.forEach(function(v, k){ if (v !== '' || k === 'categoria_id') op[k] = v; });
+        return op;
+    }
+
     function bindDelegatedHandlers(cfg){
         // avoid binding multiple times if initDettaglio is called repeatedly
         if (window._dettaglio_delegated_bound) return;
@@ -256,6 +321,11 @@
             var act = form.getAttribute('action') || form.action || '';
             if (act && act.indexOf('/modifica_transazione/') !== -1) {
                 e.preventDefault(); var fd = new FormData(form);
+                var m = act.match(/\/modifica_transazione\/(\d+)/);
+                if (m && window.dettaglioBatch) {
+                    window.dettaglioBatch.accoda(modificaFromForm(Number(m[1]), fd)).catch(function(err){ console.error('Errore modifica inline', err); showToast('Errore nel salvataggio. Riprova.','danger'); });
+                    return false;
+                }
                 postForm(act, fd).then(function(json){ if (json && json.status==='ok') { if (json.summary) applySummary(json.summary); } else { throw new Error('Update error'); } }).catch(function(err){ console.error('Errore modifica inline', err); showToast('Errore nel salvataggio. Riprova.','danger'); });
                 return false;
             }
@@ -289,6 +359,8 @@
         try{
             // expose helpers globally that templates may call
             window.applySummary = applySummary;
+            window.dettaglioBatch = createBatchQueue(cfg);
+            if (!window._dettaglio_latest_stats) window._dettaglio_latest_stats = (cfg.stats_categorie || []).slice();
             window.createTransactionRow = function(tx){ return createTransactionRow(tx, cfg); };
             window.createPendingTransactionRow = function(tx){ return createPendingTransactionRow(tx, cfg); };
             // init pieces
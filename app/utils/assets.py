@@ -0,0 +1,292 @@
+"""Pipeline degli asset statici: minificazione, bundle, fingerprint e precompressione.
+
+`python -m app.utils.assets` legge `static/js`, `static/css` e `static/vendor`
+e scrive in `static/dist`:
+
+- una copia minificata di ogni file con l'hash del contenuto nel nome
+  (`js/dettaglio_mese.3f9c1a2b7d.js`);
+- i bundle definiti in `BUNDLE`, cioè più sorgenti concatenati in un solo file;
+- le versioni `.gz` (e `.br` se il modulo `brotli` è installato) dei file di testo;
+- `manifest.json`, che mappa il nome logico sul file con fingerprint.
+
+`asset_url` e `asset_urls` leggono il manifest; se manca (sviluppo senza build)
+tornano ai sorgenti con il vecchio `?v=ASSET_VERSION`. I file di `static/dist`
+sono serviti da `servi_asset` con la variante compressa accettata dal client e
+cache immutabile di un anno: il nome cambia quando cambia il contenuto.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # precompressione brotli opzionale
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static'))
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+
+# Cartelle sorgente incluse nella build (il service worker di passwd resta fuori:
+# il suo scope dipende dal percorso)
+SORGENTI = ('js', 'css', 'vendor')
+FILE_SINGOLI = ('money.png',)
+
+# Nome logico del bundle -> sorgenti, nell'ordine di caricamento
+BUNDLE = {
+    'css/base.css': ['css/app.css', 'css/templates.css'],
+    'js/base.js': ['js/utils-format.js', 'js/fetch-helpers.js', 'js/ui-helpers.js'],
+}
+
+ESTENSIONI_TESTO = ('.js', '.css', '.svg', '.json', '.map')
+CACHE_IMMUTABILE = 365 * 24 * 3600
+
+_manifest_cache = {'mtime': None, 'voci': {}}
+
+
+# --- Minificazione ---------------------------------------------------------
+
+_CSS_TOKEN = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/|\s+', re.S)
+
+
+def minifica_css(sorgente):
+    """Toglie commenti e spazi superflui lasciando intatte le stringhe."""
+    def _sostituisci(m):
+        if m.group(1):
+            return m.group(1)
+        return '' if m.group(0).startswith('/*') else ' '
+    testo = _CSS_TOKEN.sub(_sostituisci, sorgente)
+    testo = re.sub(r'\s*([{};,>])\s*', r'\1', testo)
+    testo = re.sub(r':\s+', ':', testo)
+    return testo.replace(';}', '}').strip() + '\n'
+
+
+# Dopo questi caratteri uno `/` apre una regex e non una divisione
+_PRIMA_DI_REGEX = set('(,=:[!&|?{};+-*%<>~^')
+_PAROLE_PRIMA_DI_REGEX = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'void', 'delete')
+
+
+def minifica_js(sorgente):
+    """Minificazione conservativa: commenti e indentazione, ritorni a capo mantenuti.
+
+    Le righe restano separate per non dipendere dall'inserimento automatico dei
+    punti e virgola; stringhe, template literal e regex sono copiati così come sono.
+    """
+    out, riga = [], []
+    i, n = 0, len(sorgente)
+
+    def _ultimo_significativo():
+        for pezzo in reversed(riga):
+            pezzo = pezzo.rstrip()
+            if pezzo:
+                return pezzo
+        for pezzo in reversed(out):
+            if pezzo.strip():
+                return pezzo.rstrip()
+        return ''
+
+    def _chiudi_riga():
+        testo = ''.join(riga).strip()
+        if testo:
+            out.append(testo)
+        riga.clear()
+
+    while i < n:
+        c = sorgente[i]
+        if c in '\'"`':
+            j = i + 1
+            while j < n and sorgente[j] != c:
+                j += 2 if sorgente[j] == '\\' else 1
+            riga.append(sorgente[i:j + 1])
+            i = j + 1
+        elif sorgente.startswith('//', i):
+            j = sorgente.find('\n', i)
+            i = n if j < 0 else j
+        elif sorgente.startswith('/*', i):
+            j = sorgente.find('*/', i + 2)
+            j = n if j < 0 else j + 2
+            if '\n' in sorgente[i:j]:
+                _chiudi_riga()
+            else:
+                riga.append(' ')
+            i = j
+        elif c == '/':
+            prec = _ultimo_significativo()
+            parola = re.search(r'[A-Za-z_$]+$', prec)
+            if not prec or prec[-1] in _PRIMA_DI_REGEX or (parola and parola.group(0) in _PAROLE_PRIMA_DI_REGEX):
+                j, in_classe = i + 1, False
+                while j < n and sorgente[j] != '\n':
+                    if sorgente[j] == '\\':
+                        j += 2
+                        continue
+                    if sorgente[j] == '[':
+                        in_classe = True
+                    elif sorgente[j] == ']':
+                        in_classe = False
+                    elif sorgente[j] == '/' and not in_classe:
+                        break
+                    j += 1
+                riga.append(sorgente[i:j + 1])
+                i = j + 1
+            else:
+                riga.append(c)
+                i += 1
+        elif c == '\n':
+            _chiudi_riga()
+            i += 1
+        elif c in ' \t\r':
+            j = i
+            while j < n and sorgente[j] in ' \t\r':
+                j += 1
+            riga.append(' ')
+            i = j
+        else:
+            riga.append(c)
+            i += 1
+    _chiudi_riga()
+    return '\n'.join(out) + '\n'
+
+
+def _minifica(percorso, contenuto):
+    if percorso.endswith('.min.js') or percorso.endswith('.min.css'):
+        return contenuto
+    if percorso.endswith('.css'):
+        return minifica_css(contenuto)
+    if percorso.endswith('.js'):
+        return minifica_js(contenuto)
+    return contenuto
+
+
+# --- Build -----------------------------------------------------------------
+
+def _con_fingerprint(percorso, dati):
+    base, est = os.path.splitext(percorso)
+    return f'{base}.{hashlib.sha256(dati).hexdigest()[:10]}{est}'
+
+
+def _scrivi(relativo, dati):
+    destinazione = os.path.join(DIST_DIR, relativo)
+    os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+    with open(destinazione, 'wb') as f:
+        f.write(dati)
+    if relativo.endswith(ESTENSIONI_TESTO):
+        with open(destinazione + '.gz', 'wb') as f:
+            f.write(gzip.compress(dati, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(destinazione + '.br', 'wb') as f:
+                f.write(brotli.compress(dati, quality=11))
+
+
+def _sorgenti():
+    for cartella in SORGENTI:
+        radice = os.path.join(STATIC_DIR, cartella)
+        for dirpath, _, files in os.walk(radice):
+            for nome in sorted(files):
+                yield os.path.relpath(os.path.join(dirpath, nome), STATIC_DIR).replace(os.sep, '/')
+    for nome in FILE_SINGOLI:
+        if os.path.isfile(os.path.join(STATIC_DIR, nome)):
+            yield nome
+
+
+def build_asset():
+    """Ricostruisce `static/dist` e il manifest; ritorna il manifest scritto."""
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    minificati, manifest = {}, {}
+    for relativo in _sorgenti():
+        with open(os.path.join(STATIC_DIR, relativo), 'rb') as f:
+            dati = f.read()
+        if relativo.endswith(('.js', '.css')):
+            dati = _minifica(relativo, dati.decode('utf-8')).encode('utf-8')
+        minificati[relativo] = dati
+        manifest[relativo] = _con_fingerprint(relativo, dati)
+        _scrivi(manifest[relativo], dati)
+
+    for nome, parti in BUNDLE.items():
+        separatore = b';\n' if nome.endswith('.js') else b'\n'
+        dati = separatore.join(minificati[p] for p in parti)
+        manifest[nome] = _con_fingerprint(nome, dati)
+        _scrivi(manifest[nome], dati)
+
+    with open(MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    _manifest_cache['mtime'] = None
+    return manifest
+
+
+# --- Runtime ---------------------------------------------------------------
+
+def carica_manifest():
+    """Manifest corrente ({} se la build non è stata eseguita), riletto se cambia."""
+    try:
+        mtime = os.path.getmtime(MANIFEST)
+    except OSError:
+        _manifest_cache.update(mtime=None, voci={})
+        return {}
+    if _manifest_cache['mtime'] != mtime:
+        try:
+            with open(MANIFEST, encoding='utf-8') as f:
+                _manifest_cache.update(mtime=mtime, voci=json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning('Manifest asset non leggibile: %s', e)
+            _manifest_cache.update(mtime=None, voci={})
+    return _manifest_cache['voci']
+
+
+def asset_url(percorso, versione='2'):
+    """URL del file con fingerprint, o del sorgente con `?v=versione` se non buildato."""
+    voce = carica_manifest().get(percorso)
+    if voce:
+        return url_for('asset_dist', filename=voce)
+    return url_for('static', filename=percorso) + '?v=' + str(versione)
+
+
+def asset_urls(nome, versione='2'):
+    """URL da includere per un bundle: il file unico se buildato, altrimenti i sorgenti."""
+    if nome in carica_manifest():
+        return [asset_url(nome, versione)]
+    return [asset_url(p, versione) for p in BUNDLE.get(nome, [nome])]
+
+
+def _codifiche_accettate():
+    accettate = set()
+    for parte in request.headers.get('Accept-Encoding', '').split(','):
+        nome, _, parametri = parte.strip().partition(';')
+        if parametri.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accettate.add(nome.strip().lower())
+    return accettate
+
+
+def servi_asset(filename):
+    """Serve un file di `static/dist`, precompresso se il client lo accetta."""
+    accettate = _codifiche_accettate()
+    risposta = None
+    for codifica, estensione in (('br', '.br'), ('gzip', '.gz')):
+        if codifica in accettate and os.path.isfile(os.path.join(DIST_DIR, filename + estensione)):
+            risposta = send_from_directory(DIST_DIR, filename + estensione, max_age=CACHE_IMMUTABILE,
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            risposta.headers['Content-Encoding'] = codifica
+            break
+    if risposta is None:
+        risposta = send_from_directory(DIST_DIR, filename, max_age=CACHE_IMMUTABILE)
+    risposta.headers['Vary'] = 'Accept-Encoding'
+    risposta.cache_control.public = True
+    risposta.cache_control.immutable = True
+    return risposta
+
+
+if __name__ == '__main__':
+    voci = build_asset()
+    print(f'{len(voci)} asset scritti in {DIST_DIR}' + ('' if brotli else ' (brotli non installato: solo gzip)'))
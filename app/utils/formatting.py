@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from flask import current_app
 
 
@@ -29,6 +31,42 @@ def format_currency(value, fmt=None):
         return f'€ {val:.2f}'
 
 
+@lru_cache(maxsize=32)
+def _formattatore(fmt):
+    return fmt.format
+
+
+def crea_format_currency(fmt_default='€ {:.2f}'):
+    """`format_currency` con il formato di default già risolto, per il filtro Jinja.
+
+    Evita la lettura di `current_app.config` a ogni chiamata: il formato è letto
+    una volta alla creazione dell'app e i formati passati dai template sono
+    memorizzati in `_formattatore`.
+    """
+    formatta_default = _formattatore(fmt_default)
+
+    def _format_currency(value, fmt=None):
+        formatta = formatta_default if fmt is None else _formattatore(fmt)
+        if value is None:
+            val = 0.0
+        elif type(value) is float:
+            val = value
+        else:
+            try:
+                val = float(value)
+            except Exception:
+                try:
+                    val = float(str(value))
+                except Exception:
+                    val = 0.0
+        try:
+            return formatta(val)
+        except Exception:
+            return f'€ {val:.2f}'
+
+    return _format_currency
+
+
 def format_decimal(value, decimals=2):
     """Format a numeric value as a plain decimal string with fixed decimals.
 
@@ -0,0 +1,249 @@
+"""Risposte condizionali e compressione per pagine HTML e API JSON.
+
+La versione dei dati sta nel database: la tabella `versioni_dati` ha una riga
+per tabella, incrementata da trigger AFTER INSERT/UPDATE/DELETE nella stessa
+transazione della scrittura (quindi anche per le `text()`, per gli script in
+`scripts/` e per gli altri processi o worker). Le richieste POST/PUT/DELETE
+riuscite incrementano la riga `bp:<blueprint>`, per i dati che non stanno nel
+database. La versione di un blueprint è la somma delle righe delle tabelle che
+legge (`TABELLE_BLUEPRINT`; tutte se non elencato) ed è letta una volta per
+richiesta, prima della vista.
+
+Le GET ricevono un ETag debole calcolato da quella versione, URL, data del
+giorno, sessione e versione del codice: se il client lo ripresenta in
+`If-None-Match` la risposta è un 304 prodotto prima di eseguire la vista. Le
+risposte HTML/JSON sopra `HTTP_COMPRESSIONE_SOGLIA` byte sono compresse con
+gzip se il client lo accetta.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import time
+from datetime import date
+
+from flask import g, request, session
+from sqlalchemy import text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Tabelle lette dalle pagine di ciascun blueprint, oltre a TABELLE_COMUNI
+TABELLE_BLUEPRINT = {
+    'sanita': ('terapia_plan', 'terapia_delivery'),
+    'veicoli': ('veicoli', 'auto_bolli', 'auto_manutenzioni', 'assicurazioni'),
+    'libretto': ('libretto', 'supersmart'),
+    'ppay': (
+        'ppay_evolution_abbonamenti', 'ppay_evolution_movimenti', 'ppay_evolution_collegamenti',
+        'conti_finanziari', 'conti_finanziari_ledger', 'conti_finanziari_checkpoint', 'transazioni',
+    ),
+}
+# Lette da base.html (menu dei conti personali) in ogni pagina
+TABELLE_COMUNI = ('conto_personale',)
+
+# Mai in cache: pagine con segreti in chiaro (passwd) e stato tenuto in memoria (jobs)
+BLUEPRINT_ESCLUSI = ('passwd', 'jobs')
+
+TIPI_COMPRIMIBILI = ('text/html', 'application/json', 'text/plain', 'text/csv')
+METODI_SICURI = ('GET', 'HEAD', 'OPTIONS')
+
+TABELLA_VERSIONI = 'versioni_dati'
+
+
+def _versione_codice():
+    # Template e moduli aggiornati (nuovo deploy) invalidano gli ETag anche a dati invariati
+    radice = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ultimo = 0.0
+    for cartella, _dirs, files in os.walk(radice):
+        for nome in files:
+            if nome.endswith(('.py', '.html')):
+                try:
+                    ultimo = max(ultimo, os.path.getmtime(os.path.join(cartella, nome)))
+                except OSError:
+                    pass
+    return str(int(ultimo))
+
+
+_CODICE = _versione_codice()
+
+
+# --- Versioni nel database --------------------------------------------------
+
+def ensure_versioni_dati():
+    """Crea `versioni_dati` e i trigger che la incrementano su ogni tabella dell'app."""
+    try:
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {TABELLA_VERSIONI} "
+            "(tabella TEXT PRIMARY KEY, versione INTEGER NOT NULL DEFAULT 0)"
+        ))
+        tabelle = [r[0] for r in db.session.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name <> :v"
+        ), {'v': TABELLA_VERSIONI})]
+        for tabella in tabelle:
+            for evento in ('INSERT', 'UPDATE', 'DELETE'):
+                db.session.execute(text(
+                    f'CREATE TRIGGER IF NOT EXISTS "trg_versione_{tabella}_{evento.lower()}" '
+                    f'AFTER {evento} ON "{tabella}" BEGIN '
+                    f"INSERT INTO {TABELLA_VERSIONI} (tabella, versione) VALUES ('{tabella}', 1) "
+                    "ON CONFLICT(tabella) DO UPDATE SET versione = versione + 1; END"
+                ))
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Versioni dei dati non disponibili: %s', e)
+        return False
+
+
+def istantanea():
+    """Versioni correnti per tabella lette dal database ({} se non disponibili)."""
+    try:
+        with db.engine.connect() as conn:
+            return dict(conn.execute(text(f"SELECT tabella, versione FROM {TABELLA_VERSIONI}")).fetchall())
+    except Exception:
+        return {}
+
+
+def _incrementa(chiavi, passo=1):
+    if not chiavi:
+        return
+    try:
+        with db.engine.begin() as conn:
+            for chiave in chiavi:
+                conn.execute(text(
+                    f"INSERT INTO {TABELLA_VERSIONI} (tabella, versione) VALUES (:t, :passo) "
+                    "ON CONFLICT(tabella) DO UPDATE SET versione = versione + :passo"
+                ), {'t': chiave, 'passo': passo})
+    except Exception as e:
+        logger.warning('Versione dei dati non incrementata: %s', e)
+
+
+def invalida(tabelle=None):
+    """Forza un nuovo ETag per le tabelle indicate (tutte se None), es. dopo un ripristino.
+
+    Dopo un ripristino il database può contenere versioni più vecchie di quelle
+    già servite: le si porta oltre l'ora corrente in secondi, così non
+    coincidono con nessuna versione precedente.
+    """
+    ensure_versioni_dati()
+    if tabelle is None:
+        tabelle = list(istantanea()) or ['*']
+    _incrementa(list(tabelle), passo=int(time.time()))
+
+
+def _chiavi_blueprint(blueprint):
+    if blueprint not in TABELLE_BLUEPRINT:
+        return None
+    return TABELLE_BLUEPRINT[blueprint] + TABELLE_COMUNI + (f'bp:{blueprint}',)
+
+
+def versione(blueprint, contatori=None):
+    """Versione dei dati letti dal blueprint; `contatori` da `istantanea()` se indicata."""
+    if contatori is None:
+        contatori = istantanea()
+    chiavi = _chiavi_blueprint(blueprint)
+    if chiavi is None:
+        return sum(contatori.values())
+    return versione_tabelle(chiavi, contatori)
+
+
+def versione_tabelle(tabelle, contatori=None):
+    """Versione dei dati di un insieme di tabelle; `contatori` da `istantanea()` se indicata."""
+    if contatori is None:
+        contatori = istantanea()
+    return sum(contatori.get(t, 0) for t in tabelle)
+
+
+def versioni_richiesta():
+    """Versioni lette una sola volta per richiesta (condivise da ETag e frammenti dei template)."""
+    if '_versioni_dati' not in g:
+        g._versioni_dati = istantanea()
+    return g._versioni_dati
+
+
+# --- Hook delle richieste --------------------------------------------------
+
+def _cacheabile():
+    return (
+        request.method in ('GET', 'HEAD')
+        and request.blueprint is not None
+        and request.blueprint not in BLUEPRINT_ESCLUSI
+        and '_flashes' not in session
+    )
+
+
+def _etag(v):
+    # Le pagine dipendono anche dalla data (periodo corrente) e dalla sessione
+    sessione = sorted((k, str(val)) for k, val in session.items() if k != '_flashes')
+    chiave = '|'.join([_CODICE, str(request.blueprint), str(v), request.full_path,
+                       date.today().isoformat(), repr(sessione)])
+    return hashlib.sha1(chiave.encode('utf-8')).hexdigest()[:20]
+
+
+def _rispondi_304():
+    if not g._http_cache_attiva or not request.if_none_match:
+        return None
+    etag = _etag(g._http_cache_versione)
+    if request.if_none_match.contains_weak(etag):
+        from flask import current_app
+        risposta = current_app.response_class(status=304)
+        risposta.set_etag(etag, weak=True)
+        risposta.headers['Cache-Control'] = 'private, no-cache'
+        return risposta
+    return None
+
+
+def _registra_etag(risposta):
+    if not g.get('_http_cache_attiva') or risposta.status_code != 200 or risposta.direct_passthrough:
+        return
+    if risposta.get_etag()[0] or risposta.mimetype not in ('text/html', 'application/json'):
+        return
+    # Versione letta prima della vista: se nel frattempo i dati sono cambiati
+    # (anche per mano della richiesta stessa) la pagina è più recente del tag e
+    # la prossima richiesta riceve comunque una risposta completa
+    risposta.set_etag(_etag(g._http_cache_versione), weak=True)
+    if 'Cache-Control' not in risposta.headers:
+        risposta.headers['Cache-Control'] = 'private, no-cache'
+
+
+def _comprimi(risposta, soglia, livello):
+    if (risposta.direct_passthrough or risposta.is_streamed or risposta.status_code < 200
+            or risposta.status_code in (204, 206, 304) or 'Content-Encoding' in risposta.headers
+            or risposta.mimetype not in TIPI_COMPRIMIBILI):
+        return
+    if 'gzip' not in request.accept_encodings or request.accept_encodings['gzip'] <= 0:
+        return
+    dati = risposta.get_data()
+    if len(dati) < soglia:
+        return
+    risposta.set_data(gzip.compress(dati, compresslevel=livello))
+    risposta.headers['Content-Encoding'] = 'gzip'
+    risposta.vary.add('Accept-Encoding')
+
+
+def init_http_cache(app):
+    """Registra gli hook; va chiamata dopo gli altri before_request (autenticazione, rollover)."""
+    if not app.config.get('HTTP_CACHE', True):
+        return
+    soglia = int(app.config.get('HTTP_COMPRESSIONE_SOGLIA', 1024))
+    livello = int(app.config.get('HTTP_COMPRESSIONE_LIVELLO', 6))
+
+    @app.before_request
+    def http_cache_versione():
+        # Deciso qui: i messaggi flash vengono consumati durante il render
+        g._http_cache_attiva = _cacheabile()
+        if g._http_cache_attiva:
+            g._http_cache_versione = versione(request.blueprint, versioni_richiesta())
+        return _rispondi_304()
+
+    @app.after_request
+    def http_cache_risposta(risposta):
+        try:
+            if request.method not in METODI_SICURI and risposta.status_code < 400 and request.blueprint:
+                _incrementa([f'bp:{request.blueprint}'])
+            _registra_etag(risposta)
+            _comprimi(risposta, soglia, livello)
+        except Exception:
+            app.logger.exception('http cache: risposta lasciata invariata')
+        return risposta
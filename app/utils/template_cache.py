@@ -0,0 +1,100 @@
+"""Cache dei template: bytecode compilato su disco e frammenti renderizzati in memoria.
+
+Il bytecode dei template è salvato con `FileSystemBytecodeCache` (chiave: nome e
+checksum del sorgente, quindi un template modificato viene ricompilato), così
+un nuovo processo non ricompila le pagine più pesanti al primo accesso.
+
+Il tag `{% cache %}` memorizza l'HTML di un blocco:
+
+    {% cache 'nav-conti', versione_dati('conto_personale') %} ... {% endcache %}
+
+La chiave è la posizione del tag più i valori indicati; `versione_dati` legge
+le versioni per tabella del database (`app.utils.http_cache`, aggiornate da
+trigger anche per le scritture di altri processi) come erano all'inizio della
+richiesta, quindi un frammento renderizzato dopo una scrittura concorrente
+non può finire sotto la chiave della versione più recente. Il blocco non deve
+dipendere da altro (richiesta, data) se non è incluso nella chiave, e i dati
+che mostra vanno letti dentro il blocco (es. una funzione del contesto
+chiamata nel blocco), così un frammento in cache evita anche le query.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import has_request_context
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from app.utils import http_cache
+
+logger = logging.getLogger(__name__)
+
+
+class FrammentiCache(Extension):
+    """Estensione Jinja per il tag `{% cache chiave[, chiave...] %}...{% endcache %}`"""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(frammenti_max=256)
+        self._frammenti = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        chiavi = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            chiavi.append(parser.parse_expression())
+        corpo = parser.parse_statements(('name:endcache',), drop_needle=True)
+        posizione = nodes.Const(f'{parser.name}:{lineno}')
+        return nodes.CallBlock(
+            self.call_method('_frammento', [posizione, nodes.List(chiavi)]), [], [], corpo
+        ).set_lineno(lineno)
+
+    def _frammento(self, posizione, chiavi, caller):
+        massimo = self.environment.frammenti_max
+        if not massimo:
+            return caller()
+        chiave = (posizione, repr(chiavi))
+        with self._lock:
+            html = self._frammenti.get(chiave)
+            if html is not None:
+                self._frammenti.move_to_end(chiave)
+                return html
+        html = caller()
+        with self._lock:
+            self._frammenti[chiave] = html
+            while len(self._frammenti) > massimo:
+                self._frammenti.popitem(last=False)
+        return html
+
+    def svuota(self):
+        with self._lock:
+            self._frammenti.clear()
+
+
+def versione_dati(*tabelle):
+    """Versione delle tabelle indicate, ferma all'inizio della richiesta corrente."""
+    contatori = http_cache.versioni_richiesta() if has_request_context() else None
+    return http_cache.versione_tabelle(tabelle, contatori)
+
+
+def init_template_cache(app):
+    """Configura bytecode cache, tag `{% cache %}` e il global `versione_dati`."""
+    try:
+        directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+        if directory:
+            import os
+            os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory, pattern='bilancio-%s.cache')
+    except Exception as e:
+        logger.warning('Bytecode cache dei template non disponibile: %s', e)
+
+    app.jinja_env.add_extension(FrammentiCache)
+    app.jinja_env.frammenti_max = int(app.config.get('JINJA_FRAMMENTI_MAX', 256))
+    app.jinja_env.globals['versione_dati'] = versione_dati
+
+    @app.before_request
+    def frammenti_istantanea():
+        http_cache.versioni_richiesta()
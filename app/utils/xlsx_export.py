@@ -0,0 +1,83 @@
+"""Export XLSX in streaming (openpyxl write-only) su file temporaneo.
+
+Le righe vengono consumate da iteratori (tipicamente query con `yield_per`),
+quindi non serve tenere in memoria l'intero dataset né un `Workbook` completo.
+Il file è scritto in un `SpooledTemporaryFile`: resta in memoria fino a
+`SPOOL_MAX` byte e poi passa su disco, quindi la memoria usata non cresce con
+i dati; `xlsx_response` lo invia a blocchi e lo chiude (eliminandolo) a fine
+risposta.
+
+La cifratura con password (msoffcrypto) non è in streaming: la libreria
+legge l'intero file in chiaro e produce il file cifrato in memoria, quindi
+per gli export protetti la memoria cresce con la dimensione del file.
+"""
+import logging
+import tempfile
+
+import openpyxl
+
+logger = logging.getLogger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Oltre questa dimensione il file temporaneo passa dalla memoria al disco
+SPOOL_MAX = 1024 * 1024
+
+
+class CifraturaNonDisponibile(RuntimeError):
+    """Export protetto da password richiesto ma impossibile da cifrare."""
+
+
+def _encrypt_buffer(buffer, password):
+    """Cifra il contenuto XLSX con msoffcrypto (ECMA-376) restituendo un nuovo file temporaneo.
+
+    msoffcrypto produce il file cifrato interamente in memoria. Se la cifratura
+    non è possibile solleva CifraturaNonDisponibile: un export richiesto con
+    password non viene mai restituito in chiaro.
+    """
+    try:
+        from msoffcrypto.format.ooxml import OOXMLFile
+    except ImportError as e:
+        raise CifraturaNonDisponibile('msoffcrypto-tool non installato') from e
+    if not hasattr(OOXMLFile, 'encrypt'):
+        raise CifraturaNonDisponibile('msoffcrypto-tool senza supporto alla cifratura (serve >= 5)')
+    try:
+        buffer.seek(0)
+        out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+        OOXMLFile(buffer).encrypt(password, out)
+        out.seek(0)
+        return out
+    except Exception as e:
+        raise CifraturaNonDisponibile(f'Cifratura dell\'export non riuscita: {e}') from e
+    finally:
+        buffer.close()
+
+
+def write_xlsx(sheets, protection_password=None):
+    """Scrive uno o più fogli in modalità write-only e ritorna un file temporaneo posizionato all'inizio.
+
+    `sheets` è una sequenza di tuple (titolo, intestazioni, righe) dove `righe`
+    può essere un qualsiasi iterabile (anche un generatore).
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    for title, headers, rows in sheets:
+        ws = wb.create_sheet(title=title[:31])
+        ws.append(list(headers))
+        for row in rows:
+            ws.append(list(row))
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+    try:
+        wb.save(buffer)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    if protection_password:
+        return _encrypt_buffer(buffer, protection_password)
+    return buffer
+
+
+def xlsx_response(buffer, filename):
+    """Risposta Flask di download per un file XLSX di `write_xlsx`, inviato a blocchi e poi chiuso."""
+    from flask import send_file
+    return send_file(buffer, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename)
@@ -3,7 +3,7 @@
 Questa versione evita riferimenti a nomi specifici e usa identificatori
 dinamici (id o nome) per risalire al conto richiesto.
 """
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
 from datetime import datetime, date
 from app.services.conto_personale.conti_personali_service import ContiPersonaliService
 from app import db
@@ -106,6 +106,27 @@ def aggiungi_versamento(conto_id):
     
     return redirect(url_for('conti.view', conto_id=conto_id))
 
+@conti_bp.route('/api/<int:conto_id>/versamenti', methods=['POST'])
+def aggiungi_versamenti(conto_id):
+    """Inserimento multiplo di versamenti (JSON: lista o {"versamenti": [...]}) in una sola transazione"""
+    try:
+        from app.models.ContoPersonale import ContoPersonale
+        conto = ContoPersonale.query.get(conto_id)
+        if not conto:
+            return jsonify({'success': False, 'message': 'Conto non trovato'}), 404
+
+        payload = request.get_json(silent=True)
+        versamenti = payload.get('versamenti') if isinstance(payload, dict) else payload
+        if not isinstance(versamenti, list):
+            return jsonify({'success': False, 'message': 'Formato non valido: attesa una lista di versamenti'}), 400
+
+        success, message, inseriti = ContiPersonaliService().aggiungi_versamenti(conto.nome_conto, versamenti)
+        saldo = conto.strumento.saldo_corrente if success and conto.strumento else None
+        return jsonify({'success': success, 'message': message, 'inseriti': inseriti, 'saldo_corrente': saldo}), (200 if success else 400)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @conti_bp.route('/elimina_versamento/<int:versamento_id>', methods=['POST'])
 def elimina_versamento(versamento_id):
     """Elimina un versamento e ripristina il saldo"""
@@ -0,0 +1,2 @@
+"""Package per le view dei job in background: re-export dai moduli interni."""
+from .jobs import *  # noqa: F401,F403
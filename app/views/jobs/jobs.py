@@ -0,0 +1,58 @@
+"""Blueprint per la coda dei job: accodamento, stato, annullamento e download"""
+import os
+
+from flask import Blueprint, jsonify, request, send_file
+
+from app.services.jobs.job_service import JobService, TIPI_JOB
+
+jobs_bp = Blueprint('jobs', __name__)
+
+
+@jobs_bp.route('/', methods=['GET'])
+def elenco():
+    """Ultimi job (più recenti per primi)."""
+    limite = request.args.get('limite', 50, type=int)
+    return jsonify({'success': True, 'jobs': JobService().elenco(max(1, min(limite, 500)))})
+
+
+@jobs_bp.route('/', methods=['POST'])
+def accoda():
+    """Accoda un job: JSON {"tipo": ..., "parametri": {...}}."""
+    dati = request.get_json(silent=True) or {}
+    tipo = dati.get('tipo')
+    if tipo not in TIPI_JOB:
+        return jsonify({'success': False, 'message': 'Tipo di job non valido', 'tipi': sorted(TIPI_JOB)}), 400
+    parametri = dati.get('parametri') or {}
+    if not isinstance(parametri, dict):
+        return jsonify({'success': False, 'message': 'Parametri non validi'}), 400
+    success, message, job = JobService().accoda(tipo, parametri, unico=bool(dati.get('unico')))
+    if not success:
+        return jsonify({'success': False, 'message': message}), 500
+    return jsonify({'success': True, 'message': message, 'job': JobService().stato(job.id)}), 202
+
+
+@jobs_bp.route('/<int:job_id>', methods=['GET'])
+def stato(job_id):
+    """Stato e progresso di un job."""
+    dati = JobService().stato(job_id)
+    if dati is None:
+        return jsonify({'success': False, 'message': 'Job inesistente'}), 404
+    risposta = jsonify({'success': True, 'job': dati})
+    risposta.headers['Cache-Control'] = 'no-store'
+    return risposta
+
+
+@jobs_bp.route('/<int:job_id>/annulla', methods=['POST'])
+def annulla(job_id):
+    """Annulla un job in coda o ne chiede l'interruzione."""
+    success, message = JobService().annulla(job_id)
+    return jsonify({'success': success, 'message': message}), (200 if success else 409)
+
+
+@jobs_bp.route('/<int:job_id>/download', methods=['GET'])
+def download(job_id):
+    """Scarica il file prodotto da un job completato (es. export XLSX)."""
+    percorso = JobService().file_risultato(job_id)
+    if not percorso:
+        return jsonify({'success': False, 'message': 'Nessun file disponibile'}), 404
+    return send_file(percorso, as_attachment=True, download_name=os.path.basename(percorso))
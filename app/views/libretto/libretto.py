@@ -13,21 +13,37 @@ def dashboard():
         service = LibrettoService()
         libretto = service.get_or_create_libretto()
         depositi = service.get_depositi(libretto.id)
-        depositi_attivi = service.get_depositi(libretto.id, solo_attivi=True)
+        depositi_attivi = [d for d in depositi if not d.is_scaduto]
         statistiche = service.get_statistiche(libretto.id)
+        scadenziario = service.get_scadenziario(libretto.id)
         
         return render_template('libretto/libretto.html',
                              libretto=libretto,
                              depositi=depositi,
                              depositi_attivi=depositi_attivi,
-                             statistiche=statistiche)
+                             statistiche=statistiche,
+                             scadenziario=scadenziario)
     except Exception as e:
         flash(f'Errore nel caricamento del libretto: {str(e)}', 'error')
         return render_template('libretto/libretto.html',
                              libretto=None,
                              depositi=[],
                              depositi_attivi=[],
-                             statistiche={})
+                             statistiche={},
+                             scadenziario={})
+
+
+@libretto_bp.route('/api/scadenziario')
+def api_scadenziario():
+    """Scadenziario dei depositi attivi per mese (JSON)"""
+    try:
+        service = LibrettoService()
+        libretto = service.get_libretto()
+        if not libretto:
+            return jsonify({'success': True, 'mesi': []})
+        return jsonify({'success': True, **service.get_scadenziario(libretto.id)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 
 @libretto_bp.route('/aggiorna_saldo', methods=['POST'])
@@ -340,6 +340,18 @@ def debug_saldo_check():
 
     return jsonify({'dettaglio': detalhe_safe, 'saldi_mensili': ms_info, 'strumento': strum})
 
+@main_bp.route('/debug/ledger_check')
+def debug_ledger_check():
+    """Debug endpoint (only in debug mode): verifica disallineamenti tra ledger e saldo degli strumenti."""
+    if not current_app.debug:
+        return jsonify({'error': 'not_allowed', 'message': 'Endpoint disponibile solo in debug mode'}), 403
+    try:
+        from app.services.conti_finanziari.ledger_service import LedgerService
+        drift = LedgerService().verifica_drift()
+        return jsonify({'ok': not drift, 'drift': drift})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @main_bp.route('/saldo_iniziale')
 def saldo_iniziale():
     """Gestione saldo iniziale"""
@@ -403,6 +415,15 @@ def reset():
             months = 6
 
             full_wipe = bool(request.form.get('full_wipe'))
+            if current_app.config.get('JOBS_WORKER'):
+                # Reset in background: la richiesta non attende la rigenerazione
+                from app.services.jobs.job_service import JobService
+                ok, msg, job = JobService().accoda('reset', {'importo': importo, 'months': months, 'full_wipe': full_wipe})
+                if ok:
+                    flash(f'Reset avviato in background (job {job.id}): avanzamento su /jobs/{job.id}', 'info')
+                else:
+                    flash(f'Errore durante reset: {msg}', 'error')
+                return redirect(url_for('main.index'))
             ok, res = svc.reset_horizon(importo, months=months, full_wipe=full_wipe)
             if ok:
                 extra = ' (full wipe)' if full_wipe else ''
@@ -425,3 +446,46 @@ def reset():
     return render_template('bilancio/reset.html', saldo=saldo)
 
 # Route gestita dal blueprint dettaglio_periodo
+
+
+@main_bp.route('/gestione/backup', methods=['GET', 'POST'])
+def backup():
+    """Elenco dei backup (GET) o creazione di un nuovo backup verificato (POST)."""
+    from flask import request
+    from app.services.backup.backup_service import BackupService
+
+    svc = BackupService()
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        comprimi = payload.get('comprimi') if 'comprimi' in payload else None
+        ok, msg, info = svc.crea_backup(motivo='manuale', comprimi=comprimi)
+        if not ok:
+            return jsonify({'success': False, 'message': msg}), 500
+        return jsonify({'success': True, 'message': msg, 'backup': {k: v for k, v in info.items() if k != 'path'}})
+
+    return jsonify({'success': True, 'backup': [
+        {
+            'nome': v['nome'],
+            'timestamp': v['timestamp'].isoformat(),
+            'motivo': v['motivo'],
+            'compresso': v['compresso'],
+            'dimensione': v['dimensione'],
+        }
+        for v in svc.elenco_backup()
+    ]})
+
+
+@main_bp.route('/gestione/backup/<nome>/verifica', methods=['POST'])
+def backup_verifica(nome):
+    """Esegue `PRAGMA integrity_check` sul backup indicato."""
+    from app.services.backup.backup_service import BackupService
+    ok, msg = BackupService().verifica_backup(nome)
+    return jsonify({'success': ok, 'message': msg}), (200 if ok else 400)
+
+
+@main_bp.route('/gestione/backup/<nome>/ripristina', methods=['POST'])
+def backup_ripristina(nome):
+    """Ripristina il database dal backup indicato (lo stato corrente viene salvato prima)."""
+    from app.services.backup.backup_service import BackupService
+    ok, msg = BackupService().ripristina(nome)
+    return jsonify({'success': ok, 'message': msg}), (200 if ok else 400)
@@ -1,10 +1,13 @@
 from flask import Blueprint, render_template, request, jsonify, send_from_directory, current_app, session, redirect, url_for
 from app.services.passwd_manager.passwd_manager_service import (
     initialize_encryption, is_initialized, has_security_config,
-    get_all_credentials, search_credentials, get_categories, add_credential,
+    list_credentials, search_credentials, get_categories, add_credential,
     update_credential, delete_credential, get_credential_by_id_decrypted,
-    export_to_xlsx
+    reveal_credential_field, count_credentials_by_category, lock_vault,
+    export_to_xlsx, PBKDF2_ITERATIONS
 )
+from app.services.passwd_manager.key_rotation_service import rotate_master_key, get_rotation_status
+from app.utils.xlsx_export import xlsx_response
 from werkzeug.utils import secure_filename
 import os
 import hashlib
@@ -32,7 +35,7 @@ def index():
         return redirect(url_for('passwd.login'))
 
     # Build categories mapping expected by the template
-    data = get_all_credentials()
+    data = list_credentials()
     categories = {}
     for item in data:
         cat = item.get('CATEGORIA') or 'SENZA_CATEGORIA'
@@ -61,6 +64,7 @@ def login():
 def logout():
     session.pop('authenticated', None)
     session.pop('password_hash', None)
+    lock_vault()
     return redirect(url_for('passwd.login'))
 
 
@@ -75,7 +79,7 @@ def api_search():
 @bp.route('/api/credentials', methods=['GET', 'POST'])
 def api_credentials():
     if request.method == 'GET':
-        return jsonify(get_all_credentials())
+        return jsonify(list_credentials())
     data = request.get_json() or {}
     cid = add_credential(data.get('CATEGORIA'), data.get('SERVIZIO'), data.get('UTENZA'), data.get('PASSWORD'), data.get('ALTRO'))
     return jsonify({'id': cid})
@@ -98,25 +102,57 @@ def api_categories():
 
 @bp.route('/api/categories-with-counts')
 def api_categories_with_counts():
-    cats = get_categories()
-    # build mapping
-    mapping = {c: len(search_credentials(None, c)) for c in cats}
+    counts = count_credentials_by_category()
+    mapping = {c: counts.get(c, 0) for c in get_categories()}
     return jsonify(mapping)
 
 
 @bp.route('/api/credentials/<int:cid>/decrypted')
 def api_credential_decrypted(cid):
+    # ?campo=password|altro decifra solo il campo richiesto
+    campo = (request.args.get('campo') or '').lower()
+    if campo:
+        if campo not in ('password', 'altro'):
+            return jsonify({'error': 'campo non valido'}), 400
+        valore = reveal_credential_field(cid, campo)
+        if valore is None:
+            return jsonify({}), 404
+        return jsonify({'id': cid, campo.upper(): valore})
     c = get_credential_by_id_decrypted(cid)
     return jsonify(c or {})
 
 
+@bp.route('/api/rotate-key', methods=['POST'])
+def api_rotate_key():
+    """Ricifra tutte le credenziali con una nuova password master (riprende se interrotta)."""
+    if not session.get('authenticated') or not is_initialized():
+        return jsonify({'ok': False, 'message': 'Non autenticato'}), 401
+    data = request.get_json() or {}
+    try:
+        iterations = int(data['ITERATIONS']) if data.get('ITERATIONS') else None
+    except (TypeError, ValueError):
+        return jsonify({'ok': False, 'message': 'Numero di iterazioni non valido'}), 400
+    if iterations is not None and iterations < PBKDF2_ITERATIONS:
+        return jsonify({'ok': False, 'message': f'Le iterazioni PBKDF2 non possono essere inferiori a {PBKDF2_ITERATIONS}'}), 400
+    ok, msg = rotate_master_key(data.get('OLD_PASSWORD'), data.get('NEW_PASSWORD'), iterations=iterations)
+    if ok:
+        session['password_hash'] = hash_password(data.get('NEW_PASSWORD'))
+    return jsonify({'ok': ok, 'message': msg, 'status': get_rotation_status()}), (200 if ok else 400)
+
+
+@bp.route('/api/rotate-key/status')
+def api_rotate_key_status():
+    if not session.get('authenticated'):
+        return jsonify({'ok': False, 'message': 'Non autenticato'}), 401
+    return jsonify(get_rotation_status() or {})
+
+
 @bp.route('/api/export/xlsx')
 def api_export_xlsx():
-    path = export_to_xlsx()
-    if not path:
+    buffer = export_to_xlsx()
+    if buffer is None:
         return jsonify({'ok': False}), 500
-    directory, filename = os.path.split(path)
-    return send_from_directory(directory, filename, as_attachment=True)
+    return xlsx_response(buffer, 'password_database.xlsx')
 
 
 # Serve service worker file expected at /passwd/sw.js
@@ -5,87 +5,23 @@ from app.models.Paypal import PaypalAbbonamenti, PaypalMovimenti
 from app.models.Transazioni import Transazioni
 from app import db
 from app.utils.formatting import format_currency
+from app.services.paypal.riconciliazione_service import riconcilia_rate_paypal
 
 paypal_bp = Blueprint('paypal', __name__)
 
 def aggiorna_importi_rimanenti_paypal():
-    """Aggiorna gli importi rimanenti per tutti i piani PayPal attivi"""
-    # Include both possible active states ('attivo' legacy and 'in_corso' used elsewhere)
-    piani = PaypalAbbonamenti.query.filter(PaypalAbbonamenti.stato.in_(['attivo', 'in_corso'])).all()
-    
-    for piano in piani:
-        rate_non_pagate = PaypalMovimenti.query.filter_by(
-            piano_id=piano.id,
-            stato='in_attesa'
-        ).all()
-        # Se alcune rate in_attesa sono in realtà già collegate a una transazioni o hanno data_pagamento,
-        # consideriamole pagate e sincronizziamo lo stato per coerenza.
-        for rata in list(rate_non_pagate):
-            try:
-                # Consider a rate paid only when it has an explicit payment date
-                if rata.data_pagamento is not None:
-                    rata.stato = 'pagata'
-                    # data_pagamento already present
-                    piano.importo_rimanente = (piano.importo_rimanente or 0.0) - (rata.importo or 0.0)
-                    rate_non_pagate.remove(rata)
-                else:
-                    # Se la rata è scaduta oggi (o prima) e non ha transazioni collegata,
-                    # proviamo prima a trovare una Transazioni con importo e data corrispondenti;
-                    # se non troviamo una transazioni, consideriamo la rata come pagata automaticamente
-                    try:
-                        oggi = datetime.now().date()
-                        # Only consider unlinked/unpaid rates
-                        if rata.data_scadenza <= oggi and rata.data_pagamento is None:
-                            from app.models.Transazioni import Transazioni
-                            trans = Transazioni.query.filter(
-                                ((Transazioni.data == rata.data_scadenza) | (Transazioni.data_effettiva == rata.data_scadenza)),
-                                ).all()
-                            match = None
-                            for t in trans:
-                                try:
-                                    if abs((t.importo or 0.0) - (rata.importo or 0.0)) < 0.01:
-                                        match = t
-                                        break
-                                except Exception:
-                                    continue
-                            if match:
-                                # Se esiste una transazioni corrispondente, colleghiamola e marchiamo pagata
-                                # Mark the rate as paid using the transaction date but do NOT link IDs
-                                rata.stato = 'pagata'
-                                rata.data_pagamento = match.data_effettiva or match.data
-                                piano.importo_rimanente = (piano.importo_rimanente or 0.0) - (rata.importo or 0.0)
-                                rate_non_pagate.remove(rata)
-                            else:
-                                # Nessuna transazioni trovata: consideriamo la rata come pagata alla scadenza
-                                rata.stato = 'pagata'
-                                rata.data_pagamento = rata.data_scadenza
-                                try:
-                                    piano.importo_rimanente = (piano.importo_rimanente or 0.0) - (rata.importo or 0.0)
-                                except Exception:
-                                    pass
-                                rate_non_pagate.remove(rata)
-                    except Exception:
-                        pass
-            except Exception:
-                # Non blocchiamo l'aggiornamento globale per singoli errori
-                pass
+    """Aggiorna gli importi rimanenti per tutti i piani PayPal attivi.
 
-        importo_rimanente = sum(rata.importo for rata in rate_non_pagate)
-        piano.importo_rimanente = importo_rimanente
-        
-        # Se non ci sono più rate da pagare, imposta il piano come completato
-        if importo_rimanente == 0:
-            piano.stato = 'completato'
-    
-    db.session.commit()
+    Delega al motore di riconciliazione set-based; in esercizio viene eseguito
+    una volta al giorno dal before_request dell'applicazione.
+    """
+    return riconcilia_rate_paypal()
 
 @paypal_bp.route('/')
 def dashboard():
     """Mostra la dashboard dei piani PayPal e relative statistiche."""
     try:
-        # Aggiorna gli importi rimanenti prima di visualizzare i dati
-        aggiorna_importi_rimanenti_paypal()
-        # Ricarica i piani dopo la commit per avere lo stato aggiornato
+        # La riconciliazione delle rate è eseguita dal before_request giornaliero
         piani = PaypalAbbonamenti.query.order_by(PaypalAbbonamenti.data_creazione.desc()).all()
         totale_piani = len(piani)
         # Conta come attivi solo quelli con stato 'in_corso'
@@ -163,8 +99,8 @@ def dashboard():
 def _debug_update():
     """Esegue l'aggiornamento PayPal e restituisce lo stato (endpoint di debug)."""
     try:
-        aggiorna_importi_rimanenti_paypal()
-        return jsonify({'status': 'ok'})
+        result = aggiorna_importi_rimanenti_paypal()
+        return jsonify({'status': 'ok', 'result': result})
     except Exception as e:
         import traceback
         trace = traceback.format_exc()
@@ -3,9 +3,9 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from app.utils.formatting import format_currency
 from datetime import datetime, date, timedelta
 from app.models.PostePayEvolution import AbbonamentoPostePay, MovimentoPostePay
-from app.services.conti_finanziari.strumenti_service import StrumentiService
+from app.services.conti_finanziari.strumenti_service import SaldoInsufficiente, SaldoModificato, StrumentiService
+from app.services.ppay_evolution.addebiti_service import genera_addebiti_abbonamenti
 from types import SimpleNamespace
-import calendar
 from app import db
 
 ppay_bp = Blueprint('ppay', __name__)
@@ -35,74 +35,11 @@ def evolution():
         # Optionally skip auto-generation (used when redirecting after a manual delete)
         skip_auto = request.args.get('skip_auto')
 
-        # --- Generazione automatica movimenti per abbonamenti scaduti oggi ---
+        # --- Generazione automatica addebiti abbonamenti (inclusi mesi saltati) ---
         # IMPORTANTE: questa operazione deve essere fatta PRIMA di recuperare i dati
         if not skip_auto:
             try:
-                ss = StrumentiService()
-                oggi = date.today()
-                first_of_month = date(oggi.year, oggi.month, 1)
-                ultimo_giorno = calendar.monthrange(oggi.year, oggi.month)[1]
-                last_of_month = date(oggi.year, oggi.month, ultimo_giorno)
-
-                # Recupera gli abbonamenti attivi
-                abbonamenti_attivi = AbbonamentoPostePay.query.filter(
-                    AbbonamentoPostePay.attivo == True
-                ).all()
-
-                movimenti_creati = []  # Tiene traccia dei movimenti effettivamente creati
-                for abbonamento in abbonamenti_attivi:
-                    # Calcola la data di addebito per il mese corrente (gestendo
-                    # mesi con meno giorni del giorno_addebito impostato)
-                    try:
-                        giorno_addebito = int(abbonamento.giorno_addebito)
-                    except Exception:
-                        # Se non è valido, salta
-                        continue
-
-                    giorno_per_mese = min(giorno_addebito, ultimo_giorno)
-                    addebito_this_month = date(oggi.year, oggi.month, giorno_per_mese)
-
-                    # Se l'addebito di questo mese è già passato (<= oggi) e non
-                    # esiste ancora un movimento per questo abbonamento nel mese,
-                    # creiamo comunque il movimento e aggiorniamo il saldo
-                    if addebito_this_month <= oggi:
-                        esistente = MovimentoPostePay.query.filter(
-                            MovimentoPostePay.abbonamento_id == abbonamento.id,
-                            MovimentoPostePay.data >= first_of_month,
-                            MovimentoPostePay.data <= last_of_month
-                        ).first()
-
-                        if not esistente:
-                            mov = MovimentoPostePay(
-                                data=addebito_this_month,
-                                descrizione=f"{abbonamento.nome} {addebito_this_month.strftime('%m/%Y')}",
-                                importo=abs(abbonamento.importo),
-                                tipo='Abbonamento',
-                                tipo_movimento='uscita',
-                                abbonamento_id=abbonamento.id
-                            )
-                            db.session.add(mov)
-                            movimenti_creati.append(mov)
-                
-                # Commit una sola volta alla fine, se sono stati generati movimenti
-                if movimenti_creati:
-                    db.session.flush()  # Assicura che i movimenti siano visibili nella sessione
-                    
-                    # Aggiorna il saldo dello strumento per i movimenti appena generati
-                    try:
-                        strum = ss.get_by_descrizione('Postepay Evolution')
-                        if strum:
-                            # Aggiorna il saldo solo per i movimenti effettivamente creati
-                            for mov in movimenti_creati:
-                                signed_value = -abs(mov.importo) if mov.tipo_movimento == 'uscita' else abs(mov.importo)
-                                strum.saldo_corrente = (strum.saldo_corrente or 0.0) + signed_value
-                            
-                            db.session.commit()  # Commit finale con saldo aggiornato
-                    except Exception as e:
-                        from flask import current_app
-                        current_app.logger.error(f"Errore aggiornamento saldo dopo generazione automatica: {e}")
-                        db.session.rollback()
+                genera_addebiti_abbonamenti()
             except Exception as e:
                 # Non vogliamo rompere la visualizzazione se la generazione automatica fallisce
                 from flask import current_app
@@ -117,9 +54,9 @@ def evolution():
         strum = ss.get_by_descrizione('Postepay Evolution')
         # create a small proxy so templates expecting postepay.saldo_attuale keep working
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -229,16 +166,11 @@ def ricarica():
         )
 
         db.session.add(movimento)
+        # Saldo dello strumento (sorgente di verità) nella stessa transazione del movimento
+        if strum:
+            ss.applica_delta_by_id(strum.id_conto, signed_importo, commit=False)
         db.session.commit()
 
-        # Aggiorna saldo nello strumento (sorgente di verità) by adding the signed importo
-        try:
-            if strum:
-                new_bal = (strum.saldo_corrente or 0.0) + signed_importo
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
-        except Exception:
-            pass
-
         flash(f'Ricarica di {format_currency(importo)} aggiunta con successo!', 'success')
         
     except ValueError:
@@ -276,12 +208,6 @@ def spesa():
         else:
             data_movimento = date.today()
 
-        # Verifica saldo disponibile (compare with absolute amount)
-        current_balance = (strum.saldo_corrente if strum else 0.0)
-        if current_balance < abs(importo):
-            flash('Saldo insufficiente per questa spesa', 'error')
-            return redirect(url_for('ppay.evolution'))
-
         # Normalize: uscita -> positive importo, tipo_movimento='uscita'
         signed_importo = abs(importo)
 
@@ -294,15 +220,17 @@ def spesa():
         )
 
         db.session.add(movimento)
-        db.session.commit()
-
-        # Aggiorna saldo nello strumento (sorgente di verità) by adding the signed importo
+        # La spesa riduce il saldo nella stessa transazione del movimento; la
+        # disponibilità è verificata dalla UPDATE stessa (saldo_minimo), non da una lettura precedente
         try:
-            if strum:
-                new_bal = (strum.saldo_corrente or 0.0) + signed_importo
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
-        except Exception:
-            pass
+            if strum is None:
+                raise SaldoInsufficiente('Strumento PostePay non disponibile')
+            ss.applica_delta_by_id(strum.id_conto, -signed_importo, commit=False, saldo_minimo=0.0)
+        except SaldoInsufficiente:
+            db.session.rollback()
+            flash('Saldo insufficiente per questa spesa', 'error')
+            return redirect(url_for('ppay.evolution'))
+        db.session.commit()
 
         flash(f'Spesa di {format_currency(importo)} aggiunta con successo!', 'success')
         
@@ -318,9 +246,9 @@ def spesa():
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -412,9 +340,9 @@ def toggle_abbonamento(abbonamento_id):
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -506,9 +434,9 @@ def elimina_abbonamento(abbonamento_id):
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -582,21 +510,15 @@ def elimina_movimento(movimento_id):
         from flask import current_app
         current_app.logger.info(f"elimina_movimento called for id={movimento_id} -> movimento={movimento}")
         
-        # Se il movimento è di tipo Ricarica, cerca e cancella la transazione corrispondente
-        if movimento.tipo == 'Ricarica':
-            try:
-                from app.models.Transazioni import Transazioni
-                # Cerca transazione con categoria_id=10, stessa data e stesso importo
-                tx_correlata = Transazioni.query.filter(
-                    Transazioni.categoria_id == 10,
-                    Transazioni.data == movimento.data,
-                    Transazioni.importo == movimento.importo
-                ).first()
-                if tx_correlata:
-                    current_app.logger.info(f"Trovata transazione correlata id={tx_correlata.id}, la elimino")
-                    db.session.delete(tx_correlata)
-            except Exception as e:
-                current_app.logger.error(f"Errore ricerca/cancellazione transazione correlata: {e}")
+        # Se il movimento è collegato a una ricarica del conto, cancella anche la transazione
+        try:
+            from app.services.ppay_evolution.collegamenti_service import transazione_collegata
+            tx_correlata = transazione_collegata(movimento.id)
+            if tx_correlata:
+                current_app.logger.info(f"Trovata transazione correlata id={tx_correlata.id}, la elimino")
+                db.session.delete(tx_correlata)
+        except Exception as e:
+            current_app.logger.error(f"Errore ricerca/cancellazione transazione correlata: {e}")
         
         # Calculate signed value to subtract from balance
         signed_value = -abs(movimento.importo) if movimento.tipo_movimento == 'uscita' else abs(movimento.importo)
@@ -609,8 +531,7 @@ def elimina_movimento(movimento_id):
             strum = ss.get_by_descrizione('Postepay Evolution')
             if strum:
                 # Subtract the effect: if it was +100, now -100; if it was -100, now +100
-                new_bal = (strum.saldo_corrente or 0.0) - signed_value
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
+                ss.applica_delta_by_id(strum.id_conto, -signed_value, commit=False)
         except Exception:
             pass
 
@@ -647,11 +568,17 @@ def modifica_saldo():
         saldo_precedente = strum.saldo_corrente or 0.0
         differenza = nuovo_saldo - saldo_precedente
 
-        # Aggiorna il saldo nello strumento (sorgente di verità)
+        # Aggiorna il saldo nello strumento (sorgente di verità) solo se nessuno l'ha
+        # cambiato dopo che il form è stato mostrato; saldo e movimento nella stessa transazione
+        versione = request.form.get('versione_saldo', type=int)
         try:
-            ss.update_saldo_by_id(strum.id_conto, nuovo_saldo)
-        except Exception:
-            pass
+            ss.update_saldo_by_id(strum.id_conto, nuovo_saldo,
+                                  versione_attesa=versione if versione is not None else strum.version,
+                                  commit=False)
+        except SaldoModificato:
+            db.session.rollback()
+            flash('Il saldo è stato modificato nel frattempo: verifica il nuovo valore e riprova', 'warning')
+            return redirect(url_for('ppay.evolution'))
 
         # Crea un movimento per tracciare la modifica
         if differenza != 0:
@@ -685,9 +612,9 @@ def modifica_saldo():
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -814,9 +741,9 @@ def aggiungi_abbonamento():
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -907,8 +834,7 @@ def aggiungi_movimento():
             ss = StrumentiService()
             strum = ss.get_by_descrizione('Postepay Evolution')
             if strum:
-                new_bal = (strum.saldo_corrente or 0.0) + signed_importo
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
+                ss.applica_delta_by_id(strum.id_conto, signed_importo, commit=False)
         except Exception:
             pass
         
@@ -926,9 +852,9 @@ def aggiungi_movimento():
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -1029,9 +955,7 @@ def modifica_movimento_postepay(movimento_id):
             ss = StrumentiService()
             strum = ss.get_by_descrizione('Postepay Evolution')
             if strum:
-                delta = new_signed - old_signed
-                new_bal = (strum.saldo_corrente or 0.0) + delta
-                ss.update_saldo_by_id(strum.id_conto, new_bal)
+                ss.applica_delta_by_id(strum.id_conto, new_signed - old_signed, commit=False)
         except Exception:
             pass
 
@@ -1046,9 +970,9 @@ def modifica_movimento_postepay(movimento_id):
         ss = StrumentiService()
         strum = ss.get_by_descrizione('Postepay Evolution')
         if strum is not None:
-            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0))
+            postepay = SimpleNamespace(saldo_attuale=(strum.saldo_corrente or 0.0), versione=strum.version)
         else:
-            postepay = SimpleNamespace(saldo_attuale=0.0)
+            postepay = SimpleNamespace(saldo_attuale=0.0, versione=None)
         abbonamenti = AbbonamentoPostePay.query.order_by(AbbonamentoPostePay.nome).all()
         movimenti = MovimentoPostePay.query.order_by(MovimentoPostePay.data.desc()).limit(10).all()
 
@@ -1157,3 +1081,30 @@ def modifica_abbonamento_postepay(abbonamento_id):
         flash(f'Errore nella modifica dell\'abbonamento: {str(e)}', 'error')
         db.session.rollback()
     return redirect(url_for('ppay.evolution'))
+
+
+@ppay_bp.route('/api/collegamenti', methods=['GET'])
+def api_collegamenti():
+    """Stato della riconciliazione tra ricariche PostePay e transazioni del conto."""
+    from sqlalchemy import text
+    from app.services.ppay_evolution.collegamenti_service import categoria_ricarica_ppay
+    riga = db.session.execute(text("""
+        SELECT (SELECT COUNT(*) FROM ppay_evolution_collegamenti),
+               (SELECT COUNT(*) FROM ppay_evolution_movimenti m WHERE m.tipo = 'Ricarica'
+                  AND NOT EXISTS (SELECT 1 FROM ppay_evolution_collegamenti c WHERE c.movimento_id = m.id)),
+               (SELECT COUNT(*) FROM transazioni t WHERE t.categoria_id = :categoria
+                  AND NOT EXISTS (SELECT 1 FROM ppay_evolution_collegamenti c WHERE c.transazione_id = t.id))
+    """), {'categoria': categoria_ricarica_ppay()}).fetchone()
+    return jsonify({
+        'success': True,
+        'collegati': int(riga[0] or 0),
+        'ricariche_non_collegate': int(riga[1] or 0),
+        'transazioni_non_collegate': int(riga[2] or 0),
+    })
+
+
+@ppay_bp.route('/api/collegamenti/backfill', methods=['POST'])
+def api_collegamenti_backfill():
+    """Collega le ricariche storiche alle transazioni corrispondenti (stessa data e importo)."""
+    from app.services.ppay_evolution.collegamenti_service import backfill_collegamenti
+    return jsonify({'success': True, 'collegati': backfill_collegamenti()})
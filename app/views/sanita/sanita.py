@@ -3,10 +3,20 @@ from flask import Blueprint, render_template, request, current_app, jsonify
 from datetime import date, timedelta
 from app import db
 from app.models.Terapia import TerapiaPlan, TerapiaDelivery
+from app.services.sanita.terapia_service import crea_piano, registra_modifica, diff_piano, etag_piano
 
 sanita_bp = Blueprint('sanita', __name__)
 
 
+def _risposta_diff(plan, base_version, **extra):
+    """Risposta delle operazioni sul piano: solo le consegne cambiate dopo `base_version`."""
+    payload = {'diff': diff_piano(plan, base_version)}
+    payload.update(extra)
+    resp = jsonify(payload)
+    resp.set_etag(etag_piano(plan))
+    return resp
+
+
 @sanita_bp.route('/terapia')
 def terapia():
     """Pagina Terapia Biologica: mostra calendario annuale e strumenti per gestire le forniture."""
@@ -22,12 +32,29 @@ def terapia():
 
 @sanita_bp.route('/api/plan', methods=['GET'])
 def get_plan():
-    """Return the single active terapia plan if any."""
+    """Return the single active terapia plan if any.
+
+    Supports conditional requests (ETag/If-None-Match -> 304) and `?since=<version>`
+    to receive only the deliveries changed after that version.
+    """
     try:
         plan = TerapiaPlan.query.first()
+        etag = etag_piano(plan)
+        if request.if_none_match.contains(etag):
+            resp = current_app.response_class(status=304)
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
         if not plan:
-            return jsonify({'plan': None})
-        return jsonify({'plan': plan.to_dict()})
+            resp = jsonify({'plan': None})
+        else:
+            since = request.args.get('since', type=int)
+            diff = diff_piano(plan, since) if since is not None else None
+            resp = jsonify({'diff': diff}) if diff is not None else jsonify({'plan': plan.to_dict()})
+        resp.set_etag(etag)
+        # Il browser rivalida sempre: senza modifiche la risposta è un 304 senza corpo
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
     except Exception:
         current_app.logger.exception('Errore retrieving plan')
         return jsonify({'error': 'internal'}), 500
@@ -59,39 +86,13 @@ def save_plan():
 
         # ensure tables exist
         db.create_all()
-        
-        # Create plan
-        plan = TerapiaPlan(start_date=start, total_drugs=total, num_deliveries=num)
-        db.session.add(plan)
-        db.session.flush()
-
-        # Create ALL deliveries by date: every 28 days from start until end of next year
-        qty_per_delivery = 2
-        cur = start
-        end_year = start.year + 1
-        last_day = date(end_year, 12, 31)
-        delivery_num = 0
-        while cur <= last_day:
-            delivery_num += 1
-            # By default, when creating a new plan we should NOT mark deliveries or doses as administered.
-            d = TerapiaDelivery(
-                plan_id=plan.id,
-                delivery_number=delivery_num,
-                quantity=qty_per_delivery,
-                received=False,
-                dose1=False,
-                dose2=False
-            )
-            db.session.add(d)
-            # advance 28 days
-            cur = cur + timedelta(days=28)
-
-        # Update plan totals based on created deliveries
-        plan.num_deliveries = delivery_num
-        plan.total_drugs = plan.num_deliveries * qty_per_delivery
 
+        # Create plan and ALL deliveries (every 28 days until end of next year) in bulk
+        plan = crea_piano(start)
         db.session.commit()
-        return jsonify({'plan': plan.to_dict()})
+        resp = jsonify({'plan': plan.to_dict()})
+        resp.set_etag(etag_piano(plan))
+        return resp
     except Exception:
         current_app.logger.exception('Errore saving plan')
         db.session.rollback()
@@ -105,13 +106,13 @@ def toggle_delivery(did):
         if not delivery:
             return jsonify({'error': 'not_found'}), 404
         # Toggle received state; do NOT auto-mark doses as administered here.
-        new_state = not bool(delivery.received)
-        delivery.received = new_state
-        db.session.add(delivery)
+        plan = delivery.plan
+        base_version = plan.version or 0
+        delivery.received = not bool(delivery.received)
+        registra_modifica(plan, delivery)
         db.session.commit()
-        # Return the full plan to update UI
-        plan = TerapiaPlan.query.get(delivery.plan_id)
-        return jsonify({'plan': plan.to_dict() if plan else None})
+        # Return only the changed delivery
+        return _risposta_diff(plan, base_version)
     except Exception:
         current_app.logger.exception('Errore toggling delivery')
         db.session.rollback()
@@ -130,11 +131,11 @@ def mark_next_delivery():
             return jsonify({'error': 'no_pending'}), 400
         # Mark delivery as received (arrival). Do NOT auto-mark doses as administered;
         # individual doses (dose1/dose2) are recorded when the user confirms a date.
+        base_version = plan.version or 0
         delivery.received = True
-        db.session.add(delivery)
+        registra_modifica(plan, delivery)
         db.session.commit()
-        plan = TerapiaPlan.query.get(plan.id)
-        return jsonify({'plan': plan.to_dict()})
+        return _risposta_diff(plan, base_version)
     except Exception:
         current_app.logger.exception('Errore marking next delivery')
         db.session.rollback()
@@ -175,13 +176,14 @@ def schedule_delivery(did):
         parts = date_str.split('-')
         scheduled_date = date(int(parts[0]), int(parts[1]), int(parts[2]))
         
+        plan = delivery.plan
+        base_version = plan.version or 0
         delivery.scheduled_delivery_date = scheduled_date
-        db.session.add(delivery)
+        registra_modifica(plan, delivery)
         db.session.commit()
-        
-        # Return the full plan to update UI
-        plan = TerapiaPlan.query.get(delivery.plan_id)
-        return jsonify({'plan': plan.to_dict() if plan else None})
+
+        # Return only the changed delivery
+        return _risposta_diff(plan, base_version)
     except Exception:
         current_app.logger.exception('Errore scheduling delivery')
         db.session.rollback()
@@ -197,14 +199,15 @@ def confirm_delivery(did):
             return jsonify({'error': 'not_found'}), 404
         
         # Mark delivery as confirmed
+        plan = delivery.plan
+        base_version = plan.version or 0
         delivery.delivery_confirmed = True
         delivery.received = True  # Mark as received
-        db.session.add(delivery)
+        registra_modifica(plan, delivery)
         db.session.commit()
-        
-        # Return the full plan to update UI
-        plan = TerapiaPlan.query.get(delivery.plan_id)
-        return jsonify({'plan': plan.to_dict() if plan else None})
+
+        # Return only the changed delivery
+        return _risposta_diff(plan, base_version)
     except Exception:
         current_app.logger.exception('Errore confirming delivery')
         db.session.rollback()
@@ -254,12 +257,12 @@ def click_delivery_date():
             if not available:
                 return jsonify({'error': 'no_available', 'message': 'Non ci sono consegne disponibili da programmare.'}), 400
             
+            base_version = plan.version or 0
             available.scheduled_delivery_date = clicked_date
-            db.session.add(available)
+            registra_modifica(plan, available)
             db.session.commit()
-            
-            plan = TerapiaPlan.query.get(plan.id)
-            return jsonify({'plan': plan.to_dict(), 'message': f'Consegna #{available.delivery_number} programmata per {date_str}'})
+
+            return _risposta_diff(plan, base_version, message=f'Consegna #{available.delivery_number} programmata per {date_str}')
         
         elif action == 'confirm':
             # Confirm the delivery
@@ -269,13 +272,13 @@ def click_delivery_date():
             if existing.delivery_confirmed:
                 return jsonify({'error': 'already_confirmed', 'message': 'Questa consegna è già stata confermata.'}), 400
             
+            base_version = plan.version or 0
             existing.delivery_confirmed = True
             existing.received = True
-            db.session.add(existing)
+            registra_modifica(plan, existing)
             db.session.commit()
-            
-            plan = TerapiaPlan.query.get(plan.id)
-            return jsonify({'plan': plan.to_dict(), 'message': 'Consegna confermata'})
+
+            return _risposta_diff(plan, base_version, message='Consegna confermata')
         
         elif action == 'cancel':
             # Cancel the scheduled delivery (set date to NULL)
@@ -285,12 +288,12 @@ def click_delivery_date():
             if existing.delivery_confirmed:
                 return jsonify({'error': 'already_confirmed', 'message': 'Non puoi cancellare una consegna già confermata.'}), 400
             
+            base_version = plan.version or 0
             existing.scheduled_delivery_date = None
-            db.session.add(existing)
+            registra_modifica(plan, existing)
             db.session.commit()
-            
-            plan = TerapiaPlan.query.get(plan.id)
-            return jsonify({'plan': plan.to_dict(), 'message': 'Programmazione cancellata'})
+
+            return _risposta_diff(plan, base_version, message='Programmazione cancellata')
         
         else:
             return jsonify({'error': 'invalid_action'}), 400
@@ -430,6 +433,7 @@ def mark_delivery_by_date():
             return jsonify({'error': 'order_violation', 'message': 'Devi marcare prima la prima dose (dose1) prima di marcare la seconda.', 'required_date': required_iso}), 400
 
         # Mark the specific dose as administered
+        base_version = plan.version or 0
         if dose_index == 0:
             found.dose1 = True
         else:
@@ -439,11 +443,10 @@ def mark_delivery_by_date():
         if (int(found.quantity or 0) <= 1 and found.dose1) or (int(found.quantity or 0) >= 2 and found.dose1 and found.dose2):
             found.received = True
 
-        db.session.add(found)
+        registra_modifica(plan, found)
         db.session.commit()
 
-        plan = TerapiaPlan.query.get(plan.id)
-        return jsonify({'plan': plan.to_dict()})
+        return _risposta_diff(plan, base_version)
     except Exception:
         current_app.logger.exception('Errore marking delivery by date')
         db.session.rollback()
@@ -1,5 +1,5 @@
 """Blueprint per le categorie"""
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
 from app.services.categorie.categorie_service import CategorieService
 
 categorie_bp = Blueprint('categorie', __name__)
@@ -11,13 +11,25 @@ def index():
 	try:
 		service = CategorieService()
 		categorie = service.get_all_categories(exclude_paypal=True)
-		stats = service.get_categories_stats()
-		return render_template('bilancio/categorie.html', categorie=categorie, stats=stats)
+		stats = service.get_categories_stats(mesi=0)
+		stats_by_id = {s['id']: s for s in stats}
+		return render_template('bilancio/categorie.html', categorie=categorie, stats=stats, stats_by_id=stats_by_id)
 	except Exception as e:
 		flash(f'Errore nel caricamento delle categorie: {str(e)}', 'error')
 		return redirect(url_for('main.index'))
 
 
+@categorie_bp.route('/api/statistiche')
+def api_statistiche():
+	"""Conteggi, totali e andamento mensile per categoria (JSON)"""
+	try:
+		mesi = request.args.get('mesi', 12, type=int)
+		mesi = max(0, min(mesi or 0, 120))
+		return jsonify({'success': True, 'categorie': CategorieService().get_categories_stats(mesi=mesi)})
+	except Exception as e:
+		return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @categorie_bp.route('/lista')
 def lista():
 	"""Compatibilità: vecchio endpoint 'lista' -> reusa index"""
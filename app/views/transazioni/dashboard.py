@@ -1,5 +1,6 @@
 """Blueprint per la dashboard"""
-from flask import Blueprint
+from flask import Blueprint, request, jsonify
+from app.services.transazioni.previsioni_service import PrevisioniService, MESI_DEFAULT
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
@@ -7,3 +8,29 @@ dashboard_bp = Blueprint('dashboard', __name__)
 def index():
 	"""Dashboard dettagliata"""
 	return "Dashboard - in sviluppo"
+
+
+@dashboard_bp.route('/api/previsioni', methods=['GET', 'POST'])
+def api_previsioni():
+	"""Saldi previsti sui prossimi mesi finanziari (JSON).
+
+	GET: ?mesi=24&paypal=1&ppay=0. POST: stessi parametri nel body JSON più
+	`scenario` (lista di modifiche what-if) per confrontare base e alternativa.
+	"""
+	try:
+		dati = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+		parametri = {**request.args.to_dict(), **dati}
+		mesi = int(parametri.get('mesi') or MESI_DEFAULT)
+		includi_paypal = str(parametri.get('paypal', '1')).lower() not in ('0', 'false', 'no')
+		includi_ppay = str(parametri.get('ppay', '0')).lower() in ('1', 'true', 'yes')
+		risultato = PrevisioniService().previsione(
+			mesi=mesi,
+			scenario=dati.get('scenario'),
+			includi_paypal=includi_paypal,
+			includi_ppay=includi_ppay,
+		)
+		return jsonify({'success': True, **risultato})
+	except ValueError as e:
+		return jsonify({'success': False, 'message': str(e)}), 400
+	except Exception as e:
+		return jsonify({'success': False, 'message': str(e)}), 500
@@ -2,6 +2,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from datetime import datetime
 from app.services.transazioni.dettaglio_periodo_service import DettaglioPeriodoService
+from app.services.transazioni.dettaglio_delta_service import DettaglioDeltaService, stato_transazione
+from app.services.transazioni.operazioni_batch_service import OperazioniBatchService
+from app.services.ppay_evolution.collegamenti_service import e_ricarica_ppay
 from app.models.Transazioni import Transazioni
 from app import db
 from app.services.categorie.categorie_service import CategorieService
@@ -14,8 +17,11 @@ from app.services import get_month_boundaries
 from datetime import date
 
 
-def _recompute_summaries_from(start_year=None, start_month=None):
-	"""Recompute `saldi_mensili` from a given start (year,month) up to the last month present in DB."""
+def _recompute_summaries_from(start_year=None, start_month=None, progresso=None):
+	"""Recompute `saldi_mensili` from a given start (year,month) up to the last month present in DB.
+
+	`progresso(fatti, totale, messaggio)` viene chiamata dopo ogni mese (job in background).
+	"""
 	try:
 		from app.services.transazioni.monthly_summary_service import MonthlySummaryService
 		from app.models.SaldiMensili import SaldiMensili
@@ -61,12 +67,14 @@ def _recompute_summaries_from(start_year=None, start_month=None):
 			return
 
 		msvc = MonthlySummaryService()
-		for (y, m) in periods:
+		for i, (y, m) in enumerate(periods):
 			try:
 				msvc.regenerate_month_summary(y, m)
 			except Exception:
 				# continue best-effort
 				pass
+			if progresso:
+				progresso(i + 1, len(periods) + 1, f'Riepilogo {m:02d}/{y}')
 
 		try:
 			msvc.chain_saldo_across(periods)
@@ -76,6 +84,98 @@ def _recompute_summaries_from(start_year=None, start_month=None):
 		# swallow to avoid breaking caller
 		pass
 
+
+def _summary_completo(start_date, end_date):
+	"""Riepilogo completo del periodo per le risposte AJAX (ricalcolo dal dettaglio)."""
+	from datetime import datetime as _dt
+	start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
+	end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
+	service = DettaglioPeriodoService()
+	summary = service.dettaglio_periodo_interno(start_dt, end_dt)
+	# include stats per categoria for client-side chart updates
+	anno = end_dt.year
+	mese = end_dt.month
+	try:
+		stats = service.get_statistiche_per_categoria(anno, mese) or []
+		stats_serial = []
+		for s in stats:
+			try:
+				if isinstance(s, dict):
+					nome = s.get('categoria_nome')
+					imp = float(s.get('importo') or 0)
+				else:
+					nome = getattr(s, 'categoria_nome', None)
+					imp = float(getattr(s, 'importo', 0) or 0)
+				stats_serial.append({'categoria_nome': nome, 'importo': imp})
+			except Exception:
+				stats_serial.append({'categoria_nome': str(s), 'importo': 0.0})
+	except Exception:
+		stats_serial = []
+	# Prefer persisted monthly summary values when available
+	try:
+		ms_row = SaldiMensili.query.filter_by(year=anno, month=mese).first()
+	except Exception:
+		ms_row = None
+	if ms_row:
+		saldo_finale = float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0))))
+		out = {
+			'entrate': float(ms_row.entrate or 0.0),
+			'uscite': float(ms_row.uscite or 0.0),
+			'bilancio': float((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)),
+			'saldo_iniziale_mese': float(ms_row.saldo_iniziale or 0.0),
+			'saldo_attuale_mese': float(ms_row.saldo_iniziale or 0.0) + float(summary.get('saldo_attuale_mese') or 0.0) - float(summary.get('saldo_iniziale_mese') or 0.0),
+			'saldo_finale_mese': saldo_finale,
+			'saldo_previsto_fine_mese': saldo_finale,
+			'budget_items': summary.get('budget_items') or [],
+			'stats_categorie': stats_serial
+		}
+	else:
+		out = {
+			'entrate': float(summary.get('entrate') or 0.0),
+			'uscite': float(summary.get('uscite') or 0.0),
+			'bilancio': float(summary.get('bilancio') or 0.0),
+			'saldo_iniziale_mese': float(summary.get('saldo_iniziale_mese') or 0.0),
+			'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
+			'saldo_finale_mese': float(summary.get('saldo_finale_mese') or 0.0),
+			'saldo_previsto_fine_mese': float(summary.get('saldo_previsto_fine_mese') or 0.0),
+			'budget_items': summary.get('budget_items') or [],
+			'stats_categorie': stats_serial
+		}
+
+	# compute saldo_finale + sum of residui (defensive)
+	try:
+		b_items = summary.get('budget_items') or []
+		sum_residui = sum([float(b.get('residuo') or 0) if isinstance(b, dict) else float(getattr(b, 'residuo', 0) or 0) for b in b_items])
+		out['saldo_finale_plus_residui'] = float(out['saldo_finale_mese'] + sum_residui)
+	except Exception:
+		out['saldo_finale_plus_residui'] = float(out.get('saldo_finale_mese') or 0.0)
+	return out
+
+
+def _aggiorna_riepiloghi(variazioni, start_date, end_date, data_ricalcolo=None):
+	"""Applica le variazioni `(prima, dopo)` ai riepiloghi e ritorna il delta per il client.
+
+	Ritorna None se l'aggiornamento incrementale non è applicabile: in quel caso
+	i riepiloghi sono già stati ricalcolati da `data_ricalcolo` in poi e il
+	chiamante deve usare `_summary_completo`.
+	"""
+	try:
+		from datetime import datetime as _dt
+		start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
+		end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
+		summary = DettaglioDeltaService().applica(variazioni, start_dt, end_dt)
+	except Exception:
+		summary = None
+	if summary is None:
+		try:
+			if data_ricalcolo:
+				_recompute_summaries_from(data_ricalcolo.year, data_ricalcolo.month)
+			else:
+				_recompute_summaries_from()
+		except Exception:
+			pass
+	return summary
+
 dettaglio_periodo_bp = Blueprint('dettaglio_periodo', __name__)
 
 @dettaglio_periodo_bp.route('/')
@@ -292,6 +392,8 @@ def dettaglio_periodo(start_date, end_date):
 		if ms:
 			result['entrate'] = float(ms.entrate or 0.0)
 			result['uscite'] = float(ms.uscite or 0.0)
+			# Saldo attuale ancorato allo stesso saldo iniziale persistito (come le risposte AJAX)
+			result['saldo_attuale_mese'] = float(ms.saldo_iniziale or 0.0) + float(result.get('saldo_attuale_mese') or 0.0) - float(result.get('saldo_iniziale_mese') or 0.0)
 			result['saldo_iniziale_mese'] = float(ms.saldo_iniziale or 0.0)
 			result['saldo_finale_mese'] = float(ms.saldo_finale if ms.saldo_finale is not None else (ms.saldo_iniziale + (ms.entrate - ms.uscite)))
 			result['saldo_previsto_fine_mese'] = float(ms.saldo_finale if ms.saldo_finale is not None else (ms.saldo_iniziale + (ms.entrate - ms.uscite)))
@@ -314,57 +416,44 @@ def elimina_transazione_periodo(start_date, end_date, id):
 	"""Elimina la transazioni indicata e ritorna al dettaglio del periodo."""
 	is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 	success = False
+	summary_delta = None
 	
 	try:
 		tx = Transazioni.query.get_or_404(id)
+		prima = stato_transazione(tx)
 		
-		# Se la transazione è categoria 10 (Ricarica PPay), cerca e cancella il movimento correlato
-		if tx.categoria_id == 10:
-			try:
-				from app.models.PostePayEvolution import MovimentoPostePay
-				from app.services.conti_finanziari.strumenti_service import StrumentiService
-				from flask import current_app
+		# Se la transazione è una ricarica PPay, cancella il movimento collegato
+		try:
+			from app.services.ppay_evolution.collegamenti_service import movimento_collegato
+			from app.services.conti_finanziari.strumenti_service import StrumentiService
+			from flask import current_app
+			
+			mov_correlato = movimento_collegato(tx.id)
+			
+			if mov_correlato:
+				current_app.logger.info(f"Trovato movimento PostePay correlato id={mov_correlato.id}, lo elimino")
+				# Calcola l'effetto del movimento sul saldo (da invertire)
+				signed_value = -abs(mov_correlato.importo) if mov_correlato.tipo_movimento == 'uscita' else abs(mov_correlato.importo)
 				
-				# Cerca movimento correlato con stessa data e importo, tipo Ricarica
-				mov_correlato = MovimentoPostePay.query.filter(
-					MovimentoPostePay.tipo == 'Ricarica',
-					MovimentoPostePay.data == tx.data,
-					MovimentoPostePay.importo == tx.importo
-				).first()
+				db.session.delete(mov_correlato)
 				
-				if mov_correlato:
-					current_app.logger.info(f"Trovato movimento PostePay correlato id={mov_correlato.id}, lo elimino")
-					# Calcola l'effetto del movimento sul saldo (da invertire)
-					signed_value = -abs(mov_correlato.importo) if mov_correlato.tipo_movimento == 'uscita' else abs(mov_correlato.importo)
-					
-					db.session.delete(mov_correlato)
-					
-					# Aggiorna saldo dello Strumento PostePay invertendo l'effetto
-					try:
-						ss = StrumentiService()
-						strum = ss.get_by_descrizione('Postepay Evolution')
-						if strum:
-							new_bal = (strum.saldo_corrente or 0.0) - signed_value
-							ss.update_saldo_by_id(strum.id_conto, new_bal)
-							current_app.logger.info(f"Saldo PostePay aggiornato: {new_bal}")
-					except Exception as e:
-						current_app.logger.error(f"Errore aggiornamento saldo PostePay: {e}")
-			except Exception as e:
-				from flask import current_app
-				current_app.logger.error(f"Errore ricerca/cancellazione movimento PostePay correlato: {e}")
+				# Aggiorna saldo dello Strumento PostePay invertendo l'effetto
+				try:
+					new_bal = StrumentiService().applica_delta('Postepay Evolution', -signed_value, commit=False)
+					if new_bal is not None:
+						current_app.logger.info(f"Saldo PostePay aggiornato: {new_bal}")
+				except Exception as e:
+					current_app.logger.error(f"Errore aggiornamento saldo PostePay: {e}")
+		except Exception as e:
+			from flask import current_app
+			current_app.logger.error(f"Errore ricerca/cancellazione movimento PostePay correlato: {e}")
 		
 		db.session.delete(tx)
 		db.session.commit()
 		success = True
 		
-		# Recompute monthly summaries starting from the month of the deleted transaction
-		try:
-			if getattr(tx, 'data', None):
-				_recompute_summaries_from(tx.data.year, tx.data.month)
-			else:
-				_recompute_summaries_from()
-		except Exception:
-			pass
+		# Apply the row delta to the monthly summaries (full recompute as fallback)
+		summary_delta = _aggiorna_riepiloghi([(prima, None)], start_date, end_date, getattr(tx, 'data', None))
 		
 		if not is_ajax:
 			flash('Transazioni eliminata con successo', 'success')
@@ -384,82 +473,8 @@ def elimina_transazione_periodo(start_date, end_date, id):
 	if is_ajax:
 		if not success:
 			return jsonify({'status': 'error', 'message': 'Errore durante l\'eliminazione'}), 400
-			
 		try:
-			from datetime import datetime as _dt
-			start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
-			end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
-			service = DettaglioPeriodoService()
-			summary = service.dettaglio_periodo_interno(start_dt, end_dt)
-			# include stats per categoria for client-side chart updates
-			try:
-				anno = end_dt.year
-				mese = end_dt.month
-				stats = service.get_statistiche_per_categoria(anno, mese) or []
-				# normalize to serializable list
-				stats_serial = []
-				for s in stats:
-					try:
-						if isinstance(s, dict):
-							nome = s.get('categoria_nome')
-							imp = float(s.get('importo') or 0)
-						else:
-							nome = getattr(s, 'categoria_nome', None)
-							imp = float(getattr(s, 'importo', 0) or 0)
-						stats_serial.append({'categoria_nome': nome, 'importo': imp})
-					except Exception:
-						stats_serial.append({'categoria_nome': str(s), 'importo': 0.0})
-			except Exception:
-				stats_serial = []
-			# Keep only serializable summary fields
-			# Prefer persisted monthly summary values when available
-			try:
-				ms_row = SaldiMensili.query.filter_by(year=anno, month=mese).first()
-			except Exception:
-				ms_row = None
-			if ms_row:
-				out = {
-					'entrate': float(ms_row.entrate or 0.0),
-					'uscite': float(ms_row.uscite or 0.0),
-					'bilancio': float((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)),
-					'saldo_iniziale_mese': float(ms_row.saldo_iniziale or 0.0),
-					'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-					'saldo_finale_mese': float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)))),
-					'saldo_previsto_fine_mese': float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)))),
-					'budget_items': summary.get('budget_items') or [],
-					'stats_categorie': stats_serial
-				}
-
-				# compute saldo_finale + sum of residui (defensive)
-				try:
-					b_items = summary.get('budget_items') or []
-					sum_residui = sum([float(b.get('residuo') or 0) if isinstance(b, dict) else float(getattr(b, 'residuo', 0) or 0) for b in b_items])
-					base_finale = float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0))))
-					out['saldo_finale_plus_residui'] = float(base_finale + sum_residui)
-				except Exception:
-					out['saldo_finale_plus_residui'] = float(out.get('saldo_finale_mese') or 0.0)
-			else:
-				out = {
-					'entrate': float(summary.get('entrate') or 0.0),
-					'uscite': float(summary.get('uscite') or 0.0),
-					'bilancio': float(summary.get('bilancio') or 0.0),
-					'saldo_iniziale_mese': float(summary.get('saldo_iniziale_mese') or 0.0),
-					'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-					'saldo_finale_mese': float(summary.get('saldo_finale_mese') or 0.0),
-					'saldo_previsto_fine_mese': float(summary.get('saldo_previsto_fine_mese') or 0.0),
-					'budget_items': summary.get('budget_items') or [],
-					'stats_categorie': stats_serial
-				}
-
-				# compute saldo_finale + residui defensively
-				try:
-					b_items = summary.get('budget_items') or []
-					sum_residui = sum([float(b.get('residuo') or 0) if isinstance(b, dict) else float(getattr(b, 'residuo', 0) or 0) for b in b_items])
-					base_finale = float(summary.get('saldo_finale_mese') or 0.0)
-					out['saldo_finale_plus_residui'] = float(base_finale + sum_residui)
-				except Exception:
-					out['saldo_finale_plus_residui'] = float(out.get('saldo_finale_mese') or 0.0)
-			return jsonify({'status': 'ok', 'summary': out})
+			return jsonify({'status': 'ok', 'summary': summary_delta or _summary_completo(start_date, end_date)})
 		except Exception as ex:
 			return jsonify({'status': 'error', 'message': str(ex)}), 500
 	
@@ -539,7 +554,7 @@ def aggiungi_transazione_periodo(start_date, end_date):
 			db.session.add(transazioni)
 			db.session.commit()
 
-			if categoria_id == 10:
+			if e_ricarica_ppay(categoria_id):
 				# Use the PostePayEvolution service so the instrument balance is updated
 				# Transazione uscita dal conto principale = ricarica (entrata) su PostePay Evolution
 				try:
@@ -555,7 +570,8 @@ def aggiungi_transazione_periodo(start_date, end_date):
 						tipo='Ricarica',
 						descrizione='Ricarica PPay Evolution',
 						abbonamento_id=None,
-						tipo_movimento='entrata'
+						tipo_movimento='entrata',
+						transazione_id=transazioni.id
 					)
 					current_app.logger.info(f"Movimento PPay creato: {movimento.id if movimento else 'None'}")
 				except Exception as e:
@@ -567,93 +583,16 @@ def aggiungi_transazione_periodo(start_date, end_date):
 			current_app.logger.error(f"Errore aggiunta transazione: {str(ex)}")
 			raise
 
-		# update summaries
-		try:
-			if data_obj:
-				_recompute_summaries_from(data_obj.year, data_obj.month)
-			else:
-				_recompute_summaries_from()
-		except Exception:
-			pass
-		flash('Transazioni aggiunta con successo', 'success')
-		# prepare AJAX summary if requested
-		if is_ajax and transazioni:
-			# Build a robust summary_out: attempt to recompute the detailed summary
-			# and fall back to a minimal summary if anything fails. This ensures
-			# the client receives budget_items and updated totals immediately.
+		# update summaries with the delta of the new row
+		summary_out = _aggiorna_riepiloghi([(None, stato_transazione(transazioni))], start_date, end_date, data_obj)
+		if not is_ajax:
+			flash('Transazioni aggiunta con successo', 'success')
+		# fall back to the full summary when the delta could not be applied
+		if is_ajax and summary_out is None:
 			try:
-				from datetime import datetime as _dt
-				start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
-				end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
-				service = DettaglioPeriodoService()
-				summary = service.dettaglio_periodo_interno(start_dt, end_dt)
-				# include stats per categoria
-				try:
-					anno = end_dt.year
-					mese = end_dt.month
-					stats = service.get_statistiche_per_categoria(anno, mese) or []
-					stats_serial = []
-					for s in stats:
-						try:
-							if isinstance(s, dict):
-								stats_serial.append({'categoria_nome': s.get('categoria_nome'), 'importo': float(s.get('importo') or 0)})
-							else:
-								stats_serial.append({'categoria_nome': getattr(s, 'categoria_nome', None), 'importo': float(getattr(s, 'importo', 0) or 0)})
-						except Exception:
-							stats_serial.append({'categoria_nome': str(s), 'importo': 0.0})
-				except Exception:
-					stats_serial = []
-				summary_out = {
-					'entrate': float(summary.get('entrate') or 0.0),
-					'uscite': float(summary.get('uscite') or 0.0),
-					'bilancio': float(summary.get('bilancio') or 0.0),
-					'saldo_iniziale_mese': float(summary.get('saldo_iniziale_mese') or 0.0),
-					'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-					'saldo_finale_mese': float(summary.get('saldo_finale_mese') or 0.0),
-					'saldo_previsto_fine_mese': float(summary.get('saldo_previsto_fine_mese') or 0.0),
-					'budget_items': summary.get('budget_items') or [],
-					'stats_categorie': stats_serial
-				}
-
-				# compute saldo_finale + residui for client convenience
-				try:
-					b_items = summary.get('budget_items') or []
-					sum_residui = sum([float(b.get('residuo') or 0) if isinstance(b, dict) else float(getattr(b, 'residuo', 0) or 0) for b in b_items])
-					base_finale = float(summary.get('saldo_finale_mese') or 0.0)
-					summary_out['saldo_finale_plus_residui'] = float(base_finale + sum_residui)
-				except Exception:
-					summary_out['saldo_finale_plus_residui'] = float(summary_out.get('saldo_finale_mese') or 0.0)
-			except Exception as e:
-				# If computing the full summary failed, try a minimal safe summary so the client
-				# still receives updated totals. Do not raise further.
-				try:
-					from datetime import datetime as _dt
-					start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
-					end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
-					# best-effort minimal aggregation
-					service = DettaglioPeriodoService()
-					summary = service.dettaglio_periodo_interno(start_dt, end_dt)
-					summary_out = {
-						'entrate': float(summary.get('entrate') or 0.0),
-						'uscite': float(summary.get('uscite') or 0.0),
-						'bilancio': float(summary.get('bilancio') or 0.0),
-						'saldo_iniziale_mese': float(summary.get('saldo_iniziale_mese') or 0.0),
-						'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-						'saldo_finale_mese': float(summary.get('saldo_finale_mese') or 0.0),
-						'saldo_previsto_fine_mese': float(summary.get('saldo_previsto_fine_mese') or 0.0),
-						'budget_items': summary.get('budget_items') or [],
-						'stats_categorie': []
-					}
-
-					try:
-						b_items = summary.get('budget_items') or []
-						sum_residui = sum([float(b.get('residuo') or 0) if isinstance(b, dict) else float(getattr(b, 'residuo', 0) or 0) for b in b_items])
-						base_finale = float(summary.get('saldo_finale_mese') or 0.0)
-						summary_out['saldo_finale_plus_residui'] = float(base_finale + sum_residui)
-					except Exception:
-						summary_out['saldo_finale_plus_residui'] = float(summary_out.get('saldo_finale_mese') or 0.0)
-				except Exception:
-					summary_out = {'entrate':0.0,'uscite':0.0,'bilancio':0.0,'saldo_iniziale_mese':0.0,'saldo_attuale_mese':0.0,'saldo_finale_mese':0.0,'saldo_previsto_fine_mese':0.0,'budget_items':[],'stats_categorie':[]}
+				summary_out = _summary_completo(start_date, end_date)
+			except Exception:
+				summary_out = {'entrate':0.0,'uscite':0.0,'bilancio':0.0,'saldo_iniziale_mese':0.0,'saldo_attuale_mese':0.0,'saldo_finale_mese':0.0,'saldo_previsto_fine_mese':0.0,'budget_items':[],'stats_categorie':[]}
 
 	except Exception as e:
 		try:
@@ -683,6 +622,9 @@ def aggiungi_transazione_periodo(start_date, end_date):
 def modifica_transazione_periodo(start_date, end_date, id):
 	"""Modifica una transazioni esistente e ritorna al dettaglio del periodo."""
 	tx = Transazioni.query.get_or_404(id)
+	is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+	prima = stato_transazione(tx)
+	summary_delta = None
 	try:
 		data_str = request.form.get('data')
 		if data_str:
@@ -719,15 +661,10 @@ def modifica_transazione_periodo(start_date, end_date, id):
 		db.session.commit()
 		print(f"Transaction {id} modified: data={tx.data}, importo={tx.importo}")
 		
-		# After modifying a transaction, update monthly summaries starting from the transaction month
-		try:
-			if getattr(tx, 'data', None):
-				_recompute_summaries_from(tx.data.year, tx.data.month)
-			else:
-				_recompute_summaries_from()
-		except Exception as ex:
-			print(f"Error recomputing summaries: {ex}")
-		flash('Transazioni modificata con successo', 'success')
+		# After modifying a transaction, apply old -> new row delta to the monthly summaries
+		summary_delta = _aggiorna_riepiloghi([(prima, stato_transazione(tx))], start_date, end_date, getattr(tx, 'data', None))
+		if not is_ajax:
+			flash('Transazioni modificata con successo', 'success')
 	except Exception as e:
 		print(f"Error modifying transaction {id}: {e}")
 		import traceback
@@ -739,68 +676,36 @@ def modifica_transazione_periodo(start_date, end_date, id):
 		flash(f'Errore durante la modifica della transazioni: {str(e)}', 'error')
 
 	# If AJAX request, return updated totals (no full reload)
-	if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+	if is_ajax:
 		try:
-			from datetime import datetime as _dt
-			start_dt = _dt.strptime(start_date, '%Y-%m-%d').date()
-			end_dt = _dt.strptime(end_date, '%Y-%m-%d').date()
-			service = DettaglioPeriodoService()
-			summary = service.dettaglio_periodo_interno(start_dt, end_dt)
-			# compute stats for chart
-			try:
-				anno = end_dt.year
-				mese = end_dt.month
-				stats = service.get_statistiche_per_categoria(anno, mese) or []
-				stats_serial = []
-				for s in stats:
-					try:
-						if isinstance(s, dict):
-							nome = s.get('categoria_nome')
-							imp = float(s.get('importo') or 0)
-						else:
-							nome = getattr(s, 'categoria_nome', None)
-							imp = float(getattr(s, 'importo', 0) or 0)
-						stats_serial.append({'categoria_nome': nome, 'importo': imp})
-					except Exception:
-						stats_serial.append({'categoria_nome': str(s), 'importo': 0.0})
-			except Exception:
-				stats_serial = []
-			# Prefer persisted monthly summary values when available
-			try:
-				ms_row = SaldiMensili.query.filter_by(year=anno, month=mese).first()
-			except Exception:
-				ms_row = None
-			if ms_row:
-				out = {
-					'entrate': float(ms_row.entrate or 0.0),
-					'uscite': float(ms_row.uscite or 0.0),
-					'bilancio': float((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)),
-					'saldo_iniziale_mese': float(ms_row.saldo_iniziale or 0.0),
-					'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-					'saldo_finale_mese': float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)))),
-					'saldo_previsto_fine_mese': float(ms_row.saldo_finale if ms_row.saldo_finale is not None else (ms_row.saldo_iniziale + ((ms_row.entrate or 0.0) - (ms_row.uscite or 0.0)))),
-					'budget_items': summary.get('budget_items') or [],
-					'stats_categorie': stats_serial
-				}
-			else:
-				out = {
-					'entrate': float(summary.get('entrate') or 0.0),
-					'uscite': float(summary.get('uscite') or 0.0),
-					'bilancio': float(summary.get('bilancio') or 0.0),
-					'saldo_iniziale_mese': float(summary.get('saldo_iniziale_mese') or 0.0),
-					'saldo_attuale_mese': float(summary.get('saldo_attuale_mese') or 0.0),
-					'saldo_finale_mese': float(summary.get('saldo_finale_mese') or 0.0),
-					'saldo_previsto_fine_mese': float(summary.get('saldo_previsto_fine_mese') or 0.0),
-					'budget_items': summary.get('budget_items') or [],
-					'stats_categorie': stats_serial
-				}
-			return jsonify({'status': 'ok', 'summary': out})
+			return jsonify({'status': 'ok', 'summary': summary_delta or _summary_completo(start_date, end_date)})
 		except Exception:
 			return jsonify({'status': 'error'}), 500
 	# non-AJAX fallback
 	return redirect(url_for('dettaglio_periodo.dettaglio_periodo', start_date=start_date, end_date=end_date))
 
 
+@dettaglio_periodo_bp.route('/<start_date>/<end_date>/batch', methods=['POST'])
+def batch_transazioni_periodo(start_date, end_date):
+	"""Applica un lotto di operazioni (aggiungi/modifica/elimina) in un'unica transazione.
+
+	Body JSON: {"operazioni": [{"azione": "aggiungi"|"modifica"|"elimina", "id": ..., "data": ..., ...}]}.
+	I riepiloghi dei periodi toccati sono aggiornati una volta sola per tutto il lotto.
+	"""
+	payload = request.get_json(silent=True) or {}
+	success, msg, risultato = OperazioniBatchService().applica(payload.get('operazioni'))
+	if not success:
+		return jsonify({'status': 'error', 'message': msg, 'errori': risultato.get('errori', [])}), 400
+
+	summary = _aggiorna_riepiloghi(risultato['variazioni'], start_date, end_date, risultato['data_minima'])
+	try:
+		if summary is None:
+			summary = _summary_completo(start_date, end_date)
+	except Exception:
+		summary = None
+	return jsonify({'status': 'ok', 'message': msg, 'operazioni': risultato['operazioni'], 'summary': summary})
+
+
 @dettaglio_periodo_bp.route('/<start_date>/<end_date>/modifica_monthly_budget', methods=['POST'])
 def modifica_monthly_budget(start_date, end_date):
 	"""Aggiorna (o crea) il BudgetMensili per la categorie/mese indicati e sincronizza"""
@@ -979,8 +884,8 @@ def correggi_saldo(start_date, end_date):
 		try:
 			db.session.add(transazione)
 			db.session.commit()
-			if getattr(transazione, 'categoria_id', None) == 10:
-				# Transazione categoria 10: uscita dal conto principale = entrata su PostePay Evolution
+			if e_ricarica_ppay(getattr(transazione, 'categoria_id', None)):
+				# Transazione di ricarica PostePay: uscita dal conto principale = entrata su PostePay Evolution
 				from app.services.ppay_evolution.ppay_evolution_service import PostePayEvolutionService
 
 				ppay_svc = PostePayEvolutionService()
@@ -991,7 +896,8 @@ def correggi_saldo(start_date, end_date):
 					tipo='Ricarica',
 					descrizione='Ricarica PPay Evolution',
 					abbonamento_id=None,
-					tipo_movimento='entrata'
+					tipo_movimento='entrata',
+					transazione_id=transazione.id
 				)
 		except Exception:
 			db.session.rollback()
@@ -1,5 +1,5 @@
 """Blueprint per lo storico delle transazioni archiviate"""
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, current_app
 from app.models.TransazioniArchivio import TransazioniArchivio
 from app import db
 from sqlalchemy import distinct, desc
@@ -60,3 +60,102 @@ def index():
         totale_uscite=totale_uscite,
         bilancio=bilancio
     )
+
+
+@storico_bp.route('/api/analisi')
+def api_analisi():
+    """Totali per periodo, anno e categoria su transazioni correnti e archiviate (JSON)"""
+    try:
+        from app.services.transazioni.snapshot_service import snapshot_transazioni, FONTE_CORRENTI, FONTE_ARCHIVIO
+        da = request.args.get('da', type=int)
+        a = request.args.get('a', type=int)
+        fonte = request.args.get('fonte')
+        fonti = {'correnti': [FONTE_CORRENTI], 'archivio': [FONTE_ARCHIVIO]}.get(fonte)
+        return jsonify({
+            'success': True,
+            'periodi': snapshot_transazioni.per_periodo(da, a, fonti),
+            'anni': snapshot_transazioni.per_anno(fonti),
+            'categorie': snapshot_transazioni.per_categoria(da, a, fonti),
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@storico_bp.route('/api/report/<string:tipo_report>')
+def api_report(tipo_report):
+    """Report pluriennali (JSON): anno-su-anno, mobile-12-mesi, categorie"""
+    try:
+        from app.services.transazioni.report_service import ReportService
+        service = ReportService()
+        fino_a = request.args.get('fino_a', type=int)
+        senza_categoria = request.args.get('senza_categoria', '0') in ('1', 'true', 'yes')
+        if tipo_report == 'anno-su-anno':
+            dati = service.anno_su_anno(fino_a, senza_categoria)
+        elif tipo_report == 'mobile-12-mesi':
+            dati = service.mobile_12_mesi(fino_a, senza_categoria, finestra=request.args.get('finestra', 12, type=int) or 12)
+        elif tipo_report == 'categorie':
+            dati = service.trend_categorie(
+                tipo='entrata' if request.args.get('tipo') == 'entrata' else 'uscita',
+                ultimi_mesi=request.args.get('mesi', type=int),
+                fino_a=fino_a,
+            )
+        else:
+            return jsonify({'success': False, 'message': 'Report non riconosciuto'}), 404
+        return jsonify({'success': True, **dati})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@storico_bp.route('/export/xlsx')
+def export_xlsx():
+    """Scarica transazioni, archivio e saldi mensili in formato XLSX.
+
+    Con `?background=1` l'export diventa un job: la risposta contiene l'id e il
+    file si scarica da `/jobs/<id>/download` a job completato.
+    """
+    if request.args.get('background') and current_app.config.get('JOBS_WORKER'):
+        from app.services.jobs.job_service import JobService
+        success, message, job = JobService().accoda('export_xlsx')
+        if not success:
+            return jsonify({'success': False, 'message': message}), 500
+        return jsonify({'success': True, 'job_id': job.id,
+                        'stato_url': url_for('jobs.stato', job_id=job.id),
+                        'download_url': url_for('jobs.download', job_id=job.id)}), 202
+    try:
+        from app.services.transazioni.export_service import export_dati_finanziari
+        from app.utils.xlsx_export import xlsx_response
+        from datetime import date
+        buffer = export_dati_finanziari()
+        return xlsx_response(buffer, f"bilancio_{date.today().strftime('%Y%m%d')}.xlsx")
+    except Exception as e:
+        flash(f'Errore durante l\'export: {str(e)}', 'error')
+        return redirect(url_for('storico.index'))
+
+
+@storico_bp.route('/import', methods=['POST'])
+def import_estratto_conto():
+    """Importa un estratto conto CSV/XLSX/XLS nelle transazioni"""
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('Nessun file selezionato', 'error')
+        return redirect(url_for('storico.index'))
+    try:
+        from app.services.transazioni.import_service import importa_estratto_conto
+        success, message, risultato = importa_estratto_conto(file.stream, file.filename)
+        if success and risultato['periodi']:
+            # Un solo ricalcolo dei riepiloghi, dal periodo più vecchio importato
+            # (in background se la coda dei job è attiva)
+            primo = risultato['periodi'][0]
+            accodato = False
+            if current_app.config.get('JOBS_WORKER'):
+                from app.services.jobs.job_service import JobService
+                accodato, _, job = JobService().accoda('ricalcolo_riepiloghi', {'anno': primo // 100, 'mese': primo % 100})
+                if accodato:
+                    message += f' (riepiloghi in aggiornamento: job {job.id})'
+            if not accodato:
+                from app.views.transazioni.dettaglio_periodo import _recompute_summaries_from
+                _recompute_summaries_from(primo // 100, primo % 100)
+        flash(message, 'success' if success else 'error')
+    except Exception as e:
+        flash(f'Errore durante l\'import: {str(e)}', 'error')
+    return redirect(url_for('storico.index'))
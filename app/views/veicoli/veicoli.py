@@ -1,9 +1,10 @@
 """Gestione delle pagine e operazioni relative al garage (veicoli)."""
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
 from datetime import datetime, timedelta, date
 from app.models.Veicoli import Veicoli, AutoBolli, AutoManutenzioni, Assicurazioni
 from sqlalchemy.exc import OperationalError
 from sqlalchemy import inspect
+from sqlalchemy.orm import contains_eager
 from app import db
 
 veicoli_bp = Blueprint('veicoli', __name__)
@@ -76,101 +77,24 @@ def garage():
             veicoli = [VehicleProxy(r) for r in rows]
 
 
-        totale_costo_finanziamento = sum((v.costo_finanziamento or 0) for v in veicoli)
-        totale_versato = sum((v.totale_versato or 0) for v in veicoli)
-        totale_saldo_rimanente = sum((v.saldo_rimanente or 0) for v in veicoli)
+        # Costi, finanziamento e scadenze di tutti i veicoli con query aggregate
+        from app.services.veicoli.garage_analytics_service import GarageAnalyticsService
+        analytics = GarageAnalyticsService()
+        analisi = analytics.analizza(veicoli)
+        prossime, bolli_in_attesa = analytics.scadenze(veicoli, analisi)
 
-        nomi_mesi = {
-            1: 'Gennaio', 2: 'Febbraio', 3: 'Marzo', 4: 'Aprile',
-            5: 'Maggio', 6: 'Giugno', 7: 'Luglio', 8: 'Agosto',
-            9: 'Settembre', 10: 'Ottobre', 11: 'Novembre', 12: 'Dicembre'
-        }
+        totale_costo_finanziamento = analisi['totali']['costo_finanziamento']
+        totale_versato = analisi['totali']['totale_versato']
+        totale_saldo_rimanente = analisi['totali']['saldo_rimanente']
 
         for veicolo in veicoli:
-            try:
-                veicolo.next_bollo_scadenza = None
-                veicolo.next_assicurazione_scadenza = None
-                if getattr(veicolo, 'tipo', None) in ('auto', 'moto'):
-                    try:
-                        mese = getattr(veicolo, 'mese_scadenza_bollo', None)
-                        if mese:
-                            oggi = datetime.now()
-                            current_year = oggi.year
-                            pagato_corrente = AutoBolli.query.filter_by(veicolo_id=veicolo.id, anno_riferimento=current_year).first()
-                            next_year = current_year + 1 if pagato_corrente else current_year
-                            try:
-                                veicolo.next_bollo_scadenza = f"{nomi_mesi.get(int(mese), 'Mese '+str(mese))} {next_year}"
-                            except Exception:
-                                veicolo.next_bollo_scadenza = None
-                    except Exception:
-                        veicolo.next_bollo_scadenza = None
-                    try:
-                        last_ass = Assicurazioni.query.filter_by(veicolo_id=veicolo.id).order_by(Assicurazioni.data_pagamento.desc()).first()
-                        if last_ass and getattr(last_ass, 'data_pagamento', None):
-                            try:
-                                next_ass_date = last_ass.data_pagamento.replace(year=last_ass.data_pagamento.year + 1)
-                            except ValueError:
-                                next_ass_date = last_ass.data_pagamento.replace(day=28, month=2, year=last_ass.data_pagamento.year + 1)
-                            veicolo.next_assicurazione_scadenza = next_ass_date.strftime('%d/%m/%Y')
-                        else:
-                            veicolo.next_assicurazione_scadenza = None
-                    except Exception:
-                        current_app.logger.debug('Could not compute next expiry for veicolo id=%s', getattr(veicolo, 'id', None))
-                        continue
-            except Exception:
-                current_app.logger.debug('Could not compute next expiry (outer) for veicolo id=%s', getattr(veicolo, 'id', None))
-                continue
-
-        ultimi_bolli = AutoBolli.query.join(Veicoli).order_by(AutoBolli.data_pagamento.desc()).limit(5).all()
-        ultime_manutenzioni = AutoManutenzioni.query.join(Veicoli).order_by(AutoManutenzioni.data_intervento.desc()).limit(5).all()
-        ultime_assicurazioni = Assicurazioni.query.join(Veicoli).order_by(Assicurazioni.data_pagamento.desc()).limit(5).all()
-
-        bolli_in_attesa = []
+            veicolo.next_bollo_scadenza, veicolo.next_assicurazione_scadenza = prossime.get(veicolo.id, (None, None))
+            veicolo.analisi = analisi['veicoli'].get(veicolo.id, {})
+            veicolo._bollo_scaduto = veicolo.analisi.get('bollo_scaduto', False)
 
-        for veicolo in veicoli:
-            try:
-                if getattr(veicolo, 'tipo', None) != 'bici' and veicolo.mese_scadenza_bollo and veicolo.prima_rata:
-                    oggi = datetime.now()
-                    anno_corrente = oggi.year
-                    mese_corrente = oggi.month
-                    nome_mese_scadenza = nomi_mesi.get(veicolo.mese_scadenza_bollo, f'Mese {veicolo.mese_scadenza_bollo}')
-                    primo_anno_bollo = veicolo.prima_rata.year + 1
-                    for anno in range(primo_anno_bollo, anno_corrente + 1):
-                        bollo_pagato = AutoBolli.query.filter_by(
-                            veicolo_id=veicolo.id,
-                            anno_riferimento=anno
-                        ).first()
-                        if not bollo_pagato:
-                            ultimo_giorno = datetime(anno, veicolo.mese_scadenza_bollo, 28) + timedelta(days=4)
-                            ultimo_giorno = ultimo_giorno - timedelta(days=ultimo_giorno.day)
-                            giorni = (ultimo_giorno.date() - oggi.date()).days
-                            if anno == anno_corrente:
-                                if mese_corrente > veicolo.mese_scadenza_bollo:
-                                    priorita = 'alta'
-                                elif mese_corrente == veicolo.mese_scadenza_bollo:
-                                    priorita = 'media'
-                                else:
-                                    priorita = 'bassa'
-                            else:
-                                priorita = 'alta'
-                            bolli_in_attesa.append({
-                                'veicolo': veicolo,
-                                'tipo': 'Bollo Auto',
-                                'anno': anno,
-                                'mese_scadenza': nome_mese_scadenza,
-                                'priorita': priorita,
-                                'giorni': giorni
-                            })
-            except Exception as ve_err:
-                current_app.logger.exception('Error processing veicolo id=%s nome=%s', getattr(veicolo, 'id', None), getattr(veicolo, 'nome_completo', None))
-                bolli_in_attesa.append({
-                    'veicolo': veicolo,
-                    'tipo': 'Bollo Auto',
-                    'anno': None,
-                    'mese_scadenza': None,
-                    'priorita': 'errore',
-                    'giorni': None,
-                })
+        ultimi_bolli = AutoBolli.query.join(Veicoli).options(contains_eager(AutoBolli.veicolo)).order_by(AutoBolli.data_pagamento.desc()).limit(5).all()
+        ultime_manutenzioni = AutoManutenzioni.query.join(Veicoli).options(contains_eager(AutoManutenzioni.veicolo)).order_by(AutoManutenzioni.data_intervento.desc()).limit(5).all()
+        ultime_assicurazioni = Assicurazioni.query.join(Veicoli).options(contains_eager(Assicurazioni.veicolo)).order_by(Assicurazioni.data_pagamento.desc()).limit(5).all()
 
         current_app.logger.debug('Rendering garage template: veicoli=%d bolli=%d manutenzioni=%d', len(veicoli), len(ultimi_bolli), len(ultime_manutenzioni))
         return render_template('garage/veicoli_garage.html',
@@ -264,6 +188,18 @@ def dettaglio(veicolo_id):
         totale_manutenzioni = sum(m.costo for m in manutenzioni)
         costo_totale = (veicolo.costo_finanziamento or 0) + totale_bolli + totale_assicurazioni + totale_manutenzioni
 
+        # Costo per km e serie annuale del costo di possesso
+        from app.services.veicoli.garage_analytics_service import GarageAnalyticsService
+        analisi = GarageAnalyticsService().analizza([veicolo], solo_questi=True)
+        analisi_veicolo = analisi['veicoli'].get(veicolo.id, {})
+        serie = analisi_veicolo.get('serie', {})
+        tco_annuale = [
+            {'anno': anno, 'costo': serie['costo_anno'][i], 'cumulato': serie['tco_cumulato'][i],
+             'km': serie['km_anno'][i], 'costo_per_km': serie['costo_per_km'][i]}
+            for i, anno in enumerate(analisi['anni'])
+            if serie and (serie['costo_anno'][i] or serie['km_anno'][i])
+        ]
+
         current_app.logger.debug('Rendering dettaglio veicolo id=%s nome=%s', veicolo_id, getattr(veicolo, 'nome_completo', None))
         return render_template('garage/veicoli_dettaglio.html',
                     veicolo=veicolo,
@@ -273,13 +209,30 @@ def dettaglio(veicolo_id):
                     totale_bolli=totale_bolli,
                     totale_assicurazioni=totale_assicurazioni,
                     totale_manutenzioni=totale_manutenzioni,
-                    costo_totale=costo_totale)
+                    costo_totale=costo_totale,
+                    analisi=analisi_veicolo,
+                    tco_annuale=tco_annuale)
     except Exception as e:
         current_app.logger.exception('Errore nel caricamento dettaglio veicolo id=%s', veicolo_id)
         flash(f'Errore nel caricamento dettaglio veicolo: {str(e)}', 'error')
         return redirect(url_for('veicoli.garage'))
 
 
+@veicoli_bp.route('/api/analisi')
+def api_analisi():
+    """Costi aggregati, costo per km e serie TCO annuali di tutti i veicoli (JSON)"""
+    try:
+        from app.services.veicoli.garage_analytics_service import GarageAnalyticsService
+        analisi = GarageAnalyticsService().analizza()
+        for dati in analisi['veicoli'].values():
+            if dati.get('ultima_assicurazione'):
+                dati['ultima_assicurazione'] = dati['ultima_assicurazione'].isoformat()
+        return jsonify({'status': 'success', **analisi})
+    except Exception as e:
+        current_app.logger.exception('Errore analisi garage')
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
 @veicoli_bp.route('/aggiungi_veicolo', methods=['POST'])
 def aggiungi_veicolo():
     """Aggiunge un nuovo veicoli al garage"""
@@ -0,0 +1,64 @@
+"""Test del ripristino dei backup (BackupService)."""
+import os
+import sqlite3
+
+import pytest
+from flask import Flask
+
+from app import db
+from app.services.backup.backup_service import BackupService
+
+
+def _scrivi_db(percorso, valore):
+    conn = sqlite3.connect(percorso)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS t (valore TEXT)')
+        conn.execute('DELETE FROM t')
+        conn.execute('INSERT INTO t VALUES (?)', (valore,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _leggi_db(percorso):
+    conn = sqlite3.connect(percorso)
+    try:
+        return conn.execute('SELECT valore FROM t').fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'bilancio.db'}",
+        BACKUP_DIR=str(tmp_path / 'backup'),
+        BACKUP_COMPRESSIONE=False,
+        BACKUP_PAUSA_PASSO=0,
+        BACKUP_CONSERVA_ULTIMI=2,
+        BACKUP_CONSERVA_GIORNALIERI=0,
+        BACKUP_CONSERVA_SETTIMANALI=0,
+    )
+    db.init_app(app)
+    return app
+
+
+def test_ripristino_del_backup_piu_vecchio_conservato(app, tmp_path):
+    cartella = tmp_path / 'backup'
+    cartella.mkdir()
+    _scrivi_db(str(cartella / 'bilancio_backup_20240101_100000_manuale.db'), 'vecchio')
+    _scrivi_db(str(cartella / 'bilancio_backup_20240102_100000_manuale.db'), 'recente')
+    _scrivi_db(str(tmp_path / 'bilancio.db'), 'corrente')
+
+    with app.app_context():
+        servizio = BackupService(app)
+        # Entrambi i backup rientrano negli ultimi BACKUP_CONSERVA_ULTIMI
+        assert servizio.applica_retention() == []
+
+        ok, msg = servizio.ripristina('bilancio_backup_20240101_100000_manuale.db')
+
+        assert ok, msg
+        assert _leggi_db(str(tmp_path / 'bilancio.db')) == 'vecchio'
+        assert os.path.exists(cartella / 'bilancio_backup_20240101_100000_manuale.db')
+        assert any(v['motivo'] == 'pre-ripristino' for v in servizio.elenco_backup())